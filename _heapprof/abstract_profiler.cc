@@ -1,3 +1,18 @@
 #include "_heapprof/abstract_profiler.h"
+#include <map>
+#include <string>
 
-// Empty file to make the Python setuputils happy.
+void AbstractProfiler::GetStats(std::map<std::string, uint64_t> *stats) const {
+  (*stats)["rawHooks"] = hook_stats_.calls[kRawDomain];
+  (*stats)["memHooks"] = hook_stats_.calls[kMemDomain];
+  (*stats)["objHooks"] = hook_stats_.calls[kObjDomain];
+
+  const uint64_t total_calls = hook_stats_.calls[kRawDomain] +
+                               hook_stats_.calls[kMemDomain] +
+                               hook_stats_.calls[kObjDomain];
+  (*stats)["hookNanos"] =
+      hook_stats_.timed_calls == 0
+          ? 0
+          : static_cast<uint64_t>(static_cast<double>(hook_stats_.timed_nanos) *
+                                  total_calls / hook_stats_.timed_calls);
+}
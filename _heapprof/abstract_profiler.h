@@ -3,6 +3,9 @@
 
 #include <assert.h>
 #include <stddef.h>
+#include <stdint.h>
+#include <map>
+#include <string>
 
 // An AbstractProfiler is something that does actual profiling. For now, we
 // don't have any fancy registration mechanism to refer to these by name;
@@ -21,6 +24,34 @@ class AbstractProfiler {
   virtual void HandleMalloc(void *ptr, size_t size) {}
   virtual void HandleFree(void *ptr) {}
 
+  // Report statistics about the profiler itself, such as how much memory it is
+  // using, by adding them to *stats. This is called under the same locking
+  // rules as the Handle methods. Implementations should call this base
+  // version, which reports the hook statistics:
+  //   rawHooks, memHooks, objHooks: The number of calls to the profiler from
+  //     the hooks for each allocator domain.
+  //   hookNanos: An estimate of the total time spent in those calls.
+  virtual void GetStats(std::map<std::string, uint64_t> *stats) const;
+
+  // The indices of the allocator domains in HookStats.
+  enum Domain { kRawDomain = 0, kMemDomain = 1, kObjDomain = 2, kNumDomains };
+
+  // Statistics about the calls the profiler gets from the malloc hooks. These
+  // are maintained by malloc_patch.cc, since only it knows which domain a call
+  // came from.
+  //
+  // Reading the clock takes about as long as a call which doesn't sample
+  // anything, so timing every call would badly distort the very thing we're
+  // measuring; instead, we time one call in every kTimingInterval, and scale up.
+  struct HookStats {
+    uint64_t calls[kNumDomains] = {0, 0, 0};
+    uint64_t timed_calls = 0;
+    uint64_t timed_nanos = 0;
+  };
+  static const uint64_t kTimingInterval = 64;
+
+  HookStats *mutable_hook_stats() { return &hook_stats_; }
+
   // The default implementation is good for most cases. We could be more clever
   // here, treating oldptr == nullptr as a malloc, oldptr == newptr as a malloc
   // of the delta size, and oldptr != newptr as a free + malloc, but this would
@@ -34,6 +65,9 @@ class AbstractProfiler {
     }
     HandleMalloc(newptr, size);
   }
+
+ private:
+  HookStats hook_stats_;
 };
 
 #endif  // _HEAPPROF_ABSTRACT_PROFILER_H__
@@ -0,0 +1,55 @@
+#include "_heapprof/background_flusher.h"
+#include "_heapprof/util.h"
+
+BackgroundFlusher::BackgroundFlusher()
+    : thread_(&BackgroundFlusher::Run, this) {}
+
+BackgroundFlusher::~BackgroundFlusher() {
+  {
+    std::lock_guard<std::mutex> lock(mu_);
+    stopping_ = true;
+  }
+  work_cv_.notify_one();
+  thread_.join();
+}
+
+bool BackgroundFlusher::TrySubmit(int fd, const uint8_t *data, size_t size,
+                                  bool *busy) {
+  {
+    std::lock_guard<std::mutex> lock(mu_);
+    if (*busy) {
+      return false;
+    }
+    *busy = true;
+    jobs_.push_back({fd, data, size, busy});
+  }
+  work_cv_.notify_one();
+  return true;
+}
+
+void BackgroundFlusher::WaitFor(const bool *busy) {
+  std::unique_lock<std::mutex> lock(mu_);
+  done_cv_.wait(lock, [busy] { return !*busy; });
+}
+
+void BackgroundFlusher::Run() {
+  std::unique_lock<std::mutex> lock(mu_);
+  while (true) {
+    work_cv_.wait(lock, [this] { return stopping_ || !jobs_.empty(); });
+    if (jobs_.empty()) {
+      // Only possible if we're stopping, and there's nothing left to do.
+      return;
+    }
+    const Job job = jobs_.front();
+    jobs_.pop_front();
+
+    // Don't hold the lock while we're waiting on the disk; that's the whole
+    // point of this exercise.
+    lock.unlock();
+    WriteFully(job.fd, job.data, job.size);
+    lock.lock();
+
+    *job.busy = false;
+    done_cv_.notify_all();
+  }
+}
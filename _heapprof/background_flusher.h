@@ -0,0 +1,61 @@
+#ifndef _HEAPPROF_BACKGROUND_FLUSHER_H__
+#define _HEAPPROF_BACKGROUND_FLUSHER_H__
+
+#include <stddef.h>
+#include <stdint.h>
+#include <condition_variable>
+#include <deque>
+#include <mutex>
+#include <thread>
+
+// A BackgroundFlusher owns a native thread which writes buffers out to files
+// on behalf of BufferedWriters, so that the threads which fill those buffers
+// (i.e., whoever happened to call malloc) never have to wait for the disk.
+//
+// The thread is a plain C++ thread: it never acquires the GIL or calls into
+// Python, and the only thing it does is write(). Buffers are written in the
+// order in which they were submitted, across all writers; the profiler relies
+// on this to keep the .hpm file ahead of the .hpd file.
+//
+// This class is thread-safe.
+class BackgroundFlusher {
+ public:
+  BackgroundFlusher();
+  // Finishes all pending writes, then stops the thread.
+  ~BackgroundFlusher();
+
+  // Queue size bytes at data to be written to fd, unless *busy is already set,
+  // in which case this returns false immediately. Otherwise, *busy is set until
+  // the write completes, and the caller must not touch data until then. Each
+  // writer uses its own busy flag to track its one in-flight buffer, so this
+  // never blocks on I/O.
+  bool TrySubmit(int fd, const uint8_t *data, size_t size, bool *busy);
+
+  // Block until *busy is clear.
+  void WaitFor(const bool *busy);
+
+ private:
+  struct Job {
+    int fd;
+    const uint8_t *data;
+    size_t size;
+    bool *busy;
+  };
+
+  void Run();
+
+  // Guards everything below, including the busy flags passed to TrySubmit.
+  std::mutex mu_;
+  // Signalled when a job is queued or we're asked to stop.
+  std::condition_variable work_cv_;
+  // Signalled whenever a job completes.
+  std::condition_variable done_cv_;
+  std::deque<Job> jobs_;
+  bool stopping_ = false;
+
+  // NB: This must be declared last, so that it starts after everything above
+  // has been initialized.
+  std::thread thread_;
+};
+
+#endif  // _HEAPPROF_BACKGROUND_FLUSHER_H__
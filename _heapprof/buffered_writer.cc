@@ -0,0 +1,162 @@
+#include "_heapprof/buffered_writer.h"
+#include <stdlib.h>
+#include <string.h>
+#include <algorithm>
+#include <utility>
+#include "_heapprof/util.h"
+
+BufferedWriter::BufferedWriter(int fd, size_t capacity, int flush_interval_msec,
+                               BackgroundFlusher *flusher)
+    : fd_(fd),
+      capacity_(std::max(capacity, kMinCapacity)),
+      flush_interval_msec_(flush_interval_msec),
+      flusher_(flusher),
+      // NB: We deliberately use the C allocator rather than the Python one
+      // here; see the comments in profiler.h.
+      buffer_(reinterpret_cast<uint8_t *>(malloc(capacity_))) {
+  if (flusher_ != nullptr) {
+    spare_ = reinterpret_cast<uint8_t *>(malloc(capacity_));
+  }
+  ScheduleNextFlush();
+}
+
+BufferedWriter::~BufferedWriter() {
+  StopBackgroundFlush();
+  Flush();
+  free(buffer_);
+  free(spare_);
+}
+
+uint8_t *BufferedWriter::Reserve(size_t size) {
+  assert(size <= kMinCapacity);
+  if (PREDICT_FALSE(used_ + size > capacity_) && !Flush()) {
+    return nullptr;
+  }
+  return buffer_ + used_;
+}
+
+bool BufferedWriter::MakeRoom(size_t size) {
+  if (used_ + size <= capacity_) {
+    return true;
+  }
+  if (flusher_ == nullptr) {
+    // In synchronous mode, we can always make room -- and anything too big for
+    // the buffer just gets written straight through.
+    Flush();
+    return true;
+  }
+  return size <= capacity_ && Flush();
+}
+
+void BufferedWriter::AppendVarint(uint64_t value) {
+  uint8_t *target = Reserve(MAX_UNSIGNED_VARINT_SIZE(uint64_t));
+  if (PREDICT_TRUE(target != nullptr)) {
+    Commit(UnsafeAppendVarint(target, value));
+  }
+}
+
+void BufferedWriter::AppendFixed32(uint32_t value) {
+  uint8_t *target = Reserve(sizeof(uint32_t));
+  if (PREDICT_TRUE(target != nullptr)) {
+    Commit(UnsafeAppendFixed32(target, value));
+  }
+}
+
+void BufferedWriter::AppendFixed64(uint64_t value) {
+  const uint64_t data = absl::ghtonll(value);
+  AppendBytes(&data, sizeof(data));
+}
+
+void BufferedWriter::AppendBytes(const void *data, size_t size) {
+  if (PREDICT_FALSE(used_ + size > capacity_)) {
+    if (!Flush()) {
+      return;
+    }
+    // Something this big would just be copied straight back out again, so
+    // skip the middleman. (Only possible in synchronous mode; see MakeRoom.)
+    if (size > capacity_) {
+      if (flusher_ == nullptr) {
+        WriteFully(fd_, data, size);
+        flushed_ += size;
+      }
+      return;
+    }
+  }
+  memcpy(buffer_ + used_, data, size);
+  used_ += size;
+}
+
+bool BufferedWriter::AppendString(PyObject *value) {
+  Py_ssize_t len;
+  const char *cstr = PyUnicode_AsUTF8AndSize(value, &len);
+  if (cstr == nullptr) {
+    // Exception already set.
+    return false;
+  }
+  AppendVarint(len);
+  AppendBytes(cstr, len);
+  return true;
+}
+
+void BufferedWriter::OverwriteFixed64(off_t offset, uint64_t value) {
+  assert(flusher_ == nullptr);
+  const uint64_t data = absl::ghtonll(value);
+  if (offset >= flushed_) {
+    // It's still in the buffer.
+    memcpy(buffer_ + (offset - flushed_), &data, sizeof(data));
+  } else {
+    pwrite(fd_, &data, sizeof(data), offset);
+  }
+}
+
+void BufferedWriter::Seek(off_t offset) {
+  assert(flusher_ == nullptr);
+  Flush();
+  lseek(fd_, offset, SEEK_SET);
+  flushed_ = offset;
+}
+
+bool BufferedWriter::Flush() {
+  // If other can't flush right now, neither can we: otherwise this could put
+  // events on disk ahead of the traces they refer to.
+  if (flush_first_ != nullptr && !flush_first_->Flush()) {
+    return false;
+  }
+  if (used_ > 0) {
+    if (flusher_ == nullptr) {
+      WriteFully(fd_, buffer_, used_);
+    } else if (flusher_->TrySubmit(fd_, buffer_, used_, &spare_busy_)) {
+      // The flusher now owns what used to be buffer_, and we know the spare is
+      // idle, because otherwise TrySubmit would have failed.
+      std::swap(buffer_, spare_);
+    } else {
+      return false;
+    }
+    flushed_ += used_;
+    used_ = 0;
+  }
+  ScheduleNextFlush();
+  return true;
+}
+
+void BufferedWriter::StopBackgroundFlush() {
+  if (flusher_ == nullptr) {
+    return;
+  }
+  flusher_->WaitFor(&spare_busy_);
+  flusher_ = nullptr;
+  Flush();
+}
+
+void BufferedWriter::ScheduleNextFlush() {
+  if (flush_interval_msec_ <= 0) {
+    return;
+  }
+  gettime(&next_flush_);
+  next_flush_.tv_sec += flush_interval_msec_ / 1000;
+  next_flush_.tv_nsec += (flush_interval_msec_ % 1000) * 1000000L;
+  if (next_flush_.tv_nsec >= 1000000000L) {
+    next_flush_.tv_nsec -= 1000000000L;
+    next_flush_.tv_sec += 1;
+  }
+}
@@ -0,0 +1,150 @@
+#ifndef _HEAPPROF_BUFFERED_WRITER_H__
+#define _HEAPPROF_BUFFERED_WRITER_H__
+
+#include <stddef.h>
+#include <stdint.h>
+#include <time.h>
+#include "Python.h"
+#include "_heapprof/background_flusher.h"
+#include "_heapprof/port.h"
+
+// A BufferedWriter accumulates output destined for a file descriptor in an
+// in-memory append buffer, and hands it to the kernel in large blocks. The
+// profiler writes a great many tiny records (an event is usually under ten
+// bytes), and issuing a write() syscall for each of them costs far more than
+// encoding them; batching them up makes the per-event cost close to that of a
+// memcpy.
+//
+// The buffer is flushed when it fills, when Flush() is called explicitly, when
+// MaybeFlush() notices that the flush interval has elapsed, and when the writer
+// is destroyed. That last one is what keeps files valid on stop() and at
+// program exit.
+//
+// A BufferedWriter can run in one of two modes. In synchronous mode, a flush
+// simply calls write(). In background mode, the writer keeps a second buffer,
+// and a flush just swaps the two and hands the full one to a BackgroundFlusher;
+// the caller never waits for the disk. The price of this is that if the disk
+// falls so far behind that the previous buffer still hasn't been written by
+// the time the current one fills, there is nowhere to put new data. In that
+// case, Reserve() and MakeRoom() fail, and it's up to the caller to drop the
+// record (and, presumably, make a note of having done so).
+//
+// Like the rest of the profiler, this class is thread-compatible but not
+// thread-safe. It never touches the Python allocators, so it is safe to use
+// from inside the malloc hooks.
+class BufferedWriter {
+ public:
+  // Buffer output for fd, which must be open for writing and positioned at the
+  // start of the file; the writer does not take ownership of it. capacity is
+  // the buffer size in bytes; it is rounded up if it's too small to hold a
+  // single record. If flush_interval_msec > 0, MaybeFlush() will flush
+  // whenever at least that much time has passed since the last flush. If
+  // flusher is non-null, the writer runs in background mode; the flusher must
+  // outlive it.
+  BufferedWriter(int fd, size_t capacity, int flush_interval_msec,
+                 BackgroundFlusher *flusher = nullptr);
+  ~BufferedWriter();
+
+  // Verifies validity after construction; this is false only if we couldn't
+  // allocate the buffers.
+  bool ok() const {
+    return buffer_ != nullptr && (flusher_ == nullptr || spare_ != nullptr);
+  }
+
+  // Direct access to the buffer, for callers who want to encode records in
+  // place. Reserve() guarantees that at least size bytes are available (which
+  // may require a flush) and returns a pointer to them; after writing, call
+  // Commit() with a pointer just past the last byte written. size must be no
+  // bigger than kMinCapacity. In background mode, this returns nullptr if the
+  // room can't be found without waiting for the disk.
+  uint8_t *Reserve(size_t size);
+  void Commit(uint8_t *end) { used_ = end - buffer_; }
+
+  // Make sure that the next size bytes appended will all land in the current
+  // buffer, so that a record built out of several Append calls can't be
+  // split across a dropped flush. This can only fail in background mode, for
+  // the same reasons as Reserve(), or if size is bigger than the buffer.
+  bool MakeRoom(size_t size);
+
+  // Append single values, in the same encodings which FileReader reads. In
+  // background mode, these silently drop data if there's no room, so callers
+  // should use MakeRoom() first.
+  void AppendVarint(uint64_t value);
+  void AppendFixed32(uint32_t value);
+  void AppendFixed64(uint64_t value);
+  void AppendBytes(const void *data, size_t size);
+  // Append a Python string as varint length + UTF-8 bytes. Fails (and sets the
+  // exception) only if the passed argument isn't a valid string.
+  bool AppendString(PyObject *value);
+
+  // Overwrite eight bytes previously appended at the given file offset with
+  // value, in fixed64 encoding. Only valid in synchronous mode.
+  void OverwriteFixed64(off_t offset, uint64_t value);
+
+  // Flush, and then continue writing at the given file offset, overwriting
+  // whatever was there. Only valid in synchronous mode.
+  void Seek(off_t offset);
+
+  // Write everything buffered so far out to the file, or in background mode,
+  // hand it to the flusher. Returns false if that isn't possible because the
+  // previous background flush is still in progress.
+  bool Flush();
+
+  // Flush if the flush interval has elapsed since the last flush. now should
+  // be a recent value of gettime(); callers on the hot path generally have one
+  // lying around already.
+  inline void MaybeFlush(const struct timespec &now) {
+    if (flush_interval_msec_ > 0 &&
+        PREDICT_FALSE(now.tv_sec > next_flush_.tv_sec ||
+                      (now.tv_sec == next_flush_.tv_sec &&
+                       now.tv_nsec >= next_flush_.tv_nsec))) {
+      Flush();
+    }
+  }
+
+  // Wait for any background flush to complete, flush whatever is left, and
+  // switch to synchronous mode. This is a no-op in synchronous mode.
+  void StopBackgroundFlush();
+
+  // The number of bytes of buffer space this writer is using.
+  size_t memory_usage() const {
+    return spare_ == nullptr ? capacity_ : 2 * capacity_;
+  }
+
+  // The file offset at which the next appended byte will land.
+  off_t offset() const { return flushed_ + used_; }
+
+  // If set, other will be flushed immediately before every flush of this
+  // writer. The profiler uses this to guarantee that the stack traces an event
+  // refers to always reach the .hpm file before the event reaches the .hpd
+  // file, so that partially-written profiles remain consistent. In background
+  // mode, if other can't flush right now, this writer's flush fails too, just
+  // as if its own spare buffer were busy.
+  void set_flush_first(BufferedWriter *other) { flush_first_ = other; }
+
+  // The smallest buffer we'll agree to use; it's enough for any single
+  // fixed-size record.
+  static const size_t kMinCapacity = 256;
+
+ private:
+  // Set next_flush_ to flush_interval_msec_ from now.
+  void ScheduleNextFlush();
+
+  const int fd_;
+  const size_t capacity_;
+  const int flush_interval_msec_;
+  BackgroundFlusher *flusher_;
+  uint8_t *buffer_;
+  // In background mode, the buffer which is either idle or being written by
+  // the flusher; spare_busy_ tells which. (It's guarded by the flusher.)
+  uint8_t *spare_ = nullptr;
+  bool spare_busy_ = false;
+  // Number of bytes currently held in buffer_.
+  size_t used_ = 0;
+  // Number of bytes already handed off to the kernel or the flusher.
+  off_t flushed_ = 0;
+  struct timespec next_flush_;
+  BufferedWriter *flush_first_ = nullptr;
+};
+
+#endif  // _HEAPPROF_BUFFERED_WRITER_H__
@@ -1,67 +1,184 @@
 #include "_heapprof/file_format.h"
+#include <math.h>
 #include <algorithm>
+#include <condition_variable>
+#include <deque>
 #include <map>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <unordered_map>
 #include <utility>
 #include <vector>
+#include "_heapprof/file_reader.h"
 #include "_heapprof/scoped_object.h"
 #include "_heapprof/util.h"
 
+// Pack the contents of a vector into a bytes object.
+template <typename T>
+static PyObject *PackArray(const std::vector<T> &values) {
+  return PyBytes_FromStringAndSize(
+      reinterpret_cast<const char *>(values.data()), values.size() * sizeof(T));
+}
+
+// Convert a List[str] filenames table (see ReadMetadata) to C++, or leave it
+// empty if filenames is None. Returns false and sets the exception on failure.
+static bool LoadFilenames(PyObject *py_filenames,
+                          std::vector<std::string> *filenames) {
+  if (py_filenames == Py_None) {
+    return true;
+  }
+  const Py_ssize_t size = PyList_GET_SIZE(py_filenames);
+  filenames->resize(size);
+  for (Py_ssize_t i = 0; i < size; ++i) {
+    Py_ssize_t len;
+    const char *data =
+        PyUnicode_AsUTF8AndSize(PyList_GET_ITEM(py_filenames, i), &len);
+    if (data == nullptr) {
+      // Exception already set.
+      return false;
+    }
+    (*filenames)[i].assign(data, len);
+  }
+  return true;
+}
+
+// Append filenames[start:] to the List[str] py_filenames. Returns false and
+// sets the exception on failure.
+static bool AppendFilenames(const std::vector<std::string> &filenames,
+                            size_t start, PyObject *py_filenames) {
+  for (size_t i = start; i < filenames.size(); ++i) {
+    ScopedObject filename(PyUnicode_DecodeUTF8(
+        filenames[i].data(), filenames[i].size(), "strict"));
+    if (!filename || PyList_Append(py_filenames, filename.get()) == -1) {
+      return false;
+    }
+  }
+  return true;
+}
+
 ////////////////////////////////////////////////////////////////////////////////
 // .hpm files
 
 // Write out the initial metadata. The wire format of this metadata is:
-//   fixed32: File format version (currently 1)
+//   fixed32: File format version (currently 4)
 //   fixed64: Initial clock value.seconds
 //   fixed64: Initial clock value.nsec
 //   varint: Number of sampling ranges
 //     fixed64: max size
 //     fixed32: Probability scaled to UINT32_MAX
-void WriteMetadata(int fd, const struct timespec &start_clock,
-                   const Sampler &sampler) {
-  WriteFixed32ToFile(fd, 1);
-  WriteFixed64ToFile(fd, start_clock.tv_sec);
-  WriteFixed64ToFile(fd, start_clock.tv_nsec);
-  sampler.WriteStateToFile(fd);
+//   [v3+] varint: Mean sampling interval in bytes, or 0 for range sampling.
+//   [v2+] fixed64: Byte offset of the footer, or 0 if there is none (yet).
+//
+// The footer is written when profiling stops, after the last raw trace. Its
+// wire format is:
+//   fixed32: footer magic
+//   varint: number of stats
+//     varint: size of stat name
+//     bytes: stat name
+//     varint: stat value
+// optionally followed by an index of the raw traces, so that readers can find
+// any one of them without reading all the ones before it:
+//   fixed32: trace index magic
+//   varint: number of traces
+//     varint: file offset of the trace, minus that of the previous one (or for
+//       the first, minus zero)
+// and then, since v4, by a copy of the filename table, so that readers can
+// decode any trace without reading the ones before it to find its filenames:
+//   fixed32: filename table magic
+//   varint: number of filenames
+//     varint: size of filename
+//     bytes: filename
+// Profiles from a program that never stopped cleanly simply have no footer.
+static const uint32_t kMetadataVersion = 4;
+static const uint32_t kFooterMagic = 0x8f1e2d3c;
+static const uint32_t kTraceIndexMagic = 0x5e7a01c9;
+static const uint32_t kFilenameTableMagic = 0x3f11e7ab;
+
+off_t WriteMetadata(BufferedWriter *out, const struct timespec &start_clock,
+                    const Sampler &sampler) {
+  out->AppendFixed32(kMetadataVersion);
+  out->AppendFixed64(start_clock.tv_sec);
+  out->AppendFixed64(start_clock.tv_nsec);
+  sampler.WriteState(out);
+  const off_t footer_offset_location = out->offset();
+  out->AppendFixed64(0);
+  return footer_offset_location;
 }
 
+void WriteMetadataFooter(BufferedWriter *out, off_t footer_offset_location,
+                         const std::map<std::string, uint64_t> &stats,
+                         const std::vector<off_t> &trace_offsets,
+                         const FilenameTable &filenames) {
+  const off_t footer_offset = out->offset();
+  out->AppendFixed32(kFooterMagic);
+  out->AppendVarint(stats.size());
+  for (const auto &stat : stats) {
+    out->AppendVarint(stat.first.size());
+    out->AppendBytes(stat.first.data(), stat.first.size());
+    out->AppendVarint(stat.second);
+  }
+  out->AppendFixed32(kTraceIndexMagic);
+  out->AppendVarint(trace_offsets.size());
+  off_t last_offset = 0;
+  for (const off_t offset : trace_offsets) {
+    out->AppendVarint(offset - last_offset);
+    last_offset = offset;
+  }
+  out->AppendFixed32(kFilenameTableMagic);
+  out->AppendVarint(filenames.size());
+  for (const std::string &filename : filenames.filenames()) {
+    out->AppendVarint(filename.size());
+    out->AppendBytes(filename.data(), filename.size());
+  }
+  out->Flush();
+  out->OverwriteFixed64(footer_offset_location, footer_offset);
+}
+
+// The first format version in which raw traces refer to a filename table.
+static const uint32_t kFirstFilenameTableVersion = 4;
+
 // The C++ representation of the .hpm header
 struct RawMetadata {
   uint32_t version;
   uint64_t start_sec;
   uint64_t start_nsec;
   std::map<uint64_t, double> sampling_probability;
+  uint64_t sampling_interval = 0;
+  uint64_t footer_offset = 0;
 
   inline double start_time() const { return start_sec + 1e-9 * start_nsec; }
 };
 
 // Read the metadata from a .hpm file in C++ form; return false and set the
 // exception on failure.
-static bool ReadRawMetadata(int fd, RawMetadata *md) {
-  if (!ReadFixed32FromFile(fd, &md->version)) {
+static bool ReadRawMetadata(FileReader *in, RawMetadata *md) {
+  if (!in->ReadFixed32(&md->version)) {
     PyErr_SetString(PyExc_EOFError, "Couldn't read version");
     return false;
   }
-  if (md->version != 1) {
+  if (md->version < 1 || md->version > kMetadataVersion) {
     PyErr_Format(PyExc_ValueError, "Unknown metadata format %d", md->version);
     return false;
   }
 
-  if (!ReadFixed64FromFile(fd, &md->start_sec) ||
-      !ReadFixed64FromFile(fd, &md->start_nsec)) {
+  if (!in->ReadFixed64(&md->start_sec) ||
+      !in->ReadFixed64(&md->start_nsec)) {
     PyErr_SetString(PyExc_EOFError, "Couldn't read start time");
     return false;
   }
 
   uint64_t num_ranges;
-  if (!ReadVarintFromFile(fd, &num_ranges)) {
+  if (!in->ReadVarint(&num_ranges)) {
     PyErr_SetString(PyExc_EOFError, "Couldn't read number of sampling ranges");
     return false;
   }
   for (uint64_t i = 0; i < num_ranges; ++i) {
     uint64_t maxsize;
     uint32_t scaled_probability;
-    if (!ReadFixed64FromFile(fd, &maxsize) ||
-        !ReadFixed32FromFile(fd, &scaled_probability)) {
+    if (!in->ReadFixed64(&maxsize) ||
+        !in->ReadFixed32(&scaled_probability)) {
       PyErr_Format(PyExc_EOFError, "Couldn't read data for sampling range %d",
                    i);
       return false;
@@ -69,12 +186,111 @@ static bool ReadRawMetadata(int fd, RawMetadata *md) {
     md->sampling_probability[maxsize] =
         static_cast<double>(scaled_probability) / UINT32_MAX;
   }
+
+  if (md->version >= 3 && !in->ReadVarint(&md->sampling_interval)) {
+    PyErr_SetString(PyExc_EOFError, "Couldn't read sampling interval");
+    return false;
+  }
+  if (md->version >= 2 && !in->ReadFixed64(&md->footer_offset)) {
+    PyErr_SetString(PyExc_EOFError, "Couldn't read footer offset");
+    return false;
+  }
   return true;
 }
 
+// Read the footer of a .hpm file into a Dict[str, int], its index of raw
+// traces (if it has one) into trace_offsets, and its filename table (likewise)
+// into filenames, without disturbing the current file position. Returns nullptr
+// and sets the exception on failure.
+static PyObject *ReadMetadataFooter(FileReader *in, uint64_t footer_offset,
+                                    std::vector<uint64_t> *trace_offsets,
+                                    bool *has_trace_offsets,
+                                    std::vector<std::string> *filenames) {
+  *has_trace_offsets = false;
+  ScopedObject stats(PyDict_New());
+  if (!stats || footer_offset == 0) {
+    return stats.release();
+  }
+
+  const off_t position = in->offset();
+  if (!in->Seek(footer_offset)) {
+    PyErr_Format(PyExc_ValueError, "Invalid footer offset %llx in metadata",
+                 footer_offset);
+    return nullptr;
+  }
+  uint32_t magic = 0;
+  if (!in->ReadFixed32(&magic) || magic != kFooterMagic) {
+    PyErr_Format(PyExc_ValueError, "Bad footer magic number %08x", magic);
+    return nullptr;
+  }
+  uint64_t num_stats;
+  if (!in->ReadVarint(&num_stats)) {
+    return nullptr;
+  }
+  for (uint64_t i = 0; i < num_stats; ++i) {
+    ScopedObject name(in->ReadString());
+    uint64_t value;
+    if (!name || !in->ReadVarint(&value)) {
+      return nullptr;
+    }
+    ScopedObject py_value(PyLong_FromUnsignedLongLong(value));
+    if (!py_value ||
+        PyDict_SetItem(stats.get(), name.get(), py_value.get()) == -1) {
+      return nullptr;
+    }
+  }
+
+  // Profiles from older versions of heapprof end here.
+  if (!in->ReadFixed32(&magic)) {
+    PyErr_Clear();
+  } else {
+    uint64_t num_traces;
+    if (magic != kTraceIndexMagic || !in->ReadVarint(&num_traces)) {
+      PyErr_Format(PyExc_ValueError, "Bad trace index magic number %08x",
+                   magic);
+      return nullptr;
+    }
+    uint64_t offset = 0;
+    trace_offsets->reserve(num_traces);
+    for (uint64_t i = 0; i < num_traces; ++i) {
+      uint64_t delta;
+      if (!in->ReadVarint(&delta)) {
+        return nullptr;
+      }
+      offset += delta;
+      trace_offsets->push_back(offset);
+    }
+    *has_trace_offsets = true;
+
+    // Profiles from before filename tables end here.
+    if (!in->ReadFixed32(&magic)) {
+      PyErr_Clear();
+    } else {
+      uint64_t num_filenames;
+      if (magic != kFilenameTableMagic || !in->ReadVarint(&num_filenames)) {
+        PyErr_Format(PyExc_ValueError,
+                     "Bad filename table magic number %08x", magic);
+        return nullptr;
+      }
+      filenames->resize(num_filenames);
+      for (std::string &filename : *filenames) {
+        if (!in->ReadBytes(&filename)) {
+          return nullptr;
+        }
+      }
+    }
+  }
+
+  if (!in->Seek(position)) {
+    return nullptr;
+  }
+  return stats.release();
+}
+
 PyObject *ReadMetadata(int fd) {
+  FileReader in(fd);
   RawMetadata md;
-  if (!ReadRawMetadata(fd, &md)) {
+  if (!ReadRawMetadata(&in, &md)) {
     return nullptr;
   }
 
@@ -90,88 +306,423 @@ PyObject *ReadMetadata(int fd) {
     }
   }
 
-  return Py_BuildValue("fO", md.start_time(), sampling_rate.release());
+  std::vector<uint64_t> trace_offsets;
+  bool has_trace_offsets;
+  std::vector<std::string> filenames;
+  ScopedObject stats(ReadMetadataFooter(&in, md.footer_offset, &trace_offsets,
+                                        &has_trace_offsets, &filenames));
+  if (!stats) {
+    return nullptr;
+  }
+  // Py_BuildValue("") is None.
+  ScopedObject py_trace_offsets(
+      has_trace_offsets ? PackArray(trace_offsets) : Py_BuildValue(""));
+  ScopedObject py_filenames(md.version >= kFirstFilenameTableVersion
+                                ? PyList_New(0)
+                                : Py_BuildValue(""));
+  if (!py_trace_offsets || !py_filenames ||
+      (PyList_Check(py_filenames.get()) &&
+       !AppendFilenames(filenames, 0, py_filenames.get()))) {
+    return nullptr;
+  }
+
+  return Py_BuildValue("fNNNNNN", md.start_time(), sampling_rate.release(),
+                       PyLong_FromUnsignedLongLong(md.sampling_interval),
+                       stats.release(),
+                       PyLong_FromUnsignedLongLong(md.footer_offset),
+                       py_trace_offsets.release(), py_filenames.release());
+}
+
+bool FilenameTable::Find(PyObject *key, const char *data, size_t size,
+                         uint32_t *id) {
+  auto object_it = by_object_.find(key);
+  if (object_it != by_object_.end()) {
+    const std::string &filename = filenames_[object_it->second];
+    if (filename.size() == size && memcmp(filename.data(), data, size) == 0) {
+      *id = object_it->second;
+      return true;
+    }
+  }
+  auto name_it = by_name_.find(std::string(data, size));
+  if (name_it == by_name_.end()) {
+    return false;
+  }
+  // The same filename, in a different string object.
+  by_object_[key] = name_it->second;
+  *id = name_it->second;
+  return true;
 }
 
-bool SkipFrame(PyFrameObject *pyframe) {
-  // If the filename begins with a <, this is an internal frame and we should
-  // ignore it because these make the frames illegible.
-  const Py_UCS4 first_char =
-      PyUnicode_READ_CHAR(pyframe->f_code->co_filename, 0);
-  return (first_char == 0x3c);
+uint32_t FilenameTable::Add(PyObject *key, const char *data, size_t size) {
+  const uint32_t id = filenames_.size();
+  filenames_.emplace_back(data, size);
+  by_object_[key] = id;
+  by_name_.emplace(filenames_.back(), id);
+  return id;
 }
 
+// The filename of the truncation marker. Real frames can never have a filename
+// starting with '<', because FrameFilter always skips them.
+static const char kTruncationMarker[] = "<truncated>";
+
 // Write a new stack trace to the metadata file. The wire format for a stack
 // trace entry is a repeated group:
 //    varint: line number + 1
-//    varint: size of filename
-//    bytes: filename
+//    varint: filename id << 1, plus 1 if the filename follows
+//    [if it follows] varint: size of filename
+//    [if it follows] bytes: filename
 // terminated by a sentinel:
 //    varint: 0
-// Note, however, that the lines of this stack trace are in reverse order, going
-// from the bottom *up*!
-bool WriteRawTrace(int fd) {
-  const PyThreadState *tstate = PyGILState_GetThisThreadState();
-  if (tstate == nullptr) {
+// Each filename follows the first time it's used, and gets the next id in the
+// table; after that, traces simply refer to it by id. (Before v4, there was no
+// table, and every entry was just the line number + 1, the size of filename,
+// and the filename.) Note, however, that the lines of this stack trace are in
+// reverse order, going from the bottom *up*! If the trace was truncated, its
+// last (i.e., outermost) entry is a marker with line number 0 and filename
+// kTruncationMarker.
+bool WriteRawTrace(BufferedWriter *out,
+                   const std::vector<PyFrameObject *> &frames, bool truncated,
+                   FilenameTable *filenames) {
+  struct Entry {
+    int lineno;
+    PyObject *key;
+    const char *filename;
+    size_t size;
+    uint32_t id;
+    bool is_new;
+  };
+  std::vector<Entry> entries;
+  entries.reserve(frames.size() + 1);
+  // The entries which are the first use of their filename. These only go into
+  // the table once we're sure the trace is getting written.
+  std::vector<size_t> new_entries;
+
+  // A trace has to be written all-or-nothing, or every trace index after it
+  // would be off by one; so first, figure out what we're going to write, and
+  // how big it's going to be, and make sure there's room for it.
+  size_t size = 1;  // For the sentinel.
+  auto add_entry = [&](int lineno, PyObject *key, const char *filename,
+                       size_t len) {
+    Entry entry{lineno, key, filename, len, 0, false};
+    if (!filenames->Find(key, filename, len, &entry.id)) {
+      // This trace might use the same new filename more than once.
+      auto it = std::find_if(
+          new_entries.begin(), new_entries.end(), [&](size_t other) {
+            return entries[other].size == len &&
+                   memcmp(entries[other].filename, filename, len) == 0;
+          });
+      if (it != new_entries.end()) {
+        entry.id = entries[*it].id;
+      } else {
+        entry.id = filenames->size() + new_entries.size();
+        entry.is_new = true;
+        size += VarintSize(len) + len;
+      }
+    }
+    size += VarintSize(lineno + 1) +
+            VarintSize((static_cast<uint64_t>(entry.id) << 1) | entry.is_new);
+    if (entry.is_new) {
+      new_entries.push_back(entries.size());
+    }
+    entries.push_back(entry);
+  };
+  for (PyFrameObject *pyframe : frames) {
+    PyObject *key = pyframe->f_code->co_filename;
+    Py_ssize_t len;
+    const char *filename = PyUnicode_AsUTF8AndSize(key, &len);
+    if (filename == nullptr) {
+      return false;
+    }
+    add_entry(PyFrame_GetLineNumber(pyframe), key, filename, len);
+  }
+  if (truncated) {
+    add_entry(0, nullptr, kTruncationMarker, sizeof(kTruncationMarker) - 1);
+  }
+  if (!out->MakeRoom(size)) {
     return false;
   }
 
-  // OK, we're going to need to write a sequence of tuples,
-  // (pyframe->f_code->co_filename, line number)
-  for (PyFrameObject *pyframe = tstate->frame; pyframe != nullptr;
-       pyframe = pyframe->f_back) {
-    if (!SkipFrame(pyframe)) {
-      WriteVarintToFile(fd, PyFrame_GetLineNumber(pyframe) + 1);
-      WriteStringToFile(fd, pyframe->f_code->co_filename);
+  for (const Entry &entry : entries) {
+    if (entry.is_new) {
+      filenames->Add(entry.key, entry.filename, entry.size);
+    }
+    out->AppendVarint(entry.lineno + 1);
+    out->AppendVarint((static_cast<uint64_t>(entry.id) << 1) | entry.is_new);
+    if (entry.is_new) {
+      out->AppendVarint(entry.size);
+      out->AppendBytes(entry.filename, entry.size);
     }
   }
-  WriteVarintToFile(fd, 0);
+  out->AppendVarint(0);
   return true;
 }
 
-PyObject *ReadRawTrace(int fd) {
-  ScopedObject list(PyList_New(0));
-  if (!list) {
-    PyErr_SetString(PyExc_RuntimeError, "Failed to allocate an empty list");
+// A single line of a raw trace, before it's been turned into Python objects.
+struct RawFrame {
+  std::string filename;
+  uint64_t lineno;
+};
+
+// Read a raw trace into frames, in the order they're stored in the file.
+// frames is reused from one trace to the next, so num_frames gives the number
+// actually in this trace. filenames is the filename table, which this adds to
+// as new filenames come along, or nullptr if the file predates them. Returns
+// false and sets the exception on failure.
+static bool ReadRawFrames(FileReader *in, std::vector<std::string> *filenames,
+                          std::vector<RawFrame> *frames, size_t *num_frames) {
+  *num_frames = 0;
+  while (true) {
+    uint64_t lineno;
+    if (!in->ReadVarint(&lineno)) {
+      return false;
+    }
+    if (lineno == 0) {
+      return true;
+    }
+    if (*num_frames == frames->size()) {
+      frames->emplace_back();
+    }
+    RawFrame &frame = (*frames)[(*num_frames)++];
+    frame.lineno = lineno - 1;
+    if (filenames == nullptr) {
+      if (!in->ReadBytes(&frame.filename)) {
+        return false;
+      }
+      continue;
+    }
+
+    uint64_t ref;
+    if (!in->ReadVarint(&ref)) {
+      return false;
+    }
+    const uint64_t id = ref >> 1;
+    if (ref & 1) {
+      if (!in->ReadBytes(&frame.filename)) {
+        return false;
+      }
+      // If we've seen this filename before, e.g. from the footer, there's
+      // nothing new to learn.
+      if (id == filenames->size()) {
+        filenames->push_back(frame.filename);
+      } else if (id > filenames->size()) {
+        PyErr_Format(PyExc_ValueError, "Filename id %zu is out of order",
+                     static_cast<size_t>(id));
+        return false;
+      }
+    } else if (id < filenames->size()) {
+      frame.filename = (*filenames)[id];
+    } else {
+      PyErr_Format(PyExc_ValueError, "Unknown filename id %zu",
+                   static_cast<size_t>(id));
+      return false;
+    }
+  }
+}
+
+PyObject *ReadRawTrace(int fd, PyObject *py_filenames) {
+  std::vector<std::string> filenames;
+  if (!LoadFilenames(py_filenames, &filenames)) {
     return nullptr;
   }
+  const size_t known_filenames = filenames.size();
 
-  uint64_t lineno;
-  while (1) {
-    if (!ReadVarintFromFile(fd, &lineno)) {
-      PyErr_SetString(
-          PyExc_EOFError,
-          "Unexpected EOF when expecting line number in stack trace");
+  FileReader in(fd);
+  std::vector<RawFrame> frames;
+  size_t num_frames;
+  if (!ReadRawFrames(&in, py_filenames == Py_None ? nullptr : &filenames,
+                     &frames, &num_frames)) {
+    // Exception already set.
+    return nullptr;
+  }
+  if (py_filenames != Py_None &&
+      !AppendFilenames(filenames, known_filenames, py_filenames)) {
+    return nullptr;
+  }
+
+  ScopedObject list(PyList_New(num_frames));
+  if (!list) {
+    return nullptr;
+  }
+  for (size_t i = 0; i < num_frames; ++i) {
+    PyObject *tuple = Py_BuildValue(
+        "NN",
+        PyUnicode_DecodeUTF8(frames[i].filename.data(),
+                             frames[i].filename.size(), "strict"),
+        PyLong_FromUnsignedLongLong(frames[i].lineno));
+    if (tuple == nullptr) {
       return nullptr;
     }
+    PyList_SET_ITEM(list.get(), i, tuple);
+  }
+  return list.release();
+}
 
-    if (lineno == 0) {
-      // Sentinel -- we reached the end!
-      return list.release();
+// Read all the raw traces which start at or after start, and before end (or
+// until the end of the file, if end is zero), calling on_trace(offset, frames,
+// num_frames) for each one. filenames is as for ReadRawFrames. A trace which is
+// cut off by the end of the file, as happens while the profiler is still
+// writing it, is skipped. on_trace returns false, with the exception set, to
+// stop. Returns the offset just past the last trace read, or -1 with the
+// exception set on failure.
+template <typename OnTrace>
+static off_t ReadRawTraces(int fd, off_t start, off_t end,
+                           std::vector<std::string> *filenames,
+                           OnTrace on_trace) {
+  FileReader in(fd);
+  if (!in.Seek(start)) {
+    return -1;
+  }
+  std::vector<RawFrame> frames;
+  size_t num_frames;
+  off_t offset = start;
+  while (end == 0 || offset < end) {
+    if (!ReadRawFrames(&in, filenames, &frames, &num_frames)) {
+      if (!PyErr_ExceptionMatches(PyExc_EOFError)) {
+        return -1;
+      }
+      PyErr_Clear();
+      break;
+    }
+    if (!on_trace(offset, frames, num_frames)) {
+      return -1;
     }
+    offset = in.offset();
+  }
+  return in.Seek(offset) ? offset : -1;
+}
 
-    lineno -= 1;
-    PyObject *filename = ReadStringFromFile(fd);
-    if (!filename) {
-      PyErr_SetString(PyExc_EOFError,
-                      "Unexpected EOF when reading filename from stack trace");
-      return nullptr;
+PyObject *IndexRawTraces(int fd, off_t start, off_t end,
+                         PyObject *py_filenames) {
+  std::vector<std::string> filenames;
+  if (!LoadFilenames(py_filenames, &filenames)) {
+    return nullptr;
+  }
+  const size_t known_filenames = filenames.size();
+  std::vector<uint64_t> offsets;
+  const off_t traces_end = ReadRawTraces(
+      fd, start, end, py_filenames == Py_None ? nullptr : &filenames,
+      [&offsets](off_t offset, const std::vector<RawFrame> &, size_t) {
+        offsets.push_back(offset);
+        return true;
+      });
+  if (traces_end == -1 ||
+      (py_filenames != Py_None &&
+       !AppendFilenames(filenames, known_filenames, py_filenames))) {
+    return nullptr;
+  }
+  ScopedObject py_offsets(PackArray(offsets));
+  if (!py_offsets) {
+    return nullptr;
+  }
+  return Py_BuildValue("Nn", py_offsets.release(),
+                       static_cast<Py_ssize_t>(traces_end));
+}
+
+PyObject *ReadAllRawTraces(int fd, off_t start, off_t end,
+                           PyObject *line_type, PyObject *frames,
+                           PyObject *frame_ids, PyObject *py_filenames) {
+  std::vector<std::string> table;
+  if (!LoadFilenames(py_filenames, &table)) {
+    return nullptr;
+  }
+  const size_t known_filenames = table.size();
+  ScopedObject array_module(PyImport_ImportModule("array"));
+  if (!array_module) {
+    return nullptr;
+  }
+  ScopedObject array_type(PyObject_GetAttrString(array_module.get(), "array"));
+  ScopedObject traces(PyList_New(0));
+  // Filenames are only decoded once per call; the map holds borrowed
+  // references, and interned holds the real ones.
+  ScopedObject interned(PyList_New(0));
+  if (!array_type || !traces || !interned) {
+    return nullptr;
+  }
+  std::unordered_map<std::string, PyObject *> filenames;
+  std::map<std::pair<PyObject *, uint64_t>, uint32_t> ids;
+  std::vector<uint64_t> offsets;
+  std::vector<uint32_t> trace_ids;
+
+  // Find the id of a frame, adding it to frames and frame_ids if this is the
+  // first time anyone has seen it. Returns false and sets the exception on
+  // failure.
+  auto intern_frame = [&](const RawFrame &frame, uint32_t *id) -> bool {
+    auto filename_it = filenames.find(frame.filename);
+    if (filename_it == filenames.end()) {
+      ScopedObject filename(PyUnicode_DecodeUTF8(
+          frame.filename.data(), frame.filename.size(), "strict"));
+      if (!filename || PyList_Append(interned.get(), filename.get()) == -1) {
+        return false;
+      }
+      filename_it = filenames.emplace(frame.filename, filename.get()).first;
+    }
+    const auto key = std::make_pair(filename_it->second, frame.lineno);
+    auto id_it = ids.find(key);
+    if (id_it != ids.end()) {
+      *id = id_it->second;
+      return true;
     }
 
-    ScopedObject tuple(Py_BuildValue("Ni", filename, lineno));
-    if (!tuple) {
-      PyErr_SetString(PyExc_RuntimeError,
-                      "Failed to build result tuple for raw stack trace");
-      return nullptr;
+    ScopedObject line(PyObject_CallFunction(
+        line_type, "ON", key.first, PyLong_FromUnsignedLongLong(frame.lineno)));
+    if (!line) {
+      return false;
     }
-    // NB: PyList_Append grabs its own reference to the tuple, so we don't
-    // release it; we indeed decrement its refcount at the end of this scope.
-    if (PyList_Append(list.get(), tuple.get()) == -1) {
-      PyErr_SetString(PyExc_RuntimeError,
-                      "Failed to append result tuple to list");
-      return nullptr;
+    PyObject *known = PyDict_GetItemWithError(frame_ids, line.get());
+    if (known != nullptr) {
+      *id = PyLong_AsUnsignedLong(known);
+      if (PyErr_Occurred()) {
+        return false;
+      }
+    } else if (PyErr_Occurred()) {
+      return false;
+    } else {
+      *id = PyList_GET_SIZE(frames);
+      ScopedObject py_id(PyLong_FromUnsignedLong(*id));
+      if (!py_id || PyList_Append(frames, line.get()) == -1 ||
+          PyDict_SetItem(frame_ids, line.get(), py_id.get()) == -1) {
+        return false;
+      }
     }
+    ids.emplace(key, *id);
+    return true;
+  };
+
+  const off_t traces_end = ReadRawTraces(
+      fd, start, end, py_filenames == Py_None ? nullptr : &table,
+      [&](off_t offset, const std::vector<RawFrame> &trace_frames,
+          size_t num_frames) {
+        // Raw traces are stored on disk innermost frame first, which makes
+        // them faster to write; undo that here.
+        trace_ids.resize(num_frames);
+        for (size_t i = 0; i < num_frames; ++i) {
+          if (!intern_frame(trace_frames[num_frames - 1 - i], &trace_ids[i])) {
+            return false;
+          }
+        }
+        ScopedObject packed(PackArray(trace_ids));
+        if (!packed) {
+          return false;
+        }
+        ScopedObject trace(PyObject_CallFunction(array_type.get(), "sO", "I",
+                                                 packed.get()));
+        if (!trace) {
+          return false;
+        }
+        offsets.push_back(offset);
+        return PyList_Append(traces.get(), trace.get()) != -1;
+      });
+  if (traces_end == -1 ||
+      (py_filenames != Py_None &&
+       !AppendFilenames(table, known_filenames, py_filenames))) {
+    return nullptr;
+  }
+  ScopedObject py_offsets(PackArray(offsets));
+  if (!py_offsets) {
+    return nullptr;
   }
+  return Py_BuildValue("NNn", traces.release(), py_offsets.release(),
+                       static_cast<Py_ssize_t>(traces_end));
 }
 
 ////////////////////////////////////////////////////////////////////////////////
@@ -185,6 +736,13 @@ PyObject *ReadRawTrace(int fd) {
 // varint: abs(delta_t), seconds part
 // varint: abs(delta_t), usec (not nsec!!) part
 // varint: size
+//
+// A checkpoint is:
+//   fixed32: kCheckpointWord
+//   fixed32: checkpoint magic
+//   fixed64: clock.seconds
+//   fixed64: clock.nsec
+// and the time of the event after it is relative to that clock.
 
 // The largest possible event uses 4 bytes for the trace word, a varint-coded
 // time_t for seconds, a varint up to 10^9-1 for nsecs, and a varint-coded
@@ -192,22 +750,35 @@ PyObject *ReadRawTrace(int fd) {
 // (it's just under 2^30, which requires 5 septets), that gives the formula
 // below.
 #define MAX_EVENT_SIZE \
-  9 + MAX_SIGNED_VARINT_SIZE(time_t) + MAX_SIGNED_VARINT_SIZE(size_t)
+  (9 + MAX_SIGNED_VARINT_SIZE(time_t) + MAX_SIGNED_VARINT_SIZE(size_t))
 
-static uint8_t g_event_buffer[MAX_EVENT_SIZE];
-
-void WriteEvent(int fd, struct timespec *last_clock,
+bool WriteEvent(BufferedWriter *out, struct timespec *last_clock,
                 const struct timespec &timestamp, uint32_t traceindex,
                 size_t size, bool alloc) {
   assert(!(traceindex & kHighBits));
   assert(size >= 0);
 
+  uint8_t *const buffer = out->Reserve(MAX_EVENT_SIZE);
+  if (PREDICT_FALSE(buffer == nullptr)) {
+    return false;
+  }
+
   struct timespec delta_t;
   DeltaTime(*last_clock, timestamp, &delta_t);
   assert(delta_t.tv_nsec >= 0);
   assert(delta_t.tv_nsec < 1000000000L);
 
+  // Deltas are only written to usec granularity (see below), so advance the
+  // clock by exactly what we write, rather than to the true timestamp.
+  // Otherwise every event would lose its sub-usec remainder, and the times
+  // that readers get by adding up deltas would fall further and further behind
+  // the real clock -- and behind the clocks recorded in checkpoints.
   *last_clock = timestamp;
+  last_clock->tv_nsec -= delta_t.tv_nsec % 1000;
+  if (last_clock->tv_nsec < 0) {
+    last_clock->tv_nsec += 1000000000L;
+    --last_clock->tv_sec;
+  }
 
   uint32_t head_word = traceindex;
   if (delta_t.tv_sec < 0) {
@@ -218,14 +789,14 @@ void WriteEvent(int fd, struct timespec *last_clock,
     head_word |= kOperationIsFree;
   }
 
-  uint8_t *end = UnsafeAppendFixed32(g_event_buffer, head_word);
+  uint8_t *end = UnsafeAppendFixed32(buffer, head_word);
   // NB: Time deltas are only given to usec granularity, as per POSIX. So
   // shaving off three zeroes improves storage a lot and loses nothing!
   end = UnsafeAppendVarint(end, delta_t.tv_sec);
   end = UnsafeAppendVarint(end, delta_t.tv_nsec / 1000);
   end = UnsafeAppendVarint(end, size);
-
-  write(fd, g_event_buffer, end - g_event_buffer);
+  out->Commit(end);
+  return true;
 }
 
 struct RawEvent {
@@ -242,6 +813,17 @@ struct RawEvent {
     return result;
   }
 
+  // The exact change in the writer's clock, in usec. Unlike delta_time, this
+  // follows WriteEvent precisely: for a negative delta, only the seconds are
+  // negated, and the usec are still counted forwards. So adding these up from
+  // the start of the profile, or from a checkpoint, gives exactly the clock of
+  // the next checkpoint.
+  inline int64_t delta_micros() const {
+    const int64_t seconds = static_cast<int64_t>(delta_seconds);
+    return 1000000 * ((indexword & kDeltaIsNegative) ? -seconds : seconds) +
+           static_cast<int64_t>(delta_usec);
+  }
+
   inline int64_t byte_size() const {
     const int64_t result = static_cast<int64_t>(size);
     return is_free() ? -result : result;
@@ -252,18 +834,66 @@ struct RawEvent {
   inline uint32_t traceindex() const { return indexword & ~kHighBits; }
 };
 
-// Read a single event and return it in C++ format. Returns false and sets
-// the exception on problem.
-static bool ReadRawEvent(int fd, RawEvent *raw_event) {
-  return (ReadFixed32FromFile(fd, &raw_event->indexword) &&
-          ReadVarintFromFile(fd, &raw_event->delta_seconds) &&
-          ReadVarintFromFile(fd, &raw_event->delta_usec) &&
-          ReadVarintFromFile(fd, &raw_event->size));
+static const uint32_t kCheckpointMagic = 0x4b9c2e71;
+static const size_t kCheckpointSize =
+    2 * sizeof(uint32_t) + 2 * sizeof(uint64_t);
+
+bool WriteCheckpoint(BufferedWriter *out, const struct timespec &clock) {
+  uint8_t *const buffer = out->Reserve(kCheckpointSize);
+  if (PREDICT_FALSE(buffer == nullptr)) {
+    return false;
+  }
+  uint8_t *end = UnsafeAppendFixed32(buffer, kCheckpointWord);
+  end = UnsafeAppendFixed32(end, kCheckpointMagic);
+  end = UnsafeAppendFixed64(end, clock.tv_sec);
+  end = UnsafeAppendFixed64(end, clock.tv_nsec);
+  out->Commit(end);
+  return true;
+}
+
+// Read the rest of a checkpoint, after its kCheckpointWord. Returns false and
+// sets the exception on problem.
+static bool ReadCheckpointBody(FileReader *in, struct timespec *clock) {
+  uint32_t magic = 0;
+  uint64_t sec, nsec;
+  if (!in->ReadFixed32(&magic) || !in->ReadFixed64(&sec) ||
+      !in->ReadFixed64(&nsec)) {
+    // Exception already set.
+    return false;
+  }
+  if (magic != kCheckpointMagic || nsec >= 1000000000L) {
+    PyErr_SetString(PyExc_ValueError, "Corrupt checkpoint in .hpd file");
+    return false;
+  }
+  clock->tv_sec = sec;
+  clock->tv_nsec = nsec;
+  return true;
+}
+
+// Read a single event and return it in C++ format, skipping over any
+// checkpoints before it. Returns false and sets the exception on problem.
+static inline bool ReadRawEvent(FileReader *in, RawEvent *raw_event) {
+  if (!in->ReadFixed32(&raw_event->indexword)) {
+    return false;
+  }
+  while (PREDICT_FALSE(raw_event->indexword == kCheckpointWord)) {
+    struct timespec clock;
+    if (!ReadCheckpointBody(in, &clock) ||
+        !in->ReadFixed32(&raw_event->indexword)) {
+      return false;
+    }
+  }
+  return (in->ReadVarint(&raw_event->delta_seconds) &&
+          in->ReadVarint(&raw_event->delta_usec) &&
+          in->ReadVarint(&raw_event->size));
 }
 
 PyObject *ReadEvent(int fd) {
+  // A single event is at most a few dozen bytes, so don't read ahead any more
+  // than we need to.
+  FileReader in(fd, 0);
   RawEvent raw_event;
-  if (!ReadRawEvent(fd, &raw_event)) {
+  if (!ReadRawEvent(&in, &raw_event)) {
     // Exception already set.
     return nullptr;
   }
@@ -272,381 +902,2303 @@ PyObject *ReadEvent(int fd) {
                        raw_event.byte_size());
 }
 
+double EventScaling::operator()(uint64_t size) const {
+  if (sampling_interval != 0) {
+    return size == 0 ? 1
+                     : 1 / -expm1(-(static_cast<double>(size) /
+                                    static_cast<double>(sampling_interval)));
+  }
+  for (const auto &factor : factors) {
+    if (size < factor.first) {
+      return factor.second;
+    }
+  }
+  return 1;
+}
+
+PyObject *ReadEvents(int fd, size_t max_count, double base_time,
+                     double elapsed, const EventScaling &scaling) {
+  FileReader in(fd);
+  std::vector<double> timestamps;
+  std::vector<uint32_t> traceindices;
+  std::vector<int64_t> sizes;
+  std::vector<double> scale_factors;
+  // Don't trust max_count for the reservation, since it may be huge and the
+  // file short.
+  const size_t reserve = std::min<size_t>(max_count, 1 << 16);
+  timestamps.reserve(reserve);
+  traceindices.reserve(reserve);
+  sizes.reserve(reserve);
+  scale_factors.reserve(reserve);
+
+  RawEvent raw_event;
+  while (timestamps.size() < max_count) {
+    const off_t event_start = in.offset();
+    if (!ReadRawEvent(&in, &raw_event)) {
+      if (!PyErr_ExceptionMatches(PyExc_EOFError)) {
+        return nullptr;
+      }
+      // The end of the file, possibly partway through an event; leave the
+      // file positioned before it, so that the next batch can pick it up if
+      // the rest of it gets written.
+      PyErr_Clear();
+      if (!in.Seek(event_start)) {
+        return nullptr;
+      }
+      break;
+    }
+    // Add up the deltas relative to base_time, just as HPD._readEvents does.
+    elapsed += raw_event.delta_time();
+    timestamps.push_back(base_time + elapsed);
+    traceindices.push_back(raw_event.traceindex());
+    sizes.push_back(raw_event.byte_size());
+    scale_factors.push_back(scaling(raw_event.size));
+  }
+
+  ScopedObject py_timestamps(PackArray(timestamps));
+  ScopedObject py_traceindices(PackArray(traceindices));
+  ScopedObject py_sizes(PackArray(sizes));
+  ScopedObject py_scale_factors(PackArray(scale_factors));
+  if (!py_timestamps || !py_traceindices || !py_sizes || !py_scale_factors) {
+    return nullptr;
+  }
+  return Py_BuildValue("dNNNN", elapsed, py_timestamps.release(),
+                       py_traceindices.release(), py_sizes.release(),
+                       py_scale_factors.release());
+}
+
+PyObject *ReadCheckpoint(int fd) {
+  FileReader in(fd, 0);
+  uint32_t word = 0;
+  if (!in.ReadFixed32(&word)) {
+    // Exception already set.
+    return nullptr;
+  }
+  if (word != kCheckpointWord) {
+    PyErr_SetString(PyExc_ValueError, "No checkpoint at this offset");
+    return nullptr;
+  }
+  struct timespec clock;
+  if (!ReadCheckpointBody(&in, &clock)) {
+    // Exception already set.
+    return nullptr;
+  }
+  return PyFloat_FromDouble(clock.tv_sec + 1e-9 * clock.tv_nsec);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// .hpi files
+
+// The format of a .hpi file is:
+//   fixed32: index magic
+//   varint: number of checkpoints
+//     fixed64: clock.seconds
+//     varint: clock.nsec
+//     varint: offset of the checkpoint in the .hpd file, relative to the
+//             previous one (or, for the first, to the start of the file).
+
+static const uint32_t kCheckpointIndexMagic = 0x9e3a61c4;
+
+void WriteCheckpointIndex(BufferedWriter *out,
+                          const std::vector<Checkpoint> &checkpoints) {
+  out->AppendFixed32(kCheckpointIndexMagic);
+  out->AppendVarint(checkpoints.size());
+  off_t last_offset = 0;
+  for (const Checkpoint &checkpoint : checkpoints) {
+    out->AppendFixed64(checkpoint.clock.tv_sec);
+    out->AppendVarint(checkpoint.clock.tv_nsec);
+    out->AppendVarint(checkpoint.offset - last_offset);
+    last_offset = checkpoint.offset;
+  }
+  out->Flush();
+}
+
+// Read a .hpi file in C++ form. Returns false and sets the exception on
+// problem.
+static bool ReadRawCheckpointIndex(FileReader *in,
+                                   std::vector<Checkpoint> *checkpoints) {
+  uint32_t magic = 0;
+  uint64_t count;
+  if (!in->ReadFixed32(&magic) || !in->ReadVarint(&count)) {
+    // Exception already set.
+    return false;
+  }
+  if (magic != kCheckpointIndexMagic) {
+    PyErr_SetString(PyExc_ValueError, "Bad magic number in .hpi file");
+    return false;
+  }
+
+  uint64_t offset = 0;
+  for (uint64_t i = 0; i < count; ++i) {
+    uint64_t sec, nsec, offset_delta;
+    if (!in->ReadFixed64(&sec) || !in->ReadVarint(&nsec) ||
+        !in->ReadVarint(&offset_delta)) {
+      // Exception already set.
+      return false;
+    }
+    offset += offset_delta;
+    Checkpoint checkpoint;
+    checkpoint.clock.tv_sec = sec;
+    checkpoint.clock.tv_nsec = nsec;
+    checkpoint.offset = offset;
+    checkpoints->push_back(checkpoint);
+  }
+  return true;
+}
+
+PyObject *ReadCheckpointIndex(int fd) {
+  FileReader in(fd);
+  std::vector<Checkpoint> checkpoints;
+  if (!ReadRawCheckpointIndex(&in, &checkpoints)) {
+    // Exception already set.
+    return nullptr;
+  }
+
+  ScopedObject result(PyList_New(0));
+  if (result.get() == nullptr) {
+    // Exception already set.
+    return nullptr;
+  }
+  for (const Checkpoint &checkpoint : checkpoints) {
+    ScopedObject entry(Py_BuildValue(
+        "(dN)", checkpoint.clock.tv_sec + 1e-9 * checkpoint.clock.tv_nsec,
+        PyLong_FromLongLong(checkpoint.offset)));
+    if (entry.get() == nullptr ||
+        PyList_Append(result.get(), entry.get()) == -1) {
+      // Exception already set.
+      return nullptr;
+    }
+  }
+  return result.release();
+}
+
 ////////////////////////////////////////////////////////////////////////////////
 // .hpc files
 
 // The format of a .hpc file is:
-//   fixed32: version
+//   fixed32: version (currently 3)
 //   fixed64: initial time seconds
 //   fixed64: initial time nsec
 //   varint: msec between snapshots
 //   fixed64: byte offset to index
 //
-// Followed by a sequence of entries:
-//   fixed32: magic number
+// Followed by a sequence of snapshots. Each is either a keyframe, which lists
+// the whole snapshot:
+//   fixed32: snapshot magic
 //   varint: number of items
 //     varint: traceindex
 //     varint: size of item (for first item), or amount by which size is smaller
 //             than the previous entry (for successive items).
+// or [v3+] a delta, which lists only what changed since the snapshot before:
+//   fixed32: delta magic
+//   varint: offset of this snapshot minus the offset of the last keyframe
+//   varint: number of changes
+//     varint: traceindex
+//     varint: zigzag-encoded change in its size; a trace whose size becomes
+//             zero is no longer in the snapshot.
+// Every snapshot between a keyframe and the next one is a delta, so to read
+// one, we read its keyframe and apply the deltas after it in order.
 //
 // Followed by the index:
 //   fixed32: index magic
 //   varint: number of entries
 //   varints: relative offset of entry N from entry N-1 or (for N=0) start of
 //   file.
+//
+// [v3+] Followed by the series: the same data turned on its side, as the
+// history of each trace, so that it can be read without reading every
+// snapshot:
+//   fixed32: series magic
+//   varint: number of traces
+//     varint: traceindex, minus that of the previous trace
+//     varint: length of its series in bytes
+//   varint: length of the series of total bytes, in bytes
+// followed by the series of total bytes, and then those of the traces, in the
+// same order. Each series lists the snapshots at which the value changed:
+//     varint: snapshot number, minus that of the previous entry
+//     varint: zigzag-encoded change in the value from the previous entry
+//
+// [v2+] Followed by the state of the digester when it finished, so that
+// UpdateDigestFile can carry on from there once more events have been appended
+// to the .hpd file:
+//   fixed32: state magic
+//   fixed64: precision, as the bits of a double
+//   fixed64: offset in the .hpd file just past the last event digested
+//   [v2-3] fixed64: relative time of that event, as the bits of a double
+//   [v2-3] fixed64: relative time at which the next snapshot is due, likewise
+//   [v4+] fixed64: time of that event, in usec since the start of the
+//                  profile, as an int64
+//   [v4+] fixed64: latest time of any event so far, likewise
+//   varint: number of live traces
+//     varint: traceindex
+//     varint: live bytes, as a uint32
+//   [v3+] fixed64: offset of the last keyframe
+//   [v3+] varint: number of deltas written since then
+//   [v3+] varint: number of coarser levels
+//     varint: msec between snapshots in that level
+//
+// A digest can also have coarser levels, which make a pyramid: level N
+// (counting from 1) is in filebase.N.hpc, and holds every Kth snapshot of the
+// .hpc file, where K is the ratio of their intervals. Those files have the same
+// format, except that instead of the digester state, the index is followed by
+//   fixed32: level state magic
+//   fixed64: offset of the last keyframe
+//   varint: number of deltas written since then
+// Coarser levels are always written before the .hpc file itself, so whenever
+// that is valid, they are too.
+//
+// The doubles are stored bit-for-bit, so that an updated digest comes out
+// exactly the same as one made from scratch.
+//
+// While an update is in progress, the index offset in the header is zero, so
+// that a digest whose update never finished can't be mistaken for a good one.
 
+static const uint32_t kDigestVersion = 4;
+// The oldest version whose digester state lists the series and the coarser
+// levels, so that we can read those from it.
+static const uint32_t kDigestStateVersion = 3;
 static const uint32_t kSnapshotMagic = 0x5379a0bd;
+static const uint32_t kDeltaMagic = 0x71c4d9e2;
 static const uint32_t kIndexMagic = 0xab935776;
+static const uint32_t kDigestStateMagic = 0x3d8c1e5f;
+static const uint32_t kLevelStateMagic = 0x6a1f83d7;
+static const uint32_t kSeriesMagic = 0x2f5be804;
+
+static inline uint64_t DoubleToBits(double value) {
+  uint64_t bits;
+  memcpy(&bits, &value, sizeof(bits));
+  return bits;
+}
 
-struct HPMMetadata {
-  double initial_time;
-  // The int is the same as in a sampler; the float is the multiplicative
-  // factor.
-  std::map<uint64_t, float> scaling_factor;
+static inline double BitsToDouble(uint64_t bits) {
+  double value;
+  memcpy(&value, &bits, sizeof(value));
+  return value;
+}
 
-  // Convert a raw size (unsigned, from a single event) to a scaled size
-  // (accounting for sampling). We deliberately round this to an integer.
-  inline int scaled_size(uint64_t raw_size) const {
-    auto l_it = scaling_factor.upper_bound(raw_size);
-    if (l_it == scaling_factor.end()) {
-      return static_cast<int>(raw_size);
-    } else {
+// The C++ representation of the .hpc header and index.
+struct RawDigestMetadata {
+  uint32_t version = 0;
+  uint64_t initial_secs;
+  uint64_t initial_nsec;
+  uint64_t interval_msec;
+  // Where in the file the index offset is stored, and its value.
+  off_t index_offset_location;
+  uint64_t index_offset;
+  std::vector<off_t> snapshot_starts;
+};
+
+// The history of a single trace, or of the total bytes, in a digest, encoded
+// as in the series section.
+struct TraceSeries {
+  std::string data;
+  uint32_t last_snapshot = 0;
+  int64_t last_bytes = 0;
+
+  // Note that as of the given snapshot, the value is bytes.
+  void Append(uint32_t snapshot, int64_t bytes) {
+    uint8_t buffer[2 * MAX_UNSIGNED_VARINT_SIZE(uint64_t)];
+    uint8_t *pos = UnsafeAppendVarint(buffer, snapshot - last_snapshot);
+    pos = UnsafeAppendVarint(pos, ZigZagEncode(bytes - last_bytes));
+    data.append(reinterpret_cast<const char *>(buffer), pos - buffer);
+    last_snapshot = snapshot;
+    last_bytes = bytes;
+  }
+};
+
+// All the series of a digest.
+struct DigestSeries {
+  TraceSeries total;
+  std::unordered_map<uint32_t, TraceSeries> traces;
+};
+
+// Where the series are in a .hpc file: the offsets and lengths of the series
+// of total bytes, and of each trace.
+struct SeriesIndex {
+  // False if the file has no series, because it's a coarser level of a digest,
+  // or was made by an older version of heapprof.
+  bool present = false;
+  std::pair<off_t, size_t> total = {0, 0};
+  std::map<uint32_t, std::pair<off_t, size_t>> traces;
+};
+
+// The state a digester needs to pick up where another one left off.
+struct DigestState {
+  double precision;
+  off_t hpd_offset;
+  // [v4+] The state of the DigestClock.
+  int64_t now_usec = 0;
+  int64_t latest_usec = 0;
+  std::unordered_map<uint32_t, int> live_bytes;
+  off_t keyframe_offset;
+  int deltas_since_keyframe;
+  // The intervals of the coarser levels of the pyramid, if any.
+  std::vector<int> level_intervals_msec;
+  SeriesIndex series;
+};
+
+// The usage in a single snapshot, as a map from trace index to bytes.
+typedef std::unordered_map<uint32_t, int64_t> SnapshotUsage;
+
+// The order in which traces are listed in a keyframe: descending by size. Ties
+// are broken by trace index, so that nothing we write depends on the order of
+// a hash map.
+template <typename T>
+static bool LargerTrace(const std::pair<uint32_t, T> &a,
+                        const std::pair<uint32_t, T> &b) {
+  return a.second != b.second ? a.second > b.second : a.first < b.first;
+}
+
+template <typename T>
+static bool SmallerTrace(const std::pair<uint32_t, T> &a,
+                         const std::pair<uint32_t, T> &b) {
+  return LargerTrace(b, a);
+}
+
+// Decodes a file which is in memory, such as an mmap of it, in the same way
+// as a FileReader. Unlike a FileReader, it never touches any Python objects,
+// so it can run without the GIL; the caller has to report any failure once it
+// has the GIL back.
+class BufferReader {
+ public:
+  BufferReader(const uint8_t *data, size_t size) : data_(data), size_(size) {}
+
+  off_t offset() const { return pos_; }
+
+  bool Seek(off_t offset) {
+    if (offset < 0 || static_cast<size_t>(offset) > size_) {
+      return false;
+    }
+    pos_ = offset;
+    return true;
+  }
+
+  bool ReadFixed32(uint32_t *value) {
+    if (size_ - pos_ < sizeof(uint32_t)) {
+      return false;
+    }
+    memcpy(value, data_ + pos_, sizeof(uint32_t));
+    *value = absl::gntohl(*value);
+    pos_ += sizeof(uint32_t);
+    return true;
+  }
+
+  bool ReadVarint(uint64_t *value) {
+    const uint8_t *p = data_ + pos_;
+    if (PREDICT_TRUE(size_ - pos_ >= kMaxVarintSize)) {
+      if (!UnsafeDecodeVarint(&p, value)) {
+        return false;
+      }
+      pos_ = p - data_;
+      return true;
+    }
+    // Near the end of the file, we have to decode carefully.
+    uint64_t result = 0;
+    for (size_t i = 0; pos_ + i < size_ && i < kMaxVarintSize; ++i) {
+      result |= static_cast<uint64_t>(p[i] & 0x7f) << (7 * i);
+      if (!(p[i] & 0x80)) {
+        *value = result;
+        pos_ += i + 1;
+        return true;
+      }
+    }
+    return false;
+  }
+
+ private:
+  static const size_t kMaxVarintSize = MAX_UNSIGNED_VARINT_SIZE(uint64_t);
+
+  const uint8_t *const data_;
+  const size_t size_;
+  size_t pos_ = 0;
+};
+
+// Read the rest of a keyframe, after its magic number, into usage. in is either
+// a FileReader or a BufferReader.
+template <typename Input>
+static bool ReadKeyframe(Input *in, SnapshotUsage *usage) {
+  uint64_t num_items;
+  if (!in->ReadVarint(&num_items)) {
+    return false;
+  }
+  usage->clear();
+  usage->reserve(num_items);
+  int64_t size = 0;
+  for (uint64_t i = 0; i < num_items; ++i) {
+    uint64_t traceindex;
+    uint64_t delta_size;
+    if (!in->ReadVarint(&traceindex) || !in->ReadVarint(&delta_size)) {
+      return false;
+    }
+    if (i == 0) {
+      size = delta_size;
+    } else {
+      size -= delta_size;
+    }
+    (*usage)[traceindex] = size;
+  }
+  return true;
+}
+
+// Read the rest of a delta, after its magic number, and apply it to usage.
+template <typename Input>
+static bool ApplyDelta(Input *in, SnapshotUsage *usage) {
+  uint64_t keyframe_distance, num_changes;
+  if (!in->ReadVarint(&keyframe_distance) || !in->ReadVarint(&num_changes)) {
+    return false;
+  }
+  for (uint64_t i = 0; i < num_changes; ++i) {
+    uint64_t traceindex, change;
+    if (!in->ReadVarint(&traceindex) || !in->ReadVarint(&change)) {
+      return false;
+    }
+    int64_t &size = (*usage)[traceindex];
+    size += ZigZagDecode(change);
+    if (!size) {
+      usage->erase(traceindex);
+    }
+  }
+  return true;
+}
+
+// Read the snapshot at the given offset into usage. Returns false and sets the
+// exception on failure.
+static bool ReadSnapshot(FileReader *in, off_t offset, SnapshotUsage *usage) {
+  uint32_t magic = 0;
+  if (!in->Seek(offset) || !in->ReadFixed32(&magic)) {
+    PyErr_Format(PyExc_ValueError, "Invalid entry offset %zd",
+                 static_cast<Py_ssize_t>(offset));
+    return false;
+  }
+  if (magic == kSnapshotMagic) {
+    return ReadKeyframe(in, usage);
+  }
+
+  uint64_t keyframe_distance;
+  if (magic != kDeltaMagic || !in->ReadVarint(&keyframe_distance) ||
+      keyframe_distance > static_cast<uint64_t>(offset) ||
+      !in->Seek(offset - keyframe_distance) || !in->ReadFixed32(&magic) ||
+      magic != kSnapshotMagic || !ReadKeyframe(in, usage)) {
+    PyErr_Format(PyExc_ValueError, "Invalid entry at %zd",
+                 static_cast<Py_ssize_t>(offset));
+    return false;
+  }
+  // The deltas since the keyframe follow it directly.
+  while (true) {
+    const off_t delta_offset = in->offset();
+    if (delta_offset > offset || !in->ReadFixed32(&magic) ||
+        magic != kDeltaMagic || !ApplyDelta(in, usage)) {
+      PyErr_Format(PyExc_ValueError, "Broken delta chain for entry at %zd",
+                   static_cast<Py_ssize_t>(offset));
+      return false;
+    }
+    if (delta_offset == offset) {
+      return true;
+    }
+  }
+}
+
+// What we need to carry on writing a coarser level of a digest pyramid.
+struct DigestLevelState {
+  RawDigestMetadata md;
+  off_t keyframe_offset;
+  int deltas_since_keyframe;
+  SnapshotUsage last_snapshot;
+};
+
+// Read the header and index of a .hpc file; return false and set the
+// exception on failure. Afterwards, in is positioned just past the index.
+static bool ReadRawDigestMetadata(FileReader *in, RawDigestMetadata *md) {
+  if (!in->ReadFixed32(&md->version) || md->version < 1 ||
+      md->version > kDigestVersion) {
+    PyErr_Format(PyExc_ValueError, "Unrecognized file version %d",
+                 md->version);
+    return false;
+  }
+
+  if (!in->ReadFixed64(&md->initial_secs) ||
+      !in->ReadFixed64(&md->initial_nsec) ||
+      !in->ReadVarint(&md->interval_msec)) {
+    return false;
+  }
+  md->index_offset_location = in->offset();
+  if (!in->ReadFixed64(&md->index_offset)) {
+    return false;
+  }
+
+  if (!in->Seek(md->index_offset)) {
+    PyErr_Format(PyExc_ValueError, "Invalid index offset %llx in metadata",
+                 md->index_offset);
+    return false;
+  }
+  uint32_t magic = 0;
+  if (!in->ReadFixed32(&magic) || magic != kIndexMagic) {
+    PyErr_Format(PyExc_ValueError, "Bad index magic number %08x", magic);
+    return false;
+  }
+  uint64_t num_entries;
+  if (!in->ReadVarint(&num_entries)) {
+    PyErr_SetString(PyExc_ValueError, "Couldn't read index header");
+    return false;
+  }
+
+  md->snapshot_starts.reserve(num_entries);
+  uint64_t offset = 0;
+  for (uint64_t i = 0; i < num_entries; ++i) {
+    uint64_t delta;
+    if (!in->ReadVarint(&delta)) {
+      PyErr_SetString(PyExc_ValueError, "Broken index");
+      return false;
+    }
+    offset += delta;
+    md->snapshot_starts.push_back(offset);
+  }
+  return true;
+}
+
+// Read the table of contents of the series section, and skip past the series
+// themselves. Returns false and sets the exception on failure.
+static bool ReadSeriesIndex(FileReader *in, SeriesIndex *index) {
+  uint32_t magic = 0;
+  if (!in->ReadFixed32(&magic) || magic != kSeriesMagic) {
+    PyErr_Format(PyExc_ValueError, "Bad series magic number %08x", magic);
+    return false;
+  }
+  uint64_t num_traces;
+  if (!in->ReadVarint(&num_traces)) {
+    return false;
+  }
+  std::vector<std::pair<uint32_t, uint64_t>> lengths;
+  lengths.reserve(num_traces);
+  uint64_t traceindex = 0;
+  for (uint64_t i = 0; i < num_traces; ++i) {
+    uint64_t delta, length;
+    if (!in->ReadVarint(&delta) || !in->ReadVarint(&length)) {
+      return false;
+    }
+    traceindex += delta;
+    lengths.emplace_back(traceindex, length);
+  }
+  uint64_t total_length;
+  if (!in->ReadVarint(&total_length)) {
+    return false;
+  }
+
+  index->present = true;
+  off_t offset = in->offset();
+  index->total = std::make_pair(offset, total_length);
+  offset += total_length;
+  for (const auto &length : lengths) {
+    index->traces[length.first] = std::make_pair(offset, length.second);
+    offset += length.second;
+  }
+  return in->Seek(offset);
+}
+
+// Read a series, which is at the given offset and of the given length, into
+// series. Returns false and sets the exception on failure.
+static bool ReadSeries(FileReader *in, const std::pair<off_t, size_t> &where,
+                       TraceSeries *series) {
+  if (!in->Seek(where.first)) {
+    return false;
+  }
+  const off_t end = where.first + where.second;
+  while (in->offset() < end) {
+    uint64_t snapshot_delta, bytes_delta;
+    if (!in->ReadVarint(&snapshot_delta) || !in->ReadVarint(&bytes_delta)) {
+      return false;
+    }
+    series->Append(series->last_snapshot + snapshot_delta,
+                   series->last_bytes + ZigZagDecode(bytes_delta));
+  }
+  if (in->offset() != end) {
+    PyErr_Format(PyExc_ValueError, "Broken series at %zd",
+                 static_cast<Py_ssize_t>(where.first));
+    return false;
+  }
+  return true;
+}
+
+// Read all the series listed in index. Returns false and sets the exception on
+// failure.
+static bool ReadAllSeries(FileReader *in, const SeriesIndex &index,
+                          DigestSeries *series) {
+  if (!ReadSeries(in, index.total, &series->total)) {
+    return false;
+  }
+  for (const auto &trace : index.traces) {
+    if (!ReadSeries(in, trace.second, &series->traces[trace.first])) {
+      return false;
+    }
+  }
+  return true;
+}
+
+// Read the digester state which follows the index, skipping over the series
+// along the way. in must be positioned just past the index, as
+// ReadRawDigestMetadata leaves it, and the digest must be at least
+// kDigestStateVersion. Returns false and sets the exception on failure.
+static bool ReadDigestState(FileReader *in, const RawDigestMetadata &md,
+                            DigestState *state) {
+  assert(md.version >= kDigestStateVersion);
+  if (!ReadSeriesIndex(in, &state->series)) {
+    return false;
+  }
+  uint32_t magic = 0;
+  uint64_t precision, hpd_offset, now_usec, latest_usec, num_traces;
+  if (!in->ReadFixed32(&magic) || magic != kDigestStateMagic) {
+    PyErr_Format(PyExc_ValueError, "Bad digest state magic number %08x",
+                 magic);
+    return false;
+  }
+  if (!in->ReadFixed64(&precision) || !in->ReadFixed64(&hpd_offset) ||
+      !in->ReadFixed64(&now_usec) || !in->ReadFixed64(&latest_usec) ||
+      !in->ReadVarint(&num_traces)) {
+    return false;
+  }
+  state->precision = BitsToDouble(precision);
+  state->hpd_offset = hpd_offset;
+  // Older versions kept the clock as doubles, which aren't any use to us; but
+  // then, they can't be updated anyway.
+  if (md.version >= 4) {
+    state->now_usec = static_cast<int64_t>(now_usec);
+    state->latest_usec = static_cast<int64_t>(latest_usec);
+  }
+
+  for (uint64_t i = 0; i < num_traces; ++i) {
+    uint64_t traceindex, bytes;
+    if (!in->ReadVarint(&traceindex) || !in->ReadVarint(&bytes)) {
+      return false;
+    }
+    state->live_bytes[traceindex] =
+        static_cast<int>(static_cast<uint32_t>(bytes));
+  }
+
+  uint64_t keyframe_offset, deltas_since_keyframe;
+  if (!in->ReadFixed64(&keyframe_offset) ||
+      !in->ReadVarint(&deltas_since_keyframe)) {
+    return false;
+  }
+  state->keyframe_offset = keyframe_offset;
+  state->deltas_since_keyframe = deltas_since_keyframe;
+
+  uint64_t num_levels;
+  if (!in->ReadVarint(&num_levels)) {
+    return false;
+  }
+  for (uint64_t i = 0; i < num_levels; ++i) {
+    uint64_t interval_msec;
+    if (!in->ReadVarint(&interval_msec)) {
+      return false;
+    }
+    state->level_intervals_msec.push_back(interval_msec);
+  }
+  return true;
+}
+
+// Read the last snapshot of a digest into usage, which is left empty if there
+// are none. Returns false and sets the exception on failure.
+static bool ReadLastSnapshot(FileReader *in, const RawDigestMetadata &md,
+                             SnapshotUsage *usage) {
+  usage->clear();
+  return md.snapshot_starts.empty() ||
+         ReadSnapshot(in, md.snapshot_starts.back(), usage);
+}
+
+// Read everything needed to carry on writing a coarser level of a digest from
+// its file. Returns false and sets the exception on failure.
+static bool ReadDigestLevelState(FileReader *in, DigestLevelState *state) {
+  if (!ReadRawDigestMetadata(in, &state->md)) {
+    return false;
+  }
+  uint32_t magic = 0;
+  uint64_t keyframe_offset, deltas_since_keyframe;
+  if (!in->ReadFixed32(&magic) || magic != kLevelStateMagic) {
+    PyErr_Format(PyExc_ValueError, "Bad digest level magic number %08x",
+                 magic);
+    return false;
+  }
+  if (!in->ReadFixed64(&keyframe_offset) ||
+      !in->ReadVarint(&deltas_since_keyframe)) {
+    return false;
+  }
+  state->keyframe_offset = keyframe_offset;
+  state->deltas_since_keyframe = deltas_since_keyframe;
+  return ReadLastSnapshot(in, state->md, &state->last_snapshot);
+}
+
+struct HPMMetadata {
+  double initial_time;
+  // The same, exactly.
+  struct timespec initial_clock;
+  // The int is the same as in a sampler; the float is the multiplicative
+  // factor.
+  std::map<uint64_t, float> scaling_factor;
+  // If nonzero, the profile used interval sampling, and scaling_factor is
+  // unused.
+  double sampling_interval = 0;
+
+  // Convert a raw size (unsigned, from a single event) to a scaled size
+  // (accounting for sampling). We deliberately round this to an integer.
+  inline int scaled_size(uint64_t raw_size) const {
+    if (sampling_interval != 0) {
+      // An allocation of this size was sampled with probability
+      // 1 - exp(-size / interval); see sampler.h.
+      return raw_size == 0 ? 0
+                           : static_cast<int>(
+                                 raw_size /
+                                 -expm1(-(raw_size / sampling_interval)));
+    }
+    auto l_it = scaling_factor.upper_bound(raw_size);
+    if (l_it == scaling_factor.end()) {
+      return static_cast<int>(raw_size);
+    } else {
       return static_cast<int>(raw_size * l_it->second);
     }
   }
+
+  // The time of a checkpoint, in usec since the start of the profile.
+  inline int64_t micros_since_start(const struct timespec &clock) const {
+    const int64_t nsec =
+        1000000000LL * (static_cast<int64_t>(clock.tv_sec) -
+                        static_cast<int64_t>(initial_clock.tv_sec)) +
+        (clock.tv_nsec - initial_clock.tv_nsec);
+    return nsec / 1000;
+  }
+};
+
+// Read the metadata from a .hpm file and return it in C++ format. On error,
+// returns false and sets the exception.
+static bool GetHPMMetadata(const char *filebase, HPMMetadata *result) {
+  ScopedFile hpm(filebase, ".hpm", READ_MODE);
+  if (!hpm) {
+    return false;
+  }
+
+  FileReader in(hpm);
+  RawMetadata md;
+  if (!ReadRawMetadata(&in, &md)) {
+    return false;
+  }
+
+  result->initial_time = md.start_time();
+  result->initial_clock.tv_sec = md.start_sec;
+  result->initial_clock.tv_nsec = md.start_nsec;
+  result->sampling_interval = static_cast<double>(md.sampling_interval);
+  for (auto p : md.sampling_probability) {
+    result->scaling_factor[p.first] = (p.second == 0 ? 0 : 1.0 / p.second);
+  }
+
+  return true;
+}
+
+// What a digester knows about a single trace: its live bytes as of the latest
+// event, and its bytes as of the latest snapshot written. dirty means that the
+// trace has had events since that snapshot.
+struct DigestTrace {
+  int live = 0;
+  int64_t written = 0;
+  bool dirty = false;
+};
+typedef std::unordered_map<uint32_t, DigestTrace> DigestTraces;
+
+// Work out what to write for a snapshot with a nonzero precision, given the
+// traces. The smallest traces, totalling up to that fraction of all the live
+// bytes, are dropped, and instead aggregated into a single "other" category
+// under trace index zero. (Zero is the reserved "no trace" index, so this makes
+// good sense)
+static void ApplyPrecision(const DigestTraces &traces, double precision,
+                           SnapshotUsage *usage) {
+  std::vector<std::pair<uint32_t, int>> live;
+  live.reserve(traces.size());
+  int64_t total_size = 0;
+  for (const auto &trace : traces) {
+    if (trace.second.live) {
+      live.emplace_back(trace.first, trace.second.live);
+      total_size += trace.second.live;
+    }
+  }
+  const int64_t slop_amount = static_cast<int64_t>(total_size * precision);
+
+  // We want the longest run of the smallest traces which fits in the slop
+  // amount. Sorting everything would find it, but this is a hot loop with many
+  // thousands of traces, so instead we binary-search for the length of that
+  // run, using nth_element to partition around each guess. Everything in
+  // [0, dropped) is dropped, and is no bigger than anything in [dropped, end);
+  // everything in [kept, end) is kept.
+  size_t dropped = 0;
+  size_t kept = live.size();
+  int64_t other_bytes = 0;  // Bytes in the "OTHER" category.
+  while (dropped < kept) {
+    const size_t mid = dropped + (kept - dropped) / 2;
+    std::nth_element(live.begin() + dropped, live.begin() + mid,
+                     live.begin() + kept, SmallerTrace<int>);
+    int64_t run_bytes = 0;
+    for (size_t i = dropped; i <= mid; ++i) {
+      run_bytes += live[i].second;
+    }
+    if (other_bytes + run_bytes <= slop_amount) {
+      other_bytes += run_bytes;
+      dropped = mid + 1;
+    } else {
+      kept = mid;
+    }
+  }
+
+  usage->clear();
+  usage->reserve(live.size() - dropped + 1);
+  usage->insert(live.begin() + dropped, live.end());
+  if (other_bytes > 0) {
+    (*usage)[0] += other_bytes;
+  }
+}
+
+// Write a keyframe, given the bytes per trace; this sorts them in place.
+static void WriteKeyframe(BufferedWriter *out,
+                          std::vector<std::pair<uint32_t, int64_t>> *bytes) {
+  std::vector<std::pair<uint32_t, int64_t>> &sorted_bytes = *bytes;
+  std::sort(sorted_bytes.begin(), sorted_bytes.end(), LargerTrace<int64_t>);
+
+  out->AppendFixed32(kSnapshotMagic);
+  out->AppendVarint(sorted_bytes.size());
+  if (!sorted_bytes.empty()) {
+    out->AppendVarint(sorted_bytes[0].first);
+    out->AppendVarint(sorted_bytes[0].second);
+
+    for (size_t i = 1; i < sorted_bytes.size(); ++i) {
+      out->AppendVarint(sorted_bytes[i].first);
+      // These are sorted in descending order, so we just write the differences.
+      out->AppendVarint(sorted_bytes[i - 1].second - sorted_bytes[i].second);
+    }
+  }
+}
+
+// Write a delta, given the changes from the previous snapshot, sorted by trace
+// index, and the distance back to the last keyframe.
+static void WriteDelta(
+    BufferedWriter *out, off_t keyframe_distance,
+    const std::vector<std::pair<uint32_t, int64_t>> &changes) {
+  out->AppendFixed32(kDeltaMagic);
+  out->AppendVarint(keyframe_distance);
+  out->AppendVarint(changes.size());
+  for (const auto &change : changes) {
+    out->AppendVarint(change.first);
+    out->AppendVarint(ZigZagEncode(change.second));
+  }
+}
+
+static void TimeToStderr(float seconds) {
+  const int hours = static_cast<int>(seconds / 3600);
+  seconds -= hours * 3600;
+  const int minutes = static_cast<int>(seconds / 60);
+  seconds -= minutes * 60;
+  if (hours != 0) {
+    fprintf(stderr, "%d:%02d:%02d", hours, minutes, static_cast<int>(seconds));
+  } else {
+    fprintf(stderr, "%02d:%02d", minutes, static_cast<int>(seconds));
+  }
+}
+
+static void BytesToStderr(double bytes) {
+  if (bytes < 1.2e9) {
+    fprintf(stderr, "%0.1fMB", bytes / 1048576);
+  } else {
+    fprintf(stderr, "%0.1fGB", bytes / 1073741824);
+  }
+}
+
+// The size of the blocks in which MakeDigestFile reads and writes.
+static const size_t kDigestBufferSize = 1 << 20;
+
+// The clock of a digest: the time of the latest event, relative to the start of
+// the profile, which decides when snapshots are due. This is pulled out into
+// its own type so that every way of digesting a file keeps time in exactly the
+// same way, and thus decides to write snapshots at exactly the same events.
+//
+// Times are kept as integer usec, just as they're written, rather than as
+// floating point, so that there's no rounding error to pile up: the time after
+// any event is then exactly the same whether it's reached by adding up every
+// delta since the start of the profile, or those since a checkpoint. That's
+// what lets a parallel digest start its workers at checkpoints.
+struct DigestClock {
+  int64_t interval_usec;
+  // The time of the last event. This can go backwards, if the system clock
+  // did.
+  int64_t now_usec = 0;
+  // The latest time of any event so far, which never goes backwards.
+  int64_t latest_usec = 0;
+
+  explicit DigestClock(int interval_msec)
+      : interval_usec(static_cast<int64_t>(interval_msec) * 1000) {}
+
+  double relative_time() const { return 1e-6 * latest_usec; }
+
+  // Advance the clock past an event, and return the number of snapshots which
+  // are now due.
+  inline int Advance(const RawEvent &event) {
+    now_usec += event.delta_micros();
+    return CatchUp(now_usec);
+  }
+
+  // Move the latest time up to usec, if it's before that, and return the
+  // number of snapshots which are now due. Snapshot N (counting from 1) is
+  // due once the latest time reaches N intervals.
+  inline int CatchUp(int64_t usec) {
+    if (usec <= latest_usec) {
+      return 0;
+    }
+    const int64_t due = usec / interval_usec - latest_usec / interval_usec;
+    latest_usec = usec;
+    return static_cast<int>(due);
+  }
+};
+
+// The changes between two successive snapshots, sorted by trace index.
+typedef std::vector<std::pair<uint32_t, int64_t>> SnapshotChanges;
+
+// The output side of a single .hpc file: this writes its header, its snapshots
+// as keyframes and deltas, and its index.
+class SnapshotWriter {
+ public:
+  explicit SnapshotWriter(int fd) : fd_(fd), out_(fd, kDigestBufferSize, 0) {}
+
+  bool ok() const { return out_.ok(); }
+  BufferedWriter *out() { return &out_; }
+  // The number of snapshots in the file.
+  size_t size() const { return snapshot_starts_.size(); }
+  // The contents of the last snapshot written.
+  const SnapshotUsage &usage() const { return usage_; }
+
+  // Start a new file, by writing the header.
+  void Start(double initial_time, int interval_msec) {
+    out_.AppendFixed32(kDigestVersion);
+    const uint64_t seconds = static_cast<uint64_t>(initial_time);
+    out_.AppendFixed64(seconds);
+    const uint64_t nsec = static_cast<uint64_t>(1e9 * (initial_time - seconds));
+    out_.AppendFixed64(nsec);
+    out_.AppendVarint(interval_msec);
+    // This is where we're going to come back later and write the index
+    // location.
+    index_offset_location_ = out_.offset();
+    out_.AppendFixed64(0);
+  }
+
+  // Carry on with an existing file, whose header and index are md, whose last
+  // keyframe and the deltas since it are as given, and whose last snapshot is
+  // last_snapshot. (This takes the contents of last_snapshot.) New snapshots
+  // will overwrite the old index. Nothing else may be reading the file, since
+  // this moves its offset.
+  void Resume(const RawDigestMetadata &md, off_t keyframe_offset,
+              int deltas_since_keyframe, SnapshotUsage *last_snapshot) {
+    index_offset_location_ = md.index_offset_location;
+    snapshot_starts_ = md.snapshot_starts;
+    keyframe_offset_ = keyframe_offset;
+    deltas_since_keyframe_ = deltas_since_keyframe;
+    // The next delta will be relative to the last snapshot.
+    usage_.swap(*last_snapshot);
+    out_.Seek(md.index_offset);
+    // Until we're done, the file has no valid index; see above.
+    out_.OverwriteFixed64(index_offset_location_, 0);
+  }
+
+  // Write count copies of the snapshot which differs from the last one by
+  // changes.
+  void Write(const SnapshotChanges &changes, int count) {
+    for (const auto &change : changes) {
+      int64_t &size = usage_[change.first];
+      size += change.second;
+      if (!size) {
+        usage_.erase(change.first);
+      }
+    }
+
+    // Any further copies are the same as the first, so have no changes at all.
+    for (int i = 0; i < count; ++i) {
+      const off_t offset = out_.offset();
+      snapshot_starts_.push_back(offset);
+      // Write a keyframe if it's been a while since the last one, or if a
+      // delta wouldn't be much smaller.
+      if (keyframe_offset_ == -1 ||
+          deltas_since_keyframe_ >= kKeyframeInterval ||
+          (i == 0 && changes.size() > usage_.size() / 2)) {
+        keyframe_.assign(usage_.begin(), usage_.end());
+        WriteKeyframe(&out_, &keyframe_);
+        keyframe_offset_ = offset;
+        deltas_since_keyframe_ = 0;
+      } else {
+        WriteDelta(&out_, offset - keyframe_offset_,
+                   i == 0 ? changes : kNoChanges);
+        ++deltas_since_keyframe_;
+      }
+    }
+  }
+
+  // Write the index. The caller should follow it with the file's state,
+  // including WriteKeyframeState, and then call Finish.
+  void WriteIndex() {
+    index_offset_ = out_.offset();
+    out_.AppendFixed32(kIndexMagic);
+    out_.AppendVarint(snapshot_starts_.size());
+    if (!snapshot_starts_.empty()) {
+      out_.AppendVarint(snapshot_starts_[0]);
+      for (size_t i = 1; i < snapshot_starts_.size(); ++i) {
+        out_.AppendVarint(snapshot_starts_[i] - snapshot_starts_[i - 1]);
+      }
+    }
+  }
+
+  // Write where the chain of keyframes and deltas stands, for Resume.
+  void WriteKeyframeState() {
+    out_.AppendFixed64(keyframe_offset_);
+    out_.AppendVarint(deltas_since_keyframe_);
+  }
+
+  // Flush everything to disk, and only then point the header at the index.
+  // Returns false and sets the exception on failure.
+  bool Finish() {
+    out_.Flush();
+    // If we were updating, the old index and state may have been longer than
+    // the new ones.
+    if (ftruncate(fd_, out_.offset()) == -1) {
+      PyErr_SetFromErrno(PyExc_OSError);
+      return false;
+    }
+    out_.OverwriteFixed64(index_offset_location_, index_offset_);
+    return true;
+  }
+
+ private:
+  // The most deltas we write in a row, which bounds how much has to be read to
+  // reconstruct any one snapshot.
+  static const int kKeyframeInterval = 32;
+  static const SnapshotChanges kNoChanges;
+
+  const int fd_;
+  BufferedWriter out_;
+  off_t index_offset_location_ = 0;
+  off_t index_offset_ = 0;
+  std::vector<off_t> snapshot_starts_;
+  off_t keyframe_offset_ = -1;
+  int deltas_since_keyframe_ = 0;
+  SnapshotUsage usage_;
+  // Scratch space for writing keyframes.
+  std::vector<std::pair<uint32_t, int64_t>> keyframe_;
+};
+
+const SnapshotChanges SnapshotWriter::kNoChanges;
+
+// A coarser level of a digest pyramid. Its snapshots are every factor'th
+// snapshot of the digest proper, so they're exactly what a digest made with a
+// longer interval would hold, without having to read the .hpd file again.
+struct DigestLevel {
+  explicit DigestLevel(int fd) : snapshots(fd) {}
+
+  SnapshotWriter snapshots;
+  int interval_msec = 0;
+  int factor = 1;
+  // The sum of the changes to the digest proper since this level's last
+  // snapshot.
+  std::unordered_map<uint32_t, int64_t> pending;
+};
+
+// The output side of digesting: this keeps track of the live bytes per trace,
+// and writes out snapshots, the index, and the digester state, both to the .hpc
+// file and to any coarser levels.
+class DigestWriter {
+ public:
+  // level_fds are the files for the coarser levels, if any.
+  DigestWriter(int fd, const std::vector<int> &level_fds, double precision,
+               bool verbose)
+      : snapshots_(fd), precision_(precision), verbose_(verbose) {
+    for (int level_fd : level_fds) {
+      levels_.emplace_back(new DigestLevel(level_fd));
+    }
+  }
+
+  bool ok() const {
+    for (const auto &level : levels_) {
+      if (!level->snapshots.ok()) return false;
+    }
+    return snapshots_.ok();
+  }
+
+  // Start a new digest, by writing the headers. level_intervals_msec are the
+  // intervals of the coarser levels, each a multiple of interval_msec.
+  void Start(double initial_time, int interval_msec,
+             const std::vector<int> &level_intervals_msec) {
+    snapshots_.Start(initial_time, interval_msec);
+    for (size_t i = 0; i < levels_.size(); ++i) {
+      DigestLevel *level = levels_[i].get();
+      level->interval_msec = level_intervals_msec[i];
+      level->factor = level->interval_msec / interval_msec;
+      level->snapshots.Start(initial_time, level->interval_msec);
+    }
+  }
+
+  // Carry on with an existing digest, whose header and index are md, whose
+  // state is state, whose last snapshot is last_snapshot, and whose series are
+  // series, and likewise for its levels. (This takes the contents of the last
+  // snapshots and the series.) Nothing else may be reading the files. Returns
+  // false and sets the exception on failure.
+  bool Resume(const RawDigestMetadata &md, const DigestState &state,
+              SnapshotUsage *last_snapshot, DigestSeries *series,
+              std::vector<DigestLevelState> *level_states) {
+    std::swap(series_, *series);
+    for (const auto &trace : *last_snapshot) {
+      traces_[trace.first].written = trace.second;
+    }
+    for (const auto &trace : state.live_bytes) {
+      traces_[trace.first].live = trace.second;
+    }
+    // Any events after the last snapshot have changed traces which the next
+    // snapshot has to pick up, just as if we'd added them in this run.
+    for (auto &trace : traces_) {
+      if (trace.second.live != trace.second.written) {
+        trace.second.dirty = true;
+        dirty_.push_back(std::make_pair(trace.first, &trace.second));
+      }
+    }
+    snapshots_.Resume(md, state.keyframe_offset, state.deltas_since_keyframe,
+                      last_snapshot);
+    hpd_offset_ = state.hpd_offset;
+
+    for (size_t i = 0; i < levels_.size(); ++i) {
+      DigestLevel *level = levels_[i].get();
+      DigestLevelState &level_state = (*level_states)[i];
+      level->interval_msec = state.level_intervals_msec[i];
+      level->factor = level->interval_msec / md.interval_msec;
+      if (level_state.md.interval_msec !=
+              static_cast<uint64_t>(level->interval_msec) ||
+          level_state.md.snapshot_starts.size() !=
+              snapshots_.size() / level->factor) {
+        PyErr_Format(PyExc_ValueError,
+                     "Level %zd of the digest doesn't match the rest of it; "
+                     "make a new digest instead",
+                     i + 1);
+        return false;
+      }
+      // Whatever changed between this level's last snapshot and the digest's
+      // is still to come.
+      for (const auto &trace : snapshots_.usage()) {
+        level->pending[trace.first] += trace.second;
+      }
+      for (const auto &trace : level_state.last_snapshot) {
+        level->pending[trace.first] -= trace.second;
+      }
+      level->snapshots.Resume(level_state.md, level_state.keyframe_offset,
+                              level_state.deltas_since_keyframe,
+                              &level_state.last_snapshot);
+    }
+    return true;
+  }
+
+  // If verbose, print a message about starting to digest the part of the .hpd
+  // file from start to total_bytes.
+  void StartProgress(const char *filebase, off_t start, off_t total_bytes) {
+    start_bytes_ = start;
+    total_bytes_ = total_bytes;
+    if (verbose_) {
+      gettime(&start_time_);
+      fprintf(stderr, "Digesting %s: ", filebase);
+      BytesToStderr(total_bytes_ - start_bytes_);
+      fprintf(stderr, "\n");
+    }
+  }
+
+  // Add delta (which may be negative) to the live bytes of a trace. A trace is
+  // live exactly when the sum of all of its deltas so far is nonzero, no matter
+  // how those deltas were grouped, which is what lets a parallel digest add up
+  // runs of events separately. Traces which aren't live keep their (zero)
+  // entries, since most of them will be again soon, and churning the map costs
+  // more than skipping them when we write snapshots.
+  inline void Add(uint32_t traceindex, int delta) {
+    DigestTrace &trace = traces_[traceindex];
+    trace.live += delta;
+    if (!trace.dirty) {
+      trace.dirty = true;
+      // Pointers into an unordered_map stay valid as it grows.
+      dirty_.push_back(std::make_pair(traceindex, &trace));
+    }
+  }
+
+  // Write count copies of the current snapshot.
+  void WriteSnapshots(int count) {
+    if (count == 0) {
+      return;
+    }
+    // Work out what changed since the last snapshot. With full precision, only
+    // the traces which had events can have changed, and there are usually far
+    // fewer of those than there are traces; otherwise, any trace can move in or
+    // out of "other", so we have to look at all of them.
+    changes_.clear();
+    if (precision_ <= 0) {
+      for (const auto &dirty : dirty_) {
+        AddChange(dirty.first, dirty.second, dirty.second->live);
+      }
+    } else {
+      ApplyPrecision(traces_, precision_, &usage_);
+      traces_[0];  // "other" may not be a trace yet.
+      for (auto &trace : traces_) {
+        const auto it = usage_.find(trace.first);
+        AddChange(trace.first, &trace.second,
+                  it == usage_.end() ? 0 : it->second);
+      }
+    }
+    for (const auto &dirty : dirty_) {
+      dirty.second->dirty = false;
+    }
+    dirty_.clear();
+    std::sort(changes_.begin(), changes_.end());
+
+    const size_t first = snapshots_.size();
+    if (!changes_.empty()) {
+      TraceSeries &total = series_.total;
+      int64_t total_bytes = total.last_bytes;
+      for (const auto &change : changes_) {
+        TraceSeries &trace = series_.traces[change.first];
+        trace.Append(first, trace.last_bytes + change.second);
+        total_bytes += change.second;
+      }
+      if (total_bytes != total.last_bytes) {
+        total.Append(first, total_bytes);
+      }
+    }
+    snapshots_.Write(changes_, count);
+    for (auto &level : levels_) {
+      WriteLevelSnapshots(first, count, level.get());
+    }
+  }
+
+  // Note that some more events have been added, and report progress if it's
+  // time to. relative_time is the time of the last of them, and bytes is the
+  // offset in the .hpd file just past it.
+  void Progress(int events, double relative_time, off_t bytes) {
+    hpd_offset_ = bytes;
+    const int last_events_read = events_read_;
+    events_read_ += events;
+    if (!verbose_ || last_events_read / kProgressInterval ==
+                         events_read_ / kProgressInterval) {
+      return;
+    }
+
+    struct timespec now;
+    gettime(&now);
+    struct timespec delta;
+    DeltaTime(start_time_, now, &delta);
+    const double time_used = delta.tv_sec + 1e-9 * delta.tv_nsec;
+    const double fraction = static_cast<double>(bytes - start_bytes_) /
+                            (total_bytes_ - start_bytes_);
+    const double eta = time_used * ((1.0 / fraction) - 1);
+
+    // For those wanting to understand exactly what's being printed here: the
+    // rate is given both in MBps (of data being read) and sec/sec, i.e.
+    // seconds of profiling time per second of digestion time.
+    fprintf(stderr, "Digested ");
+    TimeToStderr(relative_time);
+    fprintf(stderr, " of data (%0.1fM events, ", 1e-6 * events_read_);
+    BytesToStderr(bytes);
+    fprintf(stderr, ") @ ");
+    BytesToStderr((bytes - start_bytes_) / time_used);
+    fprintf(stderr, "ps=%0.1fsec/sec; %0.1f%%; ETA ",
+            relative_time / time_used, 100 * fraction);
+    TimeToStderr(eta);
+    fprintf(stderr, ")\n");
+  }
+
+  // Write the indices and the state of the digest as of clock, and flush
+  // everything to disk. Returns false and sets the exception on failure.
+  bool Finish(const DigestClock &clock) {
+    // The levels go first, so that by the time the .hpc file is valid, they
+    // are too.
+    for (auto &level : levels_) {
+      level->snapshots.WriteIndex();
+      level->snapshots.out()->AppendFixed32(kLevelStateMagic);
+      level->snapshots.WriteKeyframeState();
+      if (!level->snapshots.Finish()) {
+        return false;
+      }
+    }
+
+    if (verbose_) {
+      fprintf(stderr, "Writing index with %zd entries\n", snapshots_.size());
+    }
+    snapshots_.WriteIndex();
+    BufferedWriter *out = snapshots_.out();
+    WriteSeries(out);
+    out->AppendFixed32(kDigestStateMagic);
+    out->AppendFixed64(DoubleToBits(precision_));
+    out->AppendFixed64(hpd_offset_);
+    out->AppendFixed64(static_cast<uint64_t>(clock.now_usec));
+    out->AppendFixed64(static_cast<uint64_t>(clock.latest_usec));
+    // Sorted, so that this doesn't depend on the order of a hash map.
+    std::vector<std::pair<uint32_t, int>> live_bytes;
+    for (const auto &trace : traces_) {
+      if (trace.second.live) {
+        live_bytes.emplace_back(trace.first, trace.second.live);
+      }
+    }
+    std::sort(live_bytes.begin(), live_bytes.end());
+    out->AppendVarint(live_bytes.size());
+    for (const auto &trace : live_bytes) {
+      out->AppendVarint(trace.first);
+      out->AppendVarint(static_cast<uint32_t>(trace.second));
+    }
+    snapshots_.WriteKeyframeState();
+    out->AppendVarint(levels_.size());
+    for (const auto &level : levels_) {
+      out->AppendVarint(level->interval_msec);
+    }
+    return snapshots_.Finish();
+  }
+
+ private:
+  // Note the change, if any, in a trace's bytes between the last snapshot and
+  // the one we're about to write.
+  inline void AddChange(uint32_t traceindex, DigestTrace *trace,
+                        int64_t written) {
+    if (written != trace->written) {
+      changes_.emplace_back(traceindex, written - trace->written);
+      trace->written = written;
+    }
+  }
+
+  // Write the series section.
+  void WriteSeries(BufferedWriter *out) {
+    std::vector<std::pair<uint32_t, const TraceSeries *>> traces;
+    traces.reserve(series_.traces.size());
+    for (const auto &trace : series_.traces) {
+      traces.emplace_back(trace.first, &trace.second);
+    }
+    std::sort(traces.begin(), traces.end());
+
+    out->AppendFixed32(kSeriesMagic);
+    out->AppendVarint(traces.size());
+    uint32_t last_traceindex = 0;
+    for (const auto &trace : traces) {
+      out->AppendVarint(trace.first - last_traceindex);
+      out->AppendVarint(trace.second->data.size());
+      last_traceindex = trace.first;
+    }
+    out->AppendVarint(series_.total.data.size());
+    out->AppendBytes(series_.total.data.data(), series_.total.data.size());
+    for (const auto &trace : traces) {
+      out->AppendBytes(trace.second->data.data(), trace.second->data.size());
+    }
+  }
+
+  // Bring a level up to date, given that we just wrote snapshots [first,
+  // first + count) of the digest proper, the first with changes_. Snapshot n
+  // of the level is snapshot (n + 1) * factor - 1 of the digest, since both of
+  // those are the first snapshot due at or after (n + 1) * level interval.
+  void WriteLevelSnapshots(size_t first, int count, DigestLevel *level) {
+    for (const auto &change : changes_) {
+      level->pending[change.first] += change.second;
+    }
+    const int due = (first + count) / level->factor - first / level->factor;
+    if (due == 0) {
+      return;
+    }
+    level_changes_.clear();
+    for (const auto &change : level->pending) {
+      if (change.second) {
+        level_changes_.push_back(change);
+      }
+    }
+    level->pending.clear();
+    std::sort(level_changes_.begin(), level_changes_.end());
+    level->snapshots.Write(level_changes_, due);
+  }
+
+  static const int kProgressInterval = 500000;
+
+  SnapshotWriter snapshots_;
+  std::vector<std::unique_ptr<DigestLevel>> levels_;
+  const double precision_;
+  const bool verbose_;
+  off_t start_bytes_ = 0;
+  off_t total_bytes_ = 0;
+  struct timespec start_time_;
+
+  DigestTraces traces_;
+  // The traces with events since the last snapshot.
+  std::vector<std::pair<uint32_t, DigestTrace *>> dirty_;
+  // Scratch space for working out snapshots.
+  SnapshotUsage usage_;
+  SnapshotChanges changes_;
+  SnapshotChanges level_changes_;
+  DigestSeries series_;
+  // The offset in the .hpd file just past the last event added.
+  off_t hpd_offset_ = 0;
+  int events_read_ = 0;
 };
 
-// Read the metadata from a .hpm file and return it in C++ format. On error,
-// returns false and sets the exception.
-static bool GetHPMMetadata(const char *filebase, HPMMetadata *result) {
-  ScopedFile hpm(filebase, ".hpm", false);
-  if (!hpm) {
-    return false;
+// The simple way to digest: read the events one at a time, and write out
+// snapshots as they come due.
+static void DigestSequentially(const HPMMetadata &hpm, FileReader *in,
+                               DigestClock *clock, DigestWriter *digest) {
+  RawEvent event;
+  while (ReadRawEvent(in, &event)) {
+    // This is long-running, so check the signal handler. On interrupt, though,
+    // we break, not fail: we'll dump out what we have so far.
+    if (PyErr_CheckSignals() == -1) {
+      break;
+    }
+
+    int scaled_size = hpm.scaled_size(event.size);
+    if (event.is_free()) scaled_size = -scaled_size;
+    digest->Add(event.traceindex(), scaled_size);
+    digest->WriteSnapshots(clock->Advance(event));
+    digest->Progress(1, clock->relative_time(), in->offset());
   }
+}
 
-  RawMetadata md;
-  if (!ReadRawMetadata(hpm, &md)) {
+////////////////////////////////////////////////////////////////////////////////
+// Parallel digests
+//
+// Almost all of the work of digesting is in decoding events and adding them up
+// per trace, and since addition is associative, that can be split up: cut the
+// .hpd file into chunks, have worker threads add up each chunk's events into
+// per-trace deltas, with a separate set of deltas for each run of events
+// between two snapshots, and then have the main thread apply those deltas to
+// the running totals in order, writing snapshots between runs. Because a
+// trace's live bytes depend only on the sum of its deltas (see
+// DigestWriter::Add), and the workers keep time with the same DigestClock as
+// the sequential path, the result is byte-for-byte the same.
+//
+// Events have variable lengths, so the chunks have to start somewhere we know
+// an event starts: at checkpoints. A checkpoint also gives the time, which is
+// all a worker needs to know about the events before its chunk. It doesn't
+// know the latest time before its chunk, which can be later, if the clock went
+// backwards; so each run notes the latest time as of its end, and the main
+// thread catches its own clock up to that, which comes to the same thing.
+//
+// We find the checkpoints with the index which the profiler writes to the .hpi
+// file when it stops, so that nobody has to read the whole .hpd file just to
+// work out where to cut it. A profile without an index, e.g. because it's
+// still running, is digested sequentially.
+
+// The target size of each chunk.
+static const off_t kDigestChunkSize = 4 << 20;
+
+// The sum of a run of events, ending with one after which snapshots were due.
+struct DigestRun {
+  std::unordered_map<uint32_t, int> deltas;
+  // The latest time as of the end of the run.
+  int64_t latest_usec = 0;
+};
+
+struct DigestChunk {
+  // The byte range of the .hpd file to read, and the state of the clock as of
+  // its start. Every chunk but the first starts at a checkpoint, which sets the
+  // time, so for those the main thread can pass whatever it has so far.
+  off_t start;
+  off_t end;
+  DigestClock clock;
+
+  // Filled in by the worker: the runs of events, the number of events, the
+  // offset just past the last of them, and the time of that one.
+  std::vector<DigestRun> runs;
+  int events = 0;
+  off_t events_end = 0;
+  int64_t now_usec = 0;
+  // Set if the worker stopped before the end of the chunk, because the rest of
+  // it wasn't a valid event; a sequential digest stops at the same place.
+  bool stopped = false;
+  bool done = false;
+  bool ok = true;
+
+  DigestChunk(off_t start, off_t end, const DigestClock &clock)
+      : start(start), end(end), clock(clock) {}
+};
+
+static inline uint32_t DecodeFixed32(const uint8_t *pos) {
+  uint32_t value;
+  memcpy(&value, pos, sizeof(value));
+  return absl::gntohl(value);
+}
+
+static inline uint64_t DecodeFixed64(const uint8_t *pos) {
+  uint64_t value;
+  memcpy(&value, pos, sizeof(value));
+  return absl::gntohll(value);
+}
+
+// Decode the rest of a checkpoint from memory, after its kCheckpointWord, and
+// advance *pos past it. Returns false if it's cut off by end, or corrupt.
+static inline bool DecodeCheckpointBody(const uint8_t **pos, const uint8_t *end,
+                                        struct timespec *clock) {
+  const size_t size = kCheckpointSize - sizeof(uint32_t);
+  if (end - *pos < static_cast<ptrdiff_t>(size)) {
     return false;
   }
-
-  result->initial_time = md.start_time();
-  for (auto p : md.sampling_probability) {
-    result->scaling_factor[p.first] = (p.second == 0 ? 0 : 1.0 / p.second);
+  const uint32_t magic = DecodeFixed32(*pos);
+  const uint64_t sec = DecodeFixed64(*pos + sizeof(uint32_t));
+  const uint64_t nsec =
+      DecodeFixed64(*pos + sizeof(uint32_t) + sizeof(uint64_t));
+  if (magic != kCheckpointMagic || nsec >= 1000000000L) {
+    return false;
   }
-
+  clock->tv_sec = sec;
+  clock->tv_nsec = nsec;
+  *pos += size;
   return true;
 }
 
-// Sort function to put traces in descending order by size.
-static bool SortPairs(const std::pair<uint32_t, int> &a,
-                      const std::pair<uint32_t, int> &b) {
-  return a.second > b.second;
+// Decode an event from memory, advancing *pos past it, just as ReadRawEvent
+// would, except that a checkpoint is returned as an event whose indexword is
+// kCheckpointWord, with its time in *checkpoint. Returns false if the event is
+// cut off by end, or corrupt. The buffer must be followed by at least
+// MAX_UNSIGNED_VARINT_SIZE(uint64_t) bytes of padding.
+static inline bool DecodeRawEvent(const uint8_t **pos, const uint8_t *end,
+                                  RawEvent *event,
+                                  struct timespec *checkpoint) {
+  if (end - *pos < static_cast<ptrdiff_t>(sizeof(uint32_t))) {
+    return false;
+  }
+  event->indexword = DecodeFixed32(*pos);
+  *pos += sizeof(uint32_t);
+  if (PREDICT_FALSE(event->indexword == kCheckpointWord)) {
+    return DecodeCheckpointBody(pos, end, checkpoint);
+  }
+  return (UnsafeDecodeVarint(pos, &event->delta_seconds) &&
+          UnsafeDecodeVarint(pos, &event->delta_usec) &&
+          UnsafeDecodeVarint(pos, &event->size) && *pos <= end);
 }
 
-static void WriteDigestEntry(int fd, const std::map<uint32_t, int> live_bytes,
-                             double precision) {
-  // Build up a map sorted in descending order by byte size.
-  std::vector<std::pair<uint32_t, int> > sorted_bytes;
-  sorted_bytes.reserve(live_bytes.size());
-  int64_t total_size = 0;
-  for (auto p : live_bytes) {
-    sorted_bytes.push_back(p);
-    total_size += p.second;
+// Add up the events in a chunk. This runs on a worker thread, so it must not
+// touch any Python state.
+static void DigestChunkEvents(const HPMMetadata &hpm, int fd,
+                              DigestChunk *chunk) {
+  const size_t size = chunk->end - chunk->start;
+  std::vector<uint8_t> buffer(size + MAX_UNSIGNED_VARINT_SIZE(uint64_t), 0);
+  size_t bytes_read = 0;
+  if (lseek(fd, chunk->start, SEEK_SET) == chunk->start) {
+    while (bytes_read < size) {
+      const ssize_t result =
+          read(fd, buffer.data() + bytes_read, size - bytes_read);
+      if (result <= 0) {
+        break;
+      }
+      bytes_read += result;
+    }
+  }
+  if (bytes_read != size) {
+    chunk->ok = false;
+    return;
   }
-  std::sort(sorted_bytes.begin(), sorted_bytes.end(), SortPairs);
 
-  // If a finite precision was set, we're going to drop a bunch of stack traces
-  // from the end, and instead aggregate their totals into a single "other"
-  // category which is written with trace index zero. (Zero is the reserved "no
-  // trace" index, so this makes good sense)
-  if (precision > 0) {
-    const int64_t slop_amount = static_cast<int64_t>(total_size * precision);
-    int64_t other_bytes = 0;  // Bytes in the "OTHER" category.
-    size_t last_index = sorted_bytes.size();
-    for (; last_index >= 0 && other_bytes < slop_amount; --last_index) {
-      other_bytes += sorted_bytes[last_index].second;
+  const uint8_t *const begin = buffer.data();
+  const uint8_t *const end = begin + size;
+  const uint8_t *pos = begin;
+  DigestClock clock = chunk->clock;
+  chunk->runs.emplace_back();
+  while (pos < end) {
+    RawEvent event;
+    struct timespec checkpoint;
+    if (!DecodeRawEvent(&pos, end, &event, &checkpoint)) {
+      chunk->stopped = true;
+      break;
+    }
+    if (event.indexword == kCheckpointWord) {
+      // Past the start of the chunk, this is the time the clock already has.
+      clock.now_usec = hpm.micros_since_start(checkpoint);
+      continue;
+    }
+    int scaled_size = hpm.scaled_size(event.size);
+    if (event.is_free()) scaled_size = -scaled_size;
+    chunk->runs.back().deltas[event.traceindex()] += scaled_size;
+    ++chunk->events;
+    chunk->events_end = chunk->start + (pos - begin);
+    if (clock.Advance(event)) {
+      chunk->runs.back().latest_usec = clock.latest_usec;
+      chunk->runs.emplace_back();
     }
-    sorted_bytes.resize(last_index);
+  }
+  chunk->runs.back().latest_usec = clock.latest_usec;
+  chunk->now_usec = clock.now_usec;
+}
 
-    if (other_bytes > 0) {
-      const auto pair = std::make_pair(0, other_bytes);
-      auto position = std::lower_bound(sorted_bytes.begin(), sorted_bytes.end(),
-                                       pair, SortPairs);
-      sorted_bytes.insert(position, pair);
+// A pool of threads which digest chunks, in the order in which they were
+// submitted.
+class DigestWorkers {
+ public:
+  // fds are the files the workers read from, one per worker; they (and hpm)
+  // must outlive this object.
+  DigestWorkers(const HPMMetadata &hpm, const std::vector<int> &fds)
+      : hpm_(hpm) {
+    for (int fd : fds) {
+      threads_.emplace_back(&DigestWorkers::Run, this, fd);
     }
   }
 
-  WriteFixed32ToFile(fd, kSnapshotMagic);
-  WriteVarintToFile(fd, sorted_bytes.size());
-  if (!sorted_bytes.empty()) {
-    WriteVarintToFile(fd, sorted_bytes[0].first);
-    WriteVarintToFile(fd, sorted_bytes[0].second);
+  // Finishes all submitted chunks, then stops the threads.
+  ~DigestWorkers() {
+    {
+      std::lock_guard<std::mutex> lock(mu_);
+      stopping_ = true;
+    }
+    work_cv_.notify_all();
+    for (std::thread &thread : threads_) {
+      thread.join();
+    }
+  }
 
-    for (size_t i = 1; i < sorted_bytes.size(); ++i) {
-      WriteVarintToFile(fd, sorted_bytes[i].first);
-      // These are sorted in descending order, so we just write the differences.
-      WriteVarintToFile(fd,
-                        sorted_bytes[i - 1].second - sorted_bytes[i].second);
+  void Submit(DigestChunk *chunk) {
+    {
+      std::lock_guard<std::mutex> lock(mu_);
+      queue_.push_back(chunk);
     }
+    work_cv_.notify_one();
   }
-}
 
-static void TimeToStderr(float seconds) {
-  const int hours = static_cast<int>(seconds / 3600);
-  seconds -= hours * 3600;
-  const int minutes = static_cast<int>(seconds / 60);
-  seconds -= minutes * 60;
-  if (hours != 0) {
-    fprintf(stderr, "%d:%02d:%02d", hours, minutes, static_cast<int>(seconds));
-  } else {
-    fprintf(stderr, "%02d:%02d", minutes, static_cast<int>(seconds));
+  // Block until a chunk is done. This releases the GIL while it waits.
+  void WaitFor(const DigestChunk *chunk) {
+    Py_BEGIN_ALLOW_THREADS;
+    {
+      std::unique_lock<std::mutex> lock(mu_);
+      done_cv_.wait(lock, [chunk] { return chunk->done; });
+    }
+    Py_END_ALLOW_THREADS;
   }
-}
 
-static void BytesToStderr(double bytes) {
-  if (bytes < 1.2e9) {
-    fprintf(stderr, "%0.1fMB", bytes / 1048576);
-  } else {
-    fprintf(stderr, "%0.1fGB", bytes / 1073741824);
+  bool IsDone(const DigestChunk *chunk) {
+    std::lock_guard<std::mutex> lock(mu_);
+    return chunk->done;
   }
-}
 
-// TODO(zunger): This function is still way too slow; on my laptop it can digest
-// about 50sec/sec. Some clever batch-reading and buffering of data, and maybe a
-// smarter varint decoder, could probably speed this up by a *lot*.
-bool MakeDigestFile(const char *filebase, int interval_msec, double precision,
-                    bool verbose) {
-  HPMMetadata hpm;
-  if (!GetHPMMetadata(filebase, &hpm)) {
-    return false;
+ private:
+  void Run(int fd) {
+    std::unique_lock<std::mutex> lock(mu_);
+    while (true) {
+      work_cv_.wait(lock, [this] { return stopping_ || !queue_.empty(); });
+      if (queue_.empty()) {
+        return;
+      }
+      DigestChunk *chunk = queue_.front();
+      queue_.pop_front();
+      lock.unlock();
+      DigestChunkEvents(hpm_, fd, chunk);
+      lock.lock();
+      chunk->done = true;
+      done_cv_.notify_all();
+    }
   }
 
-  ScopedFile hpd(filebase, ".hpd", false);
-  if (!hpd) return false;
+  const HPMMetadata &hpm_;
+  // Guards everything below, and the done flags of chunks.
+  std::mutex mu_;
+  std::condition_variable work_cv_;
+  std::condition_variable done_cv_;
+  std::deque<DigestChunk *> queue_;
+  bool stopping_ = false;
+  std::vector<std::thread> threads_;
+};
 
-  ScopedFile hpc(filebase, ".hpc", true);
-  if (!hpc) return false;
-  hpc.set_delete_on_exit(true);
+// Apply a finished chunk to the digest. Returns false, and sets the exception,
+// if the worker couldn't read it.
+static bool ApplyChunk(const DigestChunk &chunk, DigestClock *clock,
+                       DigestWriter *digest) {
+  if (!chunk.ok) {
+    PyErr_Format(PyExc_IOError,
+                 "Failed to read events at offsets %zd-%zd; was the file "
+                 "modified during the digest?",
+                 static_cast<Py_ssize_t>(chunk.start),
+                 static_cast<Py_ssize_t>(chunk.end));
+    return false;
+  }
+  for (const DigestRun &run : chunk.runs) {
+    for (const auto &delta : run.deltas) {
+      if (delta.second) {
+        digest->Add(delta.first, delta.second);
+      }
+    }
+    digest->WriteSnapshots(clock->CatchUp(run.latest_usec));
+  }
+  if (chunk.events > 0) {
+    clock->now_usec = chunk.now_usec;
+    digest->Progress(chunk.events, clock->relative_time(), chunk.events_end);
+  }
+  return true;
+}
 
-  // Write the header.
-  WriteFixed32ToFile(hpc, 1);
-  const uint64_t seconds = static_cast<uint64_t>(hpm.initial_time);
-  WriteFixed64ToFile(hpc, seconds);
-  const uint64_t nsec = static_cast<uint64_t>(1e9 * (hpm.initial_time - seconds));
-  WriteFixed64ToFile(hpc, nsec);
-  WriteVarintToFile(hpc, interval_msec);
-  // This is where we're going to come back later and write the index location.
-  const off_t index_offset_location = lseek(hpc, 0, SEEK_CUR);
+// Work out where to cut the .hpd file into chunks, from offset start to offset
+// total_bytes: at checkpoints from the index, about kDigestChunkSize apart.
+// splits gets the offsets at which chunks start, followed by total_bytes. (Any
+// checkpoints past total_bytes, if the file is shorter than the index says,
+// are ignored, as are the events there.) Each
+// checkpoint we use is checked against the .hpd file, which fd reads, so that
+// an index left over from some other profile can't send the workers astray.
+// Returns false if the index doesn't match the file. This doesn't touch any
+// Python state, so it can run without the GIL.
+static bool SplitAtCheckpoints(const std::vector<Checkpoint> &checkpoints,
+                               int fd, off_t start, off_t total_bytes,
+                               std::vector<off_t> *splits) {
+  splits->push_back(start);
+  for (const Checkpoint &checkpoint : checkpoints) {
+    if (checkpoint.offset - splits->back() < kDigestChunkSize) {
+      continue;
+    }
+    if (checkpoint.offset + static_cast<off_t>(kCheckpointSize) > total_bytes) {
+      break;
+    }
+    uint8_t buffer[kCheckpointSize];
+    if (lseek(fd, checkpoint.offset, SEEK_SET) != checkpoint.offset ||
+        read(fd, buffer, kCheckpointSize) !=
+            static_cast<ssize_t>(kCheckpointSize) ||
+        DecodeFixed32(buffer) != kCheckpointWord) {
+      return false;
+    }
+    const uint8_t *pos = buffer + sizeof(uint32_t);
+    struct timespec clock;
+    if (!DecodeCheckpointBody(&pos, buffer + kCheckpointSize, &clock) ||
+        clock.tv_sec != checkpoint.clock.tv_sec ||
+        clock.tv_nsec != checkpoint.clock.tv_nsec) {
+      return false;
+    }
+    splits->push_back(checkpoint.offset);
+  }
+  splits->push_back(total_bytes);
+  return true;
+}
 
-  WriteFixed64ToFile(hpc, 0);
+// Digest the chunks between each successive pair of splits.
+static bool DigestInParallel(const HPMMetadata &hpm,
+                             const std::vector<int> &fds,
+                             const std::vector<off_t> &splits,
+                             DigestClock *clock, DigestWriter *digest) {
+  // Don't let the workers get too far ahead of the main thread, so that memory
+  // use stays bounded.
+  const size_t max_pending = 2 * fds.size();
+  std::deque<std::unique_ptr<DigestChunk>> pending;
+  DigestWorkers workers(hpm, fds);
+  bool ok = true;
+  // Set once a chunk stops short, after which nothing more gets applied.
+  bool stopped = false;
+
+  // Apply finished chunks to the digest, in order. If wait is set, wait for
+  // the first one to finish.
+  auto apply_chunks = [&](bool wait) {
+    while (!pending.empty()) {
+      DigestChunk *chunk = pending.front().get();
+      if (wait) {
+        workers.WaitFor(chunk);
+      } else if (!workers.IsDone(chunk)) {
+        return;
+      }
+      wait = false;
+      if (ok && !stopped) {
+        ok = ApplyChunk(*chunk, clock, digest);
+        stopped = chunk->stopped;
+      }
+      pending.pop_front();
+    }
+  };
 
-  // Now, let's write the entries.
-  std::map<uint32_t, int> live_bytes;
-  std::vector<off_t> snapshot_starts;
+  for (size_t i = 0; i + 1 < splits.size() && ok && !stopped; ++i) {
+    pending.emplace_back(new DigestChunk(splits[i], splits[i + 1], *clock));
+    workers.Submit(pending.back().get());
+    // Same as in the sequential case: on interrupt, we stop reading, but keep
+    // what we have so far.
+    if (PyErr_CheckSignals() == -1) {
+      break;
+    }
+    apply_chunks(false);
+    while (ok && pending.size() >= max_pending) {
+      apply_chunks(true);
+    }
+  }
 
-  const double interval = static_cast<double>(interval_msec) / 1000;
-  double relative_time = 0;
-  double next_snapshot = interval;
-  int events_read = 0;
-  int snapshots_written = 0;
-  RawEvent event;
+  // Drain the queue. (We need to do this even if something failed, since
+  // the workers have pointers to these chunks.)
+  while (!pending.empty()) {
+    apply_chunks(true);
+  }
+  return ok;
+}
 
-  struct timespec start_time;
-  off_t total_bytes;
-  if (verbose) {
-    gettime(&start_time);
-    total_bytes = lseek(hpd, 0, SEEK_END);
-    lseek(hpd, 0, SEEK_SET);
-    fprintf(stderr, "Digesting %s: ", filebase);
-    BytesToStderr(total_bytes);
-    fprintf(stderr, "\n");
+// The .hpd file, opened once for the main thread, and for a parallel digest,
+// once more for each worker thread, so that they don't fight over the file
+// offset, along with the checkpoint index which tells us where to split it.
+class DigestInput {
+ public:
+  // Returns false and sets the exception if the file couldn't be opened.
+  bool Open(const char *filebase, int jobs) {
+    hpd_.reset(new ScopedFile(filebase, ".hpd", READ_MODE));
+    if (!*hpd_) return false;
+    if (jobs > 1) {
+      for (int i = 0; i < jobs; ++i) {
+        worker_files_.emplace_back(new ScopedFile(filebase, ".hpd", READ_MODE));
+        if (!*worker_files_.back()) return false;
+        worker_fds_.push_back(*worker_files_.back());
+      }
+      // Without an index, we just can't split the file.
+      ScopedFile index(filebase, ".hpi", READ_MODE);
+      if (index) {
+        FileReader in(index);
+        has_index_ = ReadRawCheckpointIndex(&in, &checkpoints_);
+      }
+      PyErr_Clear();
+    }
+    return true;
   }
 
-  while (ReadRawEvent(hpd, &event)) {
-    // This is long-running, so check the signal handler. On interrupt, though,
-    // we break, not fail: we'll dump out what we have so far.
-    if (PyErr_CheckSignals() == -1) {
-      break;
+  int fd() const { return *hpd_; }
+  // Empty unless this is a parallel digest.
+  const std::vector<int> &worker_fds() const { return worker_fds_; }
+
+  // Work out where to split the file for a parallel digest, as per
+  // SplitAtCheckpoints. Returns false if we can't, in which case the digest
+  // should be sequential.
+  bool Split(off_t start, off_t total_bytes, std::vector<off_t> *splits) const {
+    if (worker_fds_.empty() || !has_index_) {
+      return false;
     }
+    bool result;
+    Py_BEGIN_ALLOW_THREADS;
+    result = SplitAtCheckpoints(checkpoints_, worker_fds_[0], start,
+                                total_bytes, splits);
+    Py_END_ALLOW_THREADS;
+    return result;
+  }
 
-    // Fetch the event data
-    const uint32_t traceindex = event.traceindex();
-    int scaled_size = hpm.scaled_size(event.size);
-    if (event.is_free()) scaled_size = -scaled_size;
+ private:
+  std::unique_ptr<ScopedFile> hpd_;
+  std::vector<std::unique_ptr<ScopedFile>> worker_files_;
+  std::vector<int> worker_fds_;
+  bool has_index_ = false;
+  std::vector<Checkpoint> checkpoints_;
+};
 
-    // Update live_bytes and relative_time
-    auto it = live_bytes.find(traceindex);
-    if (it == live_bytes.end()) {
-      live_bytes[traceindex] = scaled_size;
-    } else {
-      it->second += scaled_size;
-      if (!it->second) {
-        live_bytes.erase(it);
-      }
+// The files for the coarser levels of a digest.
+class DigestLevelFiles {
+ public:
+  // Returns false and sets the exception if a file couldn't be opened.
+  bool Open(const char *filebase, size_t levels, int mode) {
+    for (size_t i = 1; i <= levels; ++i) {
+      std::unique_ptr<ScopedFile> file(
+          new ScopedFile(filebase, LevelExtension(i).c_str(), mode));
+      if (!*file) return false;
+      fds_.push_back(*file);
+      files_.push_back(std::move(file));
     }
+    return true;
+  }
 
-    const double delta_time = event.delta_time();
-    if (delta_time > 0) {
-      relative_time += delta_time;
+  // Get rid of any levels past the given number, left over from an earlier
+  // digest.
+  static void RemoveStale(const char *filebase, size_t levels) {
+    for (size_t i = levels + 1;
+         unlink((filebase + LevelExtension(i)).c_str()) == 0; ++i) {
     }
-    for (; relative_time >= next_snapshot; next_snapshot += interval) {
-      snapshot_starts.push_back(lseek(hpc, 0, SEEK_CUR));
-      WriteDigestEntry(hpc, live_bytes, precision);
-      ++snapshots_written;
+  }
+
+  const std::vector<int> &fds() const { return fds_; }
+
+  void set_delete_on_exit(bool v) {
+    for (auto &file : files_) {
+      file->set_delete_on_exit(v);
     }
+  }
+
+ private:
+  static std::string LevelExtension(size_t level) {
+    return "." + std::to_string(level) + ".hpc";
+  }
 
-    ++events_read;
+  std::vector<std::unique_ptr<ScopedFile>> files_;
+  std::vector<int> fds_;
+};
 
-    if (verbose && !(events_read % 500000)) {
-      struct timespec now;
-      gettime(&now);
-      struct timespec delta;
-      DeltaTime(start_time, now, &delta);
-      const double time_used = delta.tv_sec + 1e-9 * delta.tv_nsec;
-      const off_t bytes = lseek(hpd, 0, SEEK_CUR);
-      const double fraction = static_cast<double>(bytes) / total_bytes;
-      const double eta = time_used * ((1.0 / fraction) - 1);
+// Digest the events in the .hpd file from offset start onwards, and finish the
+// digest. Returns false and sets the exception on failure. If we were
+// interrupted, we stop reading but still finish the digest, so this returns
+// true, with the KeyboardInterrupt set: the files are valid and should be
+// kept, but the caller should still raise.
+static bool DigestEvents(const char *filebase, const HPMMetadata &hpm,
+                         const DigestInput &input, off_t start,
+                         DigestClock *clock, DigestWriter *digest) {
+  const off_t total_bytes = lseek(input.fd(), 0, SEEK_END);
+  if (start > total_bytes || lseek(input.fd(), start, SEEK_SET) != start) {
+    PyErr_Format(PyExc_ValueError,
+                 "The digest goes past the end of the .hpd file; was the "
+                 "profile replaced?");
+    return false;
+  }
+  digest->StartProgress(filebase, start, total_bytes);
 
-      // For those wanting to understand exactly what's being printed here: the
-      // rate is given both in MBps (of data being read) and sec/sec, i.e.
-      // seconds of profiling time per second of digestion time.
-      fprintf(stderr, "Digested ");
-      TimeToStderr(relative_time);
-      fprintf(stderr, " of data (%0.1fM events, ", 1e-6 * events_read);
-      BytesToStderr(bytes);
-      fprintf(stderr, ") @ ");
-      BytesToStderr(bytes / time_used);
-      fprintf(stderr, "ps=%0.1fsec/sec; %0.1f%%; ETA ",
-              relative_time / time_used, 100 * fraction);
-      TimeToStderr(eta);
-      fprintf(stderr, ")\n");
+  std::vector<off_t> splits;
+  if (input.Split(start, total_bytes, &splits)) {
+    if (!DigestInParallel(hpm, input.worker_fds(), splits, clock, digest)) {
+      return false;
     }
+  } else {
+    FileReader in(input.fd(), kDigestBufferSize);
+    DigestSequentially(hpm, &in, clock, digest);
   }
 
-  // ReadRawEvent set an exception; ignore it. Other exceptions are legit.
+  // ReadRawEvent set an exception; ignore it. Other exceptions are legit,
+  // except that an interrupt only means we should stop early, so set it aside
+  // until what we have so far is safely on disk.
   if (PyErr_ExceptionMatches(PyExc_EOFError) ||
       PyErr_ExceptionMatches(PyExc_ValueError)) {
     PyErr_Clear();
   }
+  PyObject *interrupt_type = nullptr;
+  PyObject *interrupt_value = nullptr;
+  PyObject *interrupt_traceback = nullptr;
+  if (PyErr_ExceptionMatches(PyExc_KeyboardInterrupt)) {
+    PyErr_Fetch(&interrupt_type, &interrupt_value, &interrupt_traceback);
+  } else if (PyErr_Occurred()) {
+    return false;
+  }
 
   // Finally, write the index.
-  if (verbose) {
-    fprintf(stderr, "Writing index with %zd entries\n", snapshot_starts.size());
+  if (!digest->Finish(*clock)) {
+    Py_XDECREF(interrupt_type);
+    Py_XDECREF(interrupt_value);
+    Py_XDECREF(interrupt_traceback);
+    return false;
+  }
+  PyErr_Restore(interrupt_type, interrupt_value, interrupt_traceback);
+  return true;
+}
+
+bool MakeDigestFile(const char *filebase, int interval_msec,
+                    const std::vector<int> &level_intervals_msec,
+                    double precision, bool verbose, int jobs) {
+  HPMMetadata hpm;
+  if (!GetHPMMetadata(filebase, &hpm)) {
+    return false;
+  }
+
+  DigestInput input;
+  if (!input.Open(filebase, jobs)) {
+    return false;
+  }
+
+  ScopedFile hpc(filebase, ".hpc", WRITE_MODE);
+  if (!hpc) return false;
+  hpc.set_delete_on_exit(true);
+  DigestLevelFiles level_files;
+  const bool levels_opened =
+      level_files.Open(filebase, level_intervals_msec.size(), WRITE_MODE);
+  level_files.set_delete_on_exit(true);
+  if (!levels_opened) return false;
+
+  // NB that this must be declared after the files, so that it's destroyed (and
+  // flushed) first.
+  DigestWriter digest(hpc, level_files.fds(), precision, verbose);
+  if (!digest.ok()) {
+    PyErr_SetString(PyExc_MemoryError, "Failed to allocate output buffer");
+    return false;
+  }
+  digest.Start(hpm.initial_time, interval_msec, level_intervals_msec);
+
+  DigestClock clock(interval_msec);
+  if (!DigestEvents(filebase, hpm, input, 0, &clock, &digest)) {
+    return false;
+  }
+  // Even if we were interrupted, what we have so far is a valid digest.
+  hpc.set_delete_on_exit(false);
+  level_files.set_delete_on_exit(false);
+  DigestLevelFiles::RemoveStale(filebase, level_intervals_msec.size());
+  return !PyErr_Occurred();
+}
+
+bool UpdateDigestFile(const char *filebase, bool verbose, int jobs) {
+  HPMMetadata hpm;
+  if (!GetHPMMetadata(filebase, &hpm)) {
+    return false;
+  }
+
+  DigestInput input;
+  if (!input.Open(filebase, jobs)) {
+    return false;
   }
-  uint64_t index_offset = static_cast<uint64_t>(lseek(hpc, 0, SEEK_CUR));
-  index_offset = absl::ghtonll(index_offset);
-  pwrite(hpc, &index_offset, sizeof(index_offset), index_offset_location);
 
-  WriteFixed32ToFile(hpc, kIndexMagic);
-  WriteVarintToFile(hpc, snapshot_starts.size());
-  if (!snapshot_starts.empty()) {
-    WriteVarintToFile(hpc, snapshot_starts[0]);
-    for (size_t i = 1; i < snapshot_starts.size(); ++i) {
-      WriteVarintToFile(hpc, snapshot_starts[i] - snapshot_starts[i - 1]);
+  ScopedFile hpc(filebase, ".hpc", UPDATE_MODE);
+  if (!hpc) return false;
+
+  // NB that all the reading has to be done before the writer moves the file
+  // offsets.
+  RawDigestMetadata md;
+  DigestState state;
+  SnapshotUsage last_snapshot;
+  DigestSeries series;
+  {
+    FileReader in(hpc);
+    if (!ReadRawDigestMetadata(&in, &md)) {
+      return false;
     }
+    if (md.version < kDigestVersion) {
+      PyErr_SetString(PyExc_ValueError,
+                      "This digest was made by an older version of heapprof, "
+                      "and can't be updated; make a new one instead");
+      return false;
+    }
+    if (!ReadDigestState(&in, md, &state) ||
+        !ReadLastSnapshot(&in, md, &last_snapshot) ||
+        !ReadAllSeries(&in, state.series, &series)) {
+      return false;
+    }
+  }
+  DigestLevelFiles level_files;
+  if (!level_files.Open(filebase, state.level_intervals_msec.size(),
+                        UPDATE_MODE)) {
+    return false;
+  }
+  std::vector<DigestLevelState> level_states(level_files.fds().size());
+  for (size_t i = 0; i < level_states.size(); ++i) {
+    FileReader in(level_files.fds()[i]);
+    if (!ReadDigestLevelState(&in, &level_states[i])) {
+      return false;
+    }
+  }
+
+  DigestWriter digest(hpc, level_files.fds(), state.precision, verbose);
+  if (!digest.ok()) {
+    PyErr_SetString(PyExc_MemoryError, "Failed to allocate output buffer");
+    return false;
+  }
+  // From here on, we're changing the files, so if we fail, there's nothing
+  // worth keeping.
+  hpc.set_delete_on_exit(true);
+  level_files.set_delete_on_exit(true);
+  if (!digest.Resume(md, state, &last_snapshot, &series, &level_states)) {
+    return false;
   }
 
+  DigestClock clock(md.interval_msec);
+  clock.now_usec = state.now_usec;
+  clock.latest_usec = state.latest_usec;
+  if (!DigestEvents(filebase, hpm, input, state.hpd_offset, &clock, &digest)) {
+    return false;
+  }
+  // Even if we were interrupted, the digest is valid up to where we stopped,
+  // and the next update will pick up from there.
   hpc.set_delete_on_exit(false);
+  level_files.set_delete_on_exit(false);
   return !PyErr_Occurred();
 }
 
 PyObject *ReadDigestMetadata(int fd) {
-  uint32_t version = 0;
-  if (!ReadFixed32FromFile(fd, &version) || version != 1) {
-    PyErr_Format(PyExc_ValueError, "Unrecognized file version %d", version);
+  FileReader in(fd);
+  RawDigestMetadata md;
+  if (!ReadRawDigestMetadata(&in, &md)) {
+    // Exception already set.
     return nullptr;
   }
 
-  uint64_t initial_secs;
-  uint64_t initial_nsec;
-  uint64_t interval_msec;
-  uint64_t index_offset;
-  if (!ReadFixed64FromFile(fd, &initial_secs) ||
-      !ReadFixed64FromFile(fd, &initial_nsec) ||
-      !ReadVarintFromFile(fd, &interval_msec) ||
-      !ReadFixed64FromFile(fd, &index_offset)) {
-    return nullptr;
+  // The coarser levels and the series are listed in the digester state, which
+  // only the .hpc file proper has.
+  DigestState state;
+  if (md.version >= kDigestStateVersion) {
+    const off_t state_offset = in.offset();
+    uint32_t magic = 0;
+    if (!in.ReadFixed32(&magic) ||
+        (magic != kLevelStateMagic &&
+         (!in.Seek(state_offset) || !ReadDigestState(&in, md, &state)))) {
+      // Exception already set.
+      return nullptr;
+    }
   }
 
-  if (lseek(fd, index_offset, SEEK_SET) != static_cast<off_t>(index_offset)) {
-    PyErr_Format(PyExc_ValueError, "Invalid index offset %llx in metadata",
-                 index_offset);
+  // off_t isn't always 64 bits, so the offsets have to be converted to pack
+  // them.
+  ScopedObject offsets(PackArray(std::vector<int64_t>(
+      md.snapshot_starts.begin(), md.snapshot_starts.end())));
+  if (!offsets) {
     return nullptr;
   }
-  uint32_t magic;
-  if (!ReadFixed32FromFile(fd, &magic) || magic != kIndexMagic) {
-    PyErr_Format(PyExc_ValueError, "Bad index magic number %08x", magic);
+  ScopedObject levels(PyList_New(state.level_intervals_msec.size()));
+  if (!levels) {
     return nullptr;
   }
-  uint64_t num_entries;
-  if (!ReadVarintFromFile(fd, &num_entries)) {
-    PyErr_SetString(PyExc_ValueError, "Couldn't read index header");
-    return nullptr;
+  for (size_t i = 0; i < state.level_intervals_msec.size(); ++i) {
+    PyList_SET_ITEM(levels.get(), i,
+                    PyFloat_FromDouble(1e-3 * state.level_intervals_msec[i]));
   }
 
-  ScopedObject offsets(PyList_New(num_entries));
-  uint64_t offset = 0;
-  for (uint64_t i = 0; i < num_entries; ++i) {
-    uint64_t delta;
-    if (!ReadVarintFromFile(fd, &delta)) {
-      PyErr_SetString(PyExc_ValueError, "Broken index");
+  // Py_BuildValue("") is None.
+  ScopedObject total_series(
+      state.series.present
+          ? Py_BuildValue("(nn)",
+                          static_cast<Py_ssize_t>(state.series.total.first),
+                          static_cast<Py_ssize_t>(state.series.total.second))
+          : Py_BuildValue(""));
+  ScopedObject trace_series(PyDict_New());
+  if (!total_series || !trace_series) {
+    return nullptr;
+  }
+  for (const auto &trace : state.series.traces) {
+    ScopedObject py_traceindex(PyLong_FromUnsignedLong(trace.first));
+    ScopedObject where(
+        Py_BuildValue("(nn)", static_cast<Py_ssize_t>(trace.second.first),
+                      static_cast<Py_ssize_t>(trace.second.second)));
+    if (!py_traceindex || !where ||
+        PyDict_SetItem(trace_series.get(), py_traceindex.get(), where.get()) ==
+            -1) {
       return nullptr;
     }
-    offset += delta;
-    PyList_SET_ITEM(offsets.get(), i, PyLong_FromLongLong(offset));
   }
 
-  const float initial_time = initial_secs + 1e-9 * initial_nsec;
-  const float interval_time = 1e-3 * interval_msec;
-  return Py_BuildValue("ffO", initial_time, interval_time, offsets.release());
+  const double initial_time = md.initial_secs + 1e-9 * md.initial_nsec;
+  const double interval_time = 1e-3 * md.interval_msec;
+  return Py_BuildValue("ffNNNNN", initial_time, interval_time,
+                       offsets.release(), levels.release(),
+                       total_series.release(), trace_series.release(),
+                       PyLong_FromUnsignedLongLong(md.index_offset));
 }
 
-PyObject *ReadDigestEntry(int fd, Py_ssize_t offset) {
-  if (lseek(fd, offset, SEEK_SET) != offset) {
-    PyErr_Format(PyExc_ValueError, "Invalid entry offset %d", offset);
+PyObject *ReadDigestSeries(int fd, Py_ssize_t offset, Py_ssize_t length) {
+  // The series is contiguous, so there's no point in buffering past its end.
+  FileReader in(fd, length);
+  if (!in.Seek(offset)) {
+    // Exception already set.
     return nullptr;
   }
-
-  uint32_t magic;
-  if (!ReadFixed32FromFile(fd, &magic) || magic != kSnapshotMagic) {
-    PyErr_Format(PyExc_ValueError, "Invalid magic number for entry at %d",
-                 offset);
+  ScopedObject result(PyList_New(0));
+  if (!result) {
+    return nullptr;
+  }
+  uint64_t snapshot = 0;
+  int64_t bytes = 0;
+  const off_t end = offset + length;
+  while (in.offset() < end) {
+    uint64_t snapshot_delta, bytes_delta;
+    if (!in.ReadVarint(&snapshot_delta) || !in.ReadVarint(&bytes_delta)) {
+      return nullptr;
+    }
+    snapshot += snapshot_delta;
+    bytes += ZigZagDecode(bytes_delta);
+    ScopedObject point(
+        Py_BuildValue("(NN)", PyLong_FromUnsignedLongLong(snapshot),
+                      PyLong_FromLongLong(bytes)));
+    if (!point || PyList_Append(result.get(), point.get()) == -1) {
+      return nullptr;
+    }
+  }
+  if (in.offset() != end) {
+    PyErr_Format(PyExc_ValueError, "Broken series at %zd", offset);
     return nullptr;
   }
+  return result.release();
+}
 
-  uint64_t num_items;
-  if (!ReadVarintFromFile(fd, &num_items)) {
+// The usage in a snapshot, in the order in which a keyframe lists it.
+typedef std::vector<std::pair<uint32_t, int64_t>> SortedUsage;
+
+// If the snapshots ReadDigestEntries is asked for are at most this many apart,
+// it decodes everything between them, rather than going back to a keyframe for
+// each one. SnapshotWriter never writes a longer chain of deltas than this, so
+// going back would rarely save anything.
+static const Py_ssize_t kMaxSnapshotWalk = 32;
+
+// Decode the snapshots in range(start, stop, step) into results, which has a
+// slot for each. This touches no Python objects, so can run without the GIL.
+// On failure, it returns false and sets bad_offset to the entry it couldn't
+// decode.
+static bool DecodeSnapshots(BufferReader *in, const int64_t *offsets,
+                            Py_ssize_t start, Py_ssize_t stop, Py_ssize_t step,
+                            std::vector<SortedUsage> *results,
+                            off_t *bad_offset) {
+  SnapshotUsage usage;
+  // The index of the last snapshot we decoded, if any, and whether usage holds
+  // a keyframe or something we've reached from one.
+  Py_ssize_t decoded = -1;
+  bool have_keyframe = false;
+  auto result = results->begin();
+  for (Py_ssize_t index = start; index < stop; index += step, ++result) {
+    const off_t offset = offsets[index];
+    *bad_offset = offset;
+    if (decoded == -1 || index - decoded > kMaxSnapshotWalk) {
+      // Go back to the keyframe this one depends on.
+      uint32_t magic = 0;
+      uint64_t keyframe_distance = 0;
+      if (!in->Seek(offset) || !in->ReadFixed32(&magic) ||
+          (magic != kSnapshotMagic &&
+           (magic != kDeltaMagic || !in->ReadVarint(&keyframe_distance) ||
+            keyframe_distance > static_cast<uint64_t>(offset))) ||
+          !in->Seek(offset - keyframe_distance)) {
+        return false;
+      }
+      have_keyframe = false;
+    }
+    // Decode everything up to and including this snapshot. The entries are
+    // contiguous, so we should land right on it.
+    while (true) {
+      const off_t entry_offset = in->offset();
+      uint32_t magic = 0;
+      if (entry_offset > offset || !in->ReadFixed32(&magic)) {
+        return false;
+      }
+      if (magic == kSnapshotMagic) {
+        if (!ReadKeyframe(in, &usage)) {
+          return false;
+        }
+        have_keyframe = true;
+      } else if (magic != kDeltaMagic || !have_keyframe ||
+                 !ApplyDelta(in, &usage)) {
+        return false;
+      }
+      if (entry_offset == offset) {
+        break;
+      }
+    }
+    decoded = index;
+    result->assign(usage.begin(), usage.end());
+    std::sort(result->begin(), result->end(), LargerTrace<int64_t>);
+  }
+  return true;
+}
+
+PyObject *ReadDigestEntries(const uint8_t *data, size_t size,
+                            const int64_t *offsets, Py_ssize_t num_offsets,
+                            Py_ssize_t start, Py_ssize_t stop,
+                            Py_ssize_t step) {
+  if (step <= 0 || start < 0 || stop > num_offsets) {
+    PyErr_Format(PyExc_ValueError,
+                 "Invalid snapshot range %zd:%zd:%zd of %zd snapshots", start,
+                 stop, step, num_offsets);
+    return nullptr;
+  }
+  const Py_ssize_t num_results =
+      start < stop ? (stop - start - 1) / step + 1 : 0;
+
+  // Decode everything without the GIL, and only make Python objects out of it
+  // afterwards.
+  std::vector<SortedUsage> results(num_results);
+  BufferReader in(data, size);
+  off_t bad_offset = 0;
+  bool ok;
+  Py_BEGIN_ALLOW_THREADS;
+  ok = DecodeSnapshots(&in, offsets, start, stop, step, &results, &bad_offset);
+  Py_END_ALLOW_THREADS;
+  if (!ok) {
+    PyErr_Format(PyExc_ValueError, "Invalid entry at %zd",
+                 static_cast<Py_ssize_t>(bad_offset));
     return nullptr;
   }
 
-  ScopedObject result(PyDict_New());
+  ScopedObject result(PyList_New(num_results));
   if (!result) {
     return nullptr;
   }
-
-  int64_t size = 0;
-  for (uint64_t i = 0; i < num_items; ++i) {
-    uint64_t traceindex;
-    uint64_t delta_size;
-    if (!ReadVarintFromFile(fd, &traceindex) ||
-        !ReadVarintFromFile(fd, &delta_size)) {
+  for (Py_ssize_t i = 0; i < num_results; ++i) {
+    ScopedObject usage(PyDict_New());
+    if (!usage) {
       return nullptr;
     }
-
-    if (i == 0) {
-      size = delta_size;
-    } else {
-      size -= delta_size;
-    }
-
-    ScopedObject py_traceindex(PyLong_FromLongLong(traceindex));
-    ScopedObject py_size(PyLong_FromLongLong(size));
-    if (!py_traceindex || !py_size ||
-        PyDict_SetItem(result.get(), py_traceindex.get(), py_size.get()) ==
-            -1) {
-      return nullptr;
+    for (const auto &trace : results[i]) {
+      ScopedObject py_traceindex(PyLong_FromUnsignedLong(trace.first));
+      ScopedObject py_size(PyLong_FromLongLong(trace.second));
+      if (!py_traceindex || !py_size ||
+          PyDict_SetItem(usage.get(), py_traceindex.get(), py_size.get()) ==
+              -1) {
+        return nullptr;
+      }
     }
+    PyList_SET_ITEM(result.get(), i, usage.release());
   }
-
   return result.release();
 }
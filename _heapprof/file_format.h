@@ -2,7 +2,12 @@
 #define _HEAPPROF_FILE_FORMAT_H__
 
 #include <time.h>
+#include <map>
+#include <string>
+#include <unordered_map>
+#include <vector>
 #include "Python.h"
+#include "_heapprof/buffered_writer.h"
 #include "_heapprof/sampler.h"
 #include "frameobject.h"
 
@@ -10,28 +15,96 @@
 // .hpm files: the metadata of a profile.
 // This consists of a metadata header, followed by a sequence of "raw traces."
 // Raw traces contain filenames and line numbers, and can be converted to nicer
-// structures by the wrapping Python code.
-
-// Write the metadata header to an .hpm file.
-void WriteMetadata(int fd, const struct timespec &start_clock,
-                   const Sampler &sampler);
-
-// Read the metadata header from an .hpm file. This will either return a tuple
-// (double initial_clock, Dict[int, double] sample_rate), or return nullptr and
-// set the exception.
+// structures by the wrapping Python code. Since format version 4, each
+// distinct filename is only written out in full once, and after that, traces
+// refer to it by an integer id.
+
+// The filenames which have been written to an .hpm file so far, by id. This is
+// what lets WriteRawTrace write each filename out only once, rather than in
+// every frame of every trace.
+class FilenameTable {
+ public:
+  // Find the id of a filename, given the Python string object it came from
+  // (or nullptr, if it didn't come from one) and its UTF-8 contents. Most
+  // lookups are just a hash of the object's address; since a string could be
+  // freed and another allocated in its place, the contents are checked as
+  // well. Returns false if this filename doesn't have an id yet.
+  bool Find(PyObject *key, const char *data, size_t size, uint32_t *id);
+
+  // Give a new filename the next id, and return it.
+  uint32_t Add(PyObject *key, const char *data, size_t size);
+
+  size_t size() const { return filenames_.size(); }
+  const std::vector<std::string> &filenames() const { return filenames_; }
+
+ private:
+  std::vector<std::string> filenames_;
+  std::unordered_map<PyObject *, uint32_t> by_object_;
+  std::unordered_map<std::string, uint32_t> by_name_;
+};
+
+// Write the metadata header to an .hpm file. Returns the file offset of the
+// header field which WriteMetadataFooter will later fill in.
+off_t WriteMetadata(BufferedWriter *out, const struct timespec &start_clock,
+                    const Sampler &sampler);
+
+// Write the metadata footer, which records statistics about the profiling run,
+// the file offset of each raw trace, and the table of filenames, at the end of
+// an .hpm file. This must be called in synchronous mode, after the last raw
+// trace has been written.
+void WriteMetadataFooter(BufferedWriter *out, off_t footer_offset_location,
+                         const std::map<std::string, uint64_t> &stats,
+                         const std::vector<off_t> &trace_offsets,
+                         const FilenameTable &filenames);
+
+// Read the metadata header and footer from an .hpm file. This will either
+// return a tuple (double initial_clock, Dict[int, double] sample_rate,
+// int sampling_interval, Dict[str, int] stats, int footer_offset,
+// Optional[bytes] trace_offsets, Optional[List[str]] filenames), or return
+// nullptr and set the exception. If the file has no footer, stats is empty and
+// footer_offset is 0; otherwise, footer_offset is also the offset at which the
+// raw traces end. trace_offsets is the file offset of each raw trace, packed as
+// native uint64s, or None if the footer has no index of them. filenames is None
+// if the file predates filename tables; otherwise, it's the table from the
+// footer, or an empty list if there's no footer, in which case the readers
+// below fill it in as they go. Either way, the file is left positioned at the
+// first raw trace.
 PyObject *ReadMetadata(int fd);
 
-// Write the current Python stack trace as a raw trace to the indicated file
-// descriptor. Returns false if there is no such trace!
-bool WriteRawTrace(int fd);
+// Write a raw trace to the indicated output, made of the given frames
+// (innermost first), plus a truncation marker if truncated is set; any
+// filenames which are new are added to the table. Returns false if there was no
+// room to write it (see BufferedWriter), in which case nothing at all is
+// written, and the table is unchanged.
+bool WriteRawTrace(BufferedWriter *out,
+                   const std::vector<PyFrameObject *> &frames, bool truncated,
+                   FilenameTable *filenames);
+
+// All the functions below which read raw traces take the List[str] filenames
+// which ReadMetadata returned, or None if it returned None. Any filenames they
+// come across which aren't in it yet are appended to it.
 
 // Read a single raw trace from the given file descriptor. Returns a
 // List[Tuple[str, int]] on success, or nullptr + raises an EOFError.
-PyObject *ReadRawTrace(int fd);
-
-// Check if a certain stack frame should be ignored when building and analyzing
-// stack traces.
-bool SkipFrame(PyFrameObject *pyframe);
+PyObject *ReadRawTrace(int fd, PyObject *filenames);
+
+// Find the raw traces in the given file descriptor which start in [start,
+// end), or from start to the end of the file if end is zero, without decoding
+// them. Returns a Tuple[bytes, int] of their offsets, packed as native uint64s,
+// and the offset just past the last of them; a trace cut off by the end of the
+// file is left out. Returns nullptr and sets the exception on failure.
+PyObject *IndexRawTraces(int fd, off_t start, off_t end, PyObject *filenames);
+
+// Like IndexRawTraces, but also decode the traces, in a single pass. Each
+// distinct frame gets an integer id: frames is a List[line_type] of the frames
+// seen so far, by id, and frame_ids is a Dict[line_type, int] mapping them back
+// to their ids, and this adds any new frames to both. Returns a
+// Tuple[List[array.array], bytes, int], where each trace is an array('I') of
+// frame ids, outermost frame first. line_type(filename, lineno) is only called
+// once per call for each distinct line.
+PyObject *ReadAllRawTraces(int fd, off_t start, off_t end,
+                           PyObject *line_type, PyObject *frames,
+                           PyObject *frame_ids, PyObject *filenames);
 
 ///////////////////////////////////////////////////////////////////////////////
 // .hpd files: the raw log of events.
@@ -44,35 +117,126 @@ const uint32_t kDeltaIsNegative = 0x80000000;
 const uint32_t kOperationIsFree = 0x40000000;
 const uint32_t kHighBits = (kDeltaIsNegative | kOperationIsFree);
 
-// Write a single heap event to the indicated file descriptor. last_clock is the
-// clock value of the previous event written; it will be updated by this method.
-// alloc is true for an allocation, or false for a free.
-void WriteEvent(int fd, struct timespec *last_clock,
+// Every so often, the profiler also writes a checkpoint, which records the
+// absolute clock, so that readers can start decoding from there rather than
+// from the start of the file. A checkpoint starts with an index word that no
+// event can have, because its trace index is never assigned, followed by a
+// magic number so that readers can make sure they really are at one.
+const uint32_t kCheckpointWord = 0xffffffff;
+// The largest trace index which may be assigned to a trace.
+const uint32_t kMaxTraceIndex = (kCheckpointWord & ~kHighBits) - 1;
+
+// Write a single heap event to the indicated output. last_clock is the clock
+// value of the previous event written; it will be updated by this method.
+// alloc is true for an allocation, or false for a free. Returns false, having
+// written nothing, if there was no room in the output.
+bool WriteEvent(BufferedWriter *out, struct timespec *last_clock,
                 const struct timespec &timestamp, uint32_t traceindex,
                 size_t size, bool alloc);
 
+// Write a checkpoint to the indicated output. clock should be the value of
+// last_clock after the last call to WriteEvent, since the next event's time
+// will be relative to it. Returns false, having written nothing, if there was
+// no room in the output.
+bool WriteCheckpoint(BufferedWriter *out, const struct timespec &clock);
+
 // Read a single heap event from the given file descriptor, given a value for
 // the timestamp of the previous event. Returns either a tuple (double
 // delta-time, int traceindex, int size), or nullptr + raises an EOFError.
+// Checkpoints are skipped.
 PyObject *ReadEvent(int fd);
 
+// The factors by which to multiply the sizes of events to account for
+// sampling, exactly as HPM.scaleFactor() computes them.
+struct EventScaling {
+  // (max size, factor) pairs, sorted by max size. An event of size N has the
+  // factor of the first pair whose max size is greater than N, or 1 if there
+  // is none.
+  std::vector<std::pair<uint64_t, double>> factors;
+  // If nonzero, the profile used interval sampling, and factors is unused.
+  uint64_t sampling_interval = 0;
+
+  double operator()(uint64_t size) const;
+};
+
+// Read up to max_count heap events from the given file descriptor, in one go.
+// The time of the first one is elapsed seconds after base_time, plus its
+// delta-time. Returns a tuple (float elapsed, bytes timestamps, bytes
+// traceindices, bytes sizes, bytes scale_factors), where elapsed is the value
+// to pass in for the next batch, and the others are packed arrays of doubles,
+// uint32s, int64s, and doubles, with one entry per event. Checkpoints are
+// skipped. At the end of the file, the arrays are shorter (possibly empty); if
+// the file ends partway through an event, as it can while a profiler is still
+// writing it, the file is left positioned at the start of that event. Returns
+// nullptr and sets an exception if the file is corrupt.
+PyObject *ReadEvents(int fd, size_t max_count, double base_time,
+                     double elapsed, const EventScaling &scaling);
+
+// Read a checkpoint from the given file descriptor, which must be positioned
+// at one. Returns its clock as a float, or nullptr + raises a ValueError if
+// there's no checkpoint there.
+PyObject *ReadCheckpoint(int fd);
+
+///////////////////////////////////////////////////////////////////////////////
+// .hpi files: an index of the checkpoints in an .hpd file.
+// This is written when profiling stops, so that readers can find the part of
+// the .hpd file they want without reading all of it. Profiles which didn't stop
+// cleanly don't have one, but their .hpd files are still perfectly readable,
+// just not as quickly.
+
+struct Checkpoint {
+  struct timespec clock;
+  // The offset of the checkpoint in the .hpd file.
+  off_t offset;
+};
+
+// Write a .hpi file to the given output.
+void WriteCheckpointIndex(BufferedWriter *out,
+                          const std::vector<Checkpoint> &checkpoints);
+
+// Read a .hpi file. Returns a List[Tuple[float, int]] of the clock and .hpd
+// file offset of each checkpoint, in order, or nullptr + raises an exception.
+PyObject *ReadCheckpointIndex(int fd);
+
 ///////////////////////////////////////////////////////////////////////////////
 // .hpc files: a digested version of an .hpd file.
 // This file is created after profiling is over; it combines the events in an
 // .hpd file into a sequence of time snapshots, which can be random-accessed.
 
-// Read filebase.hpd and create filebase.hpc.
-bool MakeDigestFile(const char *filebase, int interval_msec, double precision,
-                    bool verbose);
+// Read filebase.hpd and create filebase.hpc. If jobs > 1, the work is split
+// across that many threads; the output is the same either way. Each of
+// level_intervals_msec, which must be multiples of interval_msec, adds a
+// coarser level to the digest, in filebase.1.hpc, filebase.2.hpc, and so on.
+bool MakeDigestFile(const char *filebase, int interval_msec,
+                    const std::vector<int> &level_intervals_msec,
+                    double precision, bool verbose, int jobs);
+
+// Bring an existing filebase.hpc up to date with filebase.hpd, reading only the
+// events which were appended since the digest was made or last updated. The
+// result is the same as MakeDigestFile with the original settings would give.
+bool UpdateDigestFile(const char *filebase, bool verbose, int jobs);
 
 // Read the metadata and index from a .hpc file. Returns a
-// Tuple[float, float, List[int]], giving the initial time, the time delta
-// between frames, and a list of byte offsets for each frame in the file.
+// Tuple[float, float, bytes, List[float], Optional[Tuple[int, int]],
+//       Dict[int, Tuple[int, int]], int],
+// giving the initial time, the time delta between frames, the byte offsets of
+// each frame in the file (as packed int64s), the time deltas of the coarser
+// levels of the digest, if any, the (offset, length) of the series of total
+// bytes and of the series of each trace index, and the offset of the index. The
+// series are None and {} if the file has none, as with the coarser levels.
 PyObject *ReadDigestMetadata(int fd);
 
-// Read a single snapshot from a digest. The offset is one of the entries in the
-// list given in the metadata. The result is a dict from trace index to number
-// of live bytes at that instant.
-PyObject *ReadDigestEntry(int fd, Py_ssize_t offset);
+// Read one series from a digest, given its (offset, length) from the metadata.
+// The result is a List[Tuple[int, int]] of (snapshot index, bytes) pairs, one
+// for each snapshot at which the value changed.
+PyObject *ReadDigestSeries(int fd, Py_ssize_t offset, Py_ssize_t length);
+
+// Read the snapshots start, start + step, ... (up to but not including stop)
+// from a digest, whose contents are data and whose snapshot offsets (as given
+// in the metadata) are offsets. They're decoded without the GIL. The result is
+// a list of dicts from trace index to number of live bytes at that instant.
+PyObject *ReadDigestEntries(const uint8_t *data, size_t size,
+                            const int64_t *offsets, Py_ssize_t num_offsets,
+                            Py_ssize_t start, Py_ssize_t stop, Py_ssize_t step);
 
 #endif  // _HEAPPROF_FILE_FORMAT_H__
@@ -0,0 +1,150 @@
+#include "_heapprof/file_reader.h"
+#include <algorithm>
+#include <string>
+
+FileReader::FileReader(int fd, size_t max_buffer_size)
+    : fd_(fd),
+      max_buffer_size_(std::max(max_buffer_size, kInitialBufferSize)),
+      buffer_offset_(lseek(fd, 0, SEEK_CUR)) {}
+
+FileReader::~FileReader() {
+  // Give back whatever we read ahead but didn't use.
+  if (end_ != 0) {
+    lseek(fd_, offset(), SEEK_SET);
+  }
+}
+
+bool FileReader::Seek(off_t offset) {
+  if (offset < 0) {
+    PyErr_Format(PyExc_ValueError, "Invalid file offset %zd",
+                 static_cast<Py_ssize_t>(offset));
+    return false;
+  }
+  // If it's already buffered, we don't need to touch the file at all.
+  if (offset >= buffer_offset_ &&
+      offset <= buffer_offset_ + static_cast<off_t>(end_)) {
+    pos_ = offset - buffer_offset_;
+    return true;
+  }
+  if (lseek(fd_, offset, SEEK_SET) != offset) {
+    PyErr_Format(PyExc_ValueError, "Invalid file offset %zd",
+                 static_cast<Py_ssize_t>(offset));
+    return false;
+  }
+  buffer_offset_ = offset;
+  pos_ = end_ = 0;
+  return true;
+}
+
+bool FileReader::Refill(size_t size) {
+  // Move whatever is left to the start of the buffer.
+  const size_t remaining = end_ - pos_;
+  if (pos_ != 0) {
+    memmove(buffer_.data(), buffer_.data() + pos_, remaining);
+    buffer_offset_ += pos_;
+    pos_ = 0;
+    end_ = remaining;
+  }
+
+  // Every refill doubles the buffer, until it hits the maximum size; and it
+  // always has to be big enough to hold what was asked for.
+  size_t capacity = buffer_.empty()
+                        ? kInitialBufferSize
+                        : std::min(2 * buffer_.size(), max_buffer_size_);
+  capacity = std::max({capacity, buffer_.size(), size});
+  if (capacity != buffer_.size()) {
+    buffer_.resize(capacity);
+  }
+
+  while (end_ < buffer_.size()) {
+    const ssize_t bytes_read =
+        read(fd_, buffer_.data() + end_, buffer_.size() - end_);
+    if (bytes_read <= 0) {
+      break;
+    }
+    end_ += bytes_read;
+    // Don't wait for a full buffer, though: if the file is still being written
+    // (or is a pipe), the rest may never come.
+    if (end_ >= size) {
+      break;
+    }
+  }
+  return end_ >= size;
+}
+
+bool FileReader::ReadVarintSlow(uint64_t *value) {
+  // We might be near the end of the file, so there's no guarantee that we can
+  // get a whole maximum-length varint; decode carefully.
+  Fill(kMaxVarintSize);
+  const uint8_t *data = buffer_.data() + pos_;
+  const size_t available = end_ - pos_;
+  uint64_t result = 0;
+  for (size_t i = 0; i < available && i < kMaxVarintSize; ++i) {
+    result |= static_cast<uint64_t>(data[i] & 0x7f) << (7 * i);
+    if (!(data[i] & 0x80)) {
+      *value = result;
+      pos_ += i + 1;
+      return true;
+    }
+  }
+  if (available >= kMaxVarintSize) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Found a varint which could not decode into a uint64");
+  } else {
+    PyErr_SetString(PyExc_EOFError, "");
+  }
+  return false;
+}
+
+bool FileReader::ReadFixed64(uint64_t *value) {
+  if (!Fill(sizeof(uint64_t))) {
+    PyErr_SetString(PyExc_EOFError, "");
+    return false;
+  }
+  memcpy(value, buffer_.data() + pos_, sizeof(uint64_t));
+  *value = absl::gntohll(*value);
+  pos_ += sizeof(uint64_t);
+  return true;
+}
+
+PyObject *FileReader::ReadString() {
+  uint64_t len;
+  if (!ReadVarint(&len)) {
+    // Exception already set.
+    return nullptr;
+  }
+  // Something this long can only come from a corrupt file, and we don't want
+  // to try to allocate a buffer for it.
+  if (len > kMaxStringSize) {
+    PyErr_Format(PyExc_ValueError, "Invalid string length %zu",
+                 static_cast<size_t>(len));
+    return nullptr;
+  }
+  if (!Fill(len)) {
+    PyErr_SetString(PyExc_EOFError, "");
+    return nullptr;
+  }
+  const char *data = reinterpret_cast<const char *>(buffer_.data() + pos_);
+  pos_ += len;
+  return PyUnicode_DecodeUTF8(data, static_cast<Py_ssize_t>(len), "strict");
+}
+
+bool FileReader::ReadBytes(std::string *value) {
+  uint64_t len;
+  if (!ReadVarint(&len)) {
+    // Exception already set.
+    return false;
+  }
+  if (len > kMaxStringSize) {
+    PyErr_Format(PyExc_ValueError, "Invalid string length %zu",
+                 static_cast<size_t>(len));
+    return false;
+  }
+  if (!Fill(len)) {
+    PyErr_SetString(PyExc_EOFError, "");
+    return false;
+  }
+  value->assign(reinterpret_cast<const char *>(buffer_.data() + pos_), len);
+  pos_ += len;
+  return true;
+}
@@ -0,0 +1,119 @@
+#ifndef _HEAPPROF_FILE_READER_H__
+#define _HEAPPROF_FILE_READER_H__
+
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+#include <string>
+#include <vector>
+#include "Python.h"
+#include "_heapprof/port.h"
+#include "_heapprof/util.h"
+
+// A FileReader decodes values from a file descriptor through an in-memory
+// buffer. This is the read-side counterpart of BufferedWriter: the files we
+// read are made almost entirely of tiny varints, and reading them a few bytes
+// at a time (with an lseek() to put back whatever we over-read) costs several
+// syscalls per event, which was what limited the digester's throughput. Here,
+// data is read in blocks, and values are decoded straight out of memory.
+//
+// The buffer starts small and doubles each time it runs dry, up to
+// max_buffer_size. That way, callers which only decode a single record (like
+// readEvent, called once per event from Python) pay for a single small read,
+// while callers which read an entire file quickly work up to large block reads.
+//
+// We use read() rather than mmap() so that the same code works on every
+// platform, and on files which are still being written by a running profiler.
+//
+// The reader shares the file descriptor's offset: it starts wherever the
+// descriptor is positioned, and when it is destroyed, it puts the descriptor's
+// offset just past the last byte it decoded, so that callers (notably Python
+// code holding the same file open) can pick up exactly where it left off.
+//
+// All of the Read methods set the Python exception whenever they return false:
+// EOFError if the file ran out, or ValueError if the data was malformed.
+//
+// This class is thread-compatible, but not thread-safe.
+class FileReader {
+ public:
+  explicit FileReader(int fd, size_t max_buffer_size = kDefaultMaxBufferSize);
+  ~FileReader();
+
+  FileReader(const FileReader &) = delete;
+  FileReader &operator=(const FileReader &) = delete;
+
+  // The file offset of the next byte to be decoded.
+  off_t offset() const { return buffer_offset_ + pos_; }
+
+  // Move to an absolute file offset. Returns false, and sets a ValueError, if
+  // that isn't a valid offset.
+  bool Seek(off_t offset);
+
+  // Read single values, in the encodings written by BufferedWriter.
+  inline bool ReadVarint(uint64_t *value);
+  inline bool ReadFixed32(uint32_t *value);
+  bool ReadFixed64(uint64_t *value);
+  // Read a varint length followed by that many bytes of UTF-8. Returns a new
+  // reference on success, or nullptr with the exception set.
+  PyObject *ReadString();
+  // Likewise, but into a C++ string, without decoding it.
+  bool ReadBytes(std::string *value);
+
+  static const size_t kDefaultMaxBufferSize = 1 << 20;
+
+ private:
+  // Make sure at least size bytes are buffered past pos_, reading more of the
+  // file if need be. Returns false (but does *not* set the exception) if the
+  // file ends first; whatever was available is still buffered.
+  bool Fill(size_t size) {
+    return PREDICT_TRUE(end_ - pos_ >= size) || Refill(size);
+  }
+  // The part of Fill() which actually reads.
+  bool Refill(size_t size);
+
+  // The slow path of ReadVarint, for when a maximum-length varint might run
+  // past the end of the buffer.
+  bool ReadVarintSlow(uint64_t *value);
+
+  static const size_t kInitialBufferSize = 256;
+  static const size_t kMaxVarintSize = MAX_UNSIGNED_VARINT_SIZE(uint64_t);
+  // The longest string ReadString or ReadBytes will accept.
+  static const uint64_t kMaxStringSize = 1 << 24;
+
+  const int fd_;
+  const size_t max_buffer_size_;
+  std::vector<uint8_t> buffer_;
+  // The file offset of buffer_[0].
+  off_t buffer_offset_;
+  // The next byte to decode, and the end of valid data, as indices in buffer_.
+  size_t pos_ = 0;
+  size_t end_ = 0;
+};
+
+// Inline because these are called several times per event.
+inline bool FileReader::ReadVarint(uint64_t *value) {
+  if (PREDICT_FALSE(end_ - pos_ < kMaxVarintSize)) {
+    return ReadVarintSlow(value);
+  }
+  const uint8_t *p = buffer_.data() + pos_;
+  if (PREDICT_FALSE(!UnsafeDecodeVarint(&p, value))) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Found a varint which could not decode into a uint64");
+    return false;
+  }
+  pos_ = p - buffer_.data();
+  return true;
+}
+
+inline bool FileReader::ReadFixed32(uint32_t *value) {
+  if (PREDICT_FALSE(!Fill(sizeof(uint32_t)))) {
+    PyErr_SetString(PyExc_EOFError, "");
+    return false;
+  }
+  memcpy(value, buffer_.data() + pos_, sizeof(uint32_t));
+  *value = absl::gntohl(*value);
+  pos_ += sizeof(uint32_t);
+  return true;
+}
+
+#endif  // _HEAPPROF_FILE_READER_H__
@@ -0,0 +1,190 @@
+#ifndef _HEAPPROF_FLAT_MAP_H__
+#define _HEAPPROF_FLAT_MAP_H__
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+// A FlatMap is a hash map purpose-built for the profiler's hot-path tables: the
+// set of live sampled pointers, and the map from tracefp to trace index.
+//
+// std::unordered_map is node-based, so every insert costs a call to malloc (and
+// every erase a call to free), and every entry costs a node -- pointer, key,
+// value, and allocator overhead -- plus a bucket pointer. When you're tracking
+// millions of live pointers, that adds up to a lot of memory and a lot of time
+// spent inside the hooks. FlatMap instead keeps its entries inline in a single
+// flat array, using open addressing with linear probing, so a lookup is usually
+// a single cache miss and inserts and erases never allocate (except to grow).
+// Deletion uses backward shifting rather than tombstones, so the table never
+// fills up with dead entries, no matter how much churn there is.
+//
+// The restrictions which make this simple:
+// * Key must be an integer or pointer type, and Key() (i.e., zero or nullptr)
+//   is reserved to mean "empty slot," so it can't be used as a key: Find and
+//   Take treat it as absent, and Insert refuses it.
+// * Key and Value must be trivially copyable.
+// * Pointers to values are invalidated by any insert or erase.
+//
+// Memory comes from the C allocator, never the Python one; see profiler.h.
+//
+// This class is thread-compatible, but not thread-safe.
+template <typename Key, typename Value>
+class FlatMap {
+ public:
+  FlatMap() {}
+  ~FlatMap() { free(slots_); }
+  FlatMap(const FlatMap &) = delete;
+  FlatMap &operator=(const FlatMap &) = delete;
+
+  // Find the value for a key, or return nullptr if it isn't present.
+  Value *Find(Key key) {
+    if (slots_ == nullptr || key == Key()) {
+      return nullptr;
+    }
+    for (size_t i = Home(key);; i = (i + 1) & mask_) {
+      if (slots_[i].key == key) {
+        return &slots_[i].value;
+      } else if (slots_[i].key == Key()) {
+        return nullptr;
+      }
+    }
+  }
+
+  // Set the value for a key, replacing any existing value. This fails (and
+  // returns false) if key is Key(), or if we need to grow the table and can't
+  // allocate the memory to do so.
+  bool Insert(Key key, const Value &value) {
+    if (key == Key()) {
+      return false;
+    }
+    if ((size_ + 1) * kMaxLoadDenominator > capacity() * kMaxLoadNumerator &&
+        !Grow()) {
+      return false;
+    }
+    size_t i = Home(key);
+    while (slots_[i].key != key && slots_[i].key != Key()) {
+      i = (i + 1) & mask_;
+    }
+    if (slots_[i].key == Key()) {
+      slots_[i].key = key;
+      ++size_;
+    }
+    slots_[i].value = value;
+    return true;
+  }
+
+  // Remove a key, storing its value in *value. Returns false if it wasn't
+  // present.
+  bool Take(Key key, Value *value) {
+    if (slots_ == nullptr || key == Key()) {
+      return false;
+    }
+    size_t i = Home(key);
+    while (slots_[i].key != key) {
+      if (slots_[i].key == Key()) {
+        return false;
+      }
+      i = (i + 1) & mask_;
+    }
+    *value = slots_[i].value;
+    EraseSlot(i);
+    return true;
+  }
+
+  // Remove a key, if it's present.
+  void Erase(Key key) {
+    Value ignored;
+    Take(key, &ignored);
+  }
+
+  size_t size() const { return size_; }
+
+  // The number of bytes of memory used by this map, not counting the object
+  // itself.
+  size_t memory_usage() const { return capacity() * sizeof(Slot); }
+
+ private:
+  struct Slot {
+    Key key;
+    Value value;
+  };
+
+  size_t capacity() const { return slots_ == nullptr ? 0 : mask_ + 1; }
+
+  // The slot at which we start probing for key. This is Fibonacci hashing,
+  // which takes the high bits of a multiplicative hash; that means that keys
+  // whose low bits are always the same (like aligned pointers) still spread
+  // out nicely.
+  size_t Home(Key key) const {
+    return static_cast<size_t>((KeyBits(key) * 0x9E3779B97F4A7C15ULL) >>
+                               shift_);
+  }
+
+  static uint64_t KeyBits(const void *key) {
+    return static_cast<uint64_t>(reinterpret_cast<uintptr_t>(key));
+  }
+  static uint64_t KeyBits(uint64_t key) { return key; }
+
+  // Empty slot i, shifting back any entries after it which would otherwise
+  // become unreachable.
+  void EraseSlot(size_t i) {
+    for (size_t j = (i + 1) & mask_; slots_[j].key != Key();
+         j = (j + 1) & mask_) {
+      // The entry at j can move back to i iff i lies between its home slot and
+      // j, i.e., it's no further from j than its home is.
+      const size_t home = Home(slots_[j].key);
+      if (((j - home) & mask_) >= ((j - i) & mask_)) {
+        slots_[i] = slots_[j];
+        i = j;
+      }
+    }
+    slots_[i].key = Key();
+    --size_;
+  }
+
+  // Double the table's capacity.
+  bool Grow() {
+    const size_t old_capacity = capacity();
+    const size_t new_capacity =
+        old_capacity == 0 ? kInitialCapacity : 2 * old_capacity;
+    // NB that calloc conveniently fills everything with empty keys.
+    Slot *new_slots =
+        reinterpret_cast<Slot *>(calloc(new_capacity, sizeof(Slot)));
+    if (new_slots == nullptr) {
+      return false;
+    }
+
+    Slot *old_slots = slots_;
+    slots_ = new_slots;
+    mask_ = new_capacity - 1;
+    shift_ = 64;
+    for (size_t c = new_capacity; c > 1; c >>= 1) {
+      --shift_;
+    }
+    for (size_t i = 0; i < old_capacity; ++i) {
+      if (old_slots[i].key != Key()) {
+        size_t j = Home(old_slots[i].key);
+        while (slots_[j].key != Key()) {
+          j = (j + 1) & mask_;
+        }
+        slots_[j] = old_slots[i];
+      }
+    }
+    free(old_slots);
+    return true;
+  }
+
+  // Must be a power of two.
+  static const size_t kInitialCapacity = 1024;
+  // Linear probing gets slow quickly above about 3/4 full.
+  static const size_t kMaxLoadNumerator = 3;
+  static const size_t kMaxLoadDenominator = 4;
+
+  Slot *slots_ = nullptr;
+  // capacity() - 1, and 64 - log2(capacity()).
+  size_t mask_ = 0;
+  int shift_ = 64;
+  size_t size_ = 0;
+};
+
+#endif  // _HEAPPROF_FLAT_MAP_H__
@@ -0,0 +1,86 @@
+#include "_heapprof/frame_filter.h"
+#include <string>
+#include <vector>
+#include "_heapprof/scoped_object.h"
+
+FrameFilter::FrameFilter(Py_ssize_t max_depth, PyObject *include,
+                         PyObject *exclude)
+    : cache_(kCacheSize, CacheEntry{nullptr, nullptr, false}) {
+  if (max_depth < 0) {
+    PyErr_Format(PyExc_ValueError,
+                 "%zd is not a valid maximum stack depth; it must be a "
+                 "positive number of frames.",
+                 max_depth);
+    return;
+  }
+  if (max_depth > 0) {
+    max_depth_ = max_depth;
+  }
+  if (!ParsePrefixes(include, "includePrefixes", &include_) ||
+      !ParsePrefixes(exclude, "excludePrefixes", &exclude_)) {
+    return;
+  }
+  ok_ = true;
+}
+
+bool FrameFilter::ParsePrefixes(PyObject *prefixes, const char *name,
+                                std::vector<std::string> *out) {
+  if (prefixes == Py_None) {
+    return true;
+  }
+  ScopedObject seq(PySequence_Fast(prefixes, ""));
+  if (!seq || PyUnicode_Check(prefixes)) {
+    // A bare string is a sequence, but certainly not the one we want.
+    PyErr_Format(PyExc_TypeError, "%s is not a List[str]", name);
+    return false;
+  }
+  for (Py_ssize_t i = 0, len = PySequence_Fast_GET_SIZE(seq.get()); i < len;
+       ++i) {
+    PyObject *item = PySequence_Fast_GET_ITEM(seq.get(), i);
+    if (!PyUnicode_Check(item)) {
+      PyErr_Format(PyExc_TypeError, "%s is not a List[str]", name);
+      return false;
+    }
+    Py_ssize_t size;
+    const char *prefix = PyUnicode_AsUTF8AndSize(item, &size);
+    if (prefix == nullptr) {
+      // Exception already set.
+      return false;
+    }
+    out->emplace_back(prefix, size);
+  }
+  return true;
+}
+
+static bool HasAnyPrefix(const char *filename, size_t len,
+                         const std::vector<std::string> &prefixes) {
+  for (const std::string &prefix : prefixes) {
+    if (prefix.size() <= len &&
+        prefix.compare(0, prefix.size(), filename, prefix.size()) == 0) {
+      return true;
+    }
+  }
+  return false;
+}
+
+bool FrameFilter::SkipUncached(const PyCodeObject *code) const {
+  // If the filename begins with a <, this is an internal frame and we should
+  // ignore it because these make the frames illegible.
+  if (PyUnicode_READ_CHAR(code->co_filename, 0) == 0x3c) {
+    return true;
+  }
+  if (include_.empty() && exclude_.empty()) {
+    return false;
+  }
+
+  Py_ssize_t len;
+  const char *filename = PyUnicode_AsUTF8AndSize(code->co_filename, &len);
+  if (filename == nullptr) {
+    // We're in the middle of someone else's malloc, so there's nobody to
+    // report this to; just keep the frame, and let WriteRawTrace deal with it.
+    PyErr_Clear();
+    return false;
+  }
+  return (!include_.empty() && !HasAnyPrefix(filename, len, include_)) ||
+         HasAnyPrefix(filename, len, exclude_);
+}
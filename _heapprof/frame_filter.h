@@ -0,0 +1,91 @@
+#ifndef _HEAPPROF_FRAME_FILTER_H__
+#define _HEAPPROF_FRAME_FILTER_H__
+
+#include <stddef.h>
+#include <stdint.h>
+#include <string>
+#include <vector>
+#include "Python.h"
+#include "_heapprof/port.h"
+#include "frameobject.h"
+
+// A FrameFilter decides which frames of a Python stack get recorded in stack
+// traces, and how many of them.
+//
+// Frames whose filenames begin with '<' are internal (e.g. <frozen
+// importlib._bootstrap>) and are always skipped, because they make traces
+// illegible. Beyond that, the user can give lists of filename prefixes to
+// include and to exclude: if there are any include prefixes, only frames whose
+// filenames start with one of them are recorded, and frames whose filenames
+// start with an exclude prefix never are. Finally, if there's a maximum depth,
+// only that many of the innermost recorded frames are kept; a trace which lost
+// frames this way ends in a truncation marker (see WriteRawTrace).
+//
+// Matching filenames against prefixes is far too slow to do for every frame of
+// every sample, so the decision is cached per code object.
+//
+// This class is thread-compatible, but not thread-safe.
+class FrameFilter {
+ public:
+  // Construct a new FrameFilter. max_depth is the maximum number of frames to
+  // record, or zero for no limit. include and exclude must be sequences of
+  // strings; either may be None.
+  FrameFilter(Py_ssize_t max_depth, PyObject *include, PyObject *exclude);
+  ~FrameFilter() {}
+
+  // Tests validity after construction. If this is false, the Python exception
+  // has been set.
+  bool ok() const { return ok_; }
+
+  // Check if a certain stack frame should be left out of stack traces.
+  inline bool Skip(const PyFrameObject *pyframe);
+
+  // The maximum number of frames to record in a trace; never zero.
+  size_t max_depth() const { return max_depth_; }
+
+ private:
+  struct CacheEntry {
+    const PyCodeObject *code;
+    // Checked along with the code object, in case the code object was freed
+    // and something new allocated at the same address.
+    const PyObject *filename;
+    bool skip;
+  };
+
+  // Skip(), without the cache: actually match a code object's filename
+  // against our rules.
+  bool SkipUncached(const PyCodeObject *code) const;
+
+  // Parse a sequence of prefixes into out. Returns false (and sets the
+  // exception) on error.
+  static bool ParsePrefixes(PyObject *prefixes, const char *name,
+                            std::vector<std::string> *out);
+
+  size_t max_depth_ = SIZE_MAX;
+  // The prefixes, as UTF-8.
+  std::vector<std::string> include_;
+  std::vector<std::string> exclude_;
+
+  // A direct-mapped cache from code object to decision.
+  static const size_t kCacheSize = 1024;
+  std::vector<CacheEntry> cache_;
+
+  bool ok_ = false;
+};
+
+// Inline because this is called for every frame of every sample.
+inline bool FrameFilter::Skip(const PyFrameObject *pyframe) {
+  const PyCodeObject *code = pyframe->f_code;
+  // The low bits of an object pointer are always zero.
+  CacheEntry &entry =
+      cache_[(reinterpret_cast<uintptr_t>(code) >> 4) % kCacheSize];
+  if (PREDICT_FALSE(entry.code != code ||
+                    entry.filename != code->co_filename)) {
+    entry.code = code;
+    entry.filename = code->co_filename;
+    entry.skip = SkipUncached(code);
+  }
+  return entry.skip;
+}
+
+#endif  // _HEAPPROF_FRAME_FILTER_H__
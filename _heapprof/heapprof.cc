@@ -1,16 +1,26 @@
+#include <limits.h>
+#include <map>
 #include <memory>
+#include <string>
+#include <vector>
 #include "Python.h"
 #include "_heapprof/file_format.h"
+#include "_heapprof/frame_filter.h"
 #include "_heapprof/malloc_patch.h"
 #include "_heapprof/profiler.h"
 #include "_heapprof/sampler.h"
+#include "_heapprof/scoped_object.h"
 #include "_heapprof/stats_gatherer.h"
 
 // This file defines the _heapprof Python module, which is the outer interface
 // between the Python and C++ layers. _heapprof contains these functions:
 //
-// _heapprof.startProfiler(filebase: str, samplingRate: Dict[int, float]]) ->
-// None
+// _heapprof.startProfiler(filebase: str, samplingRate: Dict[int, float]],
+//                         samplingInterval: int, bufferSize: int,
+//                         flushIntervalMsec: int, backgroundFlush: bool,
+//                         maxStackDepth: int,
+//                         includePrefixes: Optional[List[str]],
+//                         excludePrefixes: Optional[List[str]]) -> None
 //    Starts heap profiling, writing the outputs to filebase.hpm and
 //    filebase.hpd. It is an error to call this if heap profiling is already
 //    running. Implemented in HeapProfStart().
@@ -26,6 +36,21 @@
 //        bytes, the sampling rate applied is that given for the next byte size
 //        > X (if one such exists), or 100% if it is greater than all keys in
 //        the dictionary.
+//      samplingInterval: If positive, ignore samplingRate (which must be
+//        empty) and instead sample allocations once every this many bytes, on
+//        average.
+//      bufferSize: The size, in bytes, of the in-memory buffer used for each
+//        of the output files.
+//      flushIntervalMsec: If positive, the buffers are also flushed to disk
+//        whenever this many milliseconds have passed since their last flush.
+//      backgroundFlush: If true, buffers are written to disk by a separate
+//        native thread, and events are dropped (and counted) rather than
+//        waiting for that thread if it falls behind.
+//      maxStackDepth: If positive, record only this many of the innermost
+//        frames of each stack trace, followed by a truncation marker.
+//      includePrefixes, excludePrefixes: If given, record only frames whose
+//        filenames start with one of includePrefixes, and none whose
+//        filenames start with one of excludePrefixes.
 //
 // _heapprof.startStats() -> None
 //    Starts heap profiling in stats-gathering mode. This will print a
@@ -41,45 +66,158 @@
 //    Returns True iff profiling is currently running.
 //    Implemented in HeapProfIsProfiling().
 //
+// _heapprof.profilerStats() -> Optional[Dict[str, int]]
+//    Returns statistics about the running profiler itself, such as how much
+//    memory it's using, or None if profiling isn't running.
+//    Implemented in HeapProfProfilerStats().
+//
 // _heapprof.readEvent(fd: int) -> Optional[Tuple[float, int, int]]
 //    Try to read a single event from an .hpd file open at the given file
 //    descriptor. Either returns a tuple (delta-t, traceindex, signed size) or
-//    None to mark EOF.
+//    None to mark EOF. Checkpoints are skipped.
+//
+// _heapprof.readEvents(fd: int, maxCount: int, baseTime: float,
+//                      elapsed: float, scaleFactors: List[Tuple[int, float]],
+//                      samplingInterval: int)
+//    -> Tuple[float, bytes, bytes, bytes, bytes]
+//    Read up to maxCount events at once from an .hpd file open at the given
+//    file descriptor. The first event's time is baseTime + elapsed + its
+//    delta-t; scaleFactors and samplingInterval describe the sampling, as in
+//    HPM. Returns the elapsed time to pass to the next call, and the timestamps
+//    (doubles), traceindices (uint32s), signed sizes (int64s), and scale
+//    factors (doubles) of the events, packed in native byte order. Fewer than
+//    maxCount events means the end of the file was reached.
+//
+// _heapprof.readCheckpoint(fd: int) -> float
+//    Read a checkpoint from an .hpd file open at the given file descriptor,
+//    which must be positioned at one, and return its absolute time. The next
+//    event's delta-t is relative to that. Raises ValueError if there is no
+//    checkpoint there.
 //
-// _heapprof.readRawTrace(fd: int) -> List[Tuple[str, int]]
+// _heapprof.readCheckpointIndex(fd: int) -> List[Tuple[float, int]]
+//    Read a .hpi file open at the given file descriptor. Returns the absolute
+//    time and .hpd file offset of each checkpoint, in order.
+//
+// _heapprof.readRawTrace(fd: int, filenames: Optional[List[str]] = None)
+//    -> List[Tuple[str, int]]
 //    Try to read a single raw trace from an .hpm file open at the given file
 //    descriptor. Returns a list of (filename, lineno) pairs in "normal" trace
 //    order (i.e., top part of the trace first). May raise EOFError.
+//    filenames is the filename table which readMetadata returned; this and the
+//    other functions which read raw traces need it to decode files which have
+//    one, and append any new filenames they find to it.
+//
+// _heapprof.indexRawTraces(fd: int, start: int, end: int,
+//                          filenames: Optional[List[str]] = None)
+//    -> Tuple[bytes, int]
+//    Find the raw traces in an .hpm file which start at or after the offset
+//    start and before end (or the end of the file, if end is 0), without
+//    decoding them. Returns their offsets, packed as native uint64s, and the
+//    offset just past the last one. A trace which the file ends partway
+//    through is left out.
+//
+// _heapprof.readAllRawTraces(fd: int, start: int, end: int, lineType: type,
+//                            frames: List[lineType],
+//                            frameIds: Dict[lineType, int],
+//                            filenames: Optional[List[str]] = None)
+//    -> Tuple[List[array.array], bytes, int]
+//    Like indexRawTraces, but also decodes all the traces, in "normal" trace
+//    order. Each trace is an array('I') of frame ids: frames[id] is the line
+//    for an id, and frameIds maps it back again. Lines which aren't in frames
+//    yet are made by lineType(filename, lineno) and added to both.
 //
-// _heapprof.readMetadata(fd: int) -> Tuple[float, Dict[int, float]]
-//    Try to read the metadata header from a .hpm file. Returns (start time,
-//    sampling rate map) on success; may raise EOFError.
+// _heapprof.readMetadata(fd: int) ->
+//      Tuple[float, Dict[int, float], int, Dict[str, int], int,
+//            Optional[bytes], Optional[List[str]]]
+//    Try to read the metadata header and footer from a .hpm file. Returns
+//    (start time, sampling rate map, sampling interval, profiler stats, end of
+//    raw traces, raw trace offsets, filename table) on success; may raise
+//    EOFError. The
+//    sampling interval is zero unless the profile used interval sampling. If
+//    the file has no footer (because the profiler never stopped cleanly), the
+//    stats are empty and the end of the raw traces is given as 0, meaning
+//    "read until EOF." The raw trace offsets are the file offset of each raw
+//    trace, packed as native uint64s, or None if the footer doesn't list them.
+//    The filename table is None if the file is from before .hpm files had one;
+//    otherwise it's a list, which is empty if there's no footer.
 //
 // _heapprof.makeDigestFile(
 //      filebase: str,
 //      intervalMsec: int,
 //      precision: float,
-//      verbose: bool) -> None:
+//      verbose: bool,
+//      jobs: int,
+//      levelIntervalsMsec: List[int]) -> None:
 //    Build a .hpc file out of an .hpd file. intervalMsec is the duration
 //    between successive snapshots to write. precision is the fractional error
 //    we allow by dropping "tiny, boring" traces; setting it to zero means to
-//    keep everything.
+//    keep everything. jobs is the number of worker threads to use; if it's 1,
+//    everything happens on the calling thread. levelIntervalsMsec are the
+//    durations of any coarser levels to write at the same time; they must be
+//    increasing multiples of intervalMsec.
 //
-// _heapprof.readDigestMetadata(fd: int) -> Tuple[float, float, List[int]]:
+// _heapprof.updateDigestFile(filebase: str, verbose: bool, jobs: int) -> None:
+//    Extend an existing .hpc file with whatever events have been added to the
+//    .hpd file since it was made, using the same settings it was made with.
+//    Raises ValueError if the .hpc file can't be updated, e.g. because it was
+//    made by an older version of heapprof.
+//
+// _heapprof.readDigestMetadata(fd: int) -> Tuple[float, float, bytes,
+//                                               List[float], ...]:
 //    Read the metadata and index of a .hpc file. Returns
 //      float: initial time, in seconds since the epoch
 //      float: delta time between snapshots, in seconds
-//      List[int]: sorted list of byte offsets for the snapshots in the file
+//      bytes: the sorted byte offsets of the snapshots in the file, packed as
+//          an array of int64 in native byte order
+//      List[float]: delta times of the coarser levels of the digest, if any
+//      Optional[Tuple[int, int]]: (offset, length) of the series of total
+//          bytes, or None if the file has no series
+//      Dict[int, Tuple[int, int]]: traceindex -> (offset, length) of the
+//          series of that trace
+//      int: the offset of the index in the file
+//
+// _heapprof.readDigestEntries(data: buffer, offsets: buffer, start: int,
+//                             stop: int, step: int) -> List[Dict[int, int]]:
+//    Read the snapshots in range(start, stop, step), where data is the
+//    contents of a .hpc file (e.g. an mmap of it), offsets is the packed array
+//    of offsets from readDigestMetadata, and step is positive. Returns a dict
+//    from traceindex to number of bytes for each. They're decoded straight
+//    out of data, all at once, with the GIL released; this is much faster
+//    than reading them one at a time.
 //
-// _heapprof.readDigestEntry(fd: int, offset: int) -> Dict[int, int]:
-//    Read the snapshot at a given offset from the given file. Returns a dict
-//    from traceindex to number of bytes.
+// _heapprof.readDigestSeries(fd: int, offset: int, length: int)
+//    -> List[Tuple[int, int]]:
+//    Read the series at a given (offset, length) from the given file. Returns
+//    a list of (snapshot index, bytes) for each snapshot where bytes changed.
 
 static PyObject *HeapProfStart(PyObject *self, PyObject *args) {
   // NB: PyArg_ParseTuple raises a Py exception on error.
   const char *filebase;
   PyObject *sampling_rate;
-  if (!PyArg_ParseTuple(args, "sO", &filebase, &sampling_rate)) {
+  Py_ssize_t sampling_interval;
+  Py_ssize_t buffer_size;
+  int flush_interval_msec;
+  int background_flush;
+  Py_ssize_t max_stack_depth;
+  PyObject *include_prefixes;
+  PyObject *exclude_prefixes;
+  if (!PyArg_ParseTuple(args, "sOnnipnOO", &filebase, &sampling_rate,
+                        &sampling_interval, &buffer_size, &flush_interval_msec,
+                        &background_flush, &max_stack_depth,
+                        &include_prefixes, &exclude_prefixes)) {
+    return nullptr;
+  }
+  if (buffer_size <= 0) {
+    PyErr_Format(PyExc_ValueError,
+                 "Invalid buffer size %zd; must be a positive number of bytes.",
+                 buffer_size);
+    return nullptr;
+  }
+  if (flush_interval_msec < 0) {
+    PyErr_Format(PyExc_ValueError,
+                 "Invalid flush interval %d; must be a non-negative number of "
+                 "milliseconds.",
+                 flush_interval_msec);
     return nullptr;
   }
 
@@ -88,12 +226,20 @@ static PyObject *HeapProfStart(PyObject *self, PyObject *args) {
     return nullptr;
   }
 
-  std::unique_ptr<Sampler> sampler(new Sampler(sampling_rate));
+  std::unique_ptr<Sampler> sampler(new Sampler(sampling_rate, sampling_interval));
   if (!sampler->ok()) {
     return nullptr;
   }
 
-  std::unique_ptr<Profiler> profiler(new Profiler(filebase, sampler.release()));
+  std::unique_ptr<FrameFilter> filter(
+      new FrameFilter(max_stack_depth, include_prefixes, exclude_prefixes));
+  if (!filter->ok()) {
+    return nullptr;
+  }
+
+  std::unique_ptr<Profiler> profiler(new Profiler(
+      filebase, sampler.release(), filter.release(), buffer_size,
+      flush_interval_msec, background_flush));
   if (!profiler->ok()) {
     return nullptr;
   }
@@ -126,6 +272,26 @@ static PyObject *HeapProfIsProfiling(PyObject *self, PyObject *args) {
   }
 }
 
+static PyObject *HeapProfProfilerStats(PyObject *self, PyObject *args) {
+  std::map<std::string, uint64_t> stats;
+  if (!GetProfilerStats(&stats)) {
+    Py_RETURN_NONE;
+  }
+
+  ScopedObject result(PyDict_New());
+  if (!result) {
+    return nullptr;
+  }
+  for (const auto &stat : stats) {
+    ScopedObject value(PyLong_FromUnsignedLongLong(stat.second));
+    if (!value || PyDict_SetItemString(result.get(), stat.first.c_str(),
+                                       value.get()) == -1) {
+      return nullptr;
+    }
+  }
+  return result.release();
+}
+
 // _heapprof.readEvent(fd: int, lastTime: float) -> Optional[Tuple[float, int,
 // int]]
 static PyObject *HeapProfReadEvent(PyObject *self, PyObject *args) {
@@ -136,16 +302,133 @@ static PyObject *HeapProfReadEvent(PyObject *self, PyObject *args) {
   return ReadEvent(fd);
 }
 
-// _heapprof.readRawTrace(fd: int) -> List[Tuple[str, int]]
-static PyObject *HeapProfReadRawTrace(PyObject *self, PyObject *args) {
+// _heapprof.readEvents(fd: int, maxCount: int, baseTime: float,
+//                      elapsed: float, scaleFactors: List[Tuple[int, float]],
+//                      samplingInterval: int)
+//    -> Tuple[float, bytes, bytes, bytes, bytes]
+static PyObject *HeapProfReadEvents(PyObject *self, PyObject *args) {
+  int fd;
+  Py_ssize_t max_count;
+  double base_time;
+  double elapsed;
+  PyObject *py_scale_factors;
+  Py_ssize_t sampling_interval;
+  if (!PyArg_ParseTuple(args, "inddOn", &fd, &max_count, &base_time, &elapsed,
+                        &py_scale_factors, &sampling_interval)) {
+    return nullptr;
+  }
+  if (max_count < 0 || sampling_interval < 0) {
+    PyErr_SetString(PyExc_ValueError,
+                    "maxCount and samplingInterval must be nonnegative");
+    return nullptr;
+  }
+
+  ScopedObject scale_factors(
+      PySequence_Fast(py_scale_factors, "Scale factors must be a sequence"));
+  if (!scale_factors) {
+    return nullptr;
+  }
+  EventScaling scaling;
+  scaling.sampling_interval = sampling_interval;
+  for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(scale_factors.get());
+       ++i) {
+    Py_ssize_t max_size;
+    double factor;
+    if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(scale_factors.get(), i),
+                          "nd", &max_size, &factor)) {
+      return nullptr;
+    }
+    if (max_size < 0) {
+      PyErr_Format(PyExc_ValueError,
+                   "%zd is not a valid memory allocation size.", max_size);
+      return nullptr;
+    }
+    scaling.factors.emplace_back(max_size, factor);
+  }
+  return ReadEvents(fd, max_count, base_time, elapsed, scaling);
+}
+
+// _heapprof.readCheckpoint(fd: int) -> float
+static PyObject *HeapProfReadCheckpoint(PyObject *self, PyObject *args) {
+  int fd;
+  if (!PyArg_ParseTuple(args, "i", &fd)) {
+    return nullptr;
+  }
+  return ReadCheckpoint(fd);
+}
+
+// _heapprof.readCheckpointIndex(fd: int) -> List[Tuple[float, int]]
+static PyObject *HeapProfReadCheckpointIndex(PyObject *self, PyObject *args) {
   int fd;
   if (!PyArg_ParseTuple(args, "i", &fd)) {
     return nullptr;
   }
-  return ReadRawTrace(fd);
+  return ReadCheckpointIndex(fd);
 }
 
-// _heapprof.readMetadata(fd: int) -> Tuple[float, Dict[int, float]]
+// Check that a filename table argument is either None or a list. Returns false
+// and sets the exception if not.
+static bool CheckFilenames(PyObject *filenames) {
+  if (filenames != Py_None && !PyList_Check(filenames)) {
+    PyErr_SetString(PyExc_TypeError, "filenames must be a list or None");
+    return false;
+  }
+  return true;
+}
+
+// _heapprof.readRawTrace(fd: int, filenames: Optional[List[str]] = None)
+//    -> List[Tuple[str, int]]
+static PyObject *HeapProfReadRawTrace(PyObject *self, PyObject *args) {
+  int fd;
+  PyObject *filenames = Py_None;
+  if (!PyArg_ParseTuple(args, "i|O", &fd, &filenames) ||
+      !CheckFilenames(filenames)) {
+    return nullptr;
+  }
+  return ReadRawTrace(fd, filenames);
+}
+
+// _heapprof.indexRawTraces(fd: int, start: int, end: int,
+//                          filenames: Optional[List[str]] = None)
+//    -> Tuple[bytes, int]
+static PyObject *HeapProfIndexRawTraces(PyObject *self, PyObject *args) {
+  int fd;
+  Py_ssize_t start;
+  Py_ssize_t end;
+  PyObject *filenames = Py_None;
+  if (!PyArg_ParseTuple(args, "inn|O", &fd, &start, &end, &filenames) ||
+      !CheckFilenames(filenames)) {
+    return nullptr;
+  }
+  return IndexRawTraces(fd, start, end, filenames);
+}
+
+// _heapprof.readAllRawTraces(fd: int, start: int, end: int, lineType: type,
+//                            frames: List[lineType],
+//                            frameIds: Dict[lineType, int],
+//                            filenames: Optional[List[str]] = None)
+//    -> Tuple[List[array.array], bytes, int]
+static PyObject *HeapProfReadAllRawTraces(PyObject *self, PyObject *args) {
+  int fd;
+  Py_ssize_t start;
+  Py_ssize_t end;
+  PyObject *line_type;
+  PyObject *frames;
+  PyObject *frame_ids;
+  PyObject *filenames = Py_None;
+  if (!PyArg_ParseTuple(args, "innOO!O!|O", &fd, &start, &end, &line_type,
+                        &PyList_Type, &frames, &PyDict_Type, &frame_ids,
+                        &filenames) ||
+      !CheckFilenames(filenames)) {
+    return nullptr;
+  }
+  return ReadAllRawTraces(fd, start, end, line_type, frames, frame_ids,
+                          filenames);
+}
+
+// _heapprof.readMetadata(fd: int) -> Tuple[float, Dict[int, float], int,
+//                                         Dict[str, int], int,
+//                                         Optional[bytes], Optional[List[str]]]
 static PyObject *HeapProfReadMetadata(PyObject *self, PyObject *args) {
   int fd;
   if (!PyArg_ParseTuple(args, "i", &fd)) {
@@ -159,14 +442,17 @@ static PyObject *HeapProfMakeDigestFile(PyObject *self, PyObject *args) {
   int interval_msec;
   double precision;
   int verbose;
-  if (!PyArg_ParseTuple(args, "sidp", &filebase, &interval_msec, &precision,
-                        &verbose)) {
+  int jobs;
+  PyObject *py_level_intervals;
+  if (!PyArg_ParseTuple(args, "sidpiO", &filebase, &interval_msec, &precision,
+                        &verbose, &jobs, &py_level_intervals)) {
     return nullptr;
   }
-  if (interval_msec < 0) {
+  if (interval_msec <= 0) {
     PyErr_Format(
         PyExc_ValueError,
-        "Invalid interval %d; must be a positive number of milliseconds.\n");
+        "Invalid interval %d; must be a positive number of milliseconds.",
+        interval_msec);
     return nullptr;
   }
   if (precision < 0 || precision >= 1) {
@@ -174,7 +460,58 @@ static PyObject *HeapProfMakeDigestFile(PyObject *self, PyObject *args) {
                  "Invalid precision %f; must be a value in [0, 1).", precision);
     return nullptr;
   }
-  if (!MakeDigestFile(filebase, interval_msec, precision, verbose)) {
+  if (jobs < 1) {
+    PyErr_Format(PyExc_ValueError,
+                 "Invalid number of jobs %d; must be at least one.", jobs);
+    return nullptr;
+  }
+
+  ScopedObject levels(PySequence_Fast(py_level_intervals,
+                                      "Level intervals must be a sequence"));
+  if (!levels) {
+    return nullptr;
+  }
+  std::vector<int> level_intervals_msec;
+  for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(levels.get()); ++i) {
+    const Py_ssize_t level_msec =
+        PyLong_AsSsize_t(PySequence_Fast_GET_ITEM(levels.get(), i));
+    if (level_msec == -1 && PyErr_Occurred()) {
+      return nullptr;
+    }
+    const int last_msec = level_intervals_msec.empty()
+                              ? interval_msec
+                              : level_intervals_msec.back();
+    if (level_msec <= last_msec || level_msec > INT_MAX ||
+        level_msec % interval_msec != 0) {
+      PyErr_Format(PyExc_ValueError,
+                   "Invalid level interval %zd; must be a multiple of %d "
+                   "milliseconds, and greater than %d.",
+                   level_msec, interval_msec, last_msec);
+      return nullptr;
+    }
+    level_intervals_msec.push_back(level_msec);
+  }
+
+  if (!MakeDigestFile(filebase, interval_msec, level_intervals_msec, precision,
+                      verbose, jobs)) {
+    return nullptr;
+  }
+  Py_RETURN_NONE;
+}
+
+static PyObject *HeapProfUpdateDigestFile(PyObject *self, PyObject *args) {
+  const char *filebase;
+  int verbose;
+  int jobs;
+  if (!PyArg_ParseTuple(args, "spi", &filebase, &verbose, &jobs)) {
+    return nullptr;
+  }
+  if (jobs < 1) {
+    PyErr_Format(PyExc_ValueError,
+                 "Invalid number of jobs %d; must be at least one.", jobs);
+    return nullptr;
+  }
+  if (!UpdateDigestFile(filebase, verbose, jobs)) {
     return nullptr;
   }
   Py_RETURN_NONE;
@@ -188,13 +525,34 @@ static PyObject *HeapProfReadDigestMetadata(PyObject *self, PyObject *args) {
   return ReadDigestMetadata(fd);
 }
 
-static PyObject *HeapProfReadDigestEntry(PyObject *self, PyObject *args) {
+static PyObject *HeapProfReadDigestEntries(PyObject *self, PyObject *args) {
+  Py_buffer data;
+  Py_buffer offsets;
+  Py_ssize_t start;
+  Py_ssize_t stop;
+  Py_ssize_t step;
+  if (!PyArg_ParseTuple(args, "y*y*nnn", &data, &offsets, &start, &stop,
+                        &step)) {
+    return nullptr;
+  }
+  PyObject *result = ReadDigestEntries(
+      static_cast<const uint8_t *>(data.buf), data.len,
+      static_cast<const int64_t *>(offsets.buf),
+      offsets.len / static_cast<Py_ssize_t>(sizeof(int64_t)), start, stop,
+      step);
+  PyBuffer_Release(&offsets);
+  PyBuffer_Release(&data);
+  return result;
+}
+
+static PyObject *HeapProfReadDigestSeries(PyObject *self, PyObject *args) {
   int fd;
   Py_ssize_t offset;
-  if (!PyArg_ParseTuple(args, "in", &fd, &offset)) {
+  Py_ssize_t length;
+  if (!PyArg_ParseTuple(args, "inn", &fd, &offset, &length)) {
     return nullptr;
   }
-  return ReadDigestEntry(fd, offset);
+  return ReadDigestSeries(fd, offset, length);
 }
 
 PyDoc_STRVAR(module_doc, "Logging heap profiler");
@@ -207,18 +565,34 @@ static PyMethodDef module_methods[] = {
     {"stop", HeapProfStop, METH_VARARGS, "Stop the heap profiler"},
     {"isProfiling", HeapProfIsProfiling, METH_VARARGS,
      "Test if we are currently profiling"},
+    {"profilerStats", HeapProfProfilerStats, METH_VARARGS,
+     "Get statistics about the profiler itself"},
     {"readEvent", HeapProfReadEvent, METH_VARARGS,
      "Read an event from an hpd file"},
+    {"readEvents", HeapProfReadEvents, METH_VARARGS,
+     "Read a batch of events from an hpd file"},
+    {"readCheckpoint", HeapProfReadCheckpoint, METH_VARARGS,
+     "Read a checkpoint from an hpd file"},
+    {"readCheckpointIndex", HeapProfReadCheckpointIndex, METH_VARARGS,
+     "Read the index of checkpoints from an hpi file"},
     {"readRawTrace", HeapProfReadRawTrace, METH_VARARGS,
      "Read a raw stack trace from an hpm file"},
+    {"indexRawTraces", HeapProfIndexRawTraces, METH_VARARGS,
+     "Find the offsets of the raw stack traces in an hpm file"},
+    {"readAllRawTraces", HeapProfReadAllRawTraces, METH_VARARGS,
+     "Read all the raw stack traces from an hpm file at once"},
     {"readMetadata", HeapProfReadMetadata, METH_VARARGS,
      "Read the MD header from an hpm file"},
     {"makeDigestFile", HeapProfMakeDigestFile, METH_VARARGS,
      "Convert a .hpd file into a .hpc file"},
+    {"updateDigestFile", HeapProfUpdateDigestFile, METH_VARARGS,
+     "Bring a .hpc file up to date with its .hpd file"},
     {"readDigestMetadata", HeapProfReadDigestMetadata, METH_VARARGS,
      "Read the metadata from a .hpc file"},
-    {"readDigestEntry", HeapProfReadDigestEntry, METH_VARARGS,
-     "Read a single snapshot from a .hpc file"},
+    {"readDigestEntries", HeapProfReadDigestEntries, METH_VARARGS,
+     "Read a range of snapshots from a .hpc file"},
+    {"readDigestSeries", HeapProfReadDigestSeries, METH_VARARGS,
+     "Read the history of a single trace from a .hpc file"},
     {nullptr, nullptr, 0, nullptr}};
 
 static struct PyModuleDef module_def = {
@@ -1,5 +1,9 @@
 #include "_heapprof/malloc_patch.h"
+#include <algorithm>
+#include <chrono>
+#include <map>
 #include <memory>
+#include <string>
 #include "Python.h"
 #include "_heapprof/reentrant_scope.h"
 #include "pythread.h"
@@ -35,7 +39,12 @@ static struct {
 // mutex in that case. ProfilerLock is a simple scoped lock.
 class ProfilerLock {
  public:
-  explicit ProfilerLock(void *ctx) : is_raw_(ctx == &g_base_allocators.raw) {
+  explicit ProfilerLock(void *ctx)
+      : ProfilerLock(ctx == &g_base_allocators.raw) {}
+
+  // Lock as if we were in the RAW domain. Someone who holds the GIL can use
+  // this to lock out all of the hooks.
+  explicit ProfilerLock(bool is_raw) : is_raw_(is_raw) {
     if (is_raw_) {
       PyThread_acquire_lock(lock_, 1);
     }
@@ -55,6 +64,61 @@ class ProfilerLock {
 };
 PyThread_type_lock ProfilerLock::lock_ = nullptr;
 
+// HookTimer updates the profiler's HookStats for a single call from a hook. It
+// must be created while holding the ProfilerLock, and destroyed before
+// releasing it.
+class HookTimer {
+ public:
+  // Measure how long it takes to read the clock, so that we can leave that out
+  // of our timings.
+  static void Calibrate() {
+    std::chrono::steady_clock::duration best =
+        std::chrono::steady_clock::duration::max();
+    for (int i = 0; i < 100; ++i) {
+      const auto start = std::chrono::steady_clock::now();
+      best = std::min(best, std::chrono::steady_clock::now() - start);
+    }
+    clock_overhead_ = best;
+  }
+
+  explicit HookTimer(void *ctx) : stats_(g_profiler->mutable_hook_stats()) {
+    const uint64_t calls = ++stats_->calls[Domain(ctx)];
+    timed_ = (calls % AbstractProfiler::kTimingInterval == 0);
+    if (timed_) {
+      start_ = std::chrono::steady_clock::now();
+    }
+  }
+
+  ~HookTimer() {
+    if (timed_) {
+      const auto elapsed = std::max(
+          std::chrono::steady_clock::now() - start_ - clock_overhead_,
+          std::chrono::steady_clock::duration::zero());
+      stats_->timed_calls += 1;
+      stats_->timed_nanos +=
+          std::chrono::duration_cast<std::chrono::nanoseconds>(elapsed).count();
+    }
+  }
+
+ private:
+  static int Domain(void *ctx) {
+    if (ctx == &g_base_allocators.raw) {
+      return AbstractProfiler::kRawDomain;
+    } else if (ctx == &g_base_allocators.mem) {
+      return AbstractProfiler::kMemDomain;
+    } else {
+      return AbstractProfiler::kObjDomain;
+    }
+  }
+
+  static std::chrono::steady_clock::duration clock_overhead_;
+
+  AbstractProfiler::HookStats *const stats_;
+  bool timed_;
+  std::chrono::steady_clock::time_point start_;
+};
+std::chrono::steady_clock::duration HookTimer::clock_overhead_;
+
 // The wrapped methods with which we will replace the standard malloc, etc. In
 // each case, ctx will be a pointer to the appropriate base allocator.
 
@@ -64,6 +128,7 @@ static void *WrappedMalloc(void *ctx, size_t size) {
   void *ptr = alloc->malloc(alloc->ctx, size);
   if (ptr && scope.is_top_level()) {
     ProfilerLock l(ctx);
+    HookTimer t(ctx);
     g_profiler->HandleMalloc(ptr, size);
   }
   return ptr;
@@ -75,6 +140,7 @@ static void *WrappedCalloc(void *ctx, size_t nelem, size_t elsize) {
   void *ptr = alloc->calloc(alloc->ctx, nelem, elsize);
   if (ptr && scope.is_top_level()) {
     ProfilerLock l(ctx);
+    HookTimer t(ctx);
     g_profiler->HandleMalloc(ptr, nelem * elsize);
   }
   return ptr;
@@ -86,6 +152,7 @@ static void *WrappedRealloc(void *ctx, void *ptr, size_t new_size) {
   void *ptr2 = alloc->realloc(alloc->ctx, ptr, new_size);
   if (ptr2 && scope.is_top_level()) {
     ProfilerLock l(ctx);
+    HookTimer t(ctx);
     g_profiler->HandleRealloc(ptr, ptr2, new_size);
   }
   return ptr2;
@@ -95,8 +162,10 @@ static void WrappedFree(void *ctx, void *ptr) {
   ReentrantScope scope;
   PyMemAllocatorEx *alloc = reinterpret_cast<PyMemAllocatorEx *>(ctx);
   alloc->free(alloc->ctx, ptr);
-  if (scope.is_top_level()) {
+  // free(NULL) is legal, and a no-op; there's nothing for the profiler to see.
+  if (ptr != nullptr && scope.is_top_level()) {
     ProfilerLock l(ctx);
+    HookTimer t(ctx);
     g_profiler->HandleFree(ptr);
   }
 }
@@ -105,6 +174,7 @@ static void WrappedFree(void *ctx, void *ptr) {
 
 void AttachProfiler(AbstractProfiler *profiler) {
   g_profiler.reset(profiler);
+  HookTimer::Calibrate();
 
   PyMemAllocatorEx alloc;
   alloc.malloc = WrappedMalloc;
@@ -140,6 +210,18 @@ void DetachProfiler() {
 
 bool IsProfilerAttached() { return (g_profiler != nullptr); }
 
+bool GetProfilerStats(std::map<std::string, uint64_t> *stats) {
+  if (!IsProfilerAttached()) {
+    return false;
+  }
+  // The ReentrantScope keeps any allocations made while we hold the lock from
+  // trying to take it again.
+  ReentrantScope scope;
+  ProfilerLock l(true);
+  g_profiler->GetStats(stats);
+  return true;
+}
+
 bool MallocPatchInit() {
   ProfilerLock::ModuleInit();
   return true;
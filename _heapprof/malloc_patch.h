@@ -1,6 +1,9 @@
 #ifndef _HEAPPROF_MALLOC_PATCH_H__
 #define _HEAPPROF_MALLOC_PATCH_H__
 
+#include <stdint.h>
+#include <map>
+#include <string>
 #include "_heapprof/abstract_profiler.h"
 
 // These functions do the work of connecting and disconnecting a Profiler
@@ -21,6 +24,11 @@ void DetachProfiler();
 // Test if profiling is active.
 bool IsProfilerAttached();
 
+// Fill in *stats with the attached profiler's statistics about itself (see
+// AbstractProfiler::GetStats). Returns false if no profiler is attached. The
+// caller must hold the GIL.
+bool GetProfilerStats(std::map<std::string, uint64_t> *stats);
+
 // Called to initialize this subset of the module, after the module as a whole
 // is created. Returns true on success; false is fatal.
 bool MallocPatchInit();
@@ -79,6 +79,8 @@ inline int Log2RoundUp(uint64_t x) {
 // File system access
 
 #ifdef _WIN64
+#include <errno.h>
+
 // Seriously, Microsoft? You don't have pwrite? Normal people implement write *on top of* pwrite.
 inline ssize_t pwrite(int fd, const void *buf, size_t nbytes, off_t offset) {
   const off_t pos = lseek(fd, 0, SEEK_CUR);
@@ -88,10 +90,21 @@ inline ssize_t pwrite(int fd, const void *buf, size_t nbytes, off_t offset) {
   return written;
 }
 
+// _chsize_s returns an error code, rather than setting errno and returning -1.
+inline int ftruncate(int fd, off_t length) {
+  const errno_t error = _chsize_s(fd, length);
+  if (error != 0) {
+    errno = error;
+    return -1;
+  }
+  return 0;
+}
+
 // _O_BINARY has no POSIX equivalent, but if you don't set it, it will default to a text mode that
 // will do "helpful" things like translate 0x0a to 0x0d0a when you write it.
 #define WRITE_MODE _O_WRONLY | _O_CREAT | _O_TRUNC | _O_BINARY
 #define READ_MODE _O_RDONLY | _O_BINARY
+#define UPDATE_MODE _O_RDWR | _O_BINARY
 
 #else  // Non-Windows machines
 
@@ -100,6 +113,7 @@ inline ssize_t pwrite(int fd, const void *buf, size_t nbytes, off_t offset) {
 
 #define WRITE_MODE O_WRONLY | O_CREAT | O_TRUNC
 #define READ_MODE O_RDONLY
+#define UPDATE_MODE O_RDWR
 
 #endif  // Switch over platforms
 
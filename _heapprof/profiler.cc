@@ -1,32 +1,63 @@
 #include "_heapprof/profiler.h"
 #include <fcntl.h>
 #include <stdio.h>
+#include <map>
 #include <string>
 #include "Python.h"
 #include "_heapprof/file_format.h"
 #include "_heapprof/port.h"
-#include "_heapprof/simple_hash.h"
 #include "_heapprof/util.h"
-#include "frameobject.h"
 
 //////////////////////////////////////////////////////////////////////////////////////////////////
 // Profiler
 
-Profiler::Profiler(const char *filebase, Sampler *sampler)
+Profiler::Profiler(const char *filebase, Sampler *sampler, FrameFilter *filter,
+                   size_t buffer_size, int flush_interval_msec,
+                   bool background_flush)
     : sampler_(sampler),
-      metadata_file_(filebase, ".hpm", true),
-      data_file_(filebase, ".hpd", true) {
+      metadata_file_(filebase, ".hpm", WRITE_MODE),
+      data_file_(filebase, ".hpd", WRITE_MODE),
+      flusher_(background_flush ? new BackgroundFlusher() : nullptr),
+      metadata_(metadata_file_, buffer_size, flush_interval_msec,
+                flusher_.get()),
+      data_(data_file_, buffer_size, flush_interval_msec, flusher_.get()),
+      index_filename_(std::string(filebase) + ".hpi"),
+      fingerprinter_(filter) {
   if (!metadata_file_ || !data_file_) {
     return;
   }
+  // Any index left over from a previous profile with the same name would
+  // refer to the old .hpd file, so get rid of it. We write the new one when we
+  // stop.
+  unlink(index_filename_.c_str());
+  if (!metadata_.ok() || !data_.ok()) {
+    PyErr_SetString(PyExc_MemoryError, "Failed to allocate output buffers");
+    return;
+  }
+  // Events refer to traces, so make sure traces always hit the disk first.
+  data_.set_flush_first(&metadata_);
 
   // Initialize our clock and write initial metadata.
   gettime(&last_clock_);
-  WriteMetadata(metadata_file_, last_clock_, *sampler_);
+  footer_offset_location_ = WriteMetadata(&metadata_, last_clock_, *sampler_);
   ok_ = true;
 }
 
-Profiler::~Profiler() {}
+Profiler::~Profiler() {
+  if (!ok_) {
+    return;
+  }
+  // Get everything onto disk and the background thread out of the way, so that
+  // we can finish up synchronously.
+  metadata_.StopBackgroundFlush();
+  data_.StopBackgroundFlush();
+
+  std::map<std::string, uint64_t> stats;
+  GetStats(&stats);
+  WriteMetadataFooter(&metadata_, footer_offset_location_, stats,
+                      trace_offsets_, filenames_);
+  WriteCheckpointIndexFile();
+}
 
 void Profiler::HandleMalloc(void *ptr, size_t size) {
   assert(ptr != nullptr);
@@ -35,67 +66,137 @@ void Profiler::HandleMalloc(void *ptr, size_t size) {
   }
   struct timespec timestamp;
   gettime(&timestamp);
-  const uint32_t traceindex = GetTraceIndex();
-  live_set_[ptr] = {traceindex, size};
-  WriteEvent(data_file_, &last_clock_, timestamp, traceindex, size, true);
+  uint32_t traceindex;
+  // NB that if we can't record this event, we don't add it to the live set, so
+  // its free will be ignored just like that of any other unsampled pointer. We
+  // add it before writing the event, though, since unlike writing, adding can
+  // fail without side effects.
+  if (PREDICT_FALSE(!GetTraceIndex(&traceindex) ||
+                    !live_set_.Insert(ptr, LivePointer(traceindex, size)))) {
+    ++dropped_allocs_;
+    return;
+  }
+  MaybeCheckpoint(timestamp);
+  if (PREDICT_FALSE(!WriteEvent(&data_, &last_clock_, timestamp, traceindex,
+                                size, true))) {
+    live_set_.Erase(ptr);
+    ++dropped_allocs_;
+    return;
+  }
+  if (PREDICT_FALSE(size >= LivePointer::kHugeSize)) {
+    huge_sizes_[ptr] = size;
+  }
+  ++sampled_allocs_;
+  data_.MaybeFlush(timestamp);
 }
 
 void Profiler::HandleFree(void *ptr) {
   assert(ptr != nullptr);
-  auto live_ptr = live_set_.find(ptr);
+  LivePointer live_ptr;
   // This means that this ptr wasn't sampled in HandleMalloc.
-  if (live_ptr == live_set_.end()) {
+  if (!live_set_.Take(ptr, &live_ptr)) {
     return;
   }
+  size_t size = live_ptr.size();
+  if (PREDICT_FALSE(size == LivePointer::kHugeSize)) {
+    const auto it = huge_sizes_.find(ptr);
+    if (it != huge_sizes_.end()) {
+      size = it->second;
+      huge_sizes_.erase(it);
+    }
+  }
   struct timespec timestamp;
   gettime(&timestamp);
-  WriteEvent(data_file_, &last_clock_, timestamp, live_ptr->second.traceindex,
-             live_ptr->second.size, false);
-  live_set_.erase(live_ptr);
-}
-
-// Get a unique fingerprint of the current Python stack trace. NB that this
-// fingerprint will never be committed to disk, so it only needs to be unique
-// within the scope of this program execution; that means we can safely hash
-// just the code pointers.
-static uint32_t GetTraceFP() {
-  const PyThreadState *tstate = PyGILState_GetThisThreadState();
-  if (tstate == nullptr) {
-    // This is really weird and we should figure out what the appropriate error
-    // handling is.
-    return 0;
+  MaybeCheckpoint(timestamp);
+  if (PREDICT_FALSE(!WriteEvent(&data_, &last_clock_, timestamp,
+                                live_ptr.traceindex(), size, false))) {
+    ++dropped_frees_;
+  } else {
+    ++sampled_frees_;
   }
+  data_.MaybeFlush(timestamp);
+}
 
-  SimpleHash tracefp;
-  for (PyFrameObject *pyframe = tstate->frame; pyframe != nullptr;
-       pyframe = pyframe->f_back) {
-    if (!SkipFrame(pyframe)) {
-      tracefp.add(pyframe->f_code);
-      tracefp.add(static_cast<uint32_t>(PyFrame_GetLineNumber(pyframe)));
-    }
-  }
-  return tracefp.get();
+void Profiler::GetStats(std::map<std::string, uint64_t> *stats) const {
+  AbstractProfiler::GetStats(stats);
+  (*stats)["sampledAllocs"] = sampled_allocs_;
+  (*stats)["sampledFrees"] = sampled_frees_;
+  (*stats)["droppedAllocs"] = dropped_allocs_;
+  (*stats)["droppedFrees"] = dropped_frees_;
+  (*stats)["hpdBytes"] = data_.offset();
+  (*stats)["hpmBytes"] = metadata_.offset();
+  (*stats)["distinctTraces"] = next_trace_index_ - 1;
+  (*stats)["checkpoints"] = checkpoints_.size();
+  (*stats)["liveSetEntries"] = live_set_.size();
+  (*stats)["liveSetBytes"] = live_set_.memory_usage();
+  (*stats)["traceIndexEntries"] = trace_index_.size();
+  (*stats)["traceIndexBytes"] = trace_index_.memory_usage();
+  (*stats)["bufferBytes"] = metadata_.memory_usage() + data_.memory_usage();
+  (*stats)["memoryBytes"] = (*stats)["liveSetBytes"] +
+                            (*stats)["traceIndexBytes"] +
+                            (*stats)["bufferBytes"];
 }
 
-int Profiler::GetTraceIndex() {
-  const uint32_t tracefp = GetTraceFP();
+bool Profiler::GetTraceIndex(uint32_t *traceindex) {
+  const uint32_t tracefp = fingerprinter_.Fingerprint();
   if (PREDICT_FALSE(tracefp == 0)) {
-    return 0;
+    *traceindex = 0;
+    return true;
   }
 
-  const auto it = trace_index_.find(tracefp);
-  if (PREDICT_TRUE(it != trace_index_.end())) {
-    return it->second;
+  const uint32_t *index = trace_index_.Find(tracefp);
+  if (PREDICT_TRUE(index != nullptr)) {
+    *traceindex = *index;
+    return true;
   }
 
   // First time we've seen this tracefp! Write it out to the metadata file, add
-  // its new index, and return that.
+  // its new index, and return that. If there's no room to write it, we just
+  // don't remember it, and we'll try again the next time it comes up.
+  const off_t offset = metadata_.offset();
+  if (PREDICT_FALSE(!WriteRawTrace(&metadata_, fingerprinter_.frames(),
+                                   fingerprinter_.truncated(), &filenames_))) {
+    return false;
+  }
+  trace_offsets_.push_back(offset);
   uint32_t new_index = next_trace_index_++;
-  // If we can't write a stack trace, or if the trace index overflowed, give
-  // this tracefp the "invalid index" value.
-  if (PREDICT_FALSE(!WriteRawTrace(metadata_file_) || new_index & kHighBits)) {
+  // If the trace index overflowed, give this tracefp the "invalid index" value.
+  // (This also keeps us from ever handing out the index in kCheckpointWord.)
+  if (PREDICT_FALSE(new_index > kMaxTraceIndex)) {
     new_index = 0;
   }
-  trace_index_[tracefp] = new_index;
-  return new_index;
+  // If we can't remember it, the only consequence is that the next time this
+  // trace comes up, it gets written out again under a new index.
+  trace_index_.Insert(tracefp, new_index);
+  *traceindex = new_index;
+  return true;
+}
+
+void Profiler::AddCheckpoint(const struct timespec &now) {
+  const off_t offset = data_.offset();
+  // If there's no room, we'll try again with the next event.
+  if (PREDICT_FALSE(!WriteCheckpoint(&data_, last_clock_))) {
+    return;
+  }
+  checkpoints_.push_back(Checkpoint{last_clock_, offset});
+  next_checkpoint_sec_ = now.tv_sec + kCheckpointIntervalSec;
+  next_checkpoint_offset_ = offset + kCheckpointIntervalBytes;
+}
+
+void Profiler::WriteCheckpointIndexFile() const {
+  // NB that this may run during static destruction, if the program exits
+  // without stopping the profiler, so it must not touch any Python state. The
+  // index is only there to speed up readers, so if we can't write it, we just
+  // don't.
+  const int fd = open(index_filename_.c_str(), WRITE_MODE, 0600);
+  if (fd == -1) {
+    return;
+  }
+  {
+    BufferedWriter index(fd, 64 << 10, 0);
+    if (index.ok()) {
+      WriteCheckpointIndex(&index, checkpoints_);
+    }
+  }
+  close(fd);
 }
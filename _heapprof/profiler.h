@@ -2,11 +2,20 @@
 #define _HEAPPROF_PROFILER_H__
 
 #include <time.h>
+#include <map>
 #include <memory>
+#include <string>
 #include <unordered_map>
+#include <vector>
 #include "Python.h"
 #include "_heapprof/abstract_profiler.h"
+#include "_heapprof/background_flusher.h"
+#include "_heapprof/buffered_writer.h"
+#include "_heapprof/file_format.h"
+#include "_heapprof/flat_map.h"
+#include "_heapprof/frame_filter.h"
 #include "_heapprof/sampler.h"
+#include "_heapprof/trace_fingerprinter.h"
 #include "_heapprof/util.h"
 
 // Profiler is the heart of heap profiling. When the profiler is on, a
@@ -22,30 +31,74 @@
 // for ensuring its methods are not called in parallel. (See _malloc_patch.cc
 // for how this is done, and why we don't do the seemingly simple thing of
 // making this class thread-safe instead)
+//
+// NB: Since the profiler runs inside the Python allocator hooks, it and
+// everything it owns must get their memory from the C allocator (malloc, or
+// the default operator new), never from the Python one; otherwise, we'd be
+// profiling ourselves, and in the RAW domain, deadlocking on ProfilerLock.
 class Profiler : public AbstractProfiler {
  public:
-  // Takes ownership of the sampler.
-  Profiler(const char *filebase, Sampler *sampler);
+  // Takes ownership of the sampler and the filter. Output to each file is
+  // buffered in memory in blocks of buffer_size bytes; if flush_interval_msec >
+  // 0, the buffers will also be flushed whenever they've gone that long without
+  // a flush. If background_flush is set, the actual writes happen on a
+  // separate native thread, and events which arrive while that thread is
+  // falling behind are dropped (and counted) rather than waited on.
+  Profiler(const char *filebase, Sampler *sampler, FrameFilter *filter,
+           size_t buffer_size, int flush_interval_msec, bool background_flush);
   virtual ~Profiler();
 
   // These each require that ptr (newptr) not be nullptr.
   virtual void HandleMalloc(void *ptr, size_t size);
   virtual void HandleFree(void *ptr);
 
+  // In addition to the hook statistics, reports:
+  //   sampledAllocs, sampledFrees: The number of events recorded.
+  //   droppedAllocs, droppedFrees: The number of events we had to drop; see
+  //     below.
+  //   hpdBytes, hpmBytes: The number of bytes written to each file so far,
+  //     including anything still buffered.
+  //   distinctTraces: The number of stack traces written to the .hpm file.
+  //   checkpoints: The number of checkpoints written to the .hpd file.
+  //   liveSetEntries, liveSetBytes, traceIndexEntries, traceIndexBytes,
+  //     bufferBytes: The sizes, and memory footprints, of our data structures.
+  //   memoryBytes: The sum of all of the *Bytes.
+  // These are also written to the .hpm footer when the profiler stops.
+  virtual void GetStats(std::map<std::string, uint64_t> *stats) const;
+
   // Verifies validity of the profiler after construction. If false, the
   // exception is already set.
   bool ok() const { return ok_; }
 
  private:
-  // The information we store for a live pointer.
-  struct LivePointer {
-    // The trace at which it was allocated.
-    uint32_t traceindex;
-    // The size of the memory allocated. (NB: This is the size as returned by
-    // malloc, which alas is *not* the size as actually pulled by malloc; but
-    // there's no API-agnostic way to find out what the particular malloc
-    // implementation on this machine actually did.)
-    size_t size;
+  // The information we store for a live pointer: the trace at which it was
+  // allocated, and the size of the memory allocated. (NB: This is the size as
+  // returned by malloc, which alas is *not* the size as actually pulled by
+  // malloc; but there's no API-agnostic way to find out what the particular
+  // malloc implementation on this machine actually did.)
+  //
+  // There can be millions of these, so we pack them into a single word. Valid
+  // trace indices never use the kHighBits, so they fit in 30 bits, leaving 34
+  // for the size. Allocations of 16GiB or more get kHugeSize here, and their
+  // real sizes are kept in huge_sizes_.
+  class LivePointer {
+   public:
+    LivePointer() : bits_(0) {}
+    LivePointer(uint32_t traceindex, size_t size)
+        : bits_((static_cast<uint64_t>(size < kHugeSize ? size : kHugeSize)
+                 << kTraceIndexBits) |
+                traceindex) {}
+
+    uint32_t traceindex() const {
+      return static_cast<uint32_t>(bits_ & ((1ULL << kTraceIndexBits) - 1));
+    }
+    uint64_t size() const { return bits_ >> kTraceIndexBits; }
+
+    static const int kTraceIndexBits = 30;
+    static const uint64_t kHugeSize = (1ULL << (64 - kTraceIndexBits)) - 1;
+
+   private:
+    uint64_t bits_;
   };
 
   std::unique_ptr<Sampler> sampler_;
@@ -54,23 +107,77 @@ class Profiler : public AbstractProfiler {
   ScopedFile metadata_file_;
   ScopedFile data_file_;
 
+  // The background thread which writes our buffers, if any.
+  std::unique_ptr<BackgroundFlusher> flusher_;
+
+  // The buffers through which we write to them. NB that these must be declared
+  // after the files and the flusher, so that they're destroyed (and thus
+  // flushed) first.
+  BufferedWriter metadata_;
+  BufferedWriter data_;
+
+  // Where in the .hpm file to record the location of the footer.
+  off_t footer_offset_location_ = 0;
+
+  // The number of events we had to drop because the background flusher was
+  // behind.
+  uint64_t dropped_allocs_ = 0;
+  uint64_t dropped_frees_ = 0;
+
+  // The number of events we recorded.
+  uint64_t sampled_allocs_ = 0;
+  uint64_t sampled_frees_ = 0;
+
   // The time of the previous event.
   struct timespec last_clock_;
 
+  // Every so often, we write a checkpoint to the .hpd file, so that readers
+  // can start reading from the middle of it; when we stop, we write an index
+  // of them to the .hpi file. They're due every kCheckpointIntervalSec seconds
+  // or kCheckpointIntervalBytes bytes of output, whichever comes first.
+  static const time_t kCheckpointIntervalSec = 1;
+  static const off_t kCheckpointIntervalBytes = 4 << 20;
+  const std::string index_filename_;
+  std::vector<Checkpoint> checkpoints_;
+  time_t next_checkpoint_sec_ = 0;
+  off_t next_checkpoint_offset_ = 0;
+
   // The next trace index we'll assign. Note that trace index 0 is defined to be
   // "the bogus trace index."
   uint32_t next_trace_index_ = 1;
+  // The .hpm file offset of each raw trace we've written, in order, which goes
+  // into the footer when we stop.
+  std::vector<off_t> trace_offsets_;
+  // The filenames we've written to the .hpm file so far.
+  FilenameTable filenames_;
+
+  // Computes the tracefp of each sampled allocation.
+  TraceFingerprinter fingerprinter_;
 
   // A hash map from tracefp to trace index.
-  std::unordered_map<uint32_t, uint32_t> trace_index_;
+  FlatMap<uint32_t, uint32_t> trace_index_;
 
   // Data about currently live pointers.
-  std::unordered_map<void *, LivePointer> live_set_;
+  FlatMap<void *, LivePointer> live_set_;
+  // The sizes of any live pointers too big to fit in a LivePointer.
+  std::unordered_map<void *, size_t> huge_sizes_;
 
   bool ok_ = false;
 
-  // Get the current trace index.
-  int GetTraceIndex();
+  // Get the current trace index. Returns false if the trace was new and there
+  // was no room to write it out.
+  bool GetTraceIndex(uint32_t *traceindex);
+
+  // Write a checkpoint if one is due. Call this right before writing an event.
+  void MaybeCheckpoint(const struct timespec &now) {
+    if (PREDICT_FALSE(now.tv_sec >= next_checkpoint_sec_ ||
+                      data_.offset() >= next_checkpoint_offset_)) {
+      AddCheckpoint(now);
+    }
+  }
+  void AddCheckpoint(const struct timespec &now);
+  // Write the .hpi file.
+  void WriteCheckpointIndexFile() const;
 };
 
 #endif  // _HEAPPROF_PROFILER_H__
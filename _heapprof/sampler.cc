@@ -3,17 +3,26 @@
 #include "_heapprof/scoped_object.h"
 #include "_heapprof/util.h"
 
-Sampler::Range::Range(Py_ssize_t m, double p) : max_bytes(m) {
-  if (p == 0) {
-    probability = 0;
-  } else if (p == 1) {
-    probability = UINT_FAST32_MAX;
-  } else {
-    probability = static_cast<uint_fast32_t>(p * UINT_FAST32_MAX);
-  }
-}
+// The number of distinct values which std::minstd_rand can produce.
+static const double kRngRange =
+    static_cast<double>(std::minstd_rand::max() - std::minstd_rand::min()) + 1;
+
+Sampler::Range::Range(Py_ssize_t m, double p)
+    : max_bytes(m),
+      probability(p),
+      threshold(static_cast<uint_fast32_t>(p * kRngRange)) {}
 
-Sampler::Sampler(PyObject *sampling_rate) {
+Sampler::Sampler(PyObject *sampling_rate, Py_ssize_t sampling_interval)
+    : sampling_interval_(sampling_interval > 0 ? sampling_interval : 0),
+      interval_distribution_(sampling_interval > 0 ? 1.0 / sampling_interval
+                                                   : 1.0) {
+  if (sampling_interval < 0) {
+    PyErr_Format(PyExc_ValueError,
+                 "%zd is not a valid sampling interval; it must be a positive "
+                 "number of bytes.",
+                 sampling_interval);
+    return;
+  }
   if (!PyMapping_Check(sampling_rate)) {
     PyErr_SetString(PyExc_TypeError, "samplingRate is not a Dict[int, float]");
     return;
@@ -46,6 +55,15 @@ Sampler::Sampler(PyObject *sampling_rate) {
     }
   }
 
+  if (sampling_interval_ != 0) {
+    if (!ranges_.empty()) {
+      PyErr_SetString(PyExc_ValueError,
+                      "samplingRate and samplingInterval can't both be set");
+      return;
+    }
+    bytes_until_sample_ = NextSampleInterval();
+  }
+
   sort(ranges_.begin(), ranges_.end());
 
   // Safety check: Make sure there are no repeated entries.
@@ -65,10 +83,17 @@ Sampler::Sampler(PyObject *sampling_rate) {
   ok_ = true;
 }
 
-void Sampler::WriteStateToFile(int fd) const {
-  WriteVarintToFile(fd, ranges_.size());
+int64_t Sampler::NextSampleInterval() {
+  // Round up, so that we never return zero; that would mean sampling every
+  // zero-byte allocation until the next nonzero one came along.
+  return static_cast<int64_t>(interval_distribution_(rng_)) + 1;
+}
+
+void Sampler::WriteState(BufferedWriter *out) const {
+  out->AppendVarint(ranges_.size());
   for (auto it = ranges_.begin(); it != ranges_.end(); ++it) {
-    WriteFixed64ToFile(fd, it->max_bytes);
-    WriteFixed32ToFile(fd, it->probabilityAsUint32());
+    out->AppendFixed64(it->max_bytes);
+    out->AppendFixed32(it->probabilityAsUint32());
   }
+  out->AppendVarint(sampling_interval_);
 }
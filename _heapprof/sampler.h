@@ -5,13 +5,28 @@
 #include <random>
 #include <vector>
 #include "Python.h"
+#include "_heapprof/buffered_writer.h"
+#include "_heapprof/port.h"
 
-// A Sampler maintains the map of sampling probabilities per allocation size.
-// This will probably require some performance tuning.
+// A Sampler decides which allocations get profiled. It has two modes:
+//
+// * Range sampling: Allocations are sampled with a probability which depends
+//   on their size, as given by a map from size ranges to probabilities. This
+//   is the original heapprof sampler, and gives you the most control.
+// * Interval sampling: Allocations are sampled on average once every N bytes,
+//   in the style of tcmalloc. We keep a countdown of bytes until the next
+//   sample, drawn from an exponential distribution with mean N; each
+//   allocation subtracts its size, and the one which takes the counter to zero
+//   is sampled. This means that an allocation of size S is sampled with
+//   probability 1 - exp(-S/N), so big allocations are (nearly) always caught,
+//   and -- the real reason to use it -- the common case costs one subtraction
+//   and one comparison, with no RNG draw at all.
 class Sampler {
  public:
-  // Construct a new Sampler. The argument must be a dict from int to double.
-  explicit Sampler(PyObject* sampling_rate);
+  // Construct a new Sampler. sampling_rate must be a dict from int to double;
+  // if sampling_interval is positive, we use interval sampling instead, and
+  // sampling_rate must be empty.
+  Sampler(PyObject* sampling_rate, Py_ssize_t sampling_interval);
   ~Sampler() {}
 
   // Tests validity after construction. If this is false, the Python exception
@@ -19,63 +34,74 @@ class Sampler {
   bool ok() { return ok_; }
 
   // Decide if we should profile an allocation of the given size.
-  bool Sample(int alloc_size);
+  bool Sample(size_t alloc_size);
 
-  // Write the parameters of this sampler to a file.
-  void WriteStateToFile(int fd) const;
+  // Write the parameters of this sampler to an output buffer.
+  void WriteState(BufferedWriter* out) const;
 
  private:
   struct Range {
     Range(Py_ssize_t m, double p);
-    Range& operator=(const Range& other) {
-      max_bytes = other.max_bytes;
-      probability = other.probability;
-      return *this;
-    }
     bool operator<(const Range& other) const {
       return max_bytes < other.max_bytes;
     }
 
     uint32_t probabilityAsUint32() const {
-      if (probability == 0) {
-        return 0;
-      } else if (probability == UINT_FAST32_MAX) {
-        return UINT32_MAX;
-      } else {
-        const double p = static_cast<double>(probability) / UINT_FAST32_MAX;
-        return static_cast<uint32_t>(p * UINT32_MAX);
-      }
+      return probability == 1
+                 ? UINT32_MAX
+                 : static_cast<uint32_t>(probability * UINT32_MAX);
     }
 
     Py_ssize_t max_bytes;
-    uint_fast32_t probability;
+    double probability;
+    // An allocation in this range is sampled iff a draw from rng_, minus its
+    // minimum value, is less than this.
+    uint_fast32_t threshold;
   };
 
+  // Sample an allocation of the given size in range sampling mode.
+  bool SampleRange(size_t alloc_size);
+
+  // Pick the number of bytes until the next sample in interval sampling mode.
+  int64_t NextSampleInterval();
+
   // Sorted by max_bytes.
   std::vector<Range> ranges_;
 
+  // The mean number of bytes between samples in interval mode, or zero in
+  // range mode.
+  const int64_t sampling_interval_;
+  // The countdown until our next sample, in interval mode.
+  int64_t bytes_until_sample_ = 0;
+
   // Our RNG. minstd_rand uses Lehmer's generator, which is very fast and more
   // than good enough for our purposes.
   std::minstd_rand rng_ = std::minstd_rand();
+  std::exponential_distribution<double> interval_distribution_;
 
   bool ok_ = false;
 };
 
 // Inline because this is called for every malloc.
-inline bool Sampler::Sample(int alloc_size) {
+inline bool Sampler::Sample(size_t alloc_size) {
+  if (sampling_interval_ != 0) {
+    bytes_until_sample_ -= alloc_size;
+    if (PREDICT_TRUE(bytes_until_sample_ > 0)) {
+      return false;
+    }
+    bytes_until_sample_ = NextSampleInterval();
+    return true;
+  }
+  return SampleRange(alloc_size);
+}
+
+inline bool Sampler::SampleRange(size_t alloc_size) {
   // ranges_ is small enough that a linear search is more efficient than a
   // binary one.
   for (auto it = ranges_.begin(); it != ranges_.end(); ++it) {
-    if (it->max_bytes > alloc_size) {
+    if (static_cast<size_t>(it->max_bytes) > alloc_size) {
       // Our sampling probability is it->probability
-      if (it->probability == 0) {
-        return false;
-      } else if (it->probability == UINT_FAST32_MAX) {
-        return true;
-      } else {
-        const bool result = rng_() < it->probability;
-        return result;
-      }
+      return (rng_() - std::minstd_rand::min()) < it->threshold;
     }
   }
 
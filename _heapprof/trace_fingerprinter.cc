@@ -0,0 +1,233 @@
+#include "_heapprof/trace_fingerprinter.h"
+#include <vector>
+
+// Mixed into the hash of truncated traces, so that they can't be confused with
+// untruncated traces that happen to have the same frames.
+static const uint32_t kTruncatedHash = 0x7472756e;
+
+// Frames which a TraceFingerprinter has let go of, but which nobody else had a
+// reference to either, waiting for the interpreter to release them. Only
+// touched with the GIL held.
+static std::vector<PyFrameObject *> g_dead_frames;
+static bool g_release_scheduled = false;
+
+// A pending call, so the interpreter runs it with the GIL held, between
+// bytecodes.
+static int ReleaseDeadFrames(void *) {
+  // Releasing these can run arbitrary code, including more allocations and so
+  // more calls to ReleaseFrame, so work on a copy.
+  std::vector<PyFrameObject *> frames;
+  frames.swap(g_dead_frames);
+  g_release_scheduled = false;
+  for (PyFrameObject *pyframe : frames) {
+    Py_DECREF(pyframe);
+  }
+  return 0;
+}
+
+// Drop a reference to a frame, from inside an allocation.
+static void ReleaseFrame(PyFrameObject *pyframe) {
+  if (Py_REFCNT(pyframe) > 1) {
+    Py_DECREF(pyframe);
+    return;
+  }
+  g_dead_frames.push_back(pyframe);
+  // If the pending call queue is full, we'll try again next time.
+  if (!g_release_scheduled &&
+      Py_AddPendingCall(ReleaseDeadFrames, nullptr) == 0) {
+    g_release_scheduled = true;
+  }
+}
+
+// Whether a remembered frame is still running with the same callers as when we
+// saw it. A plain function frame only runs once, and can't return until
+// everything it called has; a generator or coroutine frame can be suspended and
+// later resumed under different callers.
+static inline bool IsAnchor(const PyFrameObject *pyframe) {
+  return pyframe->f_executing &&
+         !(pyframe->f_code->co_flags &
+           (CO_GENERATOR | CO_COROUTINE | CO_ASYNC_GENERATOR));
+}
+
+TraceFingerprinter::TraceFingerprinter(FrameFilter *filter)
+    : filter_(filter),
+      line_cache_(kLineCacheSize, LineCacheEntry{nullptr, -1, 0}) {}
+
+TraceFingerprinter::~TraceFingerprinter() {
+  // If we're being destroyed after the interpreter has shut down, the frames
+  // are already gone; and if we don't hold the GIL, we can't release them.
+  if (!Py_IsInitialized() || _PyThreadState_UncheckedGet() == nullptr) {
+    return;
+  }
+  for (const auto &entry : stacks_) {
+    for (const CachedFrame &cached : entry.second.frames) {
+      Py_DECREF(cached.frame);
+    }
+  }
+  ReleaseDeadFrames(nullptr);
+}
+
+uint32_t TraceFingerprinter::Fingerprint() {
+  const PyThreadState *tstate = PyGILState_GetThisThreadState();
+  if (tstate == nullptr) {
+    // This is really weird and we should figure out what the appropriate error
+    // handling is.
+    return 0;
+  }
+
+  frames_.clear();
+  truncated_ = false;
+  if (PREDICT_TRUE(_PyThreadState_UncheckedGet() == tstate)) {
+    CachedStack *cache = &stacks_[tstate];
+    last_stack_ = cache;
+    return FingerprintCached(cache);
+  }
+
+  // We don't hold the GIL, so we can't take references to frames; hash the
+  // whole stack from scratch.
+  last_stack_ = nullptr;
+  CollectFrames(tstate->frame, nullptr);
+  SimpleHash tracefp;
+  if (truncated_) {
+    tracefp.add(kTruncatedHash);
+  }
+  for (auto it = frames_.rbegin(); it != frames_.rend(); ++it) {
+    PyFrameObject *pyframe = *it;
+    tracefp.add(pyframe->f_code);
+    tracefp.add(static_cast<uint32_t>(pyframe->f_trace != nullptr
+                                          ? PyFrame_GetLineNumber(pyframe)
+                                          : LineNumber(pyframe)));
+  }
+  return tracefp.get();
+}
+
+uint32_t TraceFingerprinter::FingerprintCached(CachedStack *cache) {
+  const PyThreadState *tstate = PyGILState_GetThisThreadState();
+  const size_t max_depth = filter_->max_depth();
+
+  // Find the anchor: the innermost remembered frame that's still running.
+  // Everything outside it is the same as last time.
+  size_t keep = cache->frames.size();
+  while (keep > 0 && !IsAnchor(cache->frames[keep - 1].frame)) {
+    --keep;
+  }
+  PyFrameObject *const anchor =
+      (keep > 0) ? cache->frames[keep - 1].frame : nullptr;
+
+  // Collect the frames inside it.
+  const PyFrameObject *stopped = CollectFrames(tstate->frame, anchor);
+  if (anchor == nullptr || stopped != anchor || truncated_) {
+    // Either there's no anchor, or it isn't on this stack, or we hit the
+    // maximum depth before getting to it. In all of those cases, frames_ now
+    // holds everything we'll record.
+    keep = 0;
+  } else {
+    // A frame which is being traced may have its line number set by the tracer
+    // rather than derived from its instruction offset, so we never trust the
+    // cache for those.
+    if (anchor->f_lasti != cache->frames[keep - 1].lasti ||
+        anchor->f_trace != nullptr) {
+      --keep;
+      if (frames_.size() == max_depth) {
+        truncated_ = true;
+      } else {
+        frames_.push_back(anchor);
+      }
+    }
+
+    // If the maximum depth cuts the stack somewhere other than where it did
+    // last time, then the outermost frames we'll record aren't the ones we
+    // remember, so rebuild the list. That's bounded by the maximum depth.
+    const size_t depth = frames_.size() + keep;
+    if (truncated_) {
+      keep = 0;
+    } else if (cache->truncated ? (depth != max_depth)
+                                : (depth > max_depth)) {
+      size_t i = keep;
+      while (i > 0 && frames_.size() < max_depth) {
+        frames_.push_back(cache->frames[--i].frame);
+      }
+      if (i > 0) {
+        truncated_ = true;
+      } else if (cache->truncated) {
+        CollectFrames(cache->frames[0].frame->f_back, nullptr);
+      }
+      keep = 0;
+    } else {
+      truncated_ = cache->truncated;
+    }
+  }
+
+  // Hash everything inside that, remembering the results for next time. Take
+  // the new references before dropping the old ones, since some frames may be
+  // in both.
+  SimpleHash tracefp;
+  if (keep > 0) {
+    tracefp = cache->frames[keep - 1].hash;
+  } else if (truncated_) {
+    tracefp.add(kTruncatedHash);
+  }
+  for (PyFrameObject *pyframe : frames_) {
+    Py_INCREF(pyframe);
+  }
+  for (size_t i = keep; i < cache->frames.size(); ++i) {
+    ReleaseFrame(cache->frames[i].frame);
+  }
+  cache->frames.erase(cache->frames.begin() + keep, cache->frames.end());
+  cache->truncated = truncated_;
+  for (auto it = frames_.rbegin(); it != frames_.rend(); ++it) {
+    PyFrameObject *pyframe = *it;
+    tracefp.add(pyframe->f_code);
+    tracefp.add(static_cast<uint32_t>(pyframe->f_trace != nullptr
+                                          ? PyFrame_GetLineNumber(pyframe)
+                                          : LineNumber(pyframe)));
+    cache->frames.push_back({pyframe, pyframe->f_lasti, tracefp});
+  }
+  return tracefp.get();
+}
+
+const std::vector<PyFrameObject *> &TraceFingerprinter::frames() {
+  if (last_stack_ != nullptr) {
+    // The cache holds the whole stack, outermost first.
+    frames_.clear();
+    for (auto it = last_stack_->frames.rbegin();
+         it != last_stack_->frames.rend(); ++it) {
+      frames_.push_back(it->frame);
+    }
+    last_stack_ = nullptr;
+  }
+  return frames_;
+}
+
+PyFrameObject *TraceFingerprinter::CollectFrames(PyFrameObject *pyframe,
+                                                 const PyFrameObject *stop) {
+  // Once we have as many frames as we're allowed, we only need to look far
+  // enough to know whether any more would have been recorded.
+  const size_t max_depth = filter_->max_depth();
+  for (; pyframe != nullptr && pyframe != stop; pyframe = pyframe->f_back) {
+    if (filter_->Skip(pyframe)) {
+      continue;
+    }
+    if (frames_.size() == max_depth) {
+      truncated_ = true;
+      break;
+    }
+    frames_.push_back(pyframe);
+  }
+  return pyframe;
+}
+
+int TraceFingerprinter::LineNumber(PyFrameObject *pyframe) {
+  // The low bits of an object pointer are always zero, and instruction offsets
+  // are always even, so shift those out before mixing.
+  const uintptr_t slot =
+      (reinterpret_cast<uintptr_t>(pyframe->f_code) >> 4) +
+      (static_cast<uintptr_t>(pyframe->f_lasti) >> 1) * 2654435761U;
+  LineCacheEntry &entry = line_cache_[slot % kLineCacheSize];
+  if (entry.code != pyframe->f_code || entry.lasti != pyframe->f_lasti) {
+    entry.code = pyframe->f_code;
+    entry.lasti = pyframe->f_lasti;
+    entry.lineno = PyCode_Addr2Line(pyframe->f_code, pyframe->f_lasti);
+  }
+  return entry.lineno;
+}
@@ -0,0 +1,132 @@
+#ifndef _HEAPPROF_TRACE_FINGERPRINTER_H__
+#define _HEAPPROF_TRACE_FINGERPRINTER_H__
+
+#include <stddef.h>
+#include <stdint.h>
+#include <memory>
+#include <unordered_map>
+#include <vector>
+#include "Python.h"
+#include "_heapprof/frame_filter.h"
+#include "_heapprof/simple_hash.h"
+#include "frameobject.h"
+
+// A TraceFingerprinter computes the "tracefp" of the current Python stack: a
+// hash of the (code object, line number) pairs of all of the frames which a
+// FrameFilter says should be recorded, which the profiler uses to find the
+// trace index of a sampled allocation. NB that this fingerprint will never be
+// committed to disk, so it only needs to be unique within the scope of this
+// program execution; that means we can safely hash just the code pointers.
+//
+// The naive way to do this is to walk the whole stack and hash every frame,
+// but that makes every sample cost O(stack depth), and most of that cost is in
+// PyFrame_GetLineNumber, which has to decode the code object's line number
+// table each time. But consecutive samples on the same thread almost always
+// share most of their stack -- typically everything but the innermost few
+// frames -- so we do it incrementally instead:
+//
+// * We hash from the outermost recorded frame inwards, so that the hash state
+//   after any given frame depends only on that frame and its callers. For each
+//   thread, we remember each frame in the last stack we fingerprinted, its
+//   instruction offset, and the hash state after that frame.
+// * On the next sample, we find the innermost remembered frame which is still
+//   running (the "anchor"), and walk inwards from the top of the stack only as
+//   far as that. Its callers can't have changed while it was running, and
+//   neither can their instruction offsets, so we resume hashing from the saved
+//   state, and only look at the frames inside it. (Generator and coroutine
+//   frames can be suspended and resumed from somewhere else, so those are
+//   never anchors; and if the anchor turns out not to be on the stack at all,
+//   as can happen with greenlets, we fall back to hashing everything.)
+// * Line numbers are further cached per (code object, instruction offset), so
+//   that a hot allocation site doesn't need to decode the line table at all.
+//
+// So a sample costs time proportional to the number of frames pushed since the
+// last one, not to the depth of the stack. This relies on frame identity: we
+// hold a reference to every remembered frame, so that none of them can be
+// freed and its memory reused for a new frame while we still remember it. A
+// frame we let go of may be the last reference to it, and freeing a frame can
+// run arbitrary Python code, which we must not do in the middle of an
+// allocation; so those are handed to the interpreter to release at its next
+// safe point. Note that this keeps the locals of frames which have returned
+// since the last sample alive until the next one.
+//
+// Allocations in the raw domain can happen without the GIL, and then we can't
+// touch reference counts; those samples walk and hash the whole stack, without
+// using the cache.
+//
+// This class is thread-compatible, but not thread-safe; it is only ever called
+// by the Profiler, under the same rules as the Profiler itself.
+class TraceFingerprinter {
+ public:
+  // Takes ownership of the filter.
+  explicit TraceFingerprinter(FrameFilter *filter);
+  ~TraceFingerprinter();
+
+  // Get the fingerprint of the current Python stack trace, or zero if we can't
+  // find the current thread's state.
+  uint32_t Fingerprint();
+
+  // The frames which went into the last fingerprint, innermost first, and
+  // whether any further recorded frames were cut off by the maximum depth.
+  // These are what should be written out if that fingerprint is new, and are
+  // only valid until the Python stack changes.
+  const std::vector<PyFrameObject *> &frames();
+  bool truncated() const { return truncated_; }
+
+ private:
+  // The state of one frame in the last stack seen on some thread.
+  struct CachedFrame {
+    // A reference we own.
+    PyFrameObject *frame;
+    int lasti;
+    // The hash of this frame and all of its callers.
+    SimpleHash hash;
+  };
+
+  // The last stack we fingerprinted on some thread.
+  struct CachedStack {
+    bool truncated = false;
+    // Outermost frame first.
+    std::vector<CachedFrame> frames;
+  };
+
+  struct LineCacheEntry {
+    const PyCodeObject *code;
+    int lasti;
+    int lineno;
+  };
+
+  // Walk the stack outwards from pyframe, appending the frames we'll record to
+  // frames_, until we reach stop (exclusive) or the end of the stack, or find
+  // more recorded frames than the maximum depth allows, in which case we set
+  // truncated_. Returns the frame at which the walk stopped.
+  PyFrameObject *CollectFrames(PyFrameObject *pyframe,
+                               const PyFrameObject *stop);
+
+  // Fingerprint() using the cache for this thread. Must hold the GIL.
+  uint32_t FingerprintCached(CachedStack *cache);
+
+  // Get the line number of a frame, which must not be one that's being traced.
+  int LineNumber(PyFrameObject *pyframe);
+
+  std::unique_ptr<FrameFilter> filter_;
+
+  // The last stack we fingerprinted on each thread. Entries for threads which
+  // have exited are never cleaned up, so their frames stay alive for as long as
+  // profiling is on.
+  std::unordered_map<const PyThreadState *, CachedStack> stacks_;
+
+  // The recorded frames of the current stack, innermost first. After a cached
+  // fingerprint, this only holds the frames inside the anchor, and last_stack_
+  // points at the rest, until frames() fills it in. (Keeping this as a member
+  // also means we don't reallocate it on every sample.)
+  std::vector<PyFrameObject *> frames_;
+  const CachedStack *last_stack_ = nullptr;
+  bool truncated_ = false;
+
+  // A direct-mapped cache from (code, lasti) to line number.
+  static const size_t kLineCacheSize = 4096;
+  std::vector<LineCacheEntry> line_cache_;
+};
+
+#endif  // _HEAPPROF_TRACE_FINGERPRINTER_H__
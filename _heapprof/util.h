@@ -15,10 +15,11 @@
 // deletes!) on exit.
 class ScopedFile {
  public:
-  // Create a ScopedFile for either reading or writing, depending on the
-  // parameter. After constructing it, if this is false, the file failed to open
-  // and the exception has been set.
-  ScopedFile(const char *filebase, const char *extension, bool write);
+  // Open a ScopedFile with the given mode: READ_MODE, WRITE_MODE (which
+  // truncates the file), or UPDATE_MODE (which reads and writes an existing
+  // file). After constructing it, if this is false, the file failed to open and
+  // the exception has been set.
+  ScopedFile(const char *filebase, const char *extension, int mode);
   ~ScopedFile();
 
   operator int() const { return fd_; }
@@ -50,12 +51,22 @@ class ScopedFile {
 #define MAX_SIGNED_VARINT_SIZE(signed_type) ((8 * sizeof(signed_type) + 5) / 7)
 #define MAX_UNSIGNED_VARINT_SIZE(us_type) ((8 * sizeof(us_type) + 6) / 7)
 
+// ZigZag-encode a signed value, so that numbers near zero of either sign have
+// short varint encodings.
+inline uint64_t ZigZagEncode(int64_t value) {
+  return (static_cast<uint64_t>(value) << 1) ^
+         static_cast<uint64_t>(value >> 63);
+}
+
+inline int64_t ZigZagDecode(uint64_t value) {
+  return static_cast<int64_t>(value >> 1) ^ -static_cast<int64_t>(value & 1);
+}
+
 // Write 'value' as a varint to the end of buffer, without doing any bounds
 // checking. (It's assumed that the caller has already guaranteed this!) Returns
 // a pointer immediately beyond that which was written. This code is based on
 // the method used in protobuf.
-inline uint8_t *UnsafeAppendVarint(uint8_t *buffer, int value) {
-  assert(value >= 0);
+inline uint8_t *UnsafeAppendVarint(uint8_t *buffer, uint64_t value) {
   // Common case: small value, one byte.
   if (value < 0x80) {
     buffer[0] = static_cast<uint8_t>(value);
@@ -79,6 +90,41 @@ inline uint8_t *UnsafeAppendVarint(uint8_t *buffer, int value) {
   return buffer;
 }
 
+// Decode a varint starting at *pos, and advance *pos past it, without doing any
+// bounds checking; the caller must guarantee that at least
+// MAX_UNSIGNED_VARINT_SIZE(uint64_t) bytes are readable. Returns false if the
+// varint is longer than that, i.e. can't be decoded into a uint64.
+inline bool UnsafeDecodeVarint(const uint8_t **pos, uint64_t *value) {
+  const uint8_t *p = *pos;
+  // Common case: a single byte.
+  if (PREDICT_TRUE(*p < 0x80)) {
+    *value = *p;
+    *pos = p + 1;
+    return true;
+  }
+  uint64_t result = *p & 0x7f;
+  for (int shift = 7; shift < 70; shift += 7) {
+    ++p;
+    result |= static_cast<uint64_t>(*p & 0x7f) << shift;
+    if (!(*p & 0x80)) {
+      *value = result;
+      *pos = p + 1;
+      return true;
+    }
+  }
+  return false;
+}
+
+// The number of bytes UnsafeAppendVarint will use to encode value.
+inline size_t VarintSize(uint64_t value) {
+  size_t size = 1;
+  while (value >= 0x80) {
+    value >>= 7;
+    ++size;
+  }
+  return size;
+}
+
 // True if x is a UINT32-aligned pointer.
 #define UINT32_ALIGNED(x) ((reinterpret_cast<intptr_t>(x) & 0x3) == 0)
 
@@ -94,27 +140,16 @@ inline uint8_t *UnsafeAppendFixed32(uint8_t *buffer, uint32_t value) {
   return buffer + sizeof(uint32_t);
 }
 
-// The read/write functions below are thread-hostile; they must only be called
-// from a single thread at a time.
-// All of these functions set the Python exception whenever they fail.
-
-// Write single numbers to a file.
-void WriteVarintToFile(int fd, uint64_t value);
-void WriteFixed32ToFile(int fd, uint32_t value);
-void WriteFixed64ToFile(int fd, uint64_t value);
-
-// Read single numbers from a file. If they return false, they also set the
-// Python exception.
-bool ReadVarintFromFile(int fd, uint64_t *value);
-bool ReadFixed32FromFile(int fd, uint32_t *value);
-bool ReadFixed64FromFile(int fd, uint64_t *value);
-
-// Write a string to a file as varint length + bytes. Fails (and sets the
-// exception) only if the passed argument isn't a valid string.
-bool WriteStringToFile(int fd, PyObject *value);
-// Returns nullptr and sets the exception on failure; returns a reference owned
-// by the caller on success.
-PyObject *ReadStringFromFile(int fd);
+inline uint8_t *UnsafeAppendFixed64(uint8_t *buffer, uint64_t value) {
+  const uint64_t norm = absl::ghtonll(value);
+  memcpy(buffer, &norm, sizeof(uint64_t));
+  return buffer + sizeof(uint64_t);
+}
+
+// Write all size bytes of data to the file, retrying on short writes. To write
+// anything smaller than a big block, use a BufferedWriter; to read, use a
+// FileReader.
+void WriteFully(int fd, const void *data, size_t size);
 
 // Set result = stop - start. result->tv_nsec is guaranteed to be in [0, 1B)
 inline void DeltaTime(const struct timespec &start, const struct timespec &stop,
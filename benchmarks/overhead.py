@@ -0,0 +1,285 @@
+"""Measure the overhead which heapprof adds to allocation-heavy programs.
+
+This runs a set of standard workloads -- lots of small objects, dict and list churn, large buffers,
+allocation at the bottom of a deep recursion, and several threads allocating buffers big enough to
+go through the RAW allocator domain -- first with no profiler, then under gatherStats(), and then
+under start() at a range of sampling rates. For each combination it reports:
+
+    seconds: The fastest time taken by the workload, over all repeats.
+    allocations: The number of allocator calls the profiler saw during that run.
+    nsPerAlloc: The extra time per allocator call, relative to the unprofiled run.
+    slowdown: The ratio of the time taken to the unprofiled time.
+    hpdBytesPerSec: How fast the profiler was writing its .hpd file.
+
+The results are written as JSON, so that they can be saved and compared over time to spot
+regressions in the hook path (sampler.h, profiler.cc, file_format.cc, and friends).
+
+Run it with::
+
+    python -m benchmarks.overhead [--output results.json]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import heapprof
+
+# The sampling rates at which to run start(), from cheapest to most expensive.
+SAMPLING_RATES: Dict[str, Dict[int, float]] = {
+    'sparse': {128: 1e-5, 8192: 0.01},
+    'default': heapprof.DEFAULT_SAMPLING_RATE,
+    'dense': {128: 1e-3, 8192: 1.0},
+    'everything': {1: 1.0},
+}
+
+CONFIGS = ['none', 'gatherStats'] + [f'start:{name}' for name in SAMPLING_RATES]
+
+
+##################################################################################################
+# Workloads
+#
+# Each of these takes a scale factor (1 is a run of a few hundred milliseconds on a typical
+# machine) and does its work; they're timed from the outside. They deliberately keep what they
+# allocate alive for a while, so that frees are interleaved with allocations the way they are in
+# real programs.
+
+
+class _Node(object):
+    __slots__ = ('value', 'next')
+
+    def __init__(self, value: int, next: Optional['_Node']) -> None:
+        self.value = value
+        self.next = next
+
+
+def smallObjects(scale: int) -> None:
+    """Many small, short-lived objects: tuples, strings, and linked-list nodes."""
+    for _ in range(scale * 80):
+        head = None
+        for i in range(5000):
+            head = _Node(i, head)
+            (i, str(i))
+
+
+def dictListChurn(scale: int) -> None:
+    """Containers which grow and shrink, so that they keep reallocating their storage."""
+    for _ in range(scale * 150):
+        d: Dict[int, List[int]] = {}
+        for i in range(2000):
+            d[i] = [i] * (i % 16)
+            d[i].append(i)
+        for i in range(0, 2000, 2):
+            del d[i]
+        list(d.items())
+
+
+def largeBuffers(scale: int) -> None:
+    """Buffers from 1KiB to 256KiB, most of which are past the small-object allocator."""
+    for _ in range(scale * 50):
+        keep = []
+        for i in range(1000):
+            keep.append(bytearray(1024 << (i % 9)))
+            if len(keep) > 16:
+                keep.pop(0)
+
+
+def _recurse(depth: int, fn: Callable[[], None]) -> None:
+    if depth <= 0:
+        fn()
+    else:
+        _recurse(depth - 1, fn)
+
+
+def deepRecursion(scale: int) -> None:
+    """Allocations made at the bottom of a 100-frame stack, which makes tracing them expensive."""
+
+    def allocate() -> None:
+        for i in range(2000):
+            [i, str(i)]
+            bytearray(256)
+
+    for _ in range(scale * 300):
+        _recurse(100, allocate)
+
+
+def threadedRaw(scale: int) -> None:
+    """Several threads at once allocating buffers which go through the RAW domain."""
+
+    def worker() -> None:
+        for i in range(scale * 50000):
+            bytearray(4096 + (i % 64) * 1024)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+WORKLOADS: Dict[str, Callable[[int], None]] = {
+    'smallObjects': smallObjects,
+    'dictListChurn': dictListChurn,
+    'largeBuffers': largeBuffers,
+    'deepRecursion': deepRecursion,
+    'threadedRaw': threadedRaw,
+}
+
+
+##################################################################################################
+# Measurement
+
+
+class Run(NamedTuple):
+    seconds: float
+    # The profiler's statistics at the end of the run, or None if there was no profiler.
+    stats: Optional[Dict[str, int]]
+    hpdBytes: int
+
+
+@contextlib.contextmanager
+def _quietStderr() -> Iterator[None]:
+    """Send stderr (at the file descriptor level) to /dev/null, to keep gatherStats() from printing
+    its report after every run.
+    """
+    sys.stderr.flush()
+    saved = os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 2)
+        yield
+    finally:
+        os.dup2(saved, 2)
+        os.close(devnull)
+        os.close(saved)
+
+
+def runOnce(workload: Callable[[int], None], scale: int, config: str, filebase: str) -> Run:
+    """Run a workload once under the given configuration."""
+    if config == 'none':
+        start = time.perf_counter()
+        workload(scale)
+        return Run(time.perf_counter() - start, None, 0)
+
+    if config == 'gatherStats':
+        heapprof.gatherStats()
+    else:
+        heapprof.start(filebase, SAMPLING_RATES[config.split(':', 1)[1]])
+
+    try:
+        start = time.perf_counter()
+        workload(scale)
+        seconds = time.perf_counter() - start
+        stats = heapprof.profilerStats()
+    finally:
+        with _quietStderr():
+            heapprof.stop()
+
+    hpdBytes = os.path.getsize(filebase + '.hpd') if config != 'gatherStats' else 0
+    return Run(seconds, stats, hpdBytes)
+
+
+def measure(name: str, scale: int, repeats: int, configs: List[str], path: str) -> List[Any]:
+    """Measure one workload under each configuration, returning a list of result dicts."""
+    workload = WORKLOADS[name]
+    # Run it once to warm things up (imports, caches, the allocator's arenas) before timing it.
+    workload(scale)
+
+    best: Dict[str, Run] = {}
+    # Interleave the configurations, so that any drift in the machine's speed affects them alike.
+    for repeat in range(repeats):
+        for config in configs:
+            filebase = os.path.join(path, f'{name}-{config.replace(":", "-")}-{repeat}')
+            run = runOnce(workload, scale, config, filebase)
+            if config not in best or run.seconds < best[config].seconds:
+                best[config] = run
+            for suffix in ('.hpm', '.hpd'):
+                if os.path.exists(filebase + suffix):
+                    os.unlink(filebase + suffix)
+
+    baseline = best['none'].seconds
+    results = []
+    for config in configs:
+        run = best[config]
+        allocations = (
+            run.stats['rawHooks'] + run.stats['memHooks'] + run.stats['objHooks']
+            if run.stats is not None
+            else None
+        )
+        results.append(
+            {
+                'workload': name,
+                'config': config,
+                'seconds': run.seconds,
+                'allocations': allocations,
+                'nsPerAlloc': 1e9 * (run.seconds - baseline) / allocations if allocations else None,
+                'slowdown': run.seconds / baseline if baseline else None,
+                'hpdBytesPerSec': run.hpdBytes / run.seconds if run.hpdBytes else None,
+            }
+        )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '--workloads',
+        default=','.join(WORKLOADS),
+        help=f'Comma-separated list of workloads to run, from: {", ".join(WORKLOADS)}',
+    )
+    parser.add_argument(
+        '--configs',
+        default=','.join(CONFIGS),
+        help=f'Comma-separated list of configurations to run, from: {", ".join(CONFIGS)}',
+    )
+    parser.add_argument('--scale', type=int, default=1, help='How much work each workload does')
+    parser.add_argument('--repeats', type=int, default=3, help='Measurements per configuration')
+    parser.add_argument('--output', help='Where to write the JSON results; default is stdout')
+    args = parser.parse_args()
+
+    workloads = args.workloads.split(',')
+    configs = args.configs.split(',')
+    for name in workloads:
+        if name not in WORKLOADS:
+            parser.error(f'Unknown workload "{name}"')
+    for config in configs:
+        if config not in CONFIGS:
+            parser.error(f'Unknown configuration "{config}"')
+    # Everything is measured relative to the unprofiled run.
+    if 'none' not in configs:
+        configs.insert(0, 'none')
+
+    results: List[Any] = []
+    with TemporaryDirectory() as path:
+        for name in workloads:
+            print(f'Running {name}...', file=sys.stderr)
+            results.extend(measure(name, args.scale, args.repeats, configs, path))
+
+    report = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'repeats': args.repeats,
+        'samplingRates': {name: list(rate.items()) for name, rate in SAMPLING_RATES.items()},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Measure how the cost of profiling a sampled allocation grows with the depth of the Python stack.
+
+Every sampled allocation has to fingerprint the current stack trace, so that the profiler can find
+(or assign) its trace index. This benchmark recurses to a range of depths, and at each depth
+repeatedly allocates objects with every allocation sampled, reporting the profiler's overhead per
+allocation as the difference between profiled and unprofiled runs.
+
+Fingerprinting only looks at the frames pushed since the previous sample on the same thread, so the
+overhead should be flat across depths: any growth with depth is a regression.
+
+Run it with::
+
+    python -m benchmarks.stack_depth
+"""
+
+import argparse
+import os
+import time
+from tempfile import TemporaryDirectory
+from typing import Callable, List
+
+import heapprof
+
+# Sample every allocation, so that each one goes through the full fingerprinting path.
+SAMPLE_EVERYTHING = {1: 1.0}
+
+
+def _atDepth(depth: int, fn: Callable[[], float]) -> float:
+    """Call fn() with (about) depth extra frames on the stack."""
+    if depth <= 0:
+        return fn()
+    return _atDepth(depth - 1, fn)
+
+
+def _allocate(count: int) -> float:
+    """Allocate count small objects from a single line of code, returning elapsed seconds."""
+    start = time.perf_counter()
+    for i in range(count):
+        # Each iteration allocates a fresh one-element list.
+        [i]
+    return time.perf_counter() - start
+
+
+def nsPerSample(depth: int, count: int, repeats: int, filebase: str) -> float:
+    """Return the profiler's overhead, in nanoseconds per sampled allocation, at the given depth."""
+    baseline: List[float] = []
+    profiled: List[float] = []
+    for _ in range(repeats):
+        baseline.append(_atDepth(depth, lambda: _allocate(count)))
+
+        heapprof.start(filebase, SAMPLE_EVERYTHING)
+        try:
+            profiled.append(_atDepth(depth, lambda: _allocate(count)))
+        finally:
+            heapprof.stop()
+
+    # NB that this is per iteration of _allocate's loop, which (thanks to the int) may make more than
+    # one allocation; what matters is how the number changes with depth.
+    return 1e9 * (min(profiled) - min(baseline)) / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--depths', default='1,10,30,60,120,250,500', help='Comma-separated list of stack depths'
+    )
+    parser.add_argument('--count', type=int, default=20000, help='Allocations per measurement')
+    parser.add_argument('--repeats', type=int, default=5, help='Measurements per depth')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as path:
+        filebase = os.path.join(path, 'hprof')
+        print('depth   ns/alloc')
+        for depth in (int(d) for d in args.depths.split(',')):
+            cost = nsPerSample(depth, args.count, args.repeats, filebase)
+            print(f'{depth:5d} {cost:10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from typing import Dict, Optional
+from typing import Dict, Optional, Sequence
 
 import _heapprof
 
@@ -12,8 +12,23 @@ from .types import (HeapTrace, RawTrace, RawTraceLine, Snapshot,  # noqa
 # be the right one for any particular case.
 DEFAULT_SAMPLING_RATE = {128: 1e-4, 8192: 0.1}
 
-
-def start(filebase: str, samplingRate: Optional[Dict[int, float]] = None) -> None:
+# Output is buffered in memory and written out in blocks of this many bytes per file, ...
+DEFAULT_BUFFER_SIZE = 1 << 20
+# ... or at least once this many seconds, so that you can watch a profile as it's being written.
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+def start(
+    filebase: str,
+    samplingRate: Optional[Dict[int, float]] = None,
+    samplingInterval: Optional[int] = None,
+    bufferSize: int = DEFAULT_BUFFER_SIZE,
+    flushInterval: Optional[float] = DEFAULT_FLUSH_INTERVAL,
+    backgroundFlush: bool = False,
+    maxStackDepth: Optional[int] = None,
+    includePrefixes: Optional[Sequence[str]] = None,
+    excludePrefixes: Optional[Sequence[str]] = None,
+) -> None:
     """Start heapprof in profiling (normal) mode.
 
     Args:
@@ -25,14 +40,63 @@ def start(filebase: str, samplingRate: Optional[Dict[int, float]] = None) -> Non
             the largest range given is always 1; thus the default value means to profile allocations
             of 1-127 bytes at 1 in 10,000, to profile allocations of 128-8,191 bytes at 1 in 10, and
             to profile all allocations of 8,192 bytes or more.
+        samplingInterval: If given, use interval sampling instead of samplingRate: rather than
+            picking a probability for each allocation based on its size, sample allocations on
+            average once every this many bytes, like tcmalloc does. An allocation of N bytes is
+            then sampled with probability 1 - exp(-N / samplingInterval). This adds much less
+            overhead to each allocation than samplingRate, at the cost of less fine-grained
+            control. A good starting point is something like 512 * 1024. You may not pass both
+            this and samplingRate.
+        bufferSize: The size, in bytes, of the in-memory buffer for each output file. Rather than
+            issuing a system call per event, the profiler fills this buffer and writes it out all
+            at once; bigger buffers mean fewer (but larger) writes.
+        flushInterval: If set, the buffers are also flushed whenever this many seconds have passed
+            since they were last flushed, so that the files on disk never fall too far behind the
+            running program. If None (or zero), the buffers are only flushed when they fill up and
+            when the profiler is stopped. Either way, stopping the profiler (or exiting the program)
+            flushes everything, and leaves complete, valid files behind.
+        backgroundFlush: If True, the buffers are written to disk by a dedicated native thread,
+            so that whichever thread happens to fill a buffer never has to wait on disk I/O. This
+            is useful on slow disks, but has a tradeoff: if that thread falls so far behind that
+            there is nowhere left to put new events, they are dropped rather than waited for. The
+            number of dropped events is recorded in the profile; see Reader.droppedEvents().
+        maxStackDepth: If set, only record this many of the innermost frames of each stack trace.
+            Traces which were cut short this way end in a truncation marker; see
+            RawTraceLine.isTruncationMarker(). This keeps deeply recursive code from producing
+            enormous .hpm files.
+        includePrefixes: If given, only record stack frames whose filenames start with one of
+            these prefixes.
+        excludePrefixes: If given, never record stack frames whose filenames start with one of
+            these prefixes. This takes precedence over includePrefixes. (Frames from "files" whose
+            names start with "<", like "<frozen importlib._bootstrap>", are never recorded.)
+            Note that filtering applies to every frame, including the innermost one: an
+            allocation made inside an excluded library is attributed to the innermost recorded
+            frame which called into it. Filtered frames don't count against maxStackDepth.
 
     Raises:
         TypeError: If samplingRate is not a mapping of the appropriate type.
-        ValueError: If samplingRate contains repeated entries.
+        ValueError: If samplingRate contains repeated entries, if both samplingRate and
+            samplingInterval are given, or if any of the other arguments are invalid.
         RuntimeError: If the profiler is already running.
     """
+    if samplingInterval is not None and samplingRate is not None:
+        raise ValueError('You may pass samplingRate or samplingInterval, but not both')
+    if samplingInterval is not None and samplingInterval <= 0:
+        raise ValueError('samplingInterval must be a positive number of bytes')
+    if samplingInterval is not None:
+        samplingRate = {}
+    if maxStackDepth is not None and maxStackDepth <= 0:
+        raise ValueError('maxStackDepth must be a positive number of frames')
     _heapprof.startProfiler(
-        filebase, samplingRate if samplingRate is not None else DEFAULT_SAMPLING_RATE
+        filebase,
+        samplingRate if samplingRate is not None else DEFAULT_SAMPLING_RATE,
+        samplingInterval or 0,
+        bufferSize,
+        int(flushInterval * 1000) if flushInterval else 0,
+        backgroundFlush,
+        maxStackDepth or 0,
+        list(includePrefixes) if includePrefixes is not None else None,
+        list(excludePrefixes) if excludePrefixes is not None else None,
     )
 
 
@@ -58,7 +122,43 @@ def isProfiling() -> bool:
     return _heapprof.isProfiling()
 
 
-def read(filebase: str, timeInterval: float = 60, precision: float = 0.01) -> Reader:
+def profilerStats() -> Optional[Dict[str, int]]:
+    """Return statistics about the running profiler itself, or None if it isn't running. These are
+    useful for figuring out what the profiler is costing you.
+
+    In any mode, these include:
+        rawHooks, memHooks, objHooks: The number of allocator calls seen by the profiler in each of
+            Python's allocator domains.
+        hookNanos: An estimate of the total time, in nanoseconds, which the profiler spent
+            handling those calls, not counting the time spent in the underlying allocator (or in
+            the thin wrappers around it). This is estimated by timing a sample of the calls, since
+            timing all of them would noticeably slow them down.
+
+    In profiling mode, they also include:
+        sampledAllocs, sampledFrees: The number of events recorded.
+        droppedAllocs, droppedFrees: The number of events dropped; see backgroundFlush in start().
+        hpdBytes, hpmBytes: The number of bytes written to each output file so far.
+        distinctTraces: The number of distinct stack traces written so far.
+        checkpoints: The number of checkpoints written to the .hpd file; see HPD.range().
+        liveSetEntries, traceIndexEntries: The number of sampled allocations which are currently
+            live, and the number of distinct stack traces being tracked.
+        liveSetBytes, traceIndexBytes, bufferBytes: The memory used by the profiler to track
+            those, and to buffer its output.
+        memoryBytes: The total of all of the above.
+
+    The same statistics are written to the profile when the profiler stops, and can be read back
+    with Reader.profilerStats().
+    """
+    return _heapprof.profilerStats()
+
+
+def read(
+    filebase: str,
+    timeInterval: float = 60,
+    precision: float = 0.01,
+    jobs: Optional[int] = 1,
+    levels: Sequence[float] = (),
+) -> Reader:
     """Open a reader, and create a digest for it if needed.
 
     Args:
@@ -71,8 +171,17 @@ def read(filebase: str, timeInterval: float = 60, precision: float = 0.01) -> Re
             memory used at that frame may be dropped into the "other stack trace" bucket.
             This can greatly shrink the size of the digest at no real cost in usefulness.
             Must be in [0, 1); a value of zero means nothing is dropped.
+        jobs: The number of threads to use to create the digest, or None to use one per CPU.
+        levels: The time intervals of any coarser levels of the digest to create; see
+            Reader.makeDigest.
     """
     r = Reader(filebase)
     if not r.hasDigest():
-        r.makeDigest(timeInterval=timeInterval, precision=precision, verbose=True)
+        r.makeDigest(
+            timeInterval=timeInterval,
+            precision=precision,
+            verbose=True,
+            jobs=jobs,
+            levels=levels,
+        )
     return r
@@ -16,6 +16,22 @@ parser.add_argument(
 )
 parser.add_argument("-o", "--output", help="Output file base", default="hprof")
 parser.add_argument("--sample", help="Sampling rate dictionary")
+parser.add_argument(
+    "--sample-interval", type=int, help="Sample once every this many bytes, instead of --sample"
+)
+parser.add_argument(
+    "--max-stack-depth", type=int, help="Record at most this many frames of each stack trace"
+)
+parser.add_argument(
+    "--include",
+    action="append",
+    help="Only record frames from files starting with this prefix (may be repeated)",
+)
+parser.add_argument(
+    "--exclude",
+    action="append",
+    help="Never record frames from files starting with this prefix (may be repeated)",
+)
 parser.add_argument("command", nargs="+")
 args = parser.parse_args()
 
@@ -39,7 +55,14 @@ globs = {
 }
 
 if args.mode == "profile":
-    heapprof.start(args.output, sampleRate)
+    heapprof.start(
+        args.output,
+        sampleRate,
+        samplingInterval=args.sample_interval,
+        maxStackDepth=args.max_stack_depth,
+        includePrefixes=args.include,
+        excludePrefixes=args.exclude,
+    )
 elif args.mode == "stats":
     heapprof.gatherStats()
 else:
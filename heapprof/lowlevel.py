@@ -1,6 +1,15 @@
+import bisect
 import linecache
-from typing import (Any, Dict, Iterable, Iterator, List, NamedTuple, Optional,
-                    Sequence)
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (Any, Deque, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Sequence, Tuple, cast)
 
 import _heapprof
 
@@ -18,17 +27,44 @@ class HPM(object):
     def __init__(self, filebase: str) -> None:
         self._mdfile = open(filebase + ".hpm", "rb")
 
-        # The raw stack traces that we've loaded so far. traceindices are 1-based indices into this
-        # array.
-        self._rawTraces: List[RawTrace] = []
+        # Every distinct line that appears in the raw stack traces we've loaded so far, by frame
+        # id, and the other way around. Traces are kept as arrays of these ids rather than as lists
+        # of RawTraceLines, so that a big profile doesn't need a pile of Python objects per trace.
+        self._frames: List[RawTraceLine] = []
+        self._frameIds: Dict[RawTraceLine, int] = {}
+        # The frame ids of the raw stack traces that we've loaded so far, by traceindex, outermost
+        # frame first.
+        self._traceFrames: Dict[int, array] = {}
         # The "clean" stack traces, including contents. We generate these separately because pulling
         # out the lines of code is expensive, so we only do it if someone asks for a given trace.
         self._traces: Dict[int, HeapTrace] = {}
-        # True if we've read to the end of self._mdfile
-        self._allTracesRead = False
 
-        # Read the metadata and compute our scale factors.
-        self._initialTime, self._samplingRate = _heapprof.readMetadata(self._mdfile.fileno())
+        # Read the metadata and compute our scale factors. If the profile was stopped cleanly, the
+        # raw traces are followed by a footer, and we need to know where to stop reading them.
+        # Newer .hpm files also write out each filename only once, and after that refer to it by its
+        # index in self._filenames; the native readers need that table to decode them, and add to
+        # it as they go. It's None for older files, which spell out every filename in full.
+        (
+            self._initialTime,
+            self._samplingRate,
+            self._samplingInterval,
+            self._profilerStats,
+            self._tracesEnd,
+            traceOffsets,
+            self._filenames,
+        ) = _heapprof.readMetadata(self._mdfile.fileno())
+        self._tracesStart = os.lseek(self._mdfile.fileno(), 0, os.SEEK_CUR)
+
+        # The file offset of each raw trace, so that we can read any one of them without reading
+        # all the ones before it; traceindex N is at self._traceOffsets[N - 1]. If the profiler
+        # stopped cleanly, this is in the footer; otherwise, we build it the first time we need
+        # it, by skimming the file, and extend it if the file grows. self._indexedTo is the offset
+        # just past the last trace in it.
+        self._traceOffsets = array("Q")
+        self._indexedTo = self._tracesStart
+        if traceOffsets is not None:
+            self._traceOffsets.frombytes(traceOffsets)
+            self._indexedTo = self._tracesEnd
         self._scaleFactors = sorted(
             [
                 (maxSize, 1 / probability if probability != 0 else 0)
@@ -50,29 +86,86 @@ class HPM(object):
         """
         return self._samplingRate
 
+    @property
+    def samplingInterval(self) -> Optional[int]:
+        """If this profile was made with interval sampling, return the mean number of bytes between
+        samples; otherwise, None. If this is set, samplingRate is empty, and an allocation of size X
+        was sampled with probability 1 - exp(-X / samplingInterval).
+        """
+        return self._samplingInterval or None
+
+    @property
+    def profilerStats(self) -> Dict[str, int]:
+        """Return the statistics which the profiler recorded about itself when it was stopped, such
+        as the number of events it had to drop and the time it spent in the allocation hooks; see
+        heapprof.profilerStats() for the full list. This is empty if the profiler was never stopped
+        cleanly.
+        """
+        return self._profilerStats
+
     def rawTrace(self, traceindex: int) -> Optional[RawTrace]:
         """Given a traceindex (of the sort found in an HPDEvent), find the corresponding raw stack
         trace. Returns None if there is no known trace for this traceindex.
         """
+        frameIds = self.traceFrames(traceindex)
+        if frameIds is None:
+            return None
+        frames = self._frames
+        return [frames[frameId] for frameId in frameIds]
+
+    def traceFrames(self, traceindex: int) -> Optional[array]:
+        """Like rawTrace, but return the trace as an array('I') of frame ids, outermost frame
+        first; frame() turns these back into RawTraceLines. This is much cheaper than rawTrace, so
+        it's the way to go if you're going to look at a lot of traces.
+        """
         # traceindex 0 is reserved to mean "the bogus index."
         if not traceindex:
             return None
+        if traceindex in self._traceFrames:
+            return self._traceFrames[traceindex]
 
         # See if we need to read the raw trace from disk.
-        while traceindex > len(self._rawTraces) and not self._allTracesRead:
-            try:
-                # Raw traces are stored on disk in reverse order, which makes them faster to write;
-                # undo that here!
-                self._rawTraces.append(
-                    list(
-                        RawTraceLine(*line)
-                        for line in reversed(_heapprof.readRawTrace(self._mdfile.fileno()))
-                    )
-                )
-            except EOFError:
-                self._allTracesRead = True
+        if traceindex > len(self._traceOffsets):
+            self._indexTraces()
+            if traceindex > len(self._traceOffsets):
+                return None
+        fd = self._mdfile.fileno()
+        os.lseek(fd, self._traceOffsets[traceindex - 1], os.SEEK_SET)
+        # Raw traces are stored on disk in reverse order, which makes them faster to write; undo
+        # that here!
+        frameIds = array(
+            "I",
+            (
+                self.frameId(RawTraceLine(*line))
+                for line in reversed(_heapprof.readRawTrace(fd, self._filenames))
+            ),
+        )
+        self._traceFrames[traceindex] = frameIds
+        return frameIds
+
+    def traceCount(self) -> int:
+        """Return the number of raw traces in the file so far; their traceindices are 1 through
+        this.
+        """
+        self._indexTraces()
+        return len(self._traceOffsets)
 
-        return self._rawTraces[traceindex - 1] if traceindex <= len(self._rawTraces) else None
+    def frame(self, frameId: int) -> RawTraceLine:
+        """Return the line of code with the given frame id."""
+        return self._frames[frameId]
+
+    def frameId(self, line: RawTraceLine) -> int:
+        """Return the frame id of a line of code. Lines which haven't shown up in any trace loaded
+        so far get a fresh id, so this is safe to call on any line at all; a line which isn't part
+        of any trace simply never matches one.
+        """
+        frameId = self._frameIds.get(line)
+        if frameId is None:
+            frameId = len(self._frames)
+            line = RawTraceLine(*line)
+            self._frames.append(line)
+            self._frameIds[line] = frameId
+        return frameId
 
     def trace(self, traceindex: int) -> Optional[HeapTrace]:
         """Given a traceindex (of the sort found in an HPDEvent), find the corresponding stack
@@ -92,6 +185,9 @@ class HPM(object):
     def scaleFactor(self, eventSize: int) -> float:
         """Given an event size, find the appropriate scale factor for it."""
         absSize = abs(eventSize)
+        if self._samplingInterval:
+            # With interval sampling, events of size zero are never sampled, so any factor will do.
+            return 1 / -math.expm1(-absSize / self._samplingInterval) if absSize else 1
         for maxSize, scaleFactor in self._scaleFactors:
             if absSize < maxSize:
                 return scaleFactor
@@ -99,10 +195,20 @@ class HPM(object):
 
     def warmRawTraceCache(self) -> None:
         """rawTrace() can be slow, because it may need to fetch traces out of the HPM file. Calling
-        this function forces that entire load to happen at once.
+        this function forces that entire load to happen at once, in a single pass over the file.
         """
-        # This number is bigger than the biggest valid trace index.
-        self.rawTrace(1 << 31)
+        traces, offsets, self._indexedTo = _heapprof.readAllRawTraces(
+            self._mdfile.fileno(),
+            self._tracesStart,
+            self._tracesEnd,
+            RawTraceLine,
+            self._frames,
+            self._frameIds,
+            self._filenames,
+        )
+        self._traceFrames = dict(enumerate(traces, 1))
+        self._traceOffsets = array("Q")
+        self._traceOffsets.frombytes(offsets)
 
     def close(self) -> None:
         if hasattr(self, "_mdfile"):
@@ -115,6 +221,15 @@ class HPM(object):
     def __del__(self) -> None:
         self.close()
 
+    def _indexTraces(self) -> None:
+        """Extend self._traceOffsets to cover all the traces in the file."""
+        if self._tracesEnd and self._indexedTo >= self._tracesEnd:
+            return
+        offsets, self._indexedTo = _heapprof.indexRawTraces(
+            self._mdfile.fileno(), self._indexedTo, self._tracesEnd, self._filenames
+        )
+        self._traceOffsets.frombytes(offsets)
+
     def _makeHeapTrace(self, rawTrace: Optional[RawTrace]) -> Optional[HeapTrace]:
         if not rawTrace:
             return None
@@ -122,7 +237,11 @@ class HPM(object):
             TraceLine(
                 filename=rawTraceLine.filename,
                 lineno=rawTraceLine.lineno,
-                fileline=linecache.getline(rawTraceLine.filename, rawTraceLine.lineno).strip(),
+                fileline=(
+                    '(outer frames not recorded)'
+                    if rawTraceLine.isTruncationMarker()
+                    else linecache.getline(rawTraceLine.filename, rawTraceLine.lineno).strip()
+                ),
             )
             for rawTraceLine in rawTrace
         ]
@@ -147,12 +266,41 @@ class HPDEvent(NamedTuple):
     scaleFactor: float
 
 
+class HPDBatch(NamedTuple):
+    """A run of consecutive events from a .hpd file, as parallel arrays with one entry per event.
+    The fields mean the same as those of HPDEvent. The arrays support the buffer protocol, so if you
+    have NumPy, np.frombuffer() can wrap them without copying.
+    """
+
+    # Timestamps, in seconds since the epoch, as doubles (typecode 'd').
+    timestamps: array
+
+    # Trace indices, as unsigned 32-bit ints (typecode 'I').
+    traceindices: array
+
+    # Signed sizes, as 64-bit ints (typecode 'q').
+    sizes: array
+
+    # Scale factors, as doubles (typecode 'd').
+    scaleFactors: array
+
+
 class HPD(Iterable[HPDEvent]):
-    """HPD is the low-level interface to a .hpd file."""
+    """HPD is the low-level interface to a .hpd file.
+
+    As well as events, the .hpd file contains periodic checkpoints which record the absolute time,
+    and when the profiler stops cleanly, it writes an index of those to a .hpi file. That lets
+    range() read a stretch of the profile without reading everything before it.
+    """
 
     def __init__(self, filebase: str, hpm: Optional[HPM] = None) -> None:
         self.hpm = hpm or HPM(filebase)
         self._dataFileName = filebase + ".hpd"
+        self._indexFileName = filebase + ".hpi"
+        # The (time, offset) of each checkpoint, loaded on first use. This is empty if there's no
+        # index, e.g. because the profile predates them or the profiler never stopped cleanly.
+        self._checkpoints: Optional[List[Tuple[float, int]]] = None
+        self._checkpointTimes: List[float] = []
 
     def __iter__(self) -> Iterator[HPDEvent]:
         """Yield a sequence of heap events. Each event contains a timestamp, a stack trace index,
@@ -162,27 +310,163 @@ class HPD(Iterable[HPDEvent]):
         has been made here at "inverse scaling" that.
         """
         with open(self._dataFileName, "rb") as datafile:
+            yield from self._readEvents(datafile.fileno(), self.hpm.initialTime)
+
+    def batches(self, size: int = 65536) -> Iterator[HPDBatch]:
+        """Yield the same events as __iter__, in batches of up to size events each. The events are
+        decoded in native code a whole batch at a time, without making a Python object for each
+        one, so this is the way to go if you're going to scan a big profile yourself.
+        """
+        with open(self._dataFileName, "rb") as datafile:
+            yield from self._readBatches(datafile.fileno(), self.hpm.initialTime, size)
+
+    def range(self, startTime: float, endTime: float) -> Iterator[HPDEvent]:
+        """Yield the events with startTime <= timestamp < endTime, just as __iter__ would. Times
+        are in seconds since the epoch, like event timestamps.
+
+        If the profile has a checkpoint index, this starts reading from the last checkpoint before
+        startTime, rather than from the start of the file, so its cost depends on the length of the
+        range rather than on where in the profile it is.
+        """
+        with open(self._dataFileName, "rb") as datafile:
+            fd = datafile.fileno()
             lastTime = self.hpm.initialTime
-            while True:
+            offset = self._checkpointBefore(startTime)
+            if offset is not None:
+                os.lseek(fd, offset, os.SEEK_SET)
                 try:
-                    deltaTime, traceindex, size = _heapprof.readEvent(datafile.fileno())
-                except EOFError:
+                    lastTime = _heapprof.readCheckpoint(fd)
+                except (ValueError, EOFError):
+                    # The index doesn't match the file; fall back to reading all of it.
+                    os.lseek(fd, 0, os.SEEK_SET)
+
+            for event in self._readEvents(fd, lastTime):
+                if event.timestamp >= endTime:
                     break
-                else:
-                    newTime = lastTime + deltaTime
-                    yield HPDEvent(newTime, traceindex, size, self.hpm.scaleFactor(size))
-                    lastTime = newTime
+                if event.timestamp >= startTime:
+                    yield event
 
+    def checkpoints(self) -> List[Tuple[float, int]]:
+        """Return the (time, file offset) of each checkpoint in the .hpi index, or an empty list
+        if there's no index.
+        """
+        if self._checkpoints is None:
+            checkpoints: List[Tuple[float, int]] = []
+            if os.path.exists(self._indexFileName):
+                with open(self._indexFileName, "rb") as indexfile:
+                    checkpoints = _heapprof.readCheckpointIndex(indexfile.fileno())
+            self._checkpoints = checkpoints
+            self._checkpointTimes = [time for time, offset in checkpoints]
+        return self._checkpoints
 
-class HPC(Sequence[Snapshot]):
-    """HPC is the low-level interface to .hpc files."""
+    ############################################################################################
+    # Implementation details beyond this point.
 
-    def __init__(self, filebase: str, hpm: Optional[HPM] = None) -> None:
+    # The number of events to decode at a time when iterating over single events.
+    _EVENT_BATCH_SIZE = 4096
+
+    def _readEvents(self, fd: int, baseTime: float) -> Iterator[HPDEvent]:
+        """Read events from fd until EOF, given the time which the first one is relative to."""
+        for batch in self._readBatches(fd, baseTime, self._EVENT_BATCH_SIZE):
+            yield from map(HPDEvent, *batch)
+
+    def _readBatches(self, fd: int, baseTime: float, size: int) -> Iterator[HPDBatch]:
+        """Read batches of events from fd until EOF, given the time which the first one is relative
+        to.
+        """
+        if size <= 0:
+            raise ValueError(f"Invalid batch size {size}; must be positive")
+        # Add up the deltas relative to baseTime, rather than adding them straight onto an absolute
+        # time: at the size of a time since the epoch, a float only has a resolution of about a
+        # quarter of a microsecond, so adding microsecond deltas to it rounds the same way every
+        # time, and the error builds up by milliseconds over a big profile.
+        elapsed = 0.0
+        while True:
+            elapsed, *packed = _heapprof.readEvents(
+                fd,
+                size,
+                baseTime,
+                elapsed,
+                self.hpm._scaleFactors,
+                self.hpm.samplingInterval or 0,
+            )
+            batch = HPDBatch(
+                *(self._unpack(typecode, data) for typecode, data in zip("dIqd", packed))
+            )
+            if batch.timestamps:
+                yield batch
+            if len(batch.timestamps) < size:
+                break
+
+    @staticmethod
+    def _unpack(typecode: str, data: bytes) -> array:
+        result = array(typecode)
+        result.frombytes(data)
+        return result
+
+    def _checkpointBefore(self, timestamp: float) -> Optional[int]:
+        """Return the offset of the last checkpoint before timestamp, if there is one."""
+        checkpoints = self.checkpoints()
+        index = bisect.bisect_left(self._checkpointTimes, timestamp) - 1
+        return checkpoints[index][1] if index >= 0 else None
+
+
+# The default memory budget for each HPC's cache of snapshots.
+DEFAULT_SNAPSHOT_CACHE_BYTES = 64 << 20
+
+
+class HPC(Sequence[Snapshot]):
+    """HPC is the low-level interface to .hpc files.
+
+    A digest can have coarser levels, whose snapshots are further apart; these are stored in
+    filebase.1.hpc, filebase.2.hpc, and so on, and levelIntervals lists their time intervals. To
+    read level N, pass level=N; level zero is the .hpc file itself.
+
+    The .hpc file itself also stores the digest transposed: for each trace index, the series of
+    (snapshot index, bytes) at each snapshot where its usage changed, stored contiguously so that
+    traceSeries() can fetch the whole history of a trace with a single read. (The coarser levels
+    don't have these, since you can just sample the ones in the .hpc file.)
+
+    The file is memory-mapped, and snapshots are decoded straight out of it. The most recently used
+    ones are kept in a cache, up to about cacheBytes of memory in all, so that looking at the same
+    snapshots over and over (as interactive analysis tends to) doesn't decode them over and over.
+    The snapshots you get back may be shared with the cache, so don't modify them.
+    """
+
+    # How many snapshots to read at a time while iterating.
+    _SNAPSHOT_BATCH_SIZE = 256
+    # The most snapshots to decode at a time while prefetching.
+    _PREFETCH_BATCH_SIZE = 16
+    # Roughly how much memory each trace in a snapshot takes up, on top of the dict itself: the
+    # trace index and the size.
+    _BYTES_PER_TRACE = 64
+
+    def __init__(
+        self,
+        filebase: str,
+        hpm: Optional[HPM] = None,
+        level: int = 0,
+        cacheBytes: int = DEFAULT_SNAPSHOT_CACHE_BYTES,
+    ) -> None:
         self.hpm = hpm or HPM(filebase)
-        self._file = open(filebase + ".hpc", "rb")
-        self.initialTime, self.timeInterval, self.offsets = _heapprof.readDigestMetadata(
-            self._file.fileno()
-        )
+        self.level = level
+        self.cacheBytes = cacheBytes
+        self._file = open(filebase + (f".{level}.hpc" if level else ".hpc"), "rb")
+        (
+            self.initialTime,
+            self.timeInterval,
+            offsets,
+            self.levelIntervals,
+            self._totalSeries,
+            self._traceSeries,
+            self.indexOffset,
+        ) = _heapprof.readDigestMetadata(self._file.fileno())
+        self.offsets = array("q")
+        self.offsets.frombytes(offsets)
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Snapshot index -> (snapshot, its approximate size in bytes), least recently used first.
+        self._cache: 'OrderedDict[int, Tuple[Snapshot, int]]' = OrderedDict()
+        self._cachedBytes = 0
 
     def __del__(self) -> None:
         self.close()
@@ -191,27 +475,151 @@ class HPC(Sequence[Snapshot]):
         return len(self.offsets)
 
     def __getitem__(self, key: Any) -> Any:
-        if not isinstance(key, int):
-            raise NotImplementedError("HPC does not support slicing")
-        return Snapshot(
-            relativeTime=key * self.timeInterval,
-            usage=_heapprof.readDigestEntry(self._file.fileno(), self.offsets[key]),
-        )
+        if isinstance(key, slice):
+            return self.readRange(range(len(self.offsets))[key])
+        if key < 0:
+            key += len(self.offsets)
+        if not 0 <= key < len(self.offsets):
+            raise IndexError("Snapshot index out of range")
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached[0]
+        return self.readRange(range(key, key + 1))[0]
 
     def __iter__(self) -> Iterator[Snapshot]:
-        for i in range(len(self.offsets)):
-            yield self[i]
+        # Read the snapshots in batches, which is much faster than one at a time, without holding
+        # the whole file in memory at once.
+        for start in range(0, len(self.offsets), self._SNAPSHOT_BATCH_SIZE):
+            stop = min(start + self._SNAPSHOT_BATCH_SIZE, len(self.offsets))
+            yield from self.readRange(range(start, stop))
+
+    def readRange(self, indices: range) -> List[Snapshot]:
+        """Return the snapshots at each of a range of indices. Whichever of them aren't in the
+        cache are all decoded with a single native call, so this is much faster than reading them
+        one by one; self[start:stop:step] is the same thing.
+        """
+        if indices.step < 0:
+            return list(reversed(self.readRange(indices[::-1])))
+        snapshots: List[Optional[Snapshot]] = []
+        for index in indices:
+            cached = self._cache.get(index)
+            if cached is None:
+                snapshots.append(None)
+            else:
+                self._cache.move_to_end(index)
+                snapshots.append(cached[0])
+        missing = [pos for pos, snapshot in enumerate(snapshots) if snapshot is None]
+        if missing:
+            # Read from the first one we're missing to the last, and keep whichever ones we need.
+            toRead = indices[missing[0] : missing[-1] + 1]
+            for pos, snapshot in zip(range(missing[0], missing[-1] + 1), self._decode(toRead)):
+                if snapshots[pos] is None:
+                    snapshots[pos] = snapshot
+                    self._addToCache(indices[pos], snapshot)
+        return cast(List[Snapshot], snapshots)
+
+    def iterPrefetching(self, prefetch: int) -> Iterator[Snapshot]:
+        """Iterate over the snapshots, like iter(self), while a background thread decodes the next
+        prefetch of them. The decoding happens without the GIL, so a loop which does real work on
+        each snapshot takes about as long as the slower of the two, rather than their sum. These
+        snapshots bypass the cache, so a full pass doesn't push out the ones you're looking at.
+        """
+        # Decode in small batches, so that the first snapshot doesn't wait for a whole prefetch's
+        # worth of them, and keep about prefetch snapshots' worth of batches queued up behind the
+        # one the caller is working on. If the caller stops early, leaving the with block waits
+        # for the worker to finish whatever batch it's on, and cancels the rest.
+        batchSize = min(prefetch, self._PREFETCH_BATCH_SIZE)
+        maxPending = max(1, prefetch // batchSize)
+        batches = (
+            range(start, min(start + batchSize, len(self.offsets)))
+            for start in range(0, len(self.offsets), batchSize)
+        )
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending: Deque[Future] = deque()
+            try:
+                for batch in batches:
+                    pending.append(executor.submit(self._decode, batch))
+                    if len(pending) > maxPending:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
 
     def __contains__(self, key: object) -> bool:
         return key in self.offsets
 
+    def hasSeries(self) -> bool:
+        """Test if this file has the transposed series read by traceSeries() and totalSeries()."""
+        return self._totalSeries is not None
+
+    def traceIndices(self) -> List[int]:
+        """Return the sorted list of trace indices which had nonzero usage at any snapshot. This
+        requires hasSeries().
+        """
+        self._checkSeries()
+        return sorted(self._traceSeries.keys())
+
+    def traceSeries(self, traceindex: int) -> List[Tuple[int, int]]:
+        """Return the history of a single trace index, as a list of (snapshot index, bytes) for
+        each snapshot at which its usage changed; before the first one, its usage was zero. This
+        requires hasSeries().
+        """
+        self._checkSeries()
+        where = self._traceSeries.get(traceindex)
+        if where is None:
+            return []
+        return _heapprof.readDigestSeries(self._file.fileno(), *where)
+
+    def totalSeries(self) -> List[Tuple[int, int]]:
+        """Like traceSeries(), but for the total usage over all traces."""
+        self._checkSeries()
+        return _heapprof.readDigestSeries(self._file.fileno(), *self._totalSeries)
+
+    def _checkSeries(self) -> None:
+        if not self.hasSeries():
+            raise ValueError("This .hpc file has no per-trace series")
+
+    def _decode(self, indices: range) -> List[Snapshot]:
+        """Decode the snapshots at a nonempty, increasing range of indices, without the cache."""
+        usages = _heapprof.readDigestEntries(
+            self._data, self.offsets, indices[0], indices[-1] + 1, indices.step
+        )
+        return [
+            Snapshot(relativeTime=index * self.timeInterval, usage=usage)
+            for index, usage in zip(indices, usages)
+        ]
+
+    def _addToCache(self, index: int, snapshot: Snapshot) -> None:
+        size = sys.getsizeof(snapshot.usage) + self._BYTES_PER_TRACE * len(snapshot.usage)
+        if size > self.cacheBytes:
+            return
+        self._cache[index] = (snapshot, size)
+        self._cachedBytes += size
+        while self._cachedBytes > self.cacheBytes:
+            _, (_, evictedSize) = self._cache.popitem(last=False)
+            self._cachedBytes -= evictedSize
+
     def close(self) -> None:
         if hasattr(self, "_file"):
+            self._cache.clear()
+            self._cachedBytes = 0
+            self._data.close()
             self._file.close()
             delattr(self, "_file")
 
     @classmethod
-    def make(cls, filebase: str, timeInterval: float, precision: float, verbose: bool) -> None:
+    def make(
+        cls,
+        filebase: str,
+        timeInterval: float,
+        precision: float,
+        verbose: bool,
+        jobs: Optional[int] = 1,
+        levels: Sequence[float] = (),
+    ) -> None:
         """Build a .hpc file out of a .hpm and .hpd file.
 
         Args:
@@ -220,5 +628,192 @@ class HPC(Sequence[Snapshot]):
             precision: The fraction of total bytes at any snapshot which can be stuffed into the
                 "other" bin. Must be a number in [0, 1).
             verbose: If set, prints out a lot of state to stderr.
+            jobs: The number of threads to use, or None to use one per CPU. The output is the same
+                no matter how many there are. Without a checkpoint index, only one is used.
+            levels: The time intervals of any coarser levels to build at the same time, in
+                increasing order, in seconds. Each must be a multiple of timeInterval.
+        """
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        _heapprof.makeDigestFile(
+            filebase,
+            int(timeInterval * 1000),
+            precision,
+            verbose,
+            jobs,
+            [int(level * 1000) for level in levels],
+        )
+
+    @classmethod
+    def update(cls, filebase: str, verbose: bool, jobs: Optional[int] = 1) -> None:
+        """Bring an existing .hpc file up to date with its .hpd file, by digesting only the events
+        which were added since it was made or last updated, and likewise its coarser levels. The
+        result is exactly the same as calling make() again with the original settings.
+
+        Raises ValueError if the .hpc file can't be updated, e.g. because it was made by an older
+        version of heapprof, or a previous update was killed partway through; in that case, make a
+        new one.
         """
-        _heapprof.makeDigestFile(filebase, int(timeInterval * 1000), precision, verbose)
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        _heapprof.updateDigestFile(filebase, verbose, jobs)
+
+
+class PrefetchingSnapshots(Sequence[Snapshot]):
+    """The same sequence of snapshots as an HPC, except that iterating over it decodes them ahead
+    of time on a background thread; see HPC.iterPrefetching.
+    """
+
+    def __init__(self, hpc: HPC, prefetch: int) -> None:
+        if prefetch <= 0:
+            raise ValueError(f'Invalid prefetch {prefetch}; must be a positive number of snapshots')
+        self.hpc = hpc
+        self.prefetch = prefetch
+
+    def __len__(self) -> int:
+        return len(self.hpc)
+
+    def __getitem__(self, key: Any) -> Any:
+        return self.hpc[key]
+
+    def __iter__(self) -> Iterator[Snapshot]:
+        return self.hpc.iterPrefetching(self.prefetch)
+
+
+class HPL(object):
+    """HPL is the low-level interface to .hpl files, which hold an inverted index of the raw traces
+    in a .hpm file: for each line of code, the traceindices of the traces which include it, and of
+    the ones which end at it. With this, the usage at a line is a sum over a few traces, rather than
+    a search through every one of them.
+
+    The index only depends on the .hpm file, so it's built the first time it's needed and saved as
+    filebase.hpl, next to the digest. Raw traces are only ever appended, so if the .hpm file grows,
+    update() just extends it.
+    """
+
+    def __init__(self, filebase: str, hpm: Optional[HPM] = None) -> None:
+        self.hpm = hpm or HPM(filebase)
+        self._fileName = filebase + ".hpl"
+        # The index covers traceindices 1 through self._numTraces. For each HPM frame id, it has the
+        # traceindices of the traces which include it, and of those which end at it, in order.
+        self._numTraces = 0
+        self._cumulative: Dict[int, array] = defaultdict(lambda: array("I"))
+        self._local: Dict[int, array] = defaultdict(lambda: array("I"))
+        self._load()
+
+    def traceIndices(self, line: RawTraceLine, cumulative: bool = True) -> Sequence[int]:
+        """Return the traceindices of the traces which include line (if cumulative) or end at it
+        (if not), in increasing order. This only covers the traces as of the last update().
+        """
+        # Don't use hpm.frameId(), which would give an unknown line an id of its own.
+        frameId = self.hpm._frameIds.get(line)
+        if frameId is None:
+            return ()
+        index = self._cumulative if cumulative else self._local
+        return index.get(frameId, ())
+
+    def update(self) -> bool:
+        """Extend the index to cover all the traces in the .hpm file, and save it. Returns false if
+        there was nothing new to add.
+        """
+        numTraces = self.hpm.traceCount()
+        if numTraces <= self._numTraces:
+            return False
+        if not self._numTraces:
+            # Building the whole index needs every trace, so load them all in a single pass.
+            self.hpm.warmRawTraceCache()
+        for traceindex in range(self._numTraces + 1, numTraces + 1):
+            frameIds = self.hpm.traceFrames(traceindex)
+            if not frameIds:
+                continue
+            for frameId in set(frameIds):
+                self._cumulative[frameId].append(traceindex)
+            self._local[frameIds[-1]].append(traceindex)
+        self._numTraces = numTraces
+        self._save()
+        return True
+
+    ############################################################################################
+    # Implementation details beyond this point.
+    #
+    # The file is a header (_HEADER), followed by the distinct filenames, in UTF-8, separated by
+    # NULs, and then by arrays of native uint32s: for each line, the index of its filename, its
+    # line number, and the number of cumulative and local traceindices it has; and then all the
+    # lines' cumulative traceindices, followed by all their local ones.
+
+    # Magic number, initial time of the profile, number of traces, lines, and bytes of filenames.
+    _HEADER = "=IdIII"
+    _MAGIC = 0x48504C31
+
+    def _load(self) -> None:
+        """Load the index from the .hpl file, if there is a usable one."""
+        try:
+            with open(self._fileName, "rb") as file:
+                magic, initialTime, numTraces, numLines, filenamesSize = struct.unpack(
+                    self._HEADER, file.read(struct.calcsize(self._HEADER))
+                )
+                # If the file isn't from this profile, just start over.
+                if magic != self._MAGIC or initialTime != self.hpm.initialTime:
+                    return
+                filenames = file.read(filenamesSize).decode("utf-8").split("\0")
+                columns = [array("I") for _ in range(4)]
+                for column in columns:
+                    column.fromfile(file, numLines)
+                filenameIndices, linenos, cumulativeSizes, localSizes = columns
+                cumulative = array("I")
+                cumulative.fromfile(file, sum(cumulativeSizes))
+                local = array("I")
+                local.fromfile(file, sum(localSizes))
+                lines = [
+                    RawTraceLine(filenames[filenameIndex], lineno)
+                    for filenameIndex, lineno in zip(filenameIndices, linenos)
+                ]
+        except (OSError, EOFError, ValueError, IndexError, struct.error):
+            # The index is only here to save time, so if it's missing or damaged, we rebuild it.
+            return
+        if numTraces > self.hpm.traceCount():
+            return
+
+        cumulativeEnd = localEnd = 0
+        for line, cumulativeSize, localSize in zip(lines, cumulativeSizes, localSizes):
+            frameId = self.hpm.frameId(line)
+            cumulativeEnd += cumulativeSize
+            self._cumulative[frameId] = cumulative[cumulativeEnd - cumulativeSize : cumulativeEnd]
+            if localSize:
+                localEnd += localSize
+                self._local[frameId] = local[localEnd - localSize : localEnd]
+        self._numTraces = numTraces
+
+    def _save(self) -> None:
+        """Write the index to the .hpl file. Like loading it, this is best-effort."""
+        frameIds = list(self._cumulative)
+        lines = [self.hpm.frame(frameId) for frameId in frameIds]
+        filenameIndices: Dict[str, int] = {}
+        for line in lines:
+            filenameIndices.setdefault(line.filename, len(filenameIndices))
+        filenames = "\0".join(filenameIndices).encode("utf-8")
+        try:
+            with open(self._fileName + ".tmp", "wb") as file:
+                file.write(
+                    struct.pack(
+                        self._HEADER,
+                        self._MAGIC,
+                        self.hpm.initialTime,
+                        self._numTraces,
+                        len(lines),
+                        len(filenames),
+                    )
+                )
+                file.write(filenames)
+                array("I", (filenameIndices[line.filename] for line in lines)).tofile(file)
+                array("I", (line.lineno for line in lines)).tofile(file)
+                array("I", (len(self._cumulative[frameId]) for frameId in frameIds)).tofile(file)
+                array("I", (len(self._local.get(frameId, ())) for frameId in frameIds)).tofile(file)
+                for frameId in frameIds:
+                    self._cumulative[frameId].tofile(file)
+                for frameId in frameIds:
+                    if frameId in self._local:
+                        self._local[frameId].tofile(file)
+            os.replace(self._fileName + ".tmp", self._fileName)
+        except OSError:
+            pass
@@ -1,24 +1,48 @@
+import bisect
 import math
+import os
+import sys
+from array import array
 from collections import defaultdict
-from typing import (Dict, List, NamedTuple, Optional, Sequence, TextIO, Tuple,
-                    Union)
+from typing import (Any, Dict, Iterable, Iterator, List, NamedTuple, Optional,
+                    Sequence, Set, TextIO, Tuple, Union)
 
 from .flow_graph import FlowGraph
-from .lowlevel import HPC, HPD, HPM
+from .lowlevel import (DEFAULT_SNAPSHOT_CACHE_BYTES, HPC, HPD, HPL, HPM,
+                       PrefetchingSnapshots)
 from .types import HeapTrace, RawTrace, RawTraceLine, Snapshot
 
 
 class Reader(object):
-    """Reader is the basic API for reading a heap profile."""
+    """Reader is the basic API for reading a heap profile.
 
-    def __init__(self, filebase: str) -> None:
+    snapshotCacheBytes bounds how much memory the digest (and each of its coarser levels) may use
+    to keep recently used snapshots around, so that looking at the same ones again is cheap. Zero
+    turns the cache off.
+    """
+
+    def __init__(
+        self, filebase: str, snapshotCacheBytes: int = DEFAULT_SNAPSHOT_CACHE_BYTES
+    ) -> None:
         self.filebase = filebase
+        self.snapshotCacheBytes = snapshotCacheBytes
 
-        # If you want access to the low-level API, you can use the hpm, hpd, and hpc variables. No
-        # harm will come to you from doing so; Reader is just a simpler interface on top of them.
+        # If you want access to the low-level API, you can use the hpm, hpd, hpc, and hpl variables.
+        # No harm will come to you from doing so; Reader is just a simpler interface on top of them.
         self._hpm = HPM(filebase)
         self._hpd = HPD(filebase, self._hpm)
         self._hpc: Optional[HPC] = None
+        # The index from lines to the traces which include them, loaded the first time we need it.
+        self._hpl: Optional[HPL] = None
+        # Every (caller, callee) pair of frame ids that's come up in a flow graph so far, by edge
+        # id, and the other way around; the same edges as pairs of lines; and the edge ids of each
+        # trace that's come up, in order.
+        self._edges: List[Tuple[int, int]] = []
+        self._edgeIds: Dict[Tuple[int, int], int] = {}
+        self._edgeLines: List[Tuple[RawTraceLine, RawTraceLine]] = []
+        self._traceEdges: Dict[int, array] = {}
+        # The coarser levels of the digest, by level number, opened as they're needed.
+        self._levels: Dict[int, HPC] = {}
 
         self._openHPC()
 
@@ -29,7 +53,12 @@ class Reader(object):
         return self._hpc is not None
 
     def makeDigest(
-        self, timeInterval: float = 60, precision: float = 0.01, verbose: bool = False
+        self,
+        timeInterval: float = 60,
+        precision: float = 0.01,
+        verbose: bool = False,
+        jobs: Optional[int] = 1,
+        levels: Sequence[float] = (),
     ) -> None:
         """Parse the ._hpm and ._hpd files to form a digest. You need to do this before most of the
         methods will work.
@@ -50,10 +79,26 @@ class Reader(object):
                 This can greatly shrink the size of the digest at no real cost in usefulness.
                 Must be in [0, 1); a value of zero means nothing is dropped.
             verbose: If true, prints status information to stderr as it runs.
+            jobs: The number of threads to use, or None to use one per CPU. Digesting a large
+                profile with several threads can be much faster, and gives exactly the same
+                result. This splits the profile at the checkpoints listed in its .hpi file, which
+                the profiler writes when it stops; a profile without one is digested on a single
+                thread.
+            levels: If given, the time intervals, in seconds, of coarser levels of the digest to
+                build at the same time, such as (10, 60, 600). Each must be a multiple of
+                timeInterval, and holds the same snapshots as a digest made with that interval
+                would, give or take rounding. This costs little beyond the extra files, and lets
+                snapshots(), snapshotAt(), and timePlot() look at the whole profile cheaply at a
+                coarse resolution, and zoom in to a finer one.
         """
-        self._hpc = None
+        self._closeHPC()
+        if verbose and self.droppedEvents():
+            sys.stderr.write(
+                f'Warning: The profiler dropped {self.droppedEvents()} events while writing this '
+                'profile; usage numbers will be less accurate.\n'
+            )
         try:
-            HPC.make(self.filebase, timeInterval, precision, verbose)
+            HPC.make(self.filebase, timeInterval, precision, verbose, jobs, levels)
         finally:
             # We do this in a "finally" block because if you control-C out of an HPC.make() call,
             # that stops the build early but we should still load the outcome, especially if we're
@@ -61,11 +106,37 @@ class Reader(object):
             # Python interpreter.
             self._openHPC()
 
+    def updateDigest(self, verbose: bool = False, jobs: Optional[int] = 1) -> None:
+        """Bring the digest up to date with the events that the profiler has written since it was
+        made (or last updated), with the same time interval, precision, and levels. This is for
+        profiles which are still being written: it only reads the new part of the ._hpd file, so
+        refreshing the digest of a long-running profile is cheap.
+
+        Like makeDigest, this leaves a valid digest behind if it's interrupted with a ctrl-C.
+
+        Args:
+            verbose: If true, prints status information to stderr as it runs.
+            jobs: The number of threads to use, or None to use one per CPU.
+
+        Raises:
+            ValueError: If there's no digest, or the digest can't be updated (because it was made
+                by an older version of heapprof, or a previous update was killed partway through);
+                in that case, call makeDigest instead.
+        """
+        if self._hpc is None:
+            raise ValueError('There is no digest to update; call makeDigest first')
+        # The update rewrites the end of the files, so the open HPCs' indices are about to be
+        # stale.
+        self._closeHPC()
+        try:
+            HPC.update(self.filebase, verbose, jobs)
+        finally:
+            self._openHPC()
+
     def close(self) -> None:
         """Close the reader. After doing this, the reader is no longer usable."""
         self._hpm.close()
-        if self._hpc:
-            self._hpc.close()
+        self._closeHPC()
 
     def __enter__(self) -> 'Reader':
         return self
@@ -105,6 +176,32 @@ class Reader(object):
         """Return the sampling rate parameters passed to the profiler."""
         return self._hpm.samplingRate
 
+    def samplingInterval(self) -> Optional[int]:
+        """Return the sampling interval passed to the profiler, if it used interval sampling."""
+        return self._hpm.samplingInterval
+
+    def profilerStats(self) -> Dict[str, int]:
+        """Return the statistics which the profiler recorded about its own operation. See
+        HPM.profilerStats.
+        """
+        return self._hpm.profilerStats
+
+    def droppedEvents(self) -> int:
+        """Return the number of alloc and free events which the profiler had to drop, because it was
+        running with backgroundFlush and couldn't write them out fast enough. If this is large
+        compared to the number of events in the profile, consider a bigger bufferSize.
+        """
+        stats = self.profilerStats()
+        return stats.get('droppedAllocs', 0) + stats.get('droppedFrees', 0)
+
+    def profilerOverhead(self) -> Optional[float]:
+        """Return an estimate of the total time, in seconds, which the profiler spent inside the
+        allocation hooks (i.e., the time it added to the program being profiled), or None if the
+        profile doesn't record this.
+        """
+        nanos = self.profilerStats().get('hookNanos')
+        return nanos / 1e9 if nanos is not None else None
+
     def snapshotInterval(self) -> float:
         """Return the time interval, in seconds, between successive time snapshots in the digest.
         """
@@ -114,6 +211,9 @@ class Reader(object):
     def trace(self, traceindex: int) -> Optional[HeapTrace]:
         """Given a trace index (of a sort which you can get from various other functions), return a
         proper stack trace. A value of None means that we have no trace stored for this index.
+
+        If the profile was recorded with a maxStackDepth and this trace was cut short, its first
+        line is a truncation marker; see TraceLine.isTruncationMarker().
         """
         return self._hpm.trace(traceindex)
 
@@ -123,17 +223,159 @@ class Reader(object):
         """
         return self._hpm.rawTrace(traceindex)
 
-    def snapshots(self) -> Sequence[Snapshot]:
-        """Return a sequence of all the time snapshots in the digest."""
-        assert self._hpc is not None
-        return self._hpc
+    def snapshots(
+        self, resolution: Optional[float] = None, prefetch: int = 0
+    ) -> Sequence[Snapshot]:
+        """Return a sequence of all the time snapshots in the digest.
+
+        If resolution is given, and the digest has coarser levels (see makeDigest), this uses the
+        coarsest level whose snapshots are at most that many seconds apart.
 
-    def snapshotAt(self, relativeTime: float) -> Snapshot:
+        If prefetch is given, then iterating over the sequence decodes the next prefetch snapshots
+        on a background thread while you work on the current ones, so a pass over the whole
+        profile which does real work on each snapshot isn't held up waiting for the disk.
+        """
+        hpc = self._digestLevel(resolution)
+        return PrefetchingSnapshots(hpc, prefetch) if prefetch else hpc
+
+    def snapshotAt(self, relativeTime: float, resolution: Optional[float] = None) -> Snapshot:
         """Return the snapshot closest in time (rounding down) to the indicated relative time.
+        resolution picks the level of the digest to use, as for snapshots().
+        """
+        hpc = self._digestLevel(resolution)
+        index = max(0, min(math.floor(relativeTime / hpc.timeInterval), len(hpc) - 1))
+        return hpc[index]
+
+    def snapshotsBetween(
+        self, startTime: float, endTime: float, resolution: Optional[float] = None
+    ) -> List[Snapshot]:
+        """Return all the snapshots whose relative times are in [startTime, endTime). They are
+        read from the digest all at once, which is much faster than fetching them one at a time
+        with snapshotAt. resolution picks the level of the digest to use, as for snapshots().
+        """
+        hpc = self._digestLevel(resolution)
+        start = max(0, math.ceil(startTime / hpc.timeInterval))
+        stop = min(len(hpc), max(start, math.ceil(endTime / hpc.timeInterval)))
+        return hpc[start:stop]
+
+    def traceSeries(self, traceindex: int, resolution: Optional[float] = None) -> List[int]:
+        """Return the number of live bytes allocated from a single trace index at each snapshot;
+        the result is parallel to snapshots(resolution). This reads the history of just that trace
+        from the digest, so is much faster than going through the snapshots when you only care
+        about one trace.
+        """
+        hpc = self._digestLevel(resolution)
+        assert self._hpc is not None
+        if not self._hpc.hasSeries():
+            return [snapshot.usage.get(traceindex, 0) for snapshot in hpc]
+        return self._denseSeries(self._hpc.traceSeries(traceindex), hpc)
+
+    def lineSeries(
+        self,
+        line: Union[str, RawTraceLine],
+        cumulative: bool = True,
+        resolution: Optional[float] = None,
+    ) -> List[int]:
+        """Like traceSeries, but for a line of code: return the number of live bytes at each
+        snapshot allocated from all the traces which include this line (if cumulative), or which
+        end at it (if not). The line may be given as a RawTraceLine or as "filename:lineno". The
+        values are the same as fastGetUsage would give for each snapshot.
+        """
+        return self._lineSeries(
+            (RawTraceLine.parse(line),), cumulative, self._digestLevel(resolution)
+        )[0]
+
+    def asArray(self, resolution: Optional[float] = None, cache: bool = True) -> Tuple[Any, Any]:
+        """Return the whole digest as a pair of NumPy arrays, (usage, traceindices). usage is a
+        dense int64 matrix with a row for each snapshot in snapshots(resolution) and a column for
+        each trace index; traceindices is the trace index of each column. This is the place to
+        start for analyses of the whole profile, like correlating or clustering traces, which
+        would otherwise spend most of their time building a dict for every snapshot.
+
+        If cache is true, the arrays are saved next to the digest, as filebase.usage.npy and
+        filebase.traces.npy (or filebase.N.usage.npy and so on for level N of the digest), along
+        with filebase.arraykey, which records which digest they were built from. Later calls --
+        from this process or any other -- memory-map those files instead of building them again,
+        as long as the digest hasn't changed since. In that case usage is a
+        read-only np.memmap, so opening it is instant, and processes looking at the same profile
+        share its pages.
+
+        This requires NumPy, which heapprof doesn't otherwise need; you can install it with
+        `pip install numpy`.
         """
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError(
+                'This functionality requires numpy. You can install it with `pip install numpy`.'
+            )
+
+        hpc = self._digestLevel(resolution)
+        prefix = self.filebase + (f'.{hpc.level}' if hpc.level else '')
+        usagePath = prefix + '.usage.npy'
+        tracesPath = prefix + '.traces.npy'
+        keyPath = prefix + '.arraykey'
+        digestKey = self._digestKey()
+        # NumPy's type stubs leave its file functions (load, save, and open_memmap) untyped, so
+        # their calls below are exempted from disallow_untyped_calls.
+        if cache and self._isArrayCurrent(keyPath, digestKey):
+            usage = np.load(usagePath, mmap_mode='r')  # type: ignore[no-untyped-call]
+            if usage.shape[0] == len(hpc):
+                return (usage, np.load(tracesPath))  # type: ignore[no-untyped-call]
+
         assert self._hpc is not None
-        index = max(0, min(math.floor(relativeTime / self._hpc.timeInterval), len(self._hpc) - 1))
-        return self._hpc[index]
+        if self._hpc.hasSeries():
+            traceindices = np.array(self._hpc.traceIndices(), dtype=np.int64)
+        else:
+            traceindices = np.array(
+                sorted(
+                    {
+                        traceindex
+                        for snapshot in self._hpc.iterPrefetching(self._SCAN_PREFETCH)
+                        for traceindex in snapshot.usage
+                    }
+                ),
+                dtype=np.int64,
+            )
+        shape = (len(hpc), len(traceindices))
+        if cache:
+            # Until the new arrays are all in place, nobody should trust the old ones.
+            if os.path.exists(keyPath):
+                os.remove(keyPath)
+            # Build it under a temporary name, so that nobody else ever maps a partial file.
+            usage = np.lib.format.open_memmap(  # type: ignore[no-untyped-call]
+                usagePath + '.tmp', mode='w+', dtype=np.int64, shape=shape
+            )
+        else:
+            usage = np.zeros(shape, dtype=np.int64)
+
+        if self._hpc.hasSeries():
+            # Fill in a column at a time from the series. Row j is snapshot (j+1) * factor - 1 of
+            # the .hpc file, and has the value of the last change at or before that.
+            factor = round(hpc.timeInterval / self._hpc.timeInterval)
+            samples = np.arange(factor - 1, len(hpc) * factor, factor)
+            for column, traceindex in enumerate(traceindices):
+                points = np.array(self._hpc.traceSeries(int(traceindex)), dtype=np.int64)
+                if not len(points):
+                    continue
+                pos = np.searchsorted(points[:, 0], samples, side='right') - 1
+                usage[:, column] = np.where(pos >= 0, points[pos, 1], 0)
+        else:
+            columns = {int(traceindex): column for column, traceindex in enumerate(traceindices)}
+            for row, snapshot in enumerate(hpc.iterPrefetching(self._SCAN_PREFETCH)):
+                for traceindex, size in snapshot.usage.items():
+                    usage[row, columns[traceindex]] = size
+
+        if not cache:
+            return (usage, traceindices)
+        usage.flush()
+        del usage
+        np.save(tracesPath, traceindices)  # type: ignore[no-untyped-call]
+        os.replace(usagePath + '.tmp', usagePath)
+        with open(keyPath + '.tmp', 'w') as keyFile:
+            keyFile.write(digestKey)
+        os.replace(keyPath + '.tmp', keyPath)
+        return (np.load(usagePath, mmap_mode='r'), traceindices)  # type: ignore[no-untyped-call]
 
     @property
     def hpm(self) -> HPM:
@@ -150,6 +392,18 @@ class Reader(object):
         """Access to the low-level HPC interface."""
         return self._hpc
 
+    @property
+    def hpl(self) -> HPL:
+        """Access to the low-level HPL interface, i.e. the index from lines of code to the traces
+        which include them. The first time this is used for a profile, the index is built, which
+        means reading every stack trace, and saved for next time; after that, it's simply brought
+        up to date with the .hpm file.
+        """
+        if self._hpl is None:
+            self._hpl = HPL(self.filebase, self._hpm)
+        self._hpl.update()
+        return self._hpl
+
     def fastGetUsage(
         self, snapshot: Snapshot, lines: Tuple[RawTraceLine, ...], cumulative: bool = True
     ) -> Tuple[Tuple[int, ...], int]:
@@ -158,21 +412,14 @@ class Reader(object):
         elements. The first N elements are the cumulative (or local) usage at the indicated trace
         lines; the last element is the total usage for all trace lines.
         """
-        data: Dict[RawTraceLine, int] = defaultdict(int)
-        total = 0
-        for traceindex, size in snapshot.usage.items():
-            total += size
-            rawTrace = self.rawTrace(traceindex)
-            if rawTrace is None:
-                continue
-            if not cumulative:
-                if rawTrace[-1] in lines:
-                    data[rawTrace[-1]] += size
-            else:
-                for line in lines:
-                    if line in rawTrace:
-                        data[line] += size
-        return (tuple(data[line] for line in lines), total)
+        # The usage at a line is just the sum over the traces which include it, which we can look
+        # up in the line index instead of searching every trace in the snapshot.
+        hpl = self.hpl
+        usage = snapshot.usage
+        return (
+            tuple(self._sumUsage(usage, hpl.traceIndices(line, cumulative)) for line in lines),
+            sum(usage.values()),
+        )
 
     ###########################################################################################
     # Analytics Functions
@@ -260,7 +507,9 @@ class Reader(object):
             plt.show()
 
     def timePlot(
-        self, lines: Optional[Dict[str, Union[str, RawTraceLine]]] = None
+        self,
+        lines: Optional[Dict[str, Union[str, RawTraceLine]]] = None,
+        points: Optional[int] = None,
     ) -> 'Reader.TimePlot':
         """Sometimes, after you've looked at usage graphs and so on, you want to see how memory
         usage in certain parts of the program is varying over time. This function helps you with
@@ -273,6 +522,10 @@ class Reader(object):
 
                 The lines may be specified either as RawTraceLine, or as "filename:lineno". This
                 latter form is provided for convenience while debugging.
+            points: If given, and the digest has coarser levels (see makeDigest), use the
+                coarsest level that still has at least this many snapshots. Plotting a long
+                profile at its finest resolution can be slow, and rarely shows more than a
+                coarser one does.
         """
         lines = lines or {}
         times: List[float] = []
@@ -281,7 +534,22 @@ class Reader(object):
 
         labels = sorted(list(lines.keys()))
         traceLines = tuple(RawTraceLine.parse(lines[label]) for label in labels)
-        for snapshot in self.snapshots():
+        snapshots = self._digestLevel(None)
+        if points is not None:
+            for level in range(len(snapshots.levelIntervals), 0, -1):
+                if len(self._level(level)) >= points:
+                    snapshots = self._level(level)
+                    break
+
+        assert self._hpc is not None
+        if self._hpc.hasSeries():
+            # Reading the series means we only touch the traces which include the lines we want.
+            times = [index * snapshots.timeInterval for index in range(len(snapshots))]
+            totalUsage = self._denseSeries(self._hpc.totalSeries(), snapshots)
+            lineValues = self._lineSeries(traceLines, True, snapshots)
+            return self.TimePlot(times, totalUsage, lineValues, labels)
+
+        for snapshot in snapshots.iterPrefetching(self._SCAN_PREFETCH):
             times.append(snapshot.relativeTime)
             data, total = self.fastGetUsage(snapshot, traceLines, cumulative=True)
             totalUsage.append(total)
@@ -318,34 +586,70 @@ class Reader(object):
         all the stack traces from the ._hpm file; once that cache is warm, future reads will be much
         faster.
         """
-        nodeLocalUsage: Dict[RawTraceLine, int] = defaultdict(int)
-        nodeCumulativeUsage: Dict[RawTraceLine, int] = defaultdict(int)
-        edgeUsage: Dict[Tuple[RawTraceLine, RawTraceLine], int] = defaultdict(int)
-        totalUsage = 0
-
+        nodeLocalUsage: Dict[int, int] = defaultdict(int)
+        nodeCumulativeUsage: Dict[int, int] = defaultdict(int)
+        edgeUsage: Dict[int, int] = defaultdict(int)
         for traceindex, size in snapshot.usage.items():
-            totalUsage += size
-
-            # Grab the stack trace. If there is none, we only account for it in the total.
-            rawTrace = self._hpm.rawTrace(traceindex)
-            if rawTrace is None:
-                continue
-
-            traceLength = len(rawTrace)
-            for i in range(traceLength):
-                # nodeCumulativeUsage == total size of all stacks including this line.
-                nodeCumulativeUsage[rawTrace[i]] += size
-                # edgeUsage == total size of all edges containing (AB)
-                if i < traceLength - 1:
-                    edgeUsage[(rawTrace[i], rawTrace[i + 1])] += size
-                else:
-                    # nodeLocalUsage == total size of all stacks ending with this line.
-                    nodeLocalUsage[rawTrace[i]] += size
-
-        return FlowGraph(
-            dict(nodeLocalUsage), dict(nodeCumulativeUsage), dict(edgeUsage), totalUsage
+            self._addToFlowGraph(nodeLocalUsage, nodeCumulativeUsage, edgeUsage, traceindex, size)
+        return self._makeFlowGraph(
+            nodeLocalUsage, nodeCumulativeUsage, edgeUsage, sum(snapshot.usage.values())
         )
 
+    def flowGraphs(self, snapshots: Iterable[Snapshot]) -> Iterator[FlowGraph]:
+        """Yield the FlowGraph of each of a sequence of snapshots, e.g. reader.snapshots(). This
+        gives the same graphs as calling flowGraph() on each one, but only the first is computed
+        from scratch: each one after that is updated from the one before, by looking at only the
+        traces whose usage changed in between. That makes this much faster if you want to see how
+        the graph changes over time, since neighboring snapshots usually differ in only a few
+        traces.
+        """
+        nodeLocalUsage: Dict[int, int] = defaultdict(int)
+        nodeCumulativeUsage: Dict[int, int] = defaultdict(int)
+        edgeUsage: Dict[int, int] = defaultdict(int)
+        graph: Optional[FlowGraph] = None
+        previous: Dict[int, int] = {}
+        for snapshot in snapshots:
+            usage = snapshot.usage
+            changes = [
+                (traceindex, size - previous.get(traceindex, 0))
+                for traceindex, size in usage.items()
+                if previous.get(traceindex) != size
+            ]
+            changes.extend(
+                (traceindex, -size)
+                for traceindex, size in previous.items()
+                if traceindex not in usage
+            )
+            totalUsage = sum(usage.values())
+
+            # If the snapshots are far enough apart, it's cheaper to just start over.
+            if graph is None or len(changes) > len(usage):
+                nodeLocalUsage.clear()
+                nodeCumulativeUsage.clear()
+                edgeUsage.clear()
+                for traceindex, size in usage.items():
+                    self._addToFlowGraph(
+                        nodeLocalUsage, nodeCumulativeUsage, edgeUsage, traceindex, size
+                    )
+                graph = self._makeFlowGraph(
+                    nodeLocalUsage, nodeCumulativeUsage, edgeUsage, totalUsage
+                )
+            else:
+                for traceindex, change in changes:
+                    self._addToFlowGraph(
+                        nodeLocalUsage, nodeCumulativeUsage, edgeUsage, traceindex, change
+                    )
+                graph = self._updateFlowGraph(
+                    graph,
+                    nodeLocalUsage,
+                    nodeCumulativeUsage,
+                    edgeUsage,
+                    [traceindex for traceindex, _ in changes],
+                    totalUsage,
+                )
+            previous = usage
+            yield graph
+
     def flowGraphAt(self, relativeTime: float) -> FlowGraph:
         return self.flowGraph(self.snapshotAt(relativeTime))
 
@@ -353,7 +657,7 @@ class Reader(object):
         """Generate a graph view of the comparison of a bunch of different time slices, and save the
         result as a .dot file to the given name. See FlowGraph.compare() for the kwargs available.
         """
-        graphs = tuple(self.flowGraphAt(t) for t in relativeTimes)
+        graphs = tuple(self.flowGraphs(self.snapshotAt(t) for t in relativeTimes))
         FlowGraph.compare(dotFile, *graphs, **kwargs)
 
     ###########################################################################################
@@ -377,13 +681,26 @@ class Reader(object):
         For speedscope, see https://github.com/jlfwong/speedscope, or use the hosted version at
         https://www.speedscope.app.
         """
+        # The name of each frame in the output, by frame id, so that we only format each one once.
+        names: Dict[int, str] = {}
         otherSize = 0
         for traceindex, size in snapshot.usage.items():
-            trace = self.trace(traceindex)
-            if trace is None:
+            frameIds = self._hpm.traceFrames(traceindex)
+            if not frameIds:
                 otherSize += size
             else:
-                traceArray = [f"{line.filename}:{line.lineno}" for line in trace]
+                traceArray = []
+                for frameId in frameIds:
+                    name = names.get(frameId)
+                    if name is None:
+                        line = self._hpm.frame(frameId)
+                        name = (
+                            line.filename
+                            if line.isTruncationMarker()
+                            else f"{line.filename}:{line.lineno}"
+                        )
+                        names[frameId] = name
+                    traceArray.append(name)
                 output.write(";".join(traceArray))
                 output.write(f" {size}\n")
 
@@ -404,10 +721,235 @@ class Reader(object):
 
     ###########################################################################################
     # Implementation details
+
+    # How many snapshots to decode ahead while making a pass over the whole digest.
+    _SCAN_PREFETCH = 256
+
     def _openHPC(self) -> None:
         """Try to open the .hpc file."""
         try:
-            self._hpc = self._hpc or HPC(self.filebase, self._hpm)
+            self._hpc = self._hpc or HPC(
+                self.filebase, self._hpm, cacheBytes=self.snapshotCacheBytes
+            )
         except (FileNotFoundError, ValueError):
             # These mean that either the file is absent or corrupt.
             pass
+
+    def _closeHPC(self) -> None:
+        """Close the .hpc file and any of its levels."""
+        if self._hpc:
+            self._hpc.close()
+        self._hpc = None
+        for level in self._levels.values():
+            level.close()
+        self._levels = {}
+
+    def _level(self, level: int) -> HPC:
+        """Return a level of the digest, opening it if need be."""
+        if level not in self._levels:
+            self._levels[level] = HPC(
+                self.filebase, self._hpm, level, cacheBytes=self.snapshotCacheBytes
+            )
+        return self._levels[level]
+
+    def _digestKey(self) -> str:
+        """Identify the current digest, for asArray's saved arrays: the size of the .hpc file, which
+        changes whenever an update adds to it, and the offset of its index, which is where its
+        snapshots end. (Unlike mtimes, these can't be fooled by a coarse-grained clock.)
+        """
+        assert self._hpc is not None
+        return f'{os.path.getsize(self.filebase + ".hpc")} {self._hpc.indexOffset}\n'
+
+    def _isArrayCurrent(self, keyPath: str, digestKey: str) -> bool:
+        """Test if the arrays saved by asArray were built from the current digest."""
+        try:
+            with open(keyPath) as keyFile:
+                return keyFile.read() == digestKey
+        except FileNotFoundError:
+            return False
+
+    def _denseSeries(self, points: List[Tuple[int, int]], hpc: HPC) -> List[int]:
+        """Given a series from the .hpc file, as a list of (snapshot index, bytes) at each change,
+        return its value at each snapshot of hpc, which is some level of the digest.
+        """
+        assert self._hpc is not None
+        # Snapshot j of a level is snapshot (j+1) * factor - 1 of the .hpc file.
+        factor = round(hpc.timeInterval / self._hpc.timeInterval)
+        result: List[int] = []
+        value = 0
+        pos = 0
+        for index in range(factor - 1, len(hpc) * factor, factor):
+            while pos < len(points) and points[pos][0] <= index:
+                value = points[pos][1]
+                pos += 1
+            result.append(value)
+        return result
+
+    def _lineSeries(
+        self, lines: Tuple[RawTraceLine, ...], cumulative: bool, hpc: HPC
+    ) -> List[List[int]]:
+        """Return the series of usage at each of the lines, parallel to the snapshots of hpc."""
+        assert self._hpc is not None
+        result = [[0] * len(hpc) for line in lines]
+        if not lines:
+            return result
+        if not self._hpc.hasSeries():
+            for index, snapshot in enumerate(hpc):
+                data, _ = self.fastGetUsage(snapshot, lines, cumulative)
+                for values, datum in zip(result, data):
+                    values[index] = datum
+            return result
+
+        # Add up the series of the traces which include each line, from the line index. Rather than
+        # expanding each series to a value per snapshot, we add its changes into the snapshots at
+        # which they happen, and then total those up across all the snapshots at once at the end.
+        # Snapshot j of a level is snapshot (j+1) * factor - 1 of the .hpc file, so a change at
+        # snapshot i of the .hpc file first shows up in snapshot i // factor of the level.
+        hpl = self.hpl
+        matches: Dict[int, List[List[int]]] = defaultdict(list)
+        for line, changes in zip(lines, result):
+            for traceindex in hpl.traceIndices(line, cumulative):
+                matches[traceindex].append(changes)
+        factor = round(hpc.timeInterval / self._hpc.timeInterval)
+        for traceindex, lineChanges in matches.items():
+            last = 0
+            for index, size in self._hpc.traceSeries(traceindex):
+                row = index // factor
+                if row >= len(hpc):
+                    break
+                for changes in lineChanges:
+                    changes[row] += size - last
+                last = size
+        for changes in result:
+            value = 0
+            for row, change in enumerate(changes):
+                value += change
+                changes[row] = value
+        return result
+
+    def _addToFlowGraph(
+        self,
+        nodeLocalUsage: Dict[int, int],
+        nodeCumulativeUsage: Dict[int, int],
+        edgeUsage: Dict[int, int],
+        traceindex: int,
+        size: int,
+    ) -> None:
+        """Add size bytes at a trace to the usage of the nodes and edges it's made of, keyed by
+        frame id and edge id respectively.
+        """
+        # If there's no stack trace, it only counts towards the total.
+        frameIds = self._hpm.traceFrames(traceindex)
+        if not frameIds:
+            return
+
+        # Break the trace down into edges the first time we see it; after that, we reuse them.
+        edgeIds = self._traceEdges.get(traceindex)
+        if edgeIds is None:
+            edgeIds = array("I")
+            for edge in zip(frameIds, frameIds[1:]):
+                edgeId = self._edgeIds.get(edge)
+                if edgeId is None:
+                    edgeId = self._edgeIds[edge] = len(self._edges)
+                    self._edges.append(edge)
+                    self._edgeLines.append((self._hpm.frame(edge[0]), self._hpm.frame(edge[1])))
+                edgeIds.append(edgeId)
+            self._traceEdges[traceindex] = edgeIds
+
+        for frameId in frameIds:
+            # nodeCumulativeUsage == total size of all stacks including this line.
+            nodeCumulativeUsage[frameId] += size
+        for edgeId in edgeIds:
+            # edgeUsage == total size of all edges containing (AB)
+            edgeUsage[edgeId] += size
+        # nodeLocalUsage == total size of all stacks ending with this line.
+        nodeLocalUsage[frameIds[-1]] += size
+
+    def _makeFlowGraph(
+        self,
+        nodeLocalUsage: Dict[int, int],
+        nodeCumulativeUsage: Dict[int, int],
+        edgeUsage: Dict[int, int],
+        totalUsage: int,
+    ) -> FlowGraph:
+        """Turn the usage from _addToFlowGraph back into lines of code, and make a FlowGraph of it.
+        Nodes and edges whose usage has gone back to zero are left out.
+        """
+        frame = self._hpm.frame
+        edgeLines = self._edgeLines
+        return FlowGraph(
+            {frame(frameId): size for frameId, size in nodeLocalUsage.items() if size},
+            {frame(frameId): size for frameId, size in nodeCumulativeUsage.items() if size},
+            {edgeLines[edgeId]: size for edgeId, size in edgeUsage.items() if size},
+            totalUsage,
+        )
+
+    def _updateFlowGraph(
+        self,
+        graph: FlowGraph,
+        nodeLocalUsage: Dict[int, int],
+        nodeCumulativeUsage: Dict[int, int],
+        edgeUsage: Dict[int, int],
+        traceindices: List[int],
+        totalUsage: int,
+    ) -> FlowGraph:
+        """Like _makeFlowGraph, but only the nodes and edges of the given traces have changed
+        since graph was made, so copy it and update just those. Copying a dict is much cheaper
+        than building it up again one entry at a time.
+        """
+        localIds: Set[int] = set()
+        cumulativeIds: Set[int] = set()
+        edgeIds: Set[int] = set()
+        for traceindex in traceindices:
+            frameIds = self._hpm.traceFrames(traceindex)
+            if frameIds:
+                localIds.add(frameIds[-1])
+                cumulativeIds.update(frameIds)
+                edgeIds.update(self._traceEdges[traceindex])
+
+        def update(
+            output: Dict[Any, int], ids: Iterable[int], usage: Dict[int, int], key: Any
+        ) -> Dict[Any, int]:
+            output = output.copy()
+            for itemId in ids:
+                size = usage[itemId]
+                if size:
+                    output[key(itemId)] = size
+                else:
+                    output.pop(key(itemId), None)
+            return output
+
+        return FlowGraph(
+            update(graph.nodeLocalUsage, localIds, nodeLocalUsage, self._hpm.frame),
+            update(
+                graph.nodeCumulativeUsage, cumulativeIds, nodeCumulativeUsage, self._hpm.frame
+            ),
+            update(graph.edgeUsage, edgeIds, edgeUsage, self._edgeLines.__getitem__),
+            totalUsage,
+        )
+
+    @staticmethod
+    def _sumUsage(usage: Dict[int, int], traceindices: Sequence[int]) -> int:
+        """Return the total usage of the given traceindices, which are in increasing order."""
+        if len(traceindices) <= len(usage):
+            return sum(usage.get(traceindex, 0) for traceindex in traceindices)
+        # Lines near the bottom of the stack can be in nearly every trace, in which case it's
+        # cheaper to go through the snapshot instead.
+        total = 0
+        for traceindex, size in usage.items():
+            pos = bisect.bisect_left(traceindices, traceindex)
+            if pos < len(traceindices) and traceindices[pos] == traceindex:
+                total += size
+        return total
+
+    def _digestLevel(self, resolution: Optional[float]) -> HPC:
+        """Return the coarsest level of the digest whose snapshots are no more than resolution
+        seconds apart, or the finest level if resolution is None or they're all too coarse.
+        """
+        assert self._hpc is not None
+        hpc = self._hpc
+        if resolution is not None:
+            for level, interval in enumerate(self._hpc.levelIntervals, 1):
+                if interval <= resolution:
+                    hpc = self._level(level)
+        return hpc
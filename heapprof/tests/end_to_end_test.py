@@ -1,9 +1,22 @@
+import ctypes
+import io
+import itertools
 import os
+import signal
+import struct
+import threading
 import time
 import unittest
+import weakref
+from collections import defaultdict
 from tempfile import TemporaryDirectory
+from typing import Dict, Iterator, List, Tuple
+from unittest import mock
 
+import _heapprof
 import heapprof
+from heapprof.lowlevel import HPC, HPM, HPDEvent
+from heapprof.types import RawTraceLine
 
 
 class EndToEndTest(unittest.TestCase):
@@ -43,6 +56,1184 @@ class EndToEndTest(unittest.TestCase):
                     # It would be nice to do some more sophisticated testing here.
                     self.assertGreater(len(snapshot.usage), 0)
 
+    def testBufferedOutput(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            with self.assertRaises(ValueError):
+                heapprof.start(hpxFile, bufferSize=0)
+
+            # With a big buffer and no periodic flushing, nothing should reach the disk until we
+            # stop.
+            heapprof.start(hpxFile, bufferSize=64 << 20, flushInterval=None)
+            list(range(100_000))
+            self.assertEqual(0, os.path.getsize(hpxFile + ".hpd"))
+            heapprof.stop()
+            self.assertGreater(os.path.getsize(hpxFile + ".hpd"), 0)
+
+            with heapprof.Reader(hpxFile) as reader:
+                events = list(reader.hpd)
+                self.assertGreater(len(events), 0)
+                # Every event should refer to a trace that made it into the .hpm file.
+                for event in events:
+                    if event.traceindex:
+                        self.assertIsNotNone(reader.rawTrace(event.traceindex))
+
+    def testTraceFingerprints(self) -> None:
+        # Consecutive samples from the same thread share most of their stack, which the profiler
+        # takes advantage of when fingerprinting traces; make sure that allocations which differ
+        # only in their innermost frames, or only in an outer one, still get the right traces.
+        def allocate(depth: int) -> list:
+            if depth:
+                return allocate(depth - 1)
+            first = bytearray(100_000)
+            second = bytearray(100_000)
+            return [first, second]
+
+        line = allocate.__code__.co_firstlineno + 2
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            for _ in range(3):
+                allocate(5)
+                allocate(10)
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                seen = set()
+                for event in reader.hpd:
+                    if event.size < 100_000:
+                        continue
+                    trace = reader.rawTrace(event.traceindex)
+                    assert trace is not None
+                    depth = sum(
+                        1 for frame in trace if frame.filename == __file__ and frame.lineno == line
+                    )
+                    seen.add((trace[-1].lineno, depth))
+                self.assertEqual(
+                    {(line + 1, 5), (line + 2, 5), (line + 1, 10), (line + 2, 10)}, seen
+                )
+
+    def testResumedGenerators(self) -> None:
+        # A generator's frame can be resumed under different callers, so the profiler can't assume
+        # that its callers are the same as the last time it saw it.
+        def generate() -> Iterator[bytearray]:
+            while True:
+                yield bytearray(100_000)
+
+        def first(gen: Iterator[bytearray]) -> bytearray:
+            return next(gen)
+
+        def second(gen: Iterator[bytearray]) -> bytearray:
+            return next(gen)
+
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            gen = generate()
+            heapprof.start(hpxFile, {})
+            for _ in range(3):
+                first(gen)
+                second(gen)
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                callers = []
+                for event in reader.hpd:
+                    if event.size < 100_000:
+                        continue
+                    trace = reader.rawTrace(event.traceindex)
+                    assert trace is not None
+                    callers.append(trace[-2].lineno)
+                firstLine = first.__code__.co_firstlineno + 1
+                secondLine = second.__code__.co_firstlineno + 1
+                self.assertEqual([firstLine, secondLine] * 3, callers)
+
+    def testReleasesFrames(self) -> None:
+        # The profiler holds on to the frames of the last stack it saw on each thread, but lets go
+        # of them once it's seen a newer one.
+        class Local:
+            pass
+
+        def allocate() -> "weakref.ref[Local]":
+            local = Local()
+            bytearray(100_000)
+            return weakref.ref(local)
+
+        with TemporaryDirectory() as path:
+            heapprof.start(os.path.join(path, "hprof"), {})
+            ref = allocate()
+            [bytearray(100_000) for _ in range(10)]
+            self.assertIsNone(ref())
+            heapprof.stop()
+
+    def testRawTraceIndex(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            lists = [[i] for i in range(10_000)]
+            strings = [str(i) for i in range(10_000)]
+            buffers = [bytearray(i) for i in range(10_000)]
+            del lists, strings, buffers
+            heapprof.stop()
+
+            hpm = HPM(hpxFile)
+            numTraces = hpm.profilerStats["distinctTraces"]
+            self.assertGreater(numTraces, 2)
+
+            # The profiler wrote an index of the traces, so reading the last one doesn't need to
+            # read all the ones before it.
+            last = hpm.rawTrace(numTraces)
+            self.assertIsNotNone(last)
+            self.assertEqual([numTraces], list(hpm._traceFrames.keys()))
+            self.assertIsNone(hpm.rawTrace(numTraces + 1))
+
+            # Reading them all at once gives the same traces, with each line only made once.
+            warm = HPM(hpxFile)
+            warm.warmRawTraceCache()
+            self.assertEqual(numTraces, len(warm._traceFrames))
+            for traceindex in range(1, numTraces + 1):
+                self.assertEqual(hpm.rawTrace(traceindex), warm.rawTrace(traceindex))
+            self.assertEqual(len(warm._frames), len(set(warm._frames)))
+
+            # Without the index, we find the same offsets, and filenames, by skimming the file.
+            filenames: List[str] = []
+            offsets, end = _heapprof.indexRawTraces(
+                hpm._mdfile.fileno(), hpm._tracesStart, hpm._tracesEnd, filenames
+            )
+            self.assertEqual(hpm._traceOffsets.tobytes(), offsets)
+            self.assertEqual(hpm._tracesEnd, end)
+            self.assertEqual(hpm._filenames, filenames)
+            hpm.close()
+            warm.close()
+
+    def testFilenameTable(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            lists = [[i] for i in range(10_000)]
+            strings = [str(i) for i in range(10_000)]
+            del lists, strings
+            heapprof.stop()
+
+            # Each filename is written out once among the traces, and once more in the footer.
+            hpm = HPM(hpxFile)
+            self.assertIn(__file__, hpm._filenames)
+            self.assertEqual(len(hpm._filenames), len(set(hpm._filenames)))
+            with open(hpxFile + ".hpm", "rb") as hpmFile:
+                contents = hpmFile.read()
+            self.assertEqual(2, contents.count(__file__.encode("utf-8")))
+            numTraces = hpm.profilerStats["distinctTraces"]
+            rawTraces = [hpm.rawTrace(traceindex) for traceindex in range(1, numTraces + 1)]
+            lastTrace = rawTraces[-1]
+            assert lastTrace is not None
+            self.assertTrue(any(line.filename == __file__ for line in lastTrace))
+
+            # A profile which was never stopped cleanly has no footer, so the filenames all have to
+            # come from the traces themselves.
+            footerOffset = struct.pack(">Q", hpm._tracesEnd)
+            location = contents.index(footerOffset, 0, hpm._tracesStart)
+            with open(os.path.join(path, "unstopped.hpm"), "wb") as hpmFile:
+                hpmFile.write(contents[:location])
+                hpmFile.write(bytes(len(footerOffset)))
+                hpmFile.write(contents[location + len(footerOffset) : hpm._tracesEnd])
+            unstopped = HPM(os.path.join(path, "unstopped"))
+            self.assertEqual([], unstopped._filenames)
+            self.assertEqual(rawTraces[-1], unstopped.rawTrace(numTraces))
+            self.assertEqual(hpm._filenames, unstopped._filenames)
+            unstopped.warmRawTraceCache()
+            self.assertEqual(rawTraces[0], unstopped.rawTrace(1))
+            hpm.close()
+            unstopped.close()
+
+            # Files from before there were filename tables spell out every filename.
+            with open(os.path.join(path, "old.hpm"), "wb") as hpmFile:
+                hpmFile.write(struct.pack(">IQQ", 3, 1, 0) + bytes([0, 0]) + bytes(8))
+                # One trace, innermost frame first, and then a sentinel.
+                for lineno, filename in ((3, b"inner.py"), (7, b"outer.py")):
+                    hpmFile.write(bytes([lineno + 1, len(filename)]) + filename)
+                hpmFile.write(bytes(1))
+            old = HPM(os.path.join(path, "old"))
+            self.assertIsNone(old._filenames)
+            self.assertEqual(
+                [RawTraceLine("outer.py", 7), RawTraceLine("inner.py", 3)], old.rawTrace(1)
+            )
+            self.assertIsNone(old.rawTrace(2))
+            old.close()
+
+    def testStackFilters(self) -> None:
+        def allocate(depth: int) -> bytearray:
+            return allocate(depth - 1) if depth else bytearray(100_000)
+
+        def bigTraces(reader: heapprof.Reader) -> list:
+            return [
+                reader.rawTrace(event.traceindex)
+                for event in reader.hpd
+                if event.size >= 100_000 and event.traceindex
+            ]
+
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            with self.assertRaises(ValueError):
+                heapprof.start(hpxFile, maxStackDepth=0)
+            with self.assertRaises(TypeError):
+                heapprof.start(hpxFile, includePrefixes=[1])  # type: ignore
+
+            # Deep stacks get cut off, but shallow ones don't. (Including only this file means that
+            # we don't need to worry about how deep unittest's own stack is.)
+            heapprof.start(hpxFile, {}, maxStackDepth=10, includePrefixes=[__file__])
+            allocate(50)
+            allocate(3)
+            heapprof.stop()
+            with heapprof.Reader(hpxFile) as reader:
+                deep, shallow = bigTraces(reader)
+                self.assertEqual(11, len(deep))
+                self.assertTrue(deep[0].isTruncationMarker())
+                self.assertFalse(any(line.isTruncationMarker() for line in deep[1:]))
+                self.assertEqual(5, len(shallow))
+                self.assertFalse(any(line.isTruncationMarker() for line in shallow))
+
+            heapprof.start(hpxFile, {}, includePrefixes=[__file__])
+            allocate(3)
+            heapprof.stop()
+            with heapprof.Reader(hpxFile) as reader:
+                (trace,) = bigTraces(reader)
+                self.assertTrue(all(line.filename == __file__ for line in trace))
+                self.assertEqual(5, len(trace))
+
+            heapprof.start(hpxFile, {}, excludePrefixes=[__file__])
+            allocate(3)
+            heapprof.stop()
+            with heapprof.Reader(hpxFile) as reader:
+                (trace,) = bigTraces(reader)
+                self.assertGreater(len(trace), 0)
+                self.assertFalse(any(line.filename == __file__ for line in trace))
+
+    def testProfilerStats(self) -> None:
+        self.assertIsNone(heapprof.profilerStats())
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            # Keep enough objects alive that the live set has to grow a few times.
+            data = [bytearray(100) for _ in range(10_000)]
+            stats = heapprof.profilerStats()
+            del data
+            afterStats = heapprof.profilerStats()
+            heapprof.stop()
+
+            assert stats is not None
+            assert afterStats is not None
+            self.assertGreaterEqual(stats['liveSetEntries'], 10_000)
+            self.assertGreater(stats['traceIndexEntries'], 0)
+            self.assertLess(afterStats['liveSetEntries'], 10_000)
+            self.assertEqual(
+                stats['memoryBytes'],
+                stats['liveSetBytes'] + stats['traceIndexBytes'] + stats['bufferBytes'],
+            )
+            self.assertIsNone(heapprof.profilerStats())
+
+            self.assertGreater(stats['memHooks'] + stats['objHooks'], 20_000)
+            self.assertGreater(stats['hookNanos'], 0)
+            self.assertGreaterEqual(stats['sampledAllocs'], 20_000)
+            self.assertGreater(afterStats['sampledFrees'], stats['sampledFrees'])
+            self.assertEqual(stats['distinctTraces'], stats['traceIndexEntries'])
+            self.assertGreater(stats['hpdBytes'], 0)
+            self.assertGreaterEqual(os.path.getsize(hpxFile + ".hpd"), afterStats['hpdBytes'])
+
+            # We only log frees of pointers whose allocations we logged, and with the same sizes, so
+            # no trace can ever free more than it allocated.
+            with heapprof.Reader(hpxFile) as reader:
+                net: Dict[int, int] = defaultdict(int)
+                for event in reader.hpd:
+                    net[event.traceindex] += event.size
+                    self.assertGreaterEqual(net[event.traceindex], 0)
+
+                # The final stats should have made it into the file.
+                finalStats = reader.profilerStats()
+                assert finalStats is not None
+                self.assertGreaterEqual(finalStats['sampledAllocs'], afterStats['sampledAllocs'])
+                overhead = reader.profilerOverhead()
+                assert overhead is not None
+                self.assertGreater(overhead, 0)
+
+    def testFreeNull(self) -> None:
+        # free(NULL) is legal, and must not look like the free of anything we're tracking.
+        freeNull = ctypes.pythonapi.PyMem_Free
+        freeNull.argtypes = [ctypes.c_void_p]
+        freeNull.restype = None
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            before = heapprof.profilerStats()
+            for _ in range(1000):
+                freeNull(None)
+            after = heapprof.profilerStats()
+            heapprof.stop()
+
+            assert before is not None
+            assert after is not None
+            self.assertLess(after['liveSetEntries'], before['liveSetEntries'] + 1000)
+            self.assertEqual(0, after['droppedAllocs'])
+
+            with heapprof.Reader(hpxFile) as reader:
+                stats = reader.profilerStats()
+                events = list(reader.hpd)
+                self.assertEqual(stats['sampledAllocs'] + stats['sampledFrees'], len(events))
+                self.assertFalse(any(event.traceindex == 0 for event in events))
+
+    def testReadEverything(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            data = [bytearray(100) for _ in range(10_000)]
+            del data
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                stats = reader.profilerStats()
+                # The readers buffer their input, so make sure that they neither skip nor repeat
+                # anything as they go.
+                events = list(reader.hpd)
+                self.assertEqual(stats['sampledAllocs'] + stats['sampledFrees'], len(events))
+                for index in range(1, stats['distinctTraces'] + 1):
+                    self.assertIsNotNone(reader.rawTrace(index))
+                self.assertIsNone(reader.rawTrace(stats['distinctTraces'] + 1))
+
+                reader.makeDigest(timeInterval=0.001, precision=0)
+                self.assertGreater(len(reader.snapshots()), 0)
+                for snapshot in reader.snapshots():
+                    self.assertTrue(all(size > 0 for size in snapshot.usage.values()))
+
+    def testParallelDigest(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            # Make enough events that the .hpd file gets split into several chunks.
+            heapprof.start(hpxFile, {})
+            for _ in range(40):
+                data = [[i] for i in range(10_000)]
+            del data
+            heapprof.stop()
+            self.assertGreater(os.path.getsize(hpxFile + ".hpd"), 8 << 20)
+
+            with heapprof.Reader(hpxFile) as reader:
+                with self.assertRaises(ValueError):
+                    reader.makeDigest(timeInterval=0.001, precision=0, jobs=0)
+
+                digests = []
+                for jobs in (1, 3, None):
+                    reader.makeDigest(timeInterval=0.001, precision=0, jobs=jobs)
+                    with open(hpxFile + ".hpc", "rb") as hpc:
+                        digests.append(hpc.read())
+                self.assertGreater(len(reader.snapshots()), 0)
+                # The chunks start at checkpoints, which the index lists.
+                self.assertGreater(len(reader.hpd.checkpoints()), 2)
+            self.assertEqual(digests[0], digests[1])
+            self.assertEqual(digests[0], digests[2])
+
+            # Without the index, we can't split the file, but we still get the same digest.
+            os.remove(hpxFile + ".hpi")
+            with heapprof.Reader(hpxFile) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0, jobs=3)
+            with open(hpxFile + ".hpc", "rb") as hpc:
+                self.assertEqual(digests[0], hpc.read())
+
+    def testDigestPrecision(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            data = []
+            for size in range(1, 200):
+                data.append([bytearray(size) for _ in range(size)])
+                if size % 3 == 0:
+                    del data[size // 2]
+            del data
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0)
+                exact = list(reader.snapshots())
+
+                digests = []
+                for jobs in (1, 3):
+                    reader.makeDigest(timeInterval=0.001, precision=0.1, jobs=jobs)
+                    with open(hpxFile + ".hpc", "rb") as hpc:
+                        digests.append(hpc.read())
+                self.assertEqual(digests[0], digests[1])
+                approximate = list(reader.snapshots())
+
+            # Dropping small traces moves their bytes into "other," but never loses any, and never
+            # moves more than the precision allows.
+            self.assertGreater(len(exact), 10)
+            self.assertEqual(len(exact), len(approximate))
+            for full, partial in zip(exact, approximate):
+                self.assertEqual(full.relativeTime, partial.relativeTime)
+                self.assertEqual(full.totalUsage(), partial.totalUsage())
+                other = partial.usage.get(0, 0) - full.usage.get(0, 0)
+                self.assertLessEqual(other, 0.1 * full.totalUsage())
+                for traceindex, size in partial.usage.items():
+                    if traceindex != 0:
+                        self.assertEqual(full.usage[traceindex], size)
+
+    def testUpdateDigest(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            for _ in range(20):
+                data = [[i] for i in range(10_000)]
+            del data
+            heapprof.stop()
+            with open(hpxFile + ".hpd", "rb") as hpd:
+                events = hpd.read()
+
+            with heapprof.Reader(hpxFile) as reader:
+                with self.assertRaises(ValueError):
+                    reader.updateDigest()
+
+                reader.makeDigest(timeInterval=0.001, precision=0)
+                fullLength = len(reader.snapshots())
+                with open(hpxFile + ".hpc", "rb") as hpc:
+                    expected = hpc.read()
+
+                # Pretend that we digested the profile while it was still being written, stopping
+                # partway through an event, and then update the digest in a few steps.
+                for jobs in (1, 3):
+                    with open(hpxFile + ".hpd", "wb") as hpd:
+                        hpd.write(events[: len(events) // 3 + 1])
+                    reader.makeDigest(timeInterval=0.001, precision=0)
+                    partialLength = len(reader.snapshots())
+                    self.assertLess(partialLength, fullLength)
+
+                    with open(hpxFile + ".hpd", "ab") as hpd:
+                        hpd.write(events[len(events) // 3 + 1 : 2 * len(events) // 3])
+                    reader.updateDigest(jobs=jobs)
+                    self.assertGreater(len(reader.snapshots()), partialLength)
+
+                    with open(hpxFile + ".hpd", "ab") as hpd:
+                        hpd.write(events[2 * len(events) // 3 :])
+                    reader.updateDigest(jobs=jobs)
+                    with open(hpxFile + ".hpc", "rb") as hpc:
+                        self.assertEqual(expected, hpc.read())
+
+                    # With nothing new, an update changes nothing.
+                    reader.updateDigest(jobs=jobs)
+                    with open(hpxFile + ".hpc", "rb") as hpc:
+                        self.assertEqual(expected, hpc.read())
+
+                # The update should pick up correctly wherever the digest left off, including
+                # partway through the events for a snapshot.
+                for step in range(1, 40):
+                    cut = step * len(events) // 40
+                    with open(hpxFile + ".hpd", "wb") as hpd:
+                        hpd.write(events[:cut])
+                    reader.makeDigest(timeInterval=0.001, precision=0)
+                    with open(hpxFile + ".hpd", "ab") as hpd:
+                        hpd.write(events[cut:])
+                    reader.updateDigest()
+                    with open(hpxFile + ".hpc", "rb") as hpc:
+                        self.assertEqual(expected, hpc.read())
+
+    @unittest.skipUnless(hasattr(signal, "setitimer"), "needs interval timers")
+    def testInterruptedUpdate(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            for _ in range(20):
+                data = [[i] for i in range(10_000)]
+            del data
+            heapprof.stop()
+            with open(hpxFile + ".hpd", "rb") as hpd:
+                events = hpd.read()
+
+            # Send ourselves a SIGINT a moment from now, by which time we'll be in the middle of
+            # digesting. (The alarm's handler only runs when the digest checks for signals, and
+            # the SIGINT is then noticed at the next check.)
+            def interruptSoon() -> None:
+                signal.setitimer(signal.ITIMER_REAL, 0.002)
+
+            oldHandler = signal.signal(
+                signal.SIGALRM, lambda signum, frame: os.kill(os.getpid(), signal.SIGINT)
+            )
+            try:
+                with heapprof.Reader(hpxFile) as reader:
+                    reader.makeDigest(timeInterval=0.001, precision=0)
+                    fullLength = len(reader.snapshots())
+                    with open(hpxFile + ".hpc", "rb") as hpc:
+                        expected = hpc.read()
+
+                    # An interrupted digest keeps what it has so far.
+                    interruptSoon()
+                    with self.assertRaises(KeyboardInterrupt):
+                        reader.makeDigest(timeInterval=0.001, precision=0)
+                    self.assertLess(len(reader.snapshots()), fullLength)
+
+                    # An interrupted update keeps the digest that was already there, plus whatever
+                    # it added to it, and the next update picks up where it left off.
+                    with open(hpxFile + ".hpd", "wb") as hpdOut:
+                        hpdOut.write(events[: len(events) // 10])
+                    reader.makeDigest(timeInterval=0.001, precision=0)
+                    partialLength = len(reader.snapshots())
+                    with open(hpxFile + ".hpd", "ab") as hpdOut:
+                        hpdOut.write(events[len(events) // 10 :])
+                    interruptSoon()
+                    with self.assertRaises(KeyboardInterrupt):
+                        reader.updateDigest()
+                    self.assertGreaterEqual(len(reader.snapshots()), partialLength)
+                    self.assertLess(len(reader.snapshots()), fullLength)
+
+                    reader.updateDigest()
+                    with open(hpxFile + ".hpc", "rb") as hpc:
+                        self.assertEqual(expected, hpc.read())
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, oldHandler)
+
+    def testDigestLevels(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            for _ in range(20):
+                data = [[i] for i in range(10_000)]
+            del data
+            heapprof.stop()
+            with open(hpxFile + ".hpd", "rb") as hpd:
+                events = hpd.read()
+
+            with heapprof.Reader(hpxFile) as reader:
+                with self.assertRaises(ValueError):
+                    reader.makeDigest(timeInterval=0.002, levels=(0.005,))
+                with self.assertRaises(ValueError):
+                    reader.makeDigest(timeInterval=0.001, levels=(0.01, 0.004))
+
+                reader.makeDigest(timeInterval=0.001, precision=0, levels=(0.004, 0.02, 0.1))
+                self.assertTrue(os.path.exists(hpxFile + ".3.hpc"))
+                reader.makeDigest(timeInterval=0.001, precision=0, levels=(0.004, 0.02))
+                self.assertFalse(os.path.exists(hpxFile + ".3.hpc"))
+
+                # Each level holds every Nth snapshot of the finest one.
+                finest = list(reader.snapshots())
+                self.assertGreater(len(finest), 100)
+                for resolution, factor in ((0.001, 1), (0.004, 4), (0.01, 4), (0.05, 20)):
+                    snapshots = reader.snapshots(resolution)
+                    self.assertEqual(len(finest) // factor, len(snapshots))
+                    for index, snapshot in enumerate(snapshots):
+                        self.assertAlmostEqual(0.001 * factor * index, snapshot.relativeTime)
+                        self.assertEqual(finest[(index + 1) * factor - 1].usage, snapshot.usage)
+                self.assertEqual(
+                    reader.snapshots(0.02)[3].usage, reader.snapshotAt(0.075, resolution=0.02).usage
+                )
+
+                plot = reader.timePlot(points=len(finest) // 10)
+                self.assertEqual(len(finest) // 4, len(plot.times))
+                plot = reader.timePlot(points=len(finest))
+                self.assertEqual(len(finest), len(plot.times))
+
+                # Updates bring all the levels up to date.
+                files = {}
+                for suffix in (".hpc", ".1.hpc", ".2.hpc"):
+                    with open(hpxFile + suffix, "rb") as hpc:
+                        files[suffix] = hpc.read()
+                with open(hpxFile + ".hpd", "wb") as hpd:
+                    hpd.write(events[: len(events) // 2])
+                reader.makeDigest(timeInterval=0.001, precision=0, levels=(0.004, 0.02))
+                with open(hpxFile + ".hpd", "ab") as hpd:
+                    hpd.write(events[len(events) // 2 :])
+                reader.updateDigest()
+                for suffix, contents in files.items():
+                    with open(hpxFile + suffix, "rb") as hpc:
+                        self.assertEqual(contents, hpc.read())
+
+    def testTraceSeries(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            for _ in range(20):
+                data = [[i] for i in range(10_000)]
+            del data
+            heapprof.stop()
+            with open(hpxFile + ".hpd", "rb") as hpd:
+                events = hpd.read()
+
+            with heapprof.Reader(hpxFile) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0.01, levels=(0.004,))
+                self.assertTrue(reader.hpc.hasSeries())
+
+                # The series are the snapshots, transposed.
+                for resolution in (None, 0.004):
+                    snapshots = reader.snapshots(resolution)
+                    self.assertGreater(len(snapshots), 10)
+                    for traceindex in reader.hpc.traceIndices():
+                        self.assertEqual(
+                            [snapshot.usage.get(traceindex, 0) for snapshot in snapshots],
+                            reader.traceSeries(traceindex, resolution),
+                        )
+                    self.assertEqual(
+                        [sum(snapshot.usage.values()) for snapshot in snapshots],
+                        reader.timePlot(points=len(snapshots)).totalUsage,
+                    )
+                self.assertEqual([], reader.hpc.traceSeries(1 << 30))
+
+                # Pick a line somewhere in the middle of a trace, and one at the end.
+                snapshots = reader.snapshots()
+                usage = snapshots[-1].usage
+                traceindex = max(usage, key=lambda t: usage[t])
+                rawTrace = reader.rawTrace(traceindex)
+                assert rawTrace is not None
+                middle = rawTrace[len(rawTrace) // 2]
+                for line, cumulative in ((middle, True), (rawTrace[-1], False)):
+                    self.assertEqual(
+                        [
+                            reader.fastGetUsage(snapshot, (line,), cumulative)[0][0]
+                            for snapshot in snapshots
+                        ],
+                        reader.lineSeries(line, cumulative),
+                    )
+
+                # Updating the digest gives the same series as making it all at once.
+                with open(hpxFile + ".hpc", "rb") as hpc:
+                    contents = hpc.read()
+                with open(hpxFile + ".hpd", "wb") as hpd:
+                    hpd.write(events[: len(events) // 2])
+                reader.makeDigest(timeInterval=0.001, precision=0.01, levels=(0.004,))
+                with open(hpxFile + ".hpd", "ab") as hpd:
+                    hpd.write(events[len(events) // 2 :])
+                reader.updateDigest()
+                with open(hpxFile + ".hpc", "rb") as hpc:
+                    self.assertEqual(contents, hpc.read())
+
+                # The coarser levels have no series of their own.
+                self.assertFalse(HPC(hpxFile, level=1).hasSeries())
+
+    def testFrameTable(self) -> None:
+        def allocate(depth: int) -> list:
+            return allocate(depth - 1) if depth else [[i] for i in range(10_000)]
+
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            data = [allocate(depth) for depth in range(5)]
+            del data
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0.01)
+                snapshot = max(reader.snapshots(), key=lambda snapshot: len(snapshot.usage))
+                self.assertGreater(len(snapshot.usage), 1)
+
+                # Traces are arrays of ids in a single table of frames.
+                hpm = reader.hpm
+                for traceindex in snapshot.usage:
+                    frameIds = hpm.traceFrames(traceindex)
+                    if frameIds is None:
+                        self.assertIsNone(reader.rawTrace(traceindex))
+                        continue
+                    self.assertEqual("I", frameIds.typecode)
+                    self.assertEqual(
+                        reader.rawTrace(traceindex), [hpm.frame(frameId) for frameId in frameIds]
+                    )
+                self.assertEqual(len(hpm._frames), len(set(hpm._frames)))
+                line = RawTraceLine("nowhere.py", 1)
+                self.assertEqual(hpm.frameId(line), hpm.frameId(line))
+
+                # The analytics match what you'd get from the traces as lists of lines.
+                nodeLocal: Dict[RawTraceLine, int] = defaultdict(int)
+                nodeCumulative: Dict[RawTraceLine, int] = defaultdict(int)
+                edges: Dict[Tuple[RawTraceLine, RawTraceLine], int] = defaultdict(int)
+                flame = []
+                otherSize = 0
+                for traceindex, size in snapshot.usage.items():
+                    rawTrace = reader.rawTrace(traceindex)
+                    if not rawTrace:
+                        otherSize += size
+                        continue
+                    for rawTraceLine in rawTrace:
+                        nodeCumulative[rawTraceLine] += size
+                    for edge in zip(rawTrace, rawTrace[1:]):
+                        edges[edge] += size
+                    nodeLocal[rawTrace[-1]] += size
+                    names = ";".join(f"{line.filename}:{line.lineno}" for line in rawTrace)
+                    flame.append(f"{names} {size}\n")
+                if otherSize:
+                    flame.append(f"OTHER {otherSize}\n")
+
+                flowGraph = reader.flowGraph(snapshot)
+                self.assertEqual(nodeLocal, flowGraph.nodeLocalUsage)
+                self.assertEqual(nodeCumulative, flowGraph.nodeCumulativeUsage)
+                self.assertEqual(edges, flowGraph.edgeUsage)
+                output = io.StringIO()
+                reader.flameGraph(snapshot, output)
+                self.assertEqual("".join(flame), output.getvalue())
+
+                # fastGetUsage counts each trace once, even if a line appears in it several times.
+                lines = tuple(nodeCumulative) + (line,)
+                usage = tuple(
+                    sum(
+                        size
+                        for traceindex, size in snapshot.usage.items()
+                        if line in (reader.rawTrace(traceindex) or ())
+                    )
+                    for line in lines
+                )
+                self.assertEqual(
+                    (usage, sum(snapshot.usage.values())), reader.fastGetUsage(snapshot, lines)
+                )
+                self.assertEqual(
+                    tuple(nodeLocal.get(line, 0) for line in lines),
+                    reader.fastGetUsage(snapshot, lines, cumulative=False)[0],
+                )
+
+    def testFlowGraphs(self) -> None:
+        def allocate(depth: int) -> list:
+            return allocate(depth - 1) if depth else [[i] for i in range(10_000)]
+
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            data = []
+            for depth in range(5):
+                data.append(allocate(depth))
+                data.append(allocate(depth + 1))
+                del data[0]
+            del data
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0.01)
+                snapshots = [snapshot for snapshot in reader.snapshots()]
+                self.assertGreater(len(snapshots), 5)
+
+                # Updating each graph from the one before gives the same graphs as making each one
+                # from scratch, whether the snapshots are in order or not.
+                expected = [reader.flowGraph(snapshot) for snapshot in snapshots]
+                self.assertEqual(expected, list(reader.flowGraphs(snapshots)))
+                shuffled = snapshots[::2] + snapshots[::-3]
+                self.assertEqual(
+                    [reader.flowGraph(snapshot) for snapshot in shuffled],
+                    list(reader.flowGraphs(shuffled)),
+                )
+
+    def testLineIndex(self) -> None:
+        def allocate(depth: int) -> list:
+            return allocate(depth - 1) if depth else [[i] for i in range(10_000)]
+
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            data = [allocate(depth) for depth in range(5)]
+            del data
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0.01)
+                numTraces = reader.profilerStats()["distinctTraces"]
+                cumulative: Dict[RawTraceLine, List[int]] = defaultdict(list)
+                local: Dict[RawTraceLine, List[int]] = defaultdict(list)
+                for traceindex in range(1, numTraces + 1):
+                    rawTrace = reader.rawTrace(traceindex)
+                    assert rawTrace is not None
+                    for line in sorted(set(rawTrace)):
+                        cumulative[line].append(traceindex)
+                    local[rawTrace[-1]].append(traceindex)
+                self.assertGreater(len(cumulative), len(local))
+
+                for line, traceindices in cumulative.items():
+                    self.assertEqual(traceindices, list(reader.hpl.traceIndices(line)))
+                    self.assertEqual(
+                        local.get(line, []), list(reader.hpl.traceIndices(line, cumulative=False))
+                    )
+                # Asking about a line that's in no trace doesn't add it to the .hpm's frames.
+                numFrames = len(reader.hpm._frames)
+                self.assertEqual([], list(reader.hpl.traceIndices(RawTraceLine("nowhere.py", 1))))
+                self.assertEqual(numFrames, len(reader.hpm._frames))
+                usage = [
+                    reader.fastGetUsage(snapshot, tuple(cumulative))
+                    for snapshot in reader.snapshots()
+                ]
+                self.assertTrue(os.path.exists(hpxFile + ".hpl"))
+
+            # The next time, the index comes straight from the .hpl file, without reading any of
+            # the traces; and if the file is damaged, it simply gets rebuilt.
+            for damage in (False, True):
+                if damage:
+                    with open(hpxFile + ".hpl", "r+b") as hplFile:
+                        hplFile.truncate(100)
+                with heapprof.Reader(hpxFile) as reader:
+                    self.assertEqual(
+                        usage,
+                        [
+                            reader.fastGetUsage(snapshot, tuple(cumulative))
+                            for snapshot in reader.snapshots()
+                        ],
+                    )
+                    self.assertEqual(damage, bool(reader.hpm._traceFrames))
+
+    def testSnapshotSlices(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            data = []
+            for i in range(100):
+                data.append([[j] for j in range(i * 50)])
+                if i % 3:
+                    del data[0]
+            del data
+            heapprof.stop()
+
+            # With no cache, every read has to decode the snapshots from the file.
+            with heapprof.Reader(hpxFile, snapshotCacheBytes=0) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0.01)
+                hpc = reader.hpc
+                # Enough snapshots to span several keyframes.
+                self.assertGreater(len(hpc), 100)
+                single = [hpc[i] for i in range(len(hpc))]
+                self.assertEqual(single, list(hpc))
+                for key in (
+                    slice(None),
+                    slice(5, 70),
+                    slice(3, None, 7),
+                    slice(1, None, 40),
+                    slice(None, None, -1),
+                    slice(-10, 2, -33),
+                    slice(50, 10),
+                ):
+                    self.assertEqual(single[key], hpc[key], key)
+
+                dt = reader.snapshotInterval()
+                self.assertEqual(single[10:20], reader.snapshotsBetween(10 * dt, 20 * dt))
+                self.assertEqual(single[:3], reader.snapshotsBetween(-1, 2.5 * dt))
+                self.assertEqual(single[-2:], reader.snapshotsBetween((len(hpc) - 2) * dt, 1e9))
+                self.assertEqual([], reader.snapshotsBetween(20 * dt, 10 * dt))
+
+    def testSnapshotCache(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            data = []
+            for i in range(100):
+                data.append([[j] for j in range(i * 50)])
+                if i % 3:
+                    del data[0]
+            del data
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0.01)
+                hpc = reader.hpc
+                self.assertEqual("q", hpc.offsets.typecode)
+                # Once a snapshot has been read, it comes straight from the cache.
+                self.assertIs(hpc[10], hpc[10])
+                self.assertIs(hpc[-1], reader.snapshotAt(reader.elapsedTime()))
+                window = hpc[5:15]
+                self.assertIs(hpc[10], window[5])
+                dt = hpc.timeInterval
+                self.assertEqual(window, reader.snapshotsBetween(5 * dt, 15 * dt))
+                expected = list(hpc)
+
+            # A small cache holds on to the most recently used snapshots, up to its budget.
+            budget = 20_000
+            with heapprof.Reader(hpxFile, snapshotCacheBytes=budget) as reader:
+                hpc = reader.hpc
+                self.assertEqual(expected, list(hpc))
+                self.assertLessEqual(hpc._cachedBytes, budget)
+                self.assertGreater(len(hpc._cache), 0)
+                self.assertLess(len(hpc._cache), len(hpc))
+                self.assertIn(len(hpc) - 1, hpc._cache)
+                self.assertNotIn(0, hpc._cache)
+                self.assertEqual(expected[::-3], hpc[::-3])
+                self.assertLessEqual(hpc._cachedBytes, budget)
+
+    def testSnapshotPrefetch(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            data = []
+            for i in range(50):
+                data.append([[j] for j in range(i * 50)])
+                if i % 3:
+                    del data[0]
+            del data
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0.01)
+                expected = [reader.hpc[i] for i in range(len(reader.hpc))]
+                reader.hpc._cache.clear()
+
+                for prefetch in (1, 7, len(expected) + 1):
+                    snapshots = reader.snapshots(prefetch=prefetch)
+                    self.assertEqual(len(expected), len(snapshots))
+                    self.assertEqual(expected[3], snapshots[3])
+                    self.assertEqual(expected, list(snapshots))
+                    # Stopping partway through is fine too.
+                    self.assertEqual(expected[:11], list(itertools.islice(snapshots, 11)))
+                # A full pass doesn't go through the cache.
+                self.assertEqual(1, len(reader.hpc._cache))
+
+                # Even with a big prefetch, the snapshots are decoded a few at a time, so that the
+                # first one doesn't have to wait for all the rest.
+                with mock.patch.object(reader.hpc, "_decode", wraps=reader.hpc._decode) as decode:
+                    self.assertEqual(expected, list(reader.snapshots(prefetch=len(expected) + 1)))
+                self.assertGreater(decode.call_count, 1)
+                for args, _ in decode.call_args_list:
+                    self.assertLessEqual(len(args[0]), HPC._PREFETCH_BATCH_SIZE)
+
+                with self.assertRaises(ValueError):
+                    reader.snapshots(prefetch=-1)
+
+    def testAsArray(self) -> None:
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest("numpy is not installed")
+
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            heapprof.start(hpxFile, {})
+            for _ in range(20):
+                data = [[i] for i in range(10_000)]
+            del data
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                reader.makeDigest(timeInterval=0.001, precision=0.01, levels=(0.004,))
+                for resolution in (None, 0.004):
+                    for cache in (False, True, True):
+                        usage, traceindices = reader.asArray(resolution, cache=cache)
+                        snapshots = reader.snapshots(resolution)
+                        self.assertEqual((len(snapshots), len(traceindices)), usage.shape)
+                        for row, snapshot in zip(usage, snapshots):
+                            self.assertEqual(
+                                snapshot.usage,
+                                {
+                                    int(traceindex): int(size)
+                                    for traceindex, size in zip(traceindices, row)
+                                    if size
+                                },
+                            )
+                    self.assertIsInstance(usage, np.memmap)
+
+                self.assertTrue(os.path.exists(hpxFile + ".usage.npy"))
+                self.assertTrue(os.path.exists(hpxFile + ".1.usage.npy"))
+
+                # As long as the digest doesn't change, the saved arrays are reused, even by another
+                # reader.
+                inode = os.stat(hpxFile + ".usage.npy").st_ino
+                with heapprof.Reader(hpxFile) as other:
+                    other.asArray()
+                self.assertEqual(inode, os.stat(hpxFile + ".usage.npy").st_ino)
+
+                # A new digest makes the saved arrays stale, even one with just as many snapshots,
+                # made immediately afterwards.
+                reader.makeDigest(timeInterval=0.001, precision=0)
+                usage, traceindices = reader.asArray()
+                snapshots = reader.snapshots()
+                self.assertEqual(len(snapshots), usage.shape[0])
+                for row, snapshot in zip(usage, snapshots):
+                    self.assertEqual(
+                        snapshot.usage,
+                        {
+                            int(traceindex): int(size)
+                            for traceindex, size in zip(traceindices, row)
+                            if size
+                        },
+                    )
+
+    def testCheckpoints(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            # Make enough output that there are several checkpoints, in bursts separated by pauses,
+            # so that we can pick time ranges whose ends are nowhere near any events.
+            heapprof.start(hpxFile, {})
+            for _ in range(4):
+                for _ in range(10):
+                    data = [[i] for i in range(10_000)]
+                time.sleep(0.05)
+            del data
+            heapprof.stop()
+            self.assertTrue(os.path.exists(hpxFile + ".hpi"))
+
+            with heapprof.Reader(hpxFile) as reader:
+                checkpoints = reader.hpd.checkpoints()
+                self.assertGreater(len(checkpoints), 2)
+                self.assertEqual(reader.profilerStats()['checkpoints'], len(checkpoints))
+
+                events = list(reader.hpd)
+                gaps = [
+                    (before.timestamp + after.timestamp) / 2
+                    for before, after in zip(events, events[1:])
+                    if after.timestamp - before.timestamp > 0.04
+                ]
+                self.assertGreaterEqual(len(gaps), 3)
+                startTime, endTime = gaps[0], gaps[2]
+                expected = [event for event in events if startTime <= event.timestamp < endTime]
+                self.assertGreater(len(expected), 0)
+                self._assertSameEvents(expected, list(reader.hpd.range(startTime, endTime)))
+
+            # Without the index, range still works; it just has to read the whole file.
+            os.unlink(hpxFile + ".hpi")
+            with heapprof.Reader(hpxFile) as reader:
+                self.assertEqual([], reader.hpd.checkpoints())
+                self._assertSameEvents(expected, list(reader.hpd.range(startTime, endTime)))
+
+    def _assertSameEvents(self, expected: list, actual: list) -> None:
+        # Timestamps are sums of deltas, so they can differ in the last few bits depending on
+        # where we started adding.
+        self.assertEqual(len(expected), len(actual))
+        for want, got in zip(expected, actual):
+            self.assertEqual(want[1:], got[1:])
+            self.assertAlmostEqual(want.timestamp, got.timestamp, places=4)
+
+    def testIntervalSampling(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            with self.assertRaises(ValueError):
+                heapprof.start(hpxFile, samplingRate={128: 0.1}, samplingInterval=1024)
+
+            heapprof.start(hpxFile, samplingInterval=16 * 1024)
+            data = [bytearray(1000) for _ in range(10_000)]
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                self.assertEqual(16 * 1024, reader.samplingInterval())
+                self.assertEqual({}, reader.samplingRate())
+                # Small allocations are rarely sampled, so get scaled up a lot; huge ones are
+                # nearly always sampled.
+                self.assertGreater(reader.hpm.scaleFactor(100), 100)
+                self.assertAlmostEqual(1, reader.hpm.scaleFactor(1 << 30))
+
+                # Once scaled, the events should roughly account for the memory we allocated.
+                estimate = sum(event.size * event.scaleFactor for event in reader.hpd)
+                self.assertGreater(estimate, 0.7 * 10_000_000)
+                self.assertLess(estimate, 1.5 * 10_000_000)
+            del data
+
+    def testEventBatches(self) -> None:
+        with TemporaryDirectory() as path:
+            for samplingRate, samplingInterval in (({128: 0.1, 8192: 0.5}, None), (None, 1024)):
+                hpxFile = os.path.join(path, f"hprof{samplingInterval}")
+                heapprof.start(
+                    hpxFile, samplingRate=samplingRate, samplingInterval=samplingInterval
+                )
+                data = [bytearray(i % 10_000) for i in range(10_000)]
+                del data
+                heapprof.stop()
+
+                with heapprof.Reader(hpxFile) as reader:
+                    events = list(reader.hpd)
+                    self.assertGreater(len(events), 1000)
+                    for event in events[:1000]:
+                        self.assertEqual(reader.hpm.scaleFactor(event.size), event.scaleFactor)
+
+                    # Batches hold the same events, however they're sliced.
+                    for size in (1, 1000, 1 << 20):
+                        batches = list(reader.hpd.batches(size))
+                        self.assertTrue(all(len(batch.sizes) <= size for batch in batches))
+                        self.assertEqual(
+                            events, [HPDEvent(*event) for batch in batches for event in zip(*batch)]
+                        )
+
+                    # If the file ends partway through an event, the batches stop before it.
+                    with open(hpxFile + ".hpd", "rb") as hpd:
+                        contents = hpd.read()
+                    with open(hpxFile + ".hpd", "wb") as hpd:
+                        hpd.write(contents[: len(contents) // 2 + 1])
+                    truncated = list(reader.hpd)
+                    self.assertLess(len(truncated), len(events))
+                    self.assertEqual(events[: len(truncated)], truncated)
+
+    def testBackgroundFlush(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            # Use small buffers, so that the background thread has plenty of work to do. It should
+            # write them out as we go, not just when we stop.
+            heapprof.start(hpxFile, bufferSize=4096, backgroundFlush=True)
+            for _ in range(3):
+                list(range(100_000))
+            deadline = time.time() + 10
+            while os.path.getsize(hpxFile + ".hpd") == 0 and time.time() < deadline:
+                list(range(10_000))
+                time.sleep(0.01)
+            self.assertGreater(os.path.getsize(hpxFile + ".hpd"), 0)
+            heapprof.stop()
+
+            with heapprof.Reader(hpxFile) as reader:
+                # Whether or not anything was dropped depends on how fast the disk is, but the
+                # count should always be recorded.
+                stats = reader.profilerStats()
+                self.assertEqual(
+                    stats['droppedAllocs'] + stats['droppedFrees'], reader.droppedEvents()
+                )
+
+                # Reading traces should stop cleanly at the footer.
+                reader.hpm.warmRawTraceCache()
+                maxIndex = 0
+                for event in reader.hpd:
+                    if event.traceindex:
+                        self.assertIsNotNone(reader.rawTrace(event.traceindex))
+                    maxIndex = max(maxIndex, event.traceindex)
+                self.assertGreater(maxIndex, 0)
+
+                reader.makeDigest(timeInterval=0.01, precision=0)
+                self.assertGreater(len(reader.snapshots()), 0)
+
+    @unittest.skipUnless(hasattr(os, "mkfifo"), "needs named pipes")
+    def testBackgroundFlushDrops(self) -> None:
+        with TemporaryDirectory() as path:
+            hpxFile = os.path.join(path, "hprof")
+
+            # Make the .hpd file a pipe which nobody is reading yet. Once the pipe fills up, the
+            # background thread is stuck writing to it, so the spare buffer stays busy and the
+            # profiler has to drop events rather than wait.
+            os.mkfifo(hpxFile + ".hpd")
+            readFd = os.open(hpxFile + ".hpd", os.O_RDONLY | os.O_NONBLOCK)
+            os.set_blocking(readFd, True)
+
+            def drain() -> None:
+                while os.read(readFd, 1 << 16):
+                    pass
+
+            drainer = threading.Thread(target=drain)
+            try:
+                # Sample everything, so that the pipe fills up quickly.
+                heapprof.start(hpxFile, {}, bufferSize=4096, backgroundFlush=True)
+                stats = heapprof.profilerStats()
+                assert stats is not None
+                for _ in range(1000):
+                    list(range(10_000))
+                    stats = heapprof.profilerStats()
+                    assert stats is not None
+                    if stats["droppedAllocs"]:
+                        break
+                # Let the background thread finish, so that stop() can.
+                drainer.start()
+                heapprof.stop()
+                drainer.join()
+            finally:
+                os.close(readFd)
+            self.assertGreater(stats["droppedAllocs"], 0)
+
 
 if __name__ == "__main__":
     unittest.main()
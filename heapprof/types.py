@@ -13,6 +13,13 @@ class RawTraceLine(NamedTuple):
         else:
             return self.filename
 
+    def isTruncationMarker(self) -> bool:
+        """If the profiler was told to record only so many frames of each stack trace (see
+        heapprof.start's maxStackDepth), traces which were cut short begin with this marker in
+        place of their outermost frames.
+        """
+        return self == TRUNCATION_MARKER
+
     @classmethod
     def parse(cls, value: Union['RawTraceLine', str]) -> 'RawTraceLine':
         if isinstance(value, RawTraceLine):
@@ -21,6 +28,10 @@ class RawTraceLine(NamedTuple):
         return cls(filename, int(linestr))
 
 
+# The filename (and line number zero) used by the profiler to mark truncated traces. No real frame
+# can have this filename, since the profiler never records frames whose filenames start with "<".
+TRUNCATION_MARKER = RawTraceLine('<truncated>', 0)
+
 # A RawTrace is the simplest form of a raw stack trace.
 RawTrace = List[RawTraceLine]
 
@@ -38,6 +49,10 @@ class TraceLine(NamedTuple):
     # The actual line of code
     fileline: str
 
+    def isTruncationMarker(self) -> bool:
+        """See RawTraceLine.isTruncationMarker."""
+        return (self.filename, self.lineno) == TRUNCATION_MARKER
+
 
 HeapTrace = List[TraceLine]
 
@@ -75,18 +75,28 @@ cppmodule = Extension(
     "_heapprof",
     sources=[
         "_heapprof/abstract_profiler.cc",
+        "_heapprof/background_flusher.cc",
+        "_heapprof/buffered_writer.cc",
         "_heapprof/file_format.cc",
+        "_heapprof/file_reader.cc",
+        "_heapprof/frame_filter.cc",
         "_heapprof/heapprof.cc",
         "_heapprof/malloc_patch.cc",
         "_heapprof/profiler.cc",
         "_heapprof/reentrant_scope.cc",
         "_heapprof/sampler.cc",
         "_heapprof/stats_gatherer.cc",
+        "_heapprof/trace_fingerprinter.cc",
         "_heapprof/util.cc",
     ],
     depends=[
         "_heapprof/abstract_profiler.h",
+        "_heapprof/background_flusher.h",
+        "_heapprof/buffered_writer.h",
         "_heapprof/file_format.h",
+        "_heapprof/file_reader.h",
+        "_heapprof/flat_map.h",
+        "_heapprof/frame_filter.h",
         "_heapprof/malloc_patch.h",
         "_heapprof/port.h",
         "_heapprof/profiler.h",
@@ -95,6 +105,7 @@ cppmodule = Extension(
         "_heapprof/scoped_object.h",
         "_heapprof/simple_hash.h",
         "_heapprof/stats_gatherer.h",
+        "_heapprof/trace_fingerprinter.h",
         "_heapprof/util.h",
     ],
     include_dirs=[os.getcwd(), "build/absl"],
@@ -102,6 +113,7 @@ cppmodule = Extension(
     libraries=["absl_base"],
     define_macros=[("PY_SSIZE_T_CLEAN", None)],
     extra_compile_args=["" if WINDOWS else "-std=c++11"],
+    extra_link_args=["" if WINDOWS else "-pthread"],
 )
 
 setup(
@@ -135,7 +147,9 @@ setup(
     # version of this run on 3.4 or above if anyone really wants to.
     python_requires=">=3.7",
     ext_modules=[cppmodule],
-    packages=find_packages(exclude=["tests", "tools", "docs", "docs_src"]),
+    packages=find_packages(
+        exclude=["tests", "tools", "docs", "docs_src", "benchmarks", "benchmarks.*"]
+    ),
     setup_requires=["cmake"],
     # Testing
     test_suite="nose.collector",